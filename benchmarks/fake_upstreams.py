@@ -0,0 +1,283 @@
+"""
+Local stand-ins for the Telegram Bot API and OpenAI chat completions, for load tests
+
+Run with `python -m benchmarks.fake_upstreams`, then point the API and workers at it:
+TELEGRAM_BASE_URL=http://localhost:8081 OPENAI_BASE_URL=http://localhost:8081
+"""
+
+import os
+import re
+import math
+import time
+import random
+import asyncio
+import argparse
+from collections import deque
+
+import orjson
+import uvicorn
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+
+# Marks the message ID in load test texts, so a completion request can be tied to its update
+MARKER_PATTERN = re.compile(r"\[lt:(\d+)\]")
+
+REPLY_TEXT = (
+    "Affect is usually a verb that means to influence something, while effect is "
+    "usually a noun that means the result of a change. "
+)
+
+
+class LatencyProfile(BaseModel):
+    """Log-normal latency given by its median and 99th percentile, in seconds"""
+
+    median: float
+    p99: float
+
+    def sample(self) -> float:
+        if self.median <= 0:
+            return 0
+        # 2.326 is the z-score of the 99th percentile
+        sigma = math.log(max(self.p99, self.median) / self.median) / 2.326
+        return random.lognormvariate(math.log(self.median), sigma)
+
+
+class UpstreamProfile(BaseModel):
+    """How a fake upstream behaves"""
+
+    latency: LatencyProfile
+    error_rate: float = 0
+    rate_limit_rate: float = 0
+    retry_after: int = 1
+
+
+class FakeSettings(BaseModel):
+    telegram: UpstreamProfile = UpstreamProfile(
+        latency=LatencyProfile(median=0.05, p99=0.3)
+    )
+    openai: UpstreamProfile = UpstreamProfile(latency=LatencyProfile(median=1.5, p99=6))
+    # Streamed completions send one chunk per word, this far apart
+    stream_chunk_delay: float = 0.02
+    reply_words: int = 60
+    max_events: int = 1_000_000
+
+
+SETTINGS = FakeSettings()
+# (kind, message ID, unix time), read by the load generator
+EVENTS: deque[tuple[str, int, float]] = deque(maxlen=SETTINGS.max_events)
+# Bot message ID -> the user message it replied to, so edits count towards that update
+REPLIES: dict[int, int] = {}
+_NEXT_MESSAGE_ID = iter(range(10**12, 10**13))
+
+app = FastAPI()
+
+
+def record(kind: str, message_id: int | None):
+    if message_id is not None:
+        EVENTS.append((kind, message_id, time.time()))
+
+
+def pick_failure(profile: UpstreamProfile) -> int | None:
+    """Returns the status of an injected failure, or None to answer normally"""
+
+    roll = random.random()
+    if roll < profile.rate_limit_rate:
+        return 429
+    if roll < profile.rate_limit_rate + profile.error_rate:
+        return 500
+    return None
+
+
+async def read_params(request: Request) -> dict:
+    """Reads bot API parameters from the query string, a JSON body or a form, like Telegram does"""
+
+    params = dict(request.query_params)
+    body = await request.body()
+    if body and request.headers.get("content-type", "").startswith("application/json"):
+        params |= orjson.loads(body)
+    elif body:
+        params |= dict(await request.form())
+    return params
+
+
+def build_bot_message(params: dict, message_id: int) -> dict:
+    return {
+        "message_id": message_id,
+        "from": {"id": 1, "is_bot": True, "first_name": "QuickLingoBot"},
+        "chat": {
+            "id": int(params.get("chat_id", 0)),
+            "title": "Load test",
+            "type": "supergroup",
+        },
+        "date": int(time.time()),
+        "text": params.get("text", ""),
+    }
+
+
+@app.api_route("/bot{token}/{method}", methods=["GET", "POST"])
+async def bot_api(token: str, method: str, request: Request):
+    params = await read_params(request)
+    profile = SETTINGS.telegram
+    await asyncio.sleep(profile.latency.sample())
+
+    failure = pick_failure(profile)
+    if failure == 429:
+        return Response(
+            orjson.dumps(
+                {
+                    "ok": False,
+                    "error_code": 429,
+                    "description": f"Too Many Requests: retry after {profile.retry_after}",
+                    "parameters": {"retry_after": profile.retry_after},
+                }
+            ),
+            status_code=429,
+            media_type="application/json",
+        )
+    if failure:
+        return Response(
+            orjson.dumps({"ok": False, "error_code": 500, "description": "Fake error"}),
+            status_code=500,
+            media_type="application/json",
+        )
+
+    if method == "sendMessage":
+        message_id = next(_NEXT_MESSAGE_ID)
+        if reply_to := params.get("reply_to_message_id"):
+            REPLIES[message_id] = int(reply_to)
+            record("telegram_send", int(reply_to))
+        result = build_bot_message(params, message_id)
+    elif method == "editMessageText":
+        message_id = int(params.get("message_id", 0))
+        record("telegram_edit", REPLIES.get(message_id))
+        result = build_bot_message(params, message_id)
+    elif method == "getUpdates":
+        result = []
+    else:
+        result = True
+    return Response(
+        orjson.dumps({"ok": True, "result": result}), media_type="application/json"
+    )
+
+
+def get_marker(payload: dict) -> int | None:
+    for message in reversed(payload.get("messages", [])):
+        if match := MARKER_PATTERN.search(str(message.get("content", ""))):
+            return int(match.group(1))
+    return None
+
+
+def build_completion(payload: dict, text: str) -> dict:
+    prompt_tokens = sum(
+        len(str(x.get("content", ""))) // 4 for x in payload["messages"]
+    )
+    return {
+        "id": f"chatcmpl-{random.getrandbits(64):x}",
+        "object": "chat.completion",
+        "model": payload.get("model"),
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": text}}],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(text) // 4,
+        },
+    }
+
+
+async def stream_completion(payload: dict, words: list[str], marker: int | None):
+    """Sends the completion word by word as server-sent events, usage in the last chunk"""
+
+    for word in words:
+        chunk = {"choices": [{"index": 0, "delta": {"content": word + " "}}]}
+        yield b"data: " + orjson.dumps(chunk) + b"\n\n"
+        await asyncio.sleep(SETTINGS.stream_chunk_delay)
+    usage = build_completion(payload, " ".join(words))["usage"]
+    yield b"data: " + orjson.dumps({"choices": [], "usage": usage}) + b"\n\n"
+    yield b"data: [DONE]\n\n"
+    record("openai_done", marker)
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    payload = orjson.loads(await request.body())
+    marker = get_marker(payload)
+    record("openai_request", marker)
+    profile = SETTINGS.openai
+
+    failure = pick_failure(profile)
+    if failure:
+        # Errors come back quickly, like a real rate limit or overloaded upstream
+        await asyncio.sleep(min(profile.latency.sample(), 0.2))
+        return Response(
+            orjson.dumps({"error": {"message": f"Fake {failure}", "code": failure}}),
+            status_code=failure,
+            headers={"retry-after": str(profile.retry_after)},
+            media_type="application/json",
+        )
+
+    words = (REPLY_TEXT.split() * SETTINGS.reply_words)[: SETTINGS.reply_words]
+    if payload.get("stream"):
+        # Time to first token, then the words trickle in
+        await asyncio.sleep(profile.latency.sample() / 3)
+        return StreamingResponse(
+            stream_completion(payload, words, marker), media_type="text/event-stream"
+        )
+
+    await asyncio.sleep(profile.latency.sample())
+    record("openai_done", marker)
+    return Response(
+        orjson.dumps(build_completion(payload, " ".join(words))),
+        media_type="application/json",
+    )
+
+
+@app.get("/loadtest/events")
+def get_events(since: int = 0):
+    """Returns the events from position `since` on, and the position to read from next"""
+
+    events = list(EVENTS)[since:]
+    return {"events": events, "next": since + len(events)}
+
+
+@app.post("/loadtest/reset")
+def reset_events():
+    EVENTS.clear()
+    REPLIES.clear()
+    return {"ok": True}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the fake Telegram and OpenAI")
+    parser.add_argument(
+        "--port", type=int, default=int(os.getenv("FAKES_PORT", "8081"))
+    )
+    parser.add_argument("--telegram-median", type=float, default=0.05)
+    parser.add_argument("--telegram-p99", type=float, default=0.3)
+    parser.add_argument("--telegram-error-rate", type=float, default=0)
+    parser.add_argument("--telegram-429-rate", type=float, default=0)
+    parser.add_argument("--openai-median", type=float, default=1.5)
+    parser.add_argument("--openai-p99", type=float, default=6)
+    parser.add_argument("--openai-error-rate", type=float, default=0)
+    parser.add_argument("--openai-429-rate", type=float, default=0)
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--stream-chunk-delay", type=float, default=0.02)
+    parser.add_argument("--reply-words", type=int, default=60)
+    args = parser.parse_args()
+
+    SETTINGS.telegram = UpstreamProfile(
+        latency=LatencyProfile(median=args.telegram_median, p99=args.telegram_p99),
+        error_rate=args.telegram_error_rate,
+        rate_limit_rate=args.telegram_429_rate,
+        retry_after=args.retry_after,
+    )
+    SETTINGS.openai = UpstreamProfile(
+        latency=LatencyProfile(median=args.openai_median, p99=args.openai_p99),
+        error_rate=args.openai_error_rate,
+        rate_limit_rate=args.openai_429_rate,
+        retry_after=args.retry_after,
+    )
+    SETTINGS.stream_chunk_delay = args.stream_chunk_delay
+    SETTINGS.reply_words = args.reply_words
+
+    # One process, so the event log is complete
+    uvicorn.run(app, host="0.0.0.0", port=args.port, log_level="warning")
@@ -0,0 +1,398 @@
+"""
+Replays Telegram updates against the ingestion API at a target rate and reports where the time goes
+
+Start Postgres, redis, `benchmarks.fake_upstreams`, the API and the workers (with `-E`
+for queue wait), all pointed at the fakes, then run
+`python -m benchmarks.load_generator --setup --rate 50 --duration 60 --workers 4`
+"""
+
+# pylint:disable=wrong-import-position
+
+import os
+import time
+import random
+import asyncio
+import argparse
+import threading
+from pathlib import Path
+
+import httpx
+import orjson
+import psycopg
+from rich import print
+from rich.table import Table
+from wrapworks import cwdtoenv
+from dotenv import load_dotenv
+
+cwdtoenv()
+load_dotenv()
+
+from benchmarks.fake_upstreams import MARKER_PATTERN
+from src.celery.main_queue import celery_master
+
+QUESTIONS = [
+    "what's the difference between 'affect' and 'effect'?",
+    "how do I use the present perfect?",
+    "is it 'fewer' or 'less' people?",
+    "what does 'break the ice' mean?",
+    "can you correct this: I am agree with you",
+    "when do I use 'a' and when 'an'?",
+]
+
+AUTHORIZE_CHATS_STATEMENT = """
+INSERT INTO CHATS (CHAT_ID, TITLE, TYPE, IS_AUTHORIZED, ALLOWED_USAGE_PER_DAY)
+VALUES (%s, %s, 'supergroup', TRUE, 1000000)
+ON CONFLICT (CHAT_ID) DO UPDATE SET IS_AUTHORIZED = TRUE, ALLOWED_USAGE_PER_DAY = 1000000;
+"""
+
+DATABASE_STATS_STATEMENT = """
+SELECT XACT_COMMIT, XACT_ROLLBACK, TUP_INSERTED, TUP_UPDATED, BLKS_READ, BLKS_HIT
+FROM PG_STAT_DATABASE
+WHERE DATNAME = CURRENT_DATABASE();
+"""
+
+STATEMENT_TIME_STATEMENT = """
+SELECT SUM(CALLS), SUM(TOTAL_EXEC_TIME) FROM PG_STAT_STATEMENTS;
+"""
+
+DATABASE_STATS = [
+    "commits",
+    "rollbacks",
+    "rows inserted",
+    "rows updated",
+    "blocks read",
+    "blocks hit",
+]
+
+# Load test chats get IDs far from real ones
+CHAT_ID_BASE = -1009000000000
+
+
+def build_update(message_id: int, chat_id: int, user_id: int, text: str) -> dict:
+    """Builds a synthetic group message update carrying the load test marker"""
+
+    return {
+        "update_id": message_id,
+        "message": {
+            "message_id": message_id,
+            "from": {"id": user_id, "is_bot": False, "first_name": f"Load {user_id}"},
+            "chat": {"id": chat_id, "title": "Load test", "type": "supergroup"},
+            "date": int(time.time()),
+            "text": f"@QuickLingoBot {text} [lt:{message_id}]",
+        },
+    }
+
+
+def generate_updates(
+    count: int, chats: int, users_per_chat: int, replay: str | None
+) -> list[dict]:
+    """
+    ### Responsibility:
+        - Build the updates to send, synthetic or replayed from a file.
+
+    ### Args:
+        - `count`: int
+            How many updates to send.
+        - `chats`: int
+            How many chats the synthetic updates are spread over.
+        - `users_per_chat`: int
+            How many users write in each chat.
+        - `replay`: str | None
+            A JSON lines file of recorded updates, cycled through until `count` are built.
+
+    ### Returns:
+        - `updates`: list[dict]
+            The updates, with unique message IDs and the marker the fakes use to follow them.
+
+    ### How does the function work:
+        - Replayed updates keep their chats, users and text, but their IDs are replaced and their chats are moved under `CHAT_ID_BASE` so `--setup` can authorize them.
+    """
+
+    base = int(time.time() * 1000)
+    if not replay:
+        return [
+            build_update(
+                base + x,
+                CHAT_ID_BASE - x % chats,
+                9_000_000 + random.randrange(chats * users_per_chat),
+                random.choice(QUESTIONS),
+            )
+            for x in range(count)
+        ]
+
+    recorded = [
+        orjson.loads(x) for x in Path(replay).read_text().splitlines() if x.strip()
+    ]
+    recorded = [
+        x for x in recorded if isinstance(x.get("message", {}).get("text"), str)
+    ]
+    updates = []
+    for x in range(count):
+        message = recorded[x % len(recorded)]["message"]
+        updates.append(
+            build_update(
+                base + x,
+                CHAT_ID_BASE - abs(message["chat"]["id"]) % 10**6,
+                message["from"]["id"],
+                message["text"],
+            )
+        )
+    return updates
+
+
+def authorize_chats(updates: list[dict]):
+    """Marks the load test chats as authorized with unlimited credits"""
+
+    chats = sorted({x["message"]["chat"]["id"] for x in updates})
+    with psycopg.connect(os.getenv("AZ_POSTGRES_URL")) as conn:
+        with conn.cursor() as cur:
+            cur.executemany(
+                AUTHORIZE_CHATS_STATEMENT, [(x, "Load test") for x in chats]
+            )
+    print(f"Authorized {len(chats)} load test chats")
+
+
+def read_database_stats() -> dict[str, float]:
+    """Reads the database wide counters, and statement time if pg_stat_statements is installed"""
+
+    with psycopg.connect(os.getenv("AZ_POSTGRES_URL"), autocommit=True) as conn:
+        stats = dict(
+            zip(DATABASE_STATS, conn.execute(DATABASE_STATS_STATEMENT).fetchone())
+        )
+        try:
+            calls, exec_time = conn.execute(STATEMENT_TIME_STATEMENT).fetchone()
+            stats |= {"statements": calls or 0, "statement ms": exec_time or 0}
+        except psycopg.Error:
+            pass
+    return {k: float(v) for k, v in stats.items()}
+
+
+class TaskEvents:
+    """
+    Collects when each update's task was received and started from Celery events.
+
+    Workers only send events when started with `-E`. Without them, queue wait
+    isn't reported and the other stages still are.
+    """
+
+    def __init__(self):
+        self.started: dict[int, float] = {}
+        self.received: dict[int, float] = {}
+        self.tasks: dict[str, int] = {}
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _on_received(self, event: dict):
+        if match := MARKER_PATTERN.search(event.get("args", "")):
+            message_id = int(match.group(1))
+            self.tasks[event["uuid"]] = message_id
+            self.received[message_id] = event["timestamp"]
+
+    def _on_started(self, event: dict):
+        if message_id := self.tasks.get(event["uuid"]):
+            self.started[message_id] = event["timestamp"]
+
+    def _run(self):
+        with celery_master.connection() as connection:
+            receiver = celery_master.events.Receiver(
+                connection,
+                handlers={
+                    "task-received": self._on_received,
+                    "task-started": self._on_started,
+                },
+            )
+            receiver.capture(limit=None, timeout=None, wakeup=True)
+
+    def start(self):
+        self.thread.start()
+
+
+async def send_updates(
+    api_url: str, updates: list[dict], rate: float
+) -> dict[int, tuple[float, float, int]]:
+    """
+    ### Responsibility:
+        - Post the updates to `/updates` at a steady rate, like Telegram's webhook would.
+
+    ### Args:
+        - `api_url`: str
+            The base URL of the ingestion API.
+        - `updates`: list[dict]
+            The updates to send.
+        - `rate`: float
+            Updates per second.
+
+    ### Returns:
+        - `sent`: dict[int, tuple[float, float, int]]
+            For each message ID, when it was sent, when the API answered and with which status.
+
+    ### How does the function work:
+        - Schedules each update at its own time and doesn't wait for earlier ones to be answered, so a slow API doesn't lower the offered rate.
+    """
+
+    sent = {}
+    started = time.time()
+    limits = httpx.Limits(max_connections=1000, max_keepalive_connections=1000)
+    async with httpx.AsyncClient(base_url=api_url, limits=limits, timeout=30) as client:
+
+        async def post(update: dict, at: float):
+            await asyncio.sleep(max(0, at - time.time()))
+            message_id = update["message"]["message_id"]
+            sent_at = time.time()
+            try:
+                response = await client.post("/updates", content=orjson.dumps(update))
+                status = response.status_code
+            except httpx.HTTPError:
+                status = 0
+            sent[message_id] = (sent_at, time.time(), status)
+
+        await asyncio.gather(
+            *[post(x, started + i / rate) for i, x in enumerate(updates)]
+        )
+    return sent
+
+
+def collect_events(
+    fakes_url: str, message_ids: set[int], timeout: float
+) -> dict[int, dict[str, list[float]]]:
+    """
+    ### Responsibility:
+        - Wait for the fakes to see every update answered, and return what they saw.
+
+    ### Args:
+        - `fakes_url`: str
+            The base URL of `fake_upstreams`.
+        - `message_ids`: set[int]
+            The updates that were accepted by the API.
+        - `timeout`: float
+            How long to wait for the last replies.
+
+    ### Returns:
+        - `events`: dict[int, dict[str, list[float]]]
+            For each message ID, the times of each kind of event the fakes recorded for it.
+
+    ### How does the function work:
+        - Polls `/loadtest/events` until every update got a Telegram reply, or no new event arrived for `timeout` seconds.
+        - Waits a little longer after that, so the last edits of streamed replies are counted.
+    """
+
+    events: dict[int, dict[str, list[float]]] = {}
+    position, last_event = 0, time.time()
+    with httpx.Client(base_url=fakes_url) as client:
+        while time.time() - last_event < timeout:
+            page = client.get("/loadtest/events", params={"since": position}).json()
+            position = page["next"]
+            for kind, message_id, at in page["events"]:
+                if message_id in message_ids:
+                    events.setdefault(message_id, {}).setdefault(kind, []).append(at)
+                    last_event = time.time()
+            answered = sum(1 for x in events.values() if "telegram_send" in x)
+            if answered >= len(message_ids):
+                timeout = min(timeout, 2)
+            time.sleep(0.5)
+    return events
+
+
+def percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def build_report(
+    sent: dict[int, tuple[float, float, int]],
+    events: dict[int, dict[str, list[float]]],
+    tasks: TaskEvents | None,
+) -> Table:
+    """Returns the per stage latency table, in milliseconds"""
+
+    stages: dict[str, list[float]] = {
+        "ingestion": [],
+        "queue wait": [],
+        "ack to LLM request": [],
+        "LLM": [],
+        "LLM to reply": [],
+        "end to end": [],
+    }
+    for message_id, (sent_at, acked_at, _) in sent.items():
+        stages["ingestion"].append(acked_at - sent_at)
+        seen = events.get(message_id, {})
+        if tasks and message_id in tasks.started:
+            stages["queue wait"].append(tasks.started[message_id] - acked_at)
+        if requests := seen.get("openai_request"):
+            stages["ack to LLM request"].append(requests[0] - acked_at)
+            if done := seen.get("openai_done"):
+                stages["LLM"].append(done[-1] - requests[0])
+                if replies := seen.get("telegram_send"):
+                    stages["LLM to reply"].append(replies[0] - done[-1])
+        if replies := seen.get("telegram_send", []) + seen.get("telegram_edit", []):
+            stages["end to end"].append(max(replies) - sent_at)
+
+    table = Table(title="Latency by stage, ms")
+    for column in ("stage", "count", "p50", "p90", "p99", "max"):
+        table.add_column(column)
+    for stage, values in stages.items():
+        if not values:
+            table.add_row(stage, "0", "-", "-", "-", "-")
+            continue
+        table.add_row(
+            stage,
+            str(len(values)),
+            *[f"{percentile(values, q) * 1000:.0f}" for q in (0.5, 0.9, 0.99)],
+            f"{max(values) * 1000:.0f}",
+        )
+    return table
+
+
+def build_database_table(before: dict, after: dict, seconds: float) -> Table:
+    table = Table(title=f"Postgres load over {seconds:.0f}s")
+    for column in ("counter", "total", "per second"):
+        table.add_column(column)
+    for key in before:
+        delta = after[key] - before[key]
+        table.add_row(key, f"{delta:.0f}", f"{delta / seconds:.1f}")
+    return table
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the update pipeline")
+    parser.add_argument("--api-url", default="http://localhost:8000")
+    parser.add_argument("--fakes-url", default="http://localhost:8081")
+    parser.add_argument("--rate", type=float, default=20, help="Updates per second")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds")
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--users-per-chat", type=int, default=5)
+    parser.add_argument("--replay", default=None, help="JSON lines of recorded updates")
+    parser.add_argument("--setup", action="store_true", help="Authorize the chats")
+    parser.add_argument("--workers", default="?", help="Worker count, for the report")
+    parser.add_argument("--drain-timeout", type=float, default=60)
+    parser.add_argument(
+        "--celery-events", action="store_true", help="Measure queue wait, needs -E"
+    )
+    args = parser.parse_args()
+
+    updates = generate_updates(
+        int(args.rate * args.duration), args.chats, args.users_per_chat, args.replay
+    )
+    if args.setup:
+        authorize_chats(updates)
+    httpx.post(f"{args.fakes_url}/loadtest/reset")
+
+    task_events = TaskEvents() if args.celery_events else None
+    if task_events:
+        task_events.start()
+
+    database_before = read_database_stats()
+    load_started = time.time()
+    sent = asyncio.run(send_updates(args.api_url, updates, args.rate))
+    sending_took = time.time() - load_started
+    accepted = {k for k, v in sent.items() if v[2] == 200}
+    events = collect_events(args.fakes_url, accepted, args.drain_timeout)
+    total_took = time.time() - load_started
+    database_after = read_database_stats()
+
+    answered = sum(1 for x in events.values() if "telegram_send" in x)
+    print(
+        f"Workers: {args.workers}, offered {len(updates)} updates at {len(updates) / sending_took:.1f}/s, "
+        f"accepted {len(accepted)}, answered {answered} ({answered / total_took:.1f}/s) in {total_took:.1f}s"
+    )
+    print(build_report({k: sent[k] for k in accepted}, events, task_events))
+    print(build_database_table(database_before, database_after, total_took))
@@ -0,0 +1,79 @@
+"""
+Measures the pydantic models parsed on every update and completion
+
+Run with `python -m benchmarks.model_parsing`
+"""
+
+# pylint:disable=wrong-import-position
+
+import timeit
+
+import orjson
+from rich import print
+from rich.table import Table
+from wrapworks import cwdtoenv
+
+cwdtoenv()
+
+from benchmarks.task_payloads import RAW_PING
+from src.models.gen_ai_models import AIResponse
+from src.models.telegram_update_models import TelegramUpdatePing
+from src.telegram.updates import get_update_kind, parse_telegram_update
+
+ITERATIONS = 50_000
+
+RAW_COMPLETION = {
+    "id": "chatcmpl-9f3c2b1a",
+    "object": "chat.completion",
+    "model": "gpt-4o-mini",
+    "choices": [
+        {
+            "index": 0,
+            "message": {
+                "role": "assistant",
+                "content": "Affect is usually a verb, effect is usually a noun. " * 8,
+            },
+            "finish_reason": "stop",
+        }
+    ],
+    "usage": {"prompt_tokens": 612, "completion_tokens": 128, "total_tokens": 740},
+}
+
+
+def measure(name: str, call) -> list[str]:
+    """Returns the per call time of `call` in microseconds"""
+
+    seconds = timeit.timeit(call, number=ITERATIONS)
+    return [name, f"{seconds / ITERATIONS * 1e6:.2f}"]
+
+
+if __name__ == "__main__":
+    ping_json = orjson.dumps(RAW_PING)
+    completion_json = orjson.dumps(RAW_COMPLETION)
+
+    table = Table(title=f"Model parsing, {ITERATIONS} iterations")
+    for column in ("step", "µs per call"):
+        table.add_column(column)
+    for row in (
+        measure("get_update_kind", lambda: get_update_kind(RAW_PING)),
+        measure("parse_telegram_update", lambda: parse_telegram_update(RAW_PING)),
+        measure(
+            "TelegramUpdatePing.model_validate",
+            lambda: TelegramUpdatePing.model_validate(RAW_PING),
+        ),
+        measure(
+            "TelegramUpdatePing.model_validate_json",
+            lambda: TelegramUpdatePing.model_validate_json(ping_json),
+        ),
+        measure(
+            "orjson.loads + model_validate",
+            lambda: TelegramUpdatePing.model_validate(orjson.loads(ping_json)),
+        ),
+        measure("AIResponse(**dict)", lambda: AIResponse(**RAW_COMPLETION)),
+        measure(
+            "AIResponse.model_validate_json",
+            lambda: AIResponse.model_validate_json(completion_json),
+        ),
+    ):
+        table.add_row(*row)
+    print(table)
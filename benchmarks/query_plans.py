@@ -0,0 +1,294 @@
+"""
+Runs the production queries under EXPLAIN ANALYZE and fails when one stops using its index or gets slow
+
+Run with `python -m benchmarks.query_plans` against a database seeded by `benchmarks.seed_dataset`
+"""
+
+# pylint:disable=wrong-import-position
+
+import os
+import sys
+import argparse
+import statistics
+from datetime import date, datetime, timezone
+
+import orjson
+import psycopg
+from pydantic import BaseModel
+from rich import print
+from rich.table import Table
+from wrapworks import cwdtoenv
+from dotenv import load_dotenv
+
+cwdtoenv()
+load_dotenv()
+
+from src.postgres.select_functions import (
+    HISTORY_LOOKBACK_DAYS,
+    CHECK_CHAT_AUTHORIZED_STATEMENT,
+    CHAT_SETTINGS_STATEMENT,
+    COUNT_TAGGED_ON_DAY_STATEMENT,
+    CHECK_USER_CREDITS_STATEMENT,
+    SPEND_ON_DAY_STATEMENT,
+    LAST_N_MESSAGES_STATEMENT,
+    LAST_N_USER_MESSAGES_STATEMENT,
+    get_user_messages_params,
+)
+from src.postgres.insert_functions import TURN_MESSAGE_STATEMENT
+from src.cache.activity_tracker import UPDATE_CHATS_LAST_ACTIVE_STATEMENT
+from src.models.gen_ai_models import LLMRoles
+
+# Tables too large to scan on the request path
+LARGE_TABLES = {"messages", "usage_daily", "chats", "users"}
+
+# The busiest chat and user of the busiest day, the worst case for every lookup
+HOTTEST_USAGE_STATEMENT = """
+SELECT DAY, CHAT_ID, USER_ID
+FROM USAGE_DAILY
+ORDER BY DAY DESC, TAGGED_MESSAGES DESC
+LIMIT 1;
+"""
+
+# Partitions and their indexes, mapped to the parent they were created from
+PARENTS_STATEMENT = """
+SELECT CHILD.RELNAME, PARENT.RELNAME
+FROM PG_INHERITS
+JOIN PG_CLASS CHILD ON CHILD.OID = PG_INHERITS.INHRELID
+JOIN PG_CLASS PARENT ON PARENT.OID = PG_INHERITS.INHPARENT;
+"""
+
+
+class QueryCase(BaseModel):
+    """A production statement, its parameters and what its plan should look like. Writes are rolled back."""
+
+    name: str
+    statement: str
+    params: tuple | dict
+    indexes: set[str] = set()
+    budget_ms: float
+
+
+class QueryResult(BaseModel):
+    name: str
+    median_ms: float
+    indexes: list[str]
+    seq_scans: list[str]
+    failures: list[str]
+    plan: dict
+
+
+def build_cases(chat_id: int, user_id: int, day: date) -> list[QueryCase]:
+    """Returns every statement the bot runs per update, with parameters from the seeded data"""
+
+    return [
+        QueryCase(
+            name="check_chat_authorized",
+            statement=CHECK_CHAT_AUTHORIZED_STATEMENT,
+            params=(chat_id,),
+            indexes={"chats_pkey"},
+            budget_ms=5,
+        ),
+        QueryCase(
+            name="chat_settings",
+            statement=CHAT_SETTINGS_STATEMENT,
+            params=(chat_id,),
+            indexes={"chats_pkey"},
+            budget_ms=5,
+        ),
+        QueryCase(
+            name="count_tagged_on_day",
+            statement=COUNT_TAGGED_ON_DAY_STATEMENT,
+            params=(day, chat_id, user_id),
+            indexes={"usage_daily_pkey"},
+            budget_ms=5,
+        ),
+        QueryCase(
+            name="check_user_credits",
+            statement=CHECK_USER_CREDITS_STATEMENT,
+            params=(day, chat_id, user_id, chat_id),
+            indexes={"usage_daily_pkey", "chats_pkey"},
+            budget_ms=5,
+        ),
+        QueryCase(
+            name="spend_on_day",
+            statement=SPEND_ON_DAY_STATEMENT,
+            params=(chat_id, day),
+            indexes={"usage_daily_pkey"},
+            budget_ms=20,
+        ),
+        QueryCase(
+            name="last_n_messages",
+            statement=LAST_N_MESSAGES_STATEMENT,
+            params=(chat_id, HISTORY_LOOKBACK_DAYS, 10),
+            indexes={"idx_messages_chatid_pgmessageid"},
+            budget_ms=20,
+        ),
+        QueryCase(
+            name="last_n_user_messages",
+            statement=LAST_N_USER_MESSAGES_STATEMENT,
+            params=get_user_messages_params(chat_id, user_id, 10),
+            indexes={"idx_messages_chatid_userid_wastagged_date"},
+            budget_ms=20,
+        ),
+        QueryCase(
+            name="insert_turn_message",
+            statement=TURN_MESSAGE_STATEMENT,
+            params=(
+                1,
+                LLMRoles.USER.value,
+                user_id,
+                chat_id,
+                "query plan check",
+                0.001,
+                300,
+                100,
+                True,
+                4,
+            ),
+            budget_ms=20,
+        ),
+        QueryCase(
+            name="flush_chats_last_active",
+            statement=UPDATE_CHATS_LAST_ACTIVE_STATEMENT,
+            params=([chat_id], [datetime.now(timezone.utc)]),
+            indexes={"chats_pkey"},
+            budget_ms=20,
+        ),
+    ]
+
+
+def walk_plan(node: dict, parents: dict[str, str], indexes: set, seq_scans: set):
+    """Collects the indexes and sequentially scanned tables of a plan, by their parent's name"""
+
+    if "Index Name" in node:
+        indexes.add(parents.get(node["Index Name"], node["Index Name"]))
+    if node.get("Node Type") == "Seq Scan":
+        table = node.get("Relation Name", "")
+        seq_scans.add(parents.get(table, table))
+    for child in node.get("Plans", []):
+        walk_plan(child, parents, indexes, seq_scans)
+
+
+def load_parents(conn: psycopg.Connection) -> dict[str, str]:
+    """Returns partition and partition index names mapped to their top-level parent"""
+
+    direct = dict(conn.execute(PARENTS_STATEMENT).fetchall())
+    parents = {}
+    for child in direct:
+        parent = direct[child]
+        while parent in direct:
+            parent = direct[parent]
+        parents[child] = parent
+    return parents
+
+
+def explain(
+    conn: psycopg.Connection,
+    case: QueryCase,
+    parents: dict[str, str],
+    runs: int,
+    budget_scale: float,
+) -> QueryResult:
+    """
+    ### Responsibility:
+        - Run a statement under `EXPLAIN (ANALYZE, BUFFERS)` and check its plan and timing.
+
+    ### Args:
+        - `conn`: psycopg.Connection
+            The connection to run on. Every run is rolled back.
+        - `case`: QueryCase
+            The statement and what to expect of it.
+        - `parents`: dict[str, str]
+            Partition names mapped to their parent, from `load_parents`.
+        - `runs`: int
+            How many times to run it. The first run warms the cache.
+        - `budget_scale`: float
+            Multiplies the latency budget, for slower machines.
+
+    ### Returns:
+        - `result`: QueryResult
+            The median execution time, the plan of the last run and what failed.
+
+    ### How does the function work:
+        - Binds the parameters on the client, so the plan is the one for these values and not a generic one.
+        - Takes the median `Execution Time` of the runs after the first.
+        - Fails when an expected index is missing from the plan, a large table is scanned sequentially, or the median crosses the budget.
+    """
+
+    timings, plan = [], {}
+    with psycopg.ClientCursor(conn) as cur:
+        for _ in range(runs + 1):
+            cur.execute(
+                "EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + case.statement,
+                case.params,
+            )
+            plan = cur.fetchone()[0][0]
+            conn.rollback()
+            timings.append(plan["Execution Time"])
+
+    indexes, seq_scans = set(), set()
+    walk_plan(plan["Plan"], parents, indexes, seq_scans)
+    median = statistics.median(timings[1:])
+
+    failures = []
+    if missing := {x.lower() for x in case.indexes} - indexes:
+        failures.append(f"doesn't use {', '.join(sorted(missing))}")
+    if scanned := seq_scans & LARGE_TABLES:
+        failures.append(f"scans {', '.join(sorted(scanned))}")
+    if median > case.budget_ms * budget_scale:
+        failures.append(f"{median:.2f}ms over {case.budget_ms * budget_scale:.2f}ms")
+
+    return QueryResult(
+        name=case.name,
+        median_ms=median,
+        indexes=sorted(indexes),
+        seq_scans=sorted(seq_scans),
+        failures=failures,
+        plan=plan,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check the plans of production queries"
+    )
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget-scale", type=float, default=1)
+    parser.add_argument("--output", default="query_plans.json")
+    args = parser.parse_args()
+
+    with psycopg.connect(os.getenv("AZ_POSTGRES_URL")) as connection:
+        hottest = connection.execute(HOTTEST_USAGE_STATEMENT).fetchone()
+        if not hottest:
+            sys.exit(
+                "USAGE_DAILY is empty, seed it with `python -m benchmarks.seed_dataset`"
+            )
+        usage_day, hot_chat, hot_user = hottest
+        partition_parents = load_parents(connection)
+        connection.rollback()
+        results = [
+            explain(connection, x, partition_parents, args.runs, args.budget_scale)
+            for x in build_cases(int(hot_chat), int(hot_user), usage_day)
+        ]
+
+    table = Table(title=f"Query plans, median of {args.runs} runs")
+    for column in ("query", "median ms", "indexes", "result"):
+        table.add_column(column)
+    for result in results:
+        table.add_row(
+            result.name,
+            f"{result.median_ms:.2f}",
+            ", ".join(result.indexes),
+            "; ".join(result.failures) or "ok",
+            style="red" if result.failures else None,
+        )
+    print(table)
+
+    with open(args.output, "wb") as f:
+        f.write(
+            orjson.dumps([x.model_dump() for x in results], option=orjson.OPT_INDENT_2)
+        )
+    print(f"Plans written to {args.output}")
+
+    if any(x.failures for x in results):
+        sys.exit(1)
@@ -0,0 +1,244 @@
+"""
+Seeds USERS, CHATS and MESSAGES with a large synthetic dataset, skewed like real traffic
+
+Run with `python -m benchmarks.seed_dataset --messages 5000000` against a scratch database,
+then check the query plans with `python -m benchmarks.query_plans`
+"""
+
+# pylint:disable=wrong-import-position
+
+import os
+import time
+import random
+import argparse
+from datetime import datetime, timedelta, timezone
+
+import psycopg
+from rich import print
+from wrapworks import cwdtoenv
+from dotenv import load_dotenv
+
+cwdtoenv()
+load_dotenv()
+
+from src.genai.token_estimator import estimate_tokens
+from src.models.gen_ai_models import LLMRoles
+
+# Seeded rows get IDs far from real ones, so they can be told apart and removed
+SEED_CHAT_ID_BASE = -1008000000000
+SEED_USER_ID_BASE = 8_000_000_000
+SEED_BOT_ID = 7_999_999_999
+
+COPY_USERS_STATEMENT = "COPY USERS (USER_ID, FIRST_NAME, USERNAME, IS_BOT) FROM STDIN"
+COPY_CHATS_STATEMENT = """
+COPY CHATS (CHAT_ID, TITLE, TYPE, IS_AUTHORIZED, ALLOWED_USAGE_PER_DAY) FROM STDIN
+"""
+COPY_MESSAGES_STATEMENT = """
+COPY MESSAGES (
+    MESSAGE_ID,
+    ROLE,
+    USER_ID,
+    CHAT_ID,
+    MESSAGE,
+    COST,
+    INPUT_TOKENS,
+    OUTPUT_TOKENS,
+    WAS_TAGGED,
+    TOKEN_COUNT,
+    INSERTED_DATE)
+FROM STDIN
+"""
+
+# Their messages go with them, through ON DELETE CASCADE
+DELETE_SEEDED_CHATS_STATEMENT = """
+DELETE FROM CHATS WHERE CHAT_ID <= %s AND CHAT_ID > %s;
+"""
+DELETE_SEEDED_USERS_STATEMENT = """
+DELETE FROM USERS WHERE USER_ID >= %s AND USER_ID < %s;
+"""
+
+QUESTIONS = [
+    "what's the difference between 'affect' and 'effect'?",
+    "how do I use the present perfect?",
+    "can you correct this: I am agree with you",
+    "what does 'break the ice' mean?",
+    "when do I use 'a' and when 'an'?",
+    "چطور می‌تونم لهجه‌ام رو بهتر کنم؟",
+]
+REPLY = (
+    "Good question! Here is how it works, with a few examples you can practice with. "
+    * 4
+)
+
+
+class SeedPlan:
+    """
+    Chats with their members and share of the traffic.
+
+    Chat sizes follow a Zipf like curve, so a few huge groups get most of the
+    messages while most chats are small, and a share of the chats are private
+    chats with a single user.
+    """
+
+    def __init__(self, chats: int, users: int, private_share: float, skew: float):
+        self.chat_ids = [SEED_CHAT_ID_BASE - x for x in range(chats)]
+        self.weights = [1 / (x + 1) ** skew for x in range(chats)]
+        total = sum(self.weights)
+        self.members: dict[int, list[int]] = {}
+        next_user = 0
+        for chat_id, weight in zip(self.chat_ids, self.weights):
+            if random.random() < private_share:
+                size = 1
+            else:
+                size = max(2, int(users * weight / total))
+            self.members[chat_id] = [
+                SEED_USER_ID_BASE + (next_user + x) % users for x in range(size)
+            ]
+            next_user += size
+        self.users = users
+
+    def pick(self, count: int) -> list[tuple[int, int]]:
+        """Returns `count` (chat, sender) pairs drawn with the traffic skew"""
+
+        chats = random.choices(self.chat_ids, weights=self.weights, k=count)
+        return [(x, random.choice(self.members[x])) for x in chats]
+
+
+def seed_parents(conn: psycopg.Connection, plan: SeedPlan):
+    with conn.cursor() as cur:
+        with cur.copy(COPY_USERS_STATEMENT) as copy:
+            copy.write_row((SEED_BOT_ID, "QuickLingoBot", "QuickLingoBot", True))
+            for x in range(plan.users):
+                copy.write_row((SEED_USER_ID_BASE + x, f"User {x}", f"user_{x}", False))
+        with cur.copy(COPY_CHATS_STATEMENT) as copy:
+            for chat_id in plan.chat_ids:
+                kind = "private" if len(plan.members[chat_id]) == 1 else "supergroup"
+                copy.write_row((chat_id, f"Chat {chat_id}", kind, True, 50))
+
+
+def seed_messages(
+    conn: psycopg.Connection, plan: SeedPlan, messages: int, days: int, batch: int
+) -> int:
+    """
+    ### Responsibility:
+        - Copy `messages` rows into MESSAGES, spread over the last `days` days in time order.
+
+    ### Args:
+        - `conn`: psycopg.Connection
+            The connection to copy with, committed after every batch.
+        - `plan`: SeedPlan
+            The chats and their members.
+        - `messages`: int
+            About how many rows to write.
+        - `days`: int
+            How many days back the data goes.
+        - `batch`: int
+            Exchanges per COPY and commit.
+
+    ### Returns:
+        - `rows`: int
+            The number of rows written.
+
+    ### How does the function work:
+        - Writes exchanges: a user message, tagged and with its cost when it got a reply, followed by the bot's reply. A quarter of the user messages get no reply, like untagged group chatter.
+        - Traffic grows towards the present, so recent partitions and days are the largest.
+        - Rows are written in time order, so `PG_MESSAGE_ID` grows with `INSERTED_DATE` as in production.
+        - The MESSAGES triggers run as usual, so `USAGE_DAILY` matches the seeded rows.
+    """
+
+    now = datetime.now(timezone.utc)
+    start = now - timedelta(days=days)
+    # Exchanges are about 1.75 rows
+    exchanges = int(messages / 1.75)
+    offsets = sorted(
+        random.betavariate(1.6, 1) * days * 86400 for _ in range(exchanges)
+    )
+
+    rows, message_id, started = 0, 0, time.perf_counter()
+    for index in range(0, exchanges, batch):
+        chunk = offsets[index : index + batch]
+        with conn.cursor() as cur:
+            with cur.copy(COPY_MESSAGES_STATEMENT) as copy:
+                for offset, (chat_id, user_id) in zip(chunk, plan.pick(len(chunk))):
+                    inserted = start + timedelta(seconds=offset)
+                    question = random.choice(QUESTIONS)
+                    replied = random.random() < 0.75
+                    input_tokens = random.randint(150, 900) if replied else 0
+                    output_tokens = random.randint(40, 400) if replied else 0
+                    message_id += 1
+                    copy.write_row(
+                        (
+                            message_id,
+                            LLMRoles.USER.value,
+                            user_id,
+                            chat_id,
+                            question,
+                            (input_tokens * 5 + output_tokens * 15) / 1e6,
+                            input_tokens,
+                            output_tokens,
+                            replied,
+                            estimate_tokens(question),
+                            inserted,
+                        )
+                    )
+                    rows += 1
+                    if not replied:
+                        continue
+                    message_id += 1
+                    copy.write_row(
+                        (
+                            message_id,
+                            LLMRoles.AI.value,
+                            SEED_BOT_ID,
+                            chat_id,
+                            REPLY,
+                            0,
+                            0,
+                            0,
+                            False,
+                            estimate_tokens(REPLY),
+                            inserted + timedelta(seconds=2),
+                        )
+                    )
+                    rows += 1
+        conn.commit()
+        print(
+            f"{rows} rows, {rows / (time.perf_counter() - started):.0f} rows/s, up to {inserted:%Y-%m-%d}"
+        )
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Seed a large synthetic dataset")
+    parser.add_argument("--messages", type=int, default=3_000_000)
+    parser.add_argument("--chats", type=int, default=5_000)
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--days", type=int, default=180)
+    parser.add_argument("--private-share", type=float, default=0.4)
+    parser.add_argument("--skew", type=float, default=1.1, help="Zipf exponent")
+    parser.add_argument("--batch", type=int, default=50_000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--reset", action="store_true", help="Remove earlier seeded rows first"
+    )
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    seed_plan = SeedPlan(args.chats, args.users, args.private_share, args.skew)
+    with psycopg.connect(os.getenv("AZ_POSTGRES_URL")) as connection:
+        if args.reset:
+            connection.execute(
+                DELETE_SEEDED_CHATS_STATEMENT,
+                (SEED_CHAT_ID_BASE, SEED_CHAT_ID_BASE - 10**9),
+            )
+            connection.execute(
+                DELETE_SEEDED_USERS_STATEMENT,
+                (SEED_BOT_ID, SEED_USER_ID_BASE + 10**9),
+            )
+            connection.commit()
+        seed_parents(connection, seed_plan)
+        connection.commit()
+        seed_messages(connection, seed_plan, args.messages, args.days, args.batch)
+        connection.autocommit = True
+        connection.execute("ANALYZE USERS, CHATS, MESSAGES, USAGE_DAILY")
+    print("Seeded and analyzed")
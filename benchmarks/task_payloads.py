@@ -0,0 +1,115 @@
+"""
+Compares the size and speed of the orjson update payloads with the pickle ones they replaced
+
+Run with `python -m benchmarks.task_payloads`
+"""
+
+# pylint:disable=wrong-import-position
+
+import pickle
+import timeit
+
+import orjson
+from rich import print
+from rich.table import Table
+from wrapworks import cwdtoenv
+
+cwdtoenv()
+
+from src.celery.payloads import encode_update, decode_update, orjson_dumps
+from src.telegram.updates import parse_telegram_update
+
+ITERATIONS = 20_000
+
+RAW_PING = {
+    "update_id": 851234567,
+    "message": {
+        "message_id": 48213,
+        "from": {
+            "id": 91234567,
+            "is_bot": False,
+            "first_name": "Sara",
+            "username": "sara_learns",
+            "language_code": "fa",
+        },
+        "chat": {
+            "id": -1001234567890,
+            "title": "Natural English Group",
+            "type": "supergroup",
+        },
+        "date": 1719400000,
+        "text": "@QuickLingoBot what's the difference between 'affect' and 'effect'?",
+        "entities": [{"offset": 0, "length": 14, "type": "mention"}],
+    },
+}
+
+RAW_NEW_MEMBER = {
+    "update_id": 851234568,
+    "message": {
+        "message_id": 48214,
+        "from": {"id": 91234568, "is_bot": False, "first_name": "Reza"},
+        "chat": {
+            "id": -1001234567890,
+            "title": "Natural English Group",
+            "type": "supergroup",
+        },
+        "date": 1719400001,
+        "new_chat_member": {
+            "id": 91234568,
+            "is_bot": False,
+            "first_name": "Reza",
+            "username": "reza_en",
+            "language_code": "fa",
+        },
+    },
+}
+
+
+def measure(name: str, raw: dict) -> list[str]:
+    """Returns the size and per message encode and decode time of both formats"""
+
+    update = parse_telegram_update(raw)
+    # Celery protocol 2 body: (args, kwargs, embed)
+    pickled = pickle.dumps(((update,), {}, {}))
+    payload = orjson_dumps(((encode_update(raw),), {}, {}))
+
+    pickle_dumps = timeit.timeit(
+        lambda: pickle.dumps(((update,), {}, {})), number=ITERATIONS
+    )
+    pickle_loads = timeit.timeit(lambda: pickle.loads(pickled), number=ITERATIONS)
+    orjson_encode = timeit.timeit(
+        lambda: orjson_dumps(((encode_update(raw),), {}, {})), number=ITERATIONS
+    )
+    orjson_decode = timeit.timeit(
+        lambda: decode_update(orjson.loads(payload)[0][0]), number=ITERATIONS
+    )
+
+    def us(seconds: float) -> str:
+        return f"{seconds / ITERATIONS * 1e6:.2f}"
+
+    return [
+        name,
+        f"{len(pickled)}",
+        f"{len(payload)}",
+        us(pickle_dumps),
+        us(orjson_encode),
+        us(pickle_loads),
+        us(orjson_decode),
+    ]
+
+
+if __name__ == "__main__":
+    table = Table(title=f"Update task payloads, {ITERATIONS} iterations")
+    for column in (
+        "update",
+        "pickle bytes",
+        "orjson bytes",
+        "pickle dumps µs",
+        "orjson encode µs",
+        "pickle loads µs",
+        "orjson decode µs",
+    ):
+        table.add_column(column)
+    table.add_row(*measure("ping", RAW_PING))
+    table.add_row(*measure("new member", RAW_NEW_MEMBER))
+    print(table)
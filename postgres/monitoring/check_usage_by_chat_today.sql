@@ -0,0 +1,14 @@
+SELECT
+	CHAT_ID,
+	SUM(TAGGED_MESSAGES) AS TAGGED_MESSAGES,
+	SUM(INPUT_TOKENS) AS INPUT_TOKENS,
+	SUM(OUTPUT_TOKENS) AS OUTPUT_TOKENS,
+	SUM(COST) AS COST
+FROM
+	USAGE_DAILY
+WHERE
+	DAY = (NOW() AT TIME ZONE 'UTC')::DATE
+GROUP BY
+	CHAT_ID
+ORDER BY
+	COST DESC;
\ No newline at end of file
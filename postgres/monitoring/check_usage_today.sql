@@ -1,7 +1,6 @@
 SELECT
 	SUM(COST)
 FROM
-	MESSAGES
+	USAGE_DAILY
 WHERE
-	COST != 0
-	AND DATE(INSERTED_DATE) = CURRENT_DATE;
\ No newline at end of file
+	DAY = (NOW() AT TIME ZONE 'UTC')::DATE;
\ No newline at end of file
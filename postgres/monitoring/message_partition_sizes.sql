@@ -0,0 +1,12 @@
+SELECT
+	CHILD.RELNAME AS PARTITION,
+	PG_GET_EXPR(CHILD.RELPARTBOUND, CHILD.OID) AS BOUND,
+	CHILD.RELTUPLES::BIGINT AS ESTIMATED_ROWS,
+	PG_SIZE_PRETTY(PG_TOTAL_RELATION_SIZE(CHILD.OID)) AS TOTAL_SIZE
+FROM
+	PG_INHERITS
+	JOIN PG_CLASS CHILD ON CHILD.OID = PG_INHERITS.INHRELID
+WHERE
+	PG_INHERITS.INHPARENT = 'public.messages'::REGCLASS
+ORDER BY
+	CHILD.RELNAME;
\ No newline at end of file
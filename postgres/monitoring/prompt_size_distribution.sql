@@ -0,0 +1,25 @@
+--
+-- Prompt and reply sizes of the answered messages of the last 7 days
+--
+SELECT
+	(INSERTED_DATE AT TIME ZONE 'UTC')::DATE AS DAY,
+	COUNT(1) AS ANSWERED_MESSAGES,
+	ROUND(AVG(INPUT_TOKENS)) AS AVG_INPUT_TOKENS,
+	PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY INPUT_TOKENS) AS P50_INPUT_TOKENS,
+	PERCENTILE_CONT(0.9) WITHIN GROUP (ORDER BY INPUT_TOKENS) AS P90_INPUT_TOKENS,
+	PERCENTILE_CONT(0.99) WITHIN GROUP (ORDER BY INPUT_TOKENS) AS P99_INPUT_TOKENS,
+	MAX(INPUT_TOKENS) AS MAX_INPUT_TOKENS,
+	ROUND(AVG(OUTPUT_TOKENS)) AS AVG_OUTPUT_TOKENS,
+	PERCENTILE_CONT(0.9) WITHIN GROUP (ORDER BY OUTPUT_TOKENS) AS P90_OUTPUT_TOKENS,
+	MAX(OUTPUT_TOKENS) AS MAX_OUTPUT_TOKENS,
+	PERCENTILE_CONT(0.9) WITHIN GROUP (ORDER BY TOKEN_COUNT) AS P90_USER_MESSAGE_TOKENS
+FROM
+	MESSAGES
+WHERE
+	WAS_TAGGED
+	AND INPUT_TOKENS > 0
+	AND INSERTED_DATE >= NOW() - INTERVAL '7 days'
+GROUP BY
+	1
+ORDER BY
+	1 DESC;
@@ -0,0 +1,28 @@
+--
+-- Function to tell the chat settings cache that a chat's settings changed
+--
+CREATE
+OR REPLACE FUNCTION NOTIFY_CHAT_SETTINGS_CHANGED () RETURNS TRIGGER AS $$
+BEGIN
+
+	IF TG_OP = 'DELETE' THEN
+		PERFORM PG_NOTIFY('chat_settings_changed', OLD.CHAT_ID::TEXT);
+	ELSE
+		PERFORM PG_NOTIFY('chat_settings_changed', NEW.CHAT_ID::TEXT);
+	END IF;
+
+	RETURN NULL;
+
+END;
+$$ LANGUAGE PLPGSQL;
+
+--
+-- Notify when an operator authorizes a chat or changes its allowance.
+-- LAST_ACTIVE updates don't touch these columns, so they don't notify.
+--
+DROP TRIGGER IF EXISTS CHATS_NOTIFY_SETTINGS_CHANGED ON CHATS;
+
+CREATE TRIGGER CHATS_NOTIFY_SETTINGS_CHANGED
+AFTER INSERT OR DELETE OR UPDATE OF IS_AUTHORIZED, ALLOWED_USAGE_PER_DAY ON CHATS
+FOR EACH ROW
+EXECUTE FUNCTION NOTIFY_CHAT_SETTINGS_CHANGED ();
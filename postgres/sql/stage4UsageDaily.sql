@@ -0,0 +1,102 @@
+--
+-- Create the USAGE_DAILY rollup table if it doesn't exist.
+-- One row per UTC day, chat and user with the credits, tokens and cost used.
+--
+CREATE TABLE IF NOT EXISTS
+	USAGE_DAILY (
+		DAY DATE NOT NULL,
+		CHAT_ID NUMERIC NOT NULL,
+		USER_ID NUMERIC NOT NULL,
+		TAGGED_MESSAGES INT NOT NULL DEFAULT 0,
+		INPUT_TOKENS NUMERIC NOT NULL DEFAULT 0,
+		OUTPUT_TOKENS NUMERIC NOT NULL DEFAULT 0,
+		COST NUMERIC NOT NULL DEFAULT 0,
+		PRIMARY KEY (DAY, CHAT_ID, USER_ID)
+	);
+
+--
+-- Function to add the messages inserted by a statement to USAGE_DAILY.
+-- Only tagged or billed messages are rolled up, other rows don't use credits.
+--
+CREATE
+OR REPLACE FUNCTION ROLLUP_USAGE_DAILY () RETURNS TRIGGER AS $$
+BEGIN
+
+	INSERT INTO USAGE_DAILY (DAY, CHAT_ID, USER_ID, TAGGED_MESSAGES, INPUT_TOKENS, OUTPUT_TOKENS, COST)
+	SELECT
+		(INSERTED_DATE AT TIME ZONE 'UTC')::DATE,
+		CHAT_ID,
+		USER_ID,
+		COUNT(1) FILTER (WHERE WAS_TAGGED),
+		COALESCE(SUM(INPUT_TOKENS), 0),
+		COALESCE(SUM(OUTPUT_TOKENS), 0),
+		COALESCE(SUM(COST), 0)
+	FROM
+		NEW_ROWS
+	WHERE
+		WAS_TAGGED
+		OR COALESCE(COST, 0) <> 0
+	GROUP BY
+		1, 2, 3
+	ON CONFLICT (DAY, CHAT_ID, USER_ID) DO UPDATE
+	SET
+		TAGGED_MESSAGES = USAGE_DAILY.TAGGED_MESSAGES + EXCLUDED.TAGGED_MESSAGES,
+		INPUT_TOKENS = USAGE_DAILY.INPUT_TOKENS + EXCLUDED.INPUT_TOKENS,
+		OUTPUT_TOKENS = USAGE_DAILY.OUTPUT_TOKENS + EXCLUDED.OUTPUT_TOKENS,
+		COST = USAGE_DAILY.COST + EXCLUDED.COST;
+
+	RETURN NULL;
+
+END;
+$$ LANGUAGE PLPGSQL;
+
+--
+-- Create a statement level trigger so a multi row insert updates each rollup row once
+--
+DROP TRIGGER IF EXISTS MESSAGES_ROLLUP_USAGE_DAILY ON MESSAGES;
+
+CREATE TRIGGER MESSAGES_ROLLUP_USAGE_DAILY
+AFTER INSERT ON MESSAGES
+REFERENCING NEW TABLE AS NEW_ROWS
+FOR EACH STATEMENT
+EXECUTE FUNCTION ROLLUP_USAGE_DAILY ();
+
+--
+-- Function to rebuild USAGE_DAILY from MESSAGES for a range of days (inclusive).
+-- Used to backfill existing data and to repair the rollup.
+--
+CREATE
+OR REPLACE FUNCTION REBUILD_USAGE_DAILY (FROM_DAY DATE, TO_DAY DATE) RETURNS INT AS $$
+DECLARE
+	ROWS_WRITTEN INT;
+BEGIN
+
+	-- Blocks the rollup trigger of concurrent inserts until the rebuild commits
+	LOCK TABLE USAGE_DAILY IN EXCLUSIVE MODE;
+
+	DELETE FROM USAGE_DAILY
+	WHERE DAY BETWEEN FROM_DAY AND TO_DAY;
+
+	INSERT INTO USAGE_DAILY (DAY, CHAT_ID, USER_ID, TAGGED_MESSAGES, INPUT_TOKENS, OUTPUT_TOKENS, COST)
+	SELECT
+		(INSERTED_DATE AT TIME ZONE 'UTC')::DATE,
+		CHAT_ID,
+		USER_ID,
+		COUNT(1) FILTER (WHERE WAS_TAGGED),
+		COALESCE(SUM(INPUT_TOKENS), 0),
+		COALESCE(SUM(OUTPUT_TOKENS), 0),
+		COALESCE(SUM(COST), 0)
+	FROM
+		MESSAGES
+	WHERE
+		INSERTED_DATE >= FROM_DAY::TIMESTAMP AT TIME ZONE 'UTC'
+		AND INSERTED_DATE < (TO_DAY + 1)::TIMESTAMP AT TIME ZONE 'UTC'
+		AND (WAS_TAGGED OR COALESCE(COST, 0) <> 0)
+	GROUP BY
+		1, 2, 3;
+
+	GET DIAGNOSTICS ROWS_WRITTEN = ROW_COUNT;
+	RETURN ROWS_WRITTEN;
+
+END;
+$$ LANGUAGE PLPGSQL;
@@ -0,0 +1,7 @@
+--
+-- Add the estimated token count of each message, used to fit the chat history
+-- into the prompt's token budget without re-tokenizing it on every request.
+-- Rows inserted before this column stay NULL and are estimated when read.
+--
+ALTER TABLE MESSAGES
+ADD COLUMN IF NOT EXISTS TOKEN_COUNT INT;
@@ -0,0 +1,16 @@
+--
+-- Add MODEL_OVERRIDE to CHATS. When set, the model router always answers the
+-- chat with this model (one of ValidLLMModels), unless the spend ceiling is hit.
+--
+ALTER TABLE CHATS
+ADD COLUMN IF NOT EXISTS MODEL_OVERRIDE TEXT;
+
+--
+-- Notify the chat settings cache when the override changes too
+--
+DROP TRIGGER IF EXISTS CHATS_NOTIFY_SETTINGS_CHANGED ON CHATS;
+
+CREATE TRIGGER CHATS_NOTIFY_SETTINGS_CHANGED
+AFTER INSERT OR DELETE OR UPDATE OF IS_AUTHORIZED, ALLOWED_USAGE_PER_DAY, MODEL_OVERRIDE ON CHATS
+FOR EACH ROW
+EXECUTE FUNCTION NOTIFY_CHAT_SETTINGS_CHANGED ();
@@ -0,0 +1,143 @@
+--
+-- Range partition MESSAGES by month of INSERTED_DATE, online.
+--
+-- Run with psql in autocommit mode (not with --single-transaction), in the
+-- same month from start to end: steps 1 and 2 prepare the current table while
+-- the bot keeps writing, step 3 swaps it for the partitioned table in one short
+-- transaction. The existing rows are never copied: the current table becomes
+-- MESSAGES_LEGACY, the partition of everything before next month.
+--
+-- Afterwards, run `python -m src.postgres.partition_manager create` once and
+-- let the scheduled `maintain_message_partitions` task keep partitions ahead.
+--
+
+--
+-- 1. Build what ATTACH PARTITION would otherwise build under lock, without blocking writes
+--
+ALTER TABLE MESSAGES
+ALTER COLUMN INSERTED_DATE
+SET DEFAULT CURRENT_TIMESTAMP;
+
+UPDATE MESSAGES
+SET INSERTED_DATE = CURRENT_TIMESTAMP
+WHERE INSERTED_DATE IS NULL;
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS MESSAGES_LEGACY_ID_DATE_IDX ON MESSAGES (PG_MESSAGE_ID, INSERTED_DATE);
+
+DO $$
+BEGIN
+
+	-- The partition constraint of the legacy partition, validated below so ATTACH skips its scan
+	EXECUTE FORMAT(
+		'ALTER TABLE MESSAGES ADD CONSTRAINT MESSAGES_LEGACY_BOUND CHECK (INSERTED_DATE IS NOT NULL AND INSERTED_DATE < %L) NOT VALID',
+		DATE_TRUNC('month', NOW() AT TIME ZONE 'UTC') AT TIME ZONE 'UTC' + INTERVAL '1 month'
+	);
+
+END;
+$$ LANGUAGE PLPGSQL;
+
+--
+-- 2. Validate while only holding a lock that lets inserts through
+--
+ALTER TABLE MESSAGES
+VALIDATE CONSTRAINT MESSAGES_LEGACY_BOUND;
+
+-- Uses the validated constraint instead of scanning the table
+ALTER TABLE MESSAGES
+ALTER COLUMN INSERTED_DATE
+SET NOT NULL;
+
+ALTER TABLE MESSAGES
+ADD CONSTRAINT MESSAGES_LEGACY_ID_DATE_KEY UNIQUE USING INDEX MESSAGES_LEGACY_ID_DATE_IDX;
+
+--
+-- 3. Swap in the partitioned table
+--
+BEGIN;
+
+SET LOCAL LOCK_TIMEOUT = '5s';
+
+LOCK TABLE MESSAGES IN ACCESS EXCLUSIVE MODE;
+
+ALTER TABLE MESSAGES
+RENAME TO MESSAGES_LEGACY;
+
+ALTER TABLE MESSAGES_LEGACY
+RENAME CONSTRAINT MESSAGES_PKEY TO MESSAGES_LEGACY_PKEY;
+
+ALTER INDEX IDX_MESSAGES_CHATID_PGMESSAGEID
+RENAME TO IDX_MESSAGES_LEGACY_CHATID_PGMESSAGEID;
+
+ALTER INDEX IDX_MESSAGES_CHATID_USERID_WASTAGGED_DATE
+RENAME TO IDX_MESSAGES_LEGACY_CHATID_USERID_WASTAGGED_DATE;
+
+-- Moved to the partitioned table, which fires them for every partition
+DROP TRIGGER IF EXISTS MESSAGES_UPDATE_LAST_ACTIVE_OF_PARENTS ON MESSAGES_LEGACY;
+
+DROP TRIGGER IF EXISTS MESSAGES_ROLLUP_USAGE_DAILY ON MESSAGES_LEGACY;
+
+CREATE TABLE
+	MESSAGES (
+		PG_MESSAGE_ID BIGINT NOT NULL DEFAULT NEXTVAL('messages_pg_message_id_seq'),
+		MESSAGE_ID NUMERIC,
+		ROLE TEXT NOT NULL,
+		USER_ID NUMERIC NOT NULL REFERENCES USERS (USER_ID) ON DELETE CASCADE ON UPDATE CASCADE,
+		CHAT_ID NUMERIC NOT NULL REFERENCES CHATS (CHAT_ID) ON DELETE CASCADE ON UPDATE CASCADE,
+		MESSAGE TEXT NOT NULL,
+		COST NUMERIC DEFAULT NULL::INT,
+		INPUT_TOKENS NUMERIC DEFAULT NULL::INT,
+		OUTPUT_TOKENS NUMERIC DEFAULT NULL::INT,
+		INSERTED_DATE TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+		WAS_TAGGED BOOLEAN DEFAULT FALSE,
+		TOKEN_COUNT INT,
+		-- The partition key has to be part of every unique constraint
+		PRIMARY KEY (PG_MESSAGE_ID, INSERTED_DATE)
+	)
+PARTITION BY
+	RANGE (INSERTED_DATE);
+
+ALTER SEQUENCE MESSAGES_PG_MESSAGE_ID_SEQ OWNED BY MESSAGES.PG_MESSAGE_ID;
+
+-- Created on every partition, the legacy ones are matched to the renamed indexes
+CREATE INDEX IF NOT EXISTS IDX_MESSAGES_CHATID_PGMESSAGEID ON MESSAGES (CHAT_ID, PG_MESSAGE_ID);
+
+CREATE INDEX IF NOT EXISTS IDX_MESSAGES_CHATID_USERID_WASTAGGED_DATE ON MESSAGES (CHAT_ID, USER_ID, INSERTED_DATE, WAS_TAGGED);
+
+DO $$
+DECLARE
+	CUTOVER TIMESTAMP WITH TIME ZONE := DATE_TRUNC('month', NOW() AT TIME ZONE 'UTC') AT TIME ZONE 'UTC' + INTERVAL '1 month';
+BEGIN
+
+	EXECUTE FORMAT(
+		'ALTER TABLE MESSAGES ATTACH PARTITION MESSAGES_LEGACY FOR VALUES FROM (MINVALUE) TO (%L)',
+		CUTOVER
+	);
+
+	-- Next month's partition, so inserts never find a gap before the manager runs
+	EXECUTE FORMAT(
+		'CREATE TABLE %I PARTITION OF MESSAGES FOR VALUES FROM (%L) TO (%L)',
+		'messages_' || TO_CHAR(CUTOVER AT TIME ZONE 'UTC', 'YYYY_MM'),
+		CUTOVER,
+		CUTOVER + INTERVAL '1 month'
+	);
+
+END;
+$$ LANGUAGE PLPGSQL;
+
+CREATE TRIGGER MESSAGES_UPDATE_LAST_ACTIVE_OF_PARENTS
+AFTER INSERT ON MESSAGES FOR EACH ROW
+EXECUTE FUNCTION UPDATE_LAST_ACTIVE ();
+
+CREATE TRIGGER MESSAGES_ROLLUP_USAGE_DAILY
+AFTER INSERT ON MESSAGES
+REFERENCING NEW TABLE AS NEW_ROWS
+FOR EACH STATEMENT
+EXECUTE FUNCTION ROLLUP_USAGE_DAILY ();
+
+COMMIT;
+
+--
+-- 4. The bound constraint is implied by the partition bound now
+--
+ALTER TABLE MESSAGES_LEGACY
+DROP CONSTRAINT MESSAGES_LEGACY_BOUND;
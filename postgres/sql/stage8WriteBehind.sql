@@ -0,0 +1,12 @@
+--
+-- The last write-behind stream entry copied into MESSAGES. Updated in the same
+-- transaction as the COPY, so a flusher that dies before trimming the stream
+-- skips the entries it already copied instead of inserting them twice.
+--
+CREATE TABLE IF NOT EXISTS
+	WRITE_BEHIND_OFFSETS (
+		STREAM TEXT PRIMARY KEY,
+		LAST_ENTRY_MS BIGINT NOT NULL DEFAULT 0,
+		LAST_ENTRY_SEQ BIGINT NOT NULL DEFAULT 0,
+		UPDATED_DATE TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+	);
\ No newline at end of file
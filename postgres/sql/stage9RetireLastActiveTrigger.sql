@@ -0,0 +1,11 @@
+--
+-- LAST_ACTIVE of USERS and CHATS is now written in batches by the
+-- `flush_activity` task from the activity recorded in redis. Deploy the
+-- workers and start `celery beat` before running this, so no activity is lost.
+--
+-- Without the trigger, inserting a message no longer updates (and locks) its
+-- user and chat rows, so a busy group's messages stop queueing on its CHATS row.
+--
+DROP TRIGGER IF EXISTS MESSAGES_UPDATE_LAST_ACTIVE_OF_PARENTS ON MESSAGES;
+
+DROP FUNCTION IF EXISTS UPDATE_LAST_ACTIVE ();
\ No newline at end of file
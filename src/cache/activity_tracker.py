@@ -0,0 +1,163 @@
+"""
+Last seen times of users and chats, kept in redis and flushed to their LAST_ACTIVE columns in batches
+"""
+
+# pylint:disable=wrong-import-position
+
+import os
+import time
+from datetime import datetime, timezone
+
+import redis
+from rich import print
+from wrapworks import cwdtoenv
+from dotenv import load_dotenv
+
+cwdtoenv()
+load_dotenv()
+
+from src.cache.core_redis_operations import REDIS_CLIENT, ASYNC_REDIS_CLIENT
+from src.postgres.core_db_operations import (
+    POSTGRES_POOL,
+    open_postgres_pool,
+    close_postgres_pool,
+)
+
+# Seconds between flushes, scheduled by `celery beat`. LAST_ACTIVE lags by up to this much
+ACTIVITY_FLUSH_INTERVAL = float(os.getenv("ACTIVITY_FLUSH_INTERVAL", "60"))
+
+USERS_ACTIVITY_KEY = "activity:users"
+CHATS_ACTIVITY_KEY = "activity:chats"
+
+# KEYS: users activity, chats activity
+# Returns both sorted sets as member, score lists and empties them
+TAKE_ACTIVITY_SCRIPT = """
+local users = redis.call('ZRANGE', KEYS[1], 0, -1, 'WITHSCORES')
+local chats = redis.call('ZRANGE', KEYS[2], 0, -1, 'WITHSCORES')
+redis.call('DEL', KEYS[1], KEYS[2])
+return {users, chats}
+"""
+
+_TAKE_ACTIVITY = REDIS_CLIENT.register_script(TAKE_ACTIVITY_SCRIPT)
+
+# Sorted by ID so concurrent flushes lock rows in the same order
+UPDATE_USERS_LAST_ACTIVE_STATEMENT = """
+UPDATE USERS
+SET LAST_ACTIVE = ACTIVITY.LAST_ACTIVE
+FROM UNNEST(%s::NUMERIC[], %s::TIMESTAMPTZ[]) AS ACTIVITY (USER_ID, LAST_ACTIVE)
+WHERE USERS.USER_ID = ACTIVITY.USER_ID
+AND (USERS.LAST_ACTIVE IS NULL OR USERS.LAST_ACTIVE < ACTIVITY.LAST_ACTIVE);
+"""
+
+UPDATE_CHATS_LAST_ACTIVE_STATEMENT = """
+UPDATE CHATS
+SET LAST_ACTIVE = ACTIVITY.LAST_ACTIVE
+FROM UNNEST(%s::NUMERIC[], %s::TIMESTAMPTZ[]) AS ACTIVITY (CHAT_ID, LAST_ACTIVE)
+WHERE CHATS.CHAT_ID = ACTIVITY.CHAT_ID
+AND (CHATS.LAST_ACTIVE IS NULL OR CHATS.LAST_ACTIVE < ACTIVITY.LAST_ACTIVE);
+"""
+
+
+def _activity_pipeline(pipe, user_ids: list[int], chat_id: int):
+    now = time.time()
+    # GT keeps the latest time when workers record out of order
+    pipe.zadd(USERS_ACTIVITY_KEY, {x: now for x in user_ids}, gt=True)
+    pipe.zadd(CHATS_ACTIVITY_KEY, {chat_id: now}, gt=True)
+
+
+def record_activity(user_ids: list[int], chat_id: int):
+    """
+    ### Responsibility:
+        - Note that users were active in a chat, for the next `flush_activity`.
+
+    ### Args:
+        - `user_ids`: list[int]
+            The senders of the recorded messages.
+        - `chat_id`: int
+            The chat they were sent in.
+
+    ### Returns:
+        - None
+
+    ### How does the function work:
+        - Sets the current time as the score of the users and the chat in two sorted sets, in one round trip. Writing the same chat again only replaces its score, so a busy group costs one entry, not a row update per message.
+        - Failures are logged and ignored, losing at most one LAST_ACTIVE update.
+    """
+
+    try:
+        with REDIS_CLIENT.pipeline(transaction=False) as pipe:
+            _activity_pipeline(pipe, user_ids, chat_id)
+            pipe.execute()
+    except redis.RedisError as e:
+        print(f"Couldn't record activity: {type(e).__name__}: {e}")
+
+
+async def async_record_activity(user_ids: list[int], chat_id: int):
+    """Async variant of `record_activity`"""
+
+    try:
+        async with ASYNC_REDIS_CLIENT.pipeline(transaction=False) as pipe:
+            _activity_pipeline(pipe, user_ids, chat_id)
+            await pipe.execute()
+    except redis.RedisError as e:
+        print(f"Couldn't record activity: {type(e).__name__}: {e}")
+
+
+def _to_rows(pairs: list) -> tuple[list[int], list[datetime]]:
+    rows = sorted(
+        (int(pairs[x]), datetime.fromtimestamp(float(pairs[x + 1]), timezone.utc))
+        for x in range(0, len(pairs), 2)
+    )
+    return [x[0] for x in rows], [x[1] for x in rows]
+
+
+def flush_activity() -> tuple[int, int]:
+    """
+    ### Responsibility:
+        - Write the recorded last seen times to `USERS.LAST_ACTIVE` and `CHATS.LAST_ACTIVE`.
+
+    ### Args:
+        - None
+
+    ### Returns:
+        - `counts`: tuple[int, int]
+            The number of users and chats flushed.
+
+    ### How does the function work:
+        - Takes and empties both sorted sets in one script, so activity recorded during the flush waits for the next one.
+        - Updates all users, then all chats, with one UPDATE each from arrays of IDs and times, in one transaction. Rows that already have a later time are left alone.
+        - If Postgres fails, puts the times back with ZADD GT, keeping any later activity, and raises.
+    """
+
+    users, chats = _TAKE_ACTIVITY(keys=[USERS_ACTIVITY_KEY, CHATS_ACTIVITY_KEY])
+    if not users and not chats:
+        return 0, 0
+
+    user_rows, chat_rows = _to_rows(users), _to_rows(chats)
+    try:
+        with POSTGRES_POOL.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(UPDATE_USERS_LAST_ACTIVE_STATEMENT, user_rows)
+                cur.execute(UPDATE_CHATS_LAST_ACTIVE_STATEMENT, chat_rows)
+    except Exception:
+        with REDIS_CLIENT.pipeline(transaction=False) as pipe:
+            for key, pairs in [
+                (USERS_ACTIVITY_KEY, users),
+                (CHATS_ACTIVITY_KEY, chats),
+            ]:
+                if pairs:
+                    pipe.zadd(
+                        key,
+                        {pairs[x]: pairs[x + 1] for x in range(0, len(pairs), 2)},
+                        gt=True,
+                    )
+            pipe.execute()
+        raise
+
+    return len(user_rows[0]), len(chat_rows[0])
+
+
+if __name__ == "__main__":
+    open_postgres_pool()
+    print(f"Flushed activity of {flush_activity()} users and chats")
+    close_postgres_pool()
@@ -0,0 +1,310 @@
+"""
+Two tier cache of chat settings with push invalidation
+"""
+
+# pylint:disable=wrong-import-position
+
+import os
+import time
+import threading
+from collections import Counter, OrderedDict
+
+import psycopg
+import redis
+from rich import print
+from wrapworks import cwdtoenv
+from dotenv import load_dotenv
+
+cwdtoenv()
+load_dotenv()
+
+from src.cache.core_redis_operations import REDIS_CLIENT, ASYNC_REDIS_CLIENT
+from src.postgres.select_functions import get_chat_settings, async_get_chat_settings
+from src.models.postgres_models import ChatSettings
+
+LOCAL_TTL = float(os.getenv("CHAT_SETTINGS_LOCAL_TTL", "60"))
+LOCAL_MAX_SIZE = int(os.getenv("CHAT_SETTINGS_LOCAL_MAX_SIZE", "10000"))
+REDIS_TTL = int(os.getenv("CHAT_SETTINGS_REDIS_TTL", "3600"))
+
+NOTIFY_CHANNEL = "chat_settings_changed"
+INVALIDATION_CHANNEL = "chat_settings:invalidations"
+# How long the subscriber waits for a message before checking its connection again
+SUBSCRIBER_POLL_TIMEOUT = 1.0
+
+# KEYS: entry, generation
+# ARGV: settings, ttl, generation read before querying Postgres
+# Fills the entry unless an invalidation bumped the generation since, which would mean the settings are stale
+FILL_SCRIPT = """
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[3] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+return 1
+"""
+
+_FILL = REDIS_CLIENT.register_script(FILL_SCRIPT)
+_ASYNC_FILL = ASYNC_REDIS_CLIENT.register_script(FILL_SCRIPT)
+
+_LOCAL_CACHE: OrderedDict[int, tuple[float, ChatSettings]] = OrderedDict()
+_LOCAL_LOCK = threading.Lock()
+_SUBSCRIBER_PID: int | None = None
+
+CACHE_STATS = Counter()
+
+
+def get_redis_key(chat_id: int) -> str:
+    return f"chat_settings:{chat_id}"
+
+
+def get_generation_key(chat_id: int) -> str:
+    """Returns the key counting a chat's invalidations, which guards fills against races"""
+
+    return f"chat_settings:generation:{chat_id}"
+
+
+def _get_local(chat_id: int) -> ChatSettings | None:
+    with _LOCAL_LOCK:
+        cached = _LOCAL_CACHE.get(chat_id)
+        if not cached:
+            return None
+        if cached[0] < time.monotonic():
+            del _LOCAL_CACHE[chat_id]
+            CACHE_STATS["local_expirations"] += 1
+            return None
+        _LOCAL_CACHE.move_to_end(chat_id)
+        return cached[1]
+
+
+def _set_local(settings: ChatSettings):
+    with _LOCAL_LOCK:
+        _LOCAL_CACHE[settings.chat_id] = (time.monotonic() + LOCAL_TTL, settings)
+        _LOCAL_CACHE.move_to_end(settings.chat_id)
+        while len(_LOCAL_CACHE) > LOCAL_MAX_SIZE:
+            _LOCAL_CACHE.popitem(last=False)
+            CACHE_STATS["local_evictions"] += 1
+
+
+def _drop_local(chat_id: int):
+    with _LOCAL_LOCK:
+        _LOCAL_CACHE.pop(chat_id, None)
+
+
+def get_cached_chat_settings(chat_id: int) -> ChatSettings:
+    """
+    ### Responsibility:
+        - Return a chat's authorization flag and daily allowance without querying Postgres on every message.
+
+    ### Args:
+        - `chat_id`: int
+            The ID of the chat.
+
+    ### Returns:
+        - `settings`: ChatSettings
+            The chat's settings.
+
+    ### How does the function work:
+        - Looks in the in-process LRU tier, whose entries live for `CHAT_SETTINGS_LOCAL_TTL` seconds.
+        - On a miss, looks in the shared redis tier, whose entries live for `CHAT_SETTINGS_REDIS_TTL` seconds.
+        - On a miss in both, reads `CHATS` with `get_chat_settings` and fills both tiers.
+        - The redis entry and the chat's invalidation generation are read together, and the fill is skipped if an invalidation bumped the generation while Postgres was read, so a stale row isn't cached for `CHAT_SETTINGS_REDIS_TTL`.
+        - Falls back to Postgres if redis is unreachable, so a redis outage doesn't stop the bot.
+        - Both tiers are invalidated as soon as an operator changes `CHATS`, see `invalidate_chat_settings`.
+    """
+
+    ensure_invalidation_subscriber()
+
+    if settings := _get_local(chat_id):
+        CACHE_STATS["local_hits"] += 1
+        return settings
+
+    generation = None
+    try:
+        data, generation = REDIS_CLIENT.mget(
+            get_redis_key(chat_id), get_generation_key(chat_id)
+        )
+        if data:
+            CACHE_STATS["redis_hits"] += 1
+            settings = ChatSettings.model_validate_json(data)
+            _set_local(settings)
+            return settings
+    except redis.RedisError as e:
+        CACHE_STATS["redis_errors"] += 1
+        print(f"Chat settings cache can't reach redis: {type(e).__name__}: {e}")
+
+    CACHE_STATS["misses"] += 1
+    settings = get_chat_settings(chat_id)
+    _set_local(settings)
+    try:
+        if not _FILL(
+            keys=[get_redis_key(chat_id), get_generation_key(chat_id)],
+            args=[settings.model_dump_json(), REDIS_TTL, generation or "0"],
+        ):
+            CACHE_STATS["skipped_fills"] += 1
+    except redis.RedisError:
+        CACHE_STATS["redis_errors"] += 1
+
+    return settings
+
+
+async def async_get_cached_chat_settings(chat_id: int) -> ChatSettings:
+    """Async variant of `get_cached_chat_settings` using the async redis and postgres clients"""
+
+    ensure_invalidation_subscriber()
+
+    if settings := _get_local(chat_id):
+        CACHE_STATS["local_hits"] += 1
+        return settings
+
+    generation = None
+    try:
+        data, generation = await ASYNC_REDIS_CLIENT.mget(
+            get_redis_key(chat_id), get_generation_key(chat_id)
+        )
+        if data:
+            CACHE_STATS["redis_hits"] += 1
+            settings = ChatSettings.model_validate_json(data)
+            _set_local(settings)
+            return settings
+    except redis.RedisError as e:
+        CACHE_STATS["redis_errors"] += 1
+        print(f"Chat settings cache can't reach redis: {type(e).__name__}: {e}")
+
+    CACHE_STATS["misses"] += 1
+    settings = await async_get_chat_settings(chat_id)
+    _set_local(settings)
+    try:
+        if not await _ASYNC_FILL(
+            keys=[get_redis_key(chat_id), get_generation_key(chat_id)],
+            args=[settings.model_dump_json(), REDIS_TTL, generation or "0"],
+        ):
+            CACHE_STATS["skipped_fills"] += 1
+    except redis.RedisError:
+        CACHE_STATS["redis_errors"] += 1
+
+    return settings
+
+
+def invalidate_chat_settings(chat_id: int):
+    """
+    ### Responsibility:
+        - Drop a chat's cached settings everywhere after they changed in Postgres.
+
+    ### Args:
+        - `chat_id`: int
+            The ID of the chat whose settings changed.
+
+    ### Returns:
+        - None
+
+    ### How does the function work:
+        - Drops the entry from this process's local tier and from redis, and bumps the chat's generation so fills that read Postgres before the change are skipped.
+        - Publishes the chat ID on `INVALIDATION_CHANNEL` so every other process drops its local entry too.
+    """
+
+    CACHE_STATS["invalidations"] += 1
+    _drop_local(chat_id)
+    with REDIS_CLIENT.pipeline() as pipe:
+        pipe.delete(get_redis_key(chat_id))
+        pipe.incr(get_generation_key(chat_id))
+        pipe.expire(get_generation_key(chat_id), REDIS_TTL)
+        pipe.publish(INVALIDATION_CHANNEL, chat_id)
+        pipe.execute()
+
+
+def get_chat_settings_cache_stats() -> dict:
+    """Returns the hit, miss, eviction and invalidation counters of this process"""
+
+    with _LOCAL_LOCK:
+        size = len(_LOCAL_CACHE)
+    return dict(CACHE_STATS) | {"local_size": size}
+
+
+def _listen_for_chat_changes():
+    while True:
+        try:
+            with psycopg.connect(os.getenv("AZ_POSTGRES_URL"), autocommit=True) as conn:
+                conn.execute(f"LISTEN {NOTIFY_CHANNEL}")
+                print(f"Listening for {NOTIFY_CHANNEL} notifications")
+                for notify in conn.notifies():
+                    invalidate_chat_settings(int(notify.payload))
+        except (psycopg.Error, redis.RedisError, ValueError) as e:
+            print(f"Chat settings listener failed: {type(e).__name__}: {e}")
+            time.sleep(5)
+
+
+def start_chat_settings_listener() -> threading.Thread:
+    """
+    ### Responsibility:
+        - Turn Postgres `chat_settings_changed` notifications into cache invalidations.
+
+    ### Returns:
+        - `thread`: threading.Thread
+            The daemon thread running the listener.
+
+    ### How does the function work:
+        - Opens a dedicated autocommit connection and LISTENs on the channel the `CHATS_NOTIFY_SETTINGS_CHANGED` trigger notifies.
+        - Calls `invalidate_chat_settings` for every notification, reconnecting if the connection drops.
+        - Only one listener is needed for the whole deployment, extra ones just repeat the invalidation.
+    """
+
+    thread = threading.Thread(
+        target=_listen_for_chat_changes, name="chat-settings-listener", daemon=True
+    )
+    thread.start()
+    return thread
+
+
+def _clear_local():
+    with _LOCAL_LOCK:
+        _LOCAL_CACHE.clear()
+
+
+def _subscribe_to_invalidations():
+    while True:
+        pubsub = REDIS_CLIENT.pubsub(ignore_subscribe_messages=True)
+        try:
+            pubsub.subscribe(INVALIDATION_CHANNEL)
+            # Invalidations published while we weren't subscribed are gone
+            _clear_local()
+            while True:
+                # Polls instead of `listen`, which raises once the socket timeout passes without a message
+                message = pubsub.get_message(timeout=SUBSCRIBER_POLL_TIMEOUT)
+                if message:
+                    _drop_local(int(message["data"]))
+        except (redis.RedisError, ValueError) as e:
+            print(f"Chat settings subscriber failed: {type(e).__name__}: {e}")
+            time.sleep(5)
+        finally:
+            pubsub.close()
+
+
+def ensure_invalidation_subscriber():
+    """
+    ### Responsibility:
+        - Make sure this process drops local entries that other processes invalidated.
+
+    ### Returns:
+        - None
+
+    ### How does the function work:
+        - Starts a daemon thread subscribed to `INVALIDATION_CHANNEL` the first time it's called in a process, including forked children.
+        - The thread polls with `get_message`, so the client's socket timeout doesn't drop an idle subscription, and its health checks catch dead connections.
+        - The local tier is cleared every time the thread (re)subscribes, since it may have missed invalidations.
+    """
+
+    global _SUBSCRIBER_PID
+
+    if _SUBSCRIBER_PID == os.getpid():
+        return
+    _SUBSCRIBER_PID = os.getpid()
+    _clear_local()
+
+    threading.Thread(
+        target=_subscribe_to_invalidations,
+        name="chat-settings-subscriber",
+        daemon=True,
+    ).start()
+
+
+if __name__ == "__main__":
+    start_chat_settings_listener().join()
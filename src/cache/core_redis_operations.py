@@ -0,0 +1,36 @@
+"""
+Contain the shared redis clients
+"""
+
+import os
+
+import redis
+import redis.asyncio
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Redis is already our Celery broker, so caches default to the same server
+REDIS_URL = os.getenv("REDIS_URL") or os.getenv(
+    "CELERY_BROKER", "redis://localhost:6379/0"
+)
+
+# redis-py checks the pid on every checkout, so this pool is safe to use after a fork
+REDIS_CLIENT = redis.Redis.from_url(
+    REDIS_URL,
+    decode_responses=True,
+    socket_timeout=float(os.getenv("REDIS_SOCKET_TIMEOUT", "2")),
+    health_check_interval=30,
+)
+
+# Used by the event loop worker, connections bind to the loop that first uses them
+ASYNC_REDIS_CLIENT = redis.asyncio.Redis.from_url(
+    REDIS_URL,
+    decode_responses=True,
+    socket_timeout=float(os.getenv("REDIS_SOCKET_TIMEOUT", "2")),
+    health_check_interval=30,
+)
+
+
+if __name__ == "__main__":
+    print(REDIS_CLIENT.ping())
@@ -0,0 +1,325 @@
+"""
+Atomic per user daily credit counters in redis
+"""
+
+# pylint:disable=wrong-import-position
+
+import os
+import time
+import uuid
+from datetime import date
+
+import redis
+from pydantic import BaseModel
+from rich import print
+from wrapworks import cwdtoenv
+from dotenv import load_dotenv
+
+cwdtoenv()
+load_dotenv()
+
+from src.cache.core_redis_operations import REDIS_CLIENT, ASYNC_REDIS_CLIENT
+from src.postgres.select_functions import (
+    get_usage_day,
+    get_usage_day_bounds,
+    count_tagged_messages_on_day,
+    async_count_tagged_messages_on_day,
+)
+from src.cache.write_behind_buffer import (
+    get_pending_messages,
+    async_get_pending_messages,
+    count_pending_tagged_messages,
+)
+
+# A reservation that is neither committed nor refunded (crashed worker) frees itself after this.
+# A turn that outlives it is still charged when it commits
+RESERVATION_TTL = int(os.getenv("CREDIT_RESERVATION_TTL", "300"))
+
+# Keep counters a little past midnight so late commits of yesterday's turns still land
+COUNTER_GRACE_SECONDS = 3600
+
+# KEYS: used counter, pending reservations
+# ARGV: allowed, now, reservation id, reservation ttl, expire at
+# Returns -1 when the counter isn't loaded, 0 when out of credits, 1 when reserved
+RESERVE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return -1
+end
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', ARGV[2])
+local used = tonumber(redis.call('GET', KEYS[1]))
+local pending = redis.call('ZCARD', KEYS[2])
+if used + pending >= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('ZADD', KEYS[2], tonumber(ARGV[2]) + tonumber(ARGV[4]), ARGV[3])
+redis.call('EXPIREAT', KEYS[2], ARGV[5])
+return 1
+"""
+
+# KEYS: used counter, pending reservations
+# ARGV: reservation id, expire at
+# Charges the credit even when the reservation already expired, returns 0 then.
+# A counter that expired is left alone, it's reloaded from Postgres with the turn in it
+COMMIT_SCRIPT = """
+local removed = redis.call('ZREM', KEYS[2], ARGV[1])
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('INCR', KEYS[1])
+    redis.call('EXPIREAT', KEYS[1], ARGV[2])
+end
+return removed
+"""
+
+_RESERVE = REDIS_CLIENT.register_script(RESERVE_SCRIPT)
+_COMMIT = REDIS_CLIENT.register_script(COMMIT_SCRIPT)
+_ASYNC_RESERVE = ASYNC_REDIS_CLIENT.register_script(RESERVE_SCRIPT)
+_ASYNC_COMMIT = ASYNC_REDIS_CLIENT.register_script(COMMIT_SCRIPT)
+
+
+class CreditReservation(BaseModel):
+    """One credit held for a message while its reply is generated"""
+
+    chat_id: int
+    user_id: int
+    day: date
+    reservation_id: str | None = None
+
+
+def get_counter_keys(chat_id: int, user_id: int, day: date) -> list[str]:
+    """Returns the used counter and pending reservations keys of a user's day"""
+
+    # The hash tag keeps both keys on the same slot if redis is ever clustered
+    prefix = f"credits:{{{chat_id}:{user_id}}}:{day.isoformat()}"
+    return [f"{prefix}:used", f"{prefix}:pending"]
+
+
+def get_counter_expiry(day: date) -> int:
+    """Returns the unix time at which a day's counters expire"""
+
+    return int(get_usage_day_bounds(day)[1].timestamp()) + COUNTER_GRACE_SECONDS
+
+
+def load_counter(chat_id: int, user_id: int, day: date):
+    """
+    ### Responsibility:
+        - Rebuild a user's used credits counter from Postgres on a cold start.
+
+    ### Args:
+        - `chat_id`: int
+            The ID of the chat.
+        - `user_id`: int
+            The ID of the user.
+        - `day`: date
+            The usage day to load.
+
+    ### Returns:
+        - None
+
+    ### How does the function work:
+        - Counts the user's tagged messages of the day with `count_tagged_messages_on_day`, plus the ones still in the write-behind buffer.
+        - Stores the count with SET NX, so a counter another worker already loaded (and may have incremented) is kept.
+    """
+
+    used = count_tagged_messages_on_day(
+        chat_id, user_id, day
+    ) + count_pending_tagged_messages(
+        get_pending_messages(chat_id), user_id, get_usage_day_bounds(day)
+    )
+    used_key, _ = get_counter_keys(chat_id, user_id, day)
+    REDIS_CLIENT.set(used_key, used, nx=True, exat=get_counter_expiry(day))
+
+
+def reserve_credit(
+    chat_id: int, user_id: int, allowed_usage_per_day: int
+) -> CreditReservation | None:
+    """
+    ### Responsibility:
+        - Atomically hold one of a user's daily credits for the message being answered.
+        - Prevent two in-flight messages from both taking the last credit.
+
+    ### Args:
+        - `chat_id`: int
+            The ID of the chat.
+        - `user_id`: int
+            The ID of the user.
+        - `allowed_usage_per_day`: int
+            The chat's daily allowance.
+
+    ### Returns:
+        - `reservation`: CreditReservation | None
+            The reservation to pass to `commit_credit` or `refund_credit`, or None if the user has no credits left.
+
+    ### How does the function work:
+        - Runs `RESERVE_SCRIPT`, which drops expired reservations and reserves a credit if used plus pending credits are below the allowance.
+        - If the day's counter isn't in redis yet, loads it from Postgres with `load_counter` and tries again.
+        - If redis is unreachable, falls back to the Postgres credit check and returns a reservation without an ID, which commit and refund ignore.
+    """
+
+    day = get_usage_day()
+    keys = get_counter_keys(chat_id, user_id, day)
+    reservation_id = uuid.uuid4().hex
+
+    try:
+        for _ in range(2):
+            result = _RESERVE(
+                keys=keys,
+                args=[
+                    allowed_usage_per_day,
+                    time.time(),
+                    reservation_id,
+                    RESERVATION_TTL,
+                    get_counter_expiry(day),
+                ],
+            )
+            if result != -1:
+                break
+            load_counter(chat_id, user_id, day)
+    except redis.RedisError as e:
+        print(f"Credit counters can't reach redis: {type(e).__name__}: {e}")
+        used = count_tagged_messages_on_day(chat_id, user_id, day)
+        if used >= allowed_usage_per_day:
+            return None
+        return CreditReservation(chat_id=chat_id, user_id=user_id, day=day)
+
+    print(f"reserve_credit: {result}")
+    if result != 1:
+        return None
+    return CreditReservation(
+        chat_id=chat_id, user_id=user_id, day=day, reservation_id=reservation_id
+    )
+
+
+def commit_credit(reservation: CreditReservation):
+    """
+    ### Responsibility:
+        - Turn a reservation into a used credit once the reply was delivered.
+
+    ### Args:
+        - `reservation`: CreditReservation
+            The reservation returned by `reserve_credit`.
+
+    ### Returns:
+        - None
+
+    ### How does the function work:
+        - Runs `COMMIT_SCRIPT`, which removes the reservation and increments the used counter.
+        - Increments it even when the reservation outlived `RESERVATION_TTL` and was dropped, so a slow turn is still charged.
+    """
+
+    if not reservation.reservation_id:
+        return
+
+    keys = get_counter_keys(reservation.chat_id, reservation.user_id, reservation.day)
+    try:
+        _COMMIT(
+            keys=keys,
+            args=[reservation.reservation_id, get_counter_expiry(reservation.day)],
+        )
+    except redis.RedisError as e:
+        print(f"Couldn't commit credit: {type(e).__name__}: {e}")
+
+
+def refund_credit(reservation: CreditReservation):
+    """
+    ### Responsibility:
+        - Give a reserved credit back after generating or sending the reply failed.
+
+    ### Args:
+        - `reservation`: CreditReservation
+            The reservation returned by `reserve_credit`.
+
+    ### Returns:
+        - None
+    """
+
+    if not reservation.reservation_id:
+        return
+
+    _, pending_key = get_counter_keys(
+        reservation.chat_id, reservation.user_id, reservation.day
+    )
+    try:
+        REDIS_CLIENT.zrem(pending_key, reservation.reservation_id)
+    except redis.RedisError as e:
+        print(f"Couldn't refund credit: {type(e).__name__}: {e}")
+
+
+async def async_load_counter(chat_id: int, user_id: int, day: date):
+    """Async variant of `load_counter`"""
+
+    used = await async_count_tagged_messages_on_day(
+        chat_id, user_id, day
+    ) + count_pending_tagged_messages(
+        await async_get_pending_messages(chat_id), user_id, get_usage_day_bounds(day)
+    )
+    used_key, _ = get_counter_keys(chat_id, user_id, day)
+    await ASYNC_REDIS_CLIENT.set(used_key, used, nx=True, exat=get_counter_expiry(day))
+
+
+async def async_reserve_credit(
+    chat_id: int, user_id: int, allowed_usage_per_day: int
+) -> CreditReservation | None:
+    """Async variant of `reserve_credit`"""
+
+    day = get_usage_day()
+    keys = get_counter_keys(chat_id, user_id, day)
+    reservation_id = uuid.uuid4().hex
+
+    try:
+        for _ in range(2):
+            result = await _ASYNC_RESERVE(
+                keys=keys,
+                args=[
+                    allowed_usage_per_day,
+                    time.time(),
+                    reservation_id,
+                    RESERVATION_TTL,
+                    get_counter_expiry(day),
+                ],
+            )
+            if result != -1:
+                break
+            await async_load_counter(chat_id, user_id, day)
+    except redis.RedisError as e:
+        print(f"Credit counters can't reach redis: {type(e).__name__}: {e}")
+        used = await async_count_tagged_messages_on_day(chat_id, user_id, day)
+        if used >= allowed_usage_per_day:
+            return None
+        return CreditReservation(chat_id=chat_id, user_id=user_id, day=day)
+
+    print(f"reserve_credit: {result}")
+    if result != 1:
+        return None
+    return CreditReservation(
+        chat_id=chat_id, user_id=user_id, day=day, reservation_id=reservation_id
+    )
+
+
+async def async_commit_credit(reservation: CreditReservation):
+    """Async variant of `commit_credit`"""
+
+    if not reservation.reservation_id:
+        return
+
+    keys = get_counter_keys(reservation.chat_id, reservation.user_id, reservation.day)
+    try:
+        await _ASYNC_COMMIT(
+            keys=keys,
+            args=[reservation.reservation_id, get_counter_expiry(reservation.day)],
+        )
+    except redis.RedisError as e:
+        print(f"Couldn't commit credit: {type(e).__name__}: {e}")
+
+
+async def async_refund_credit(reservation: CreditReservation):
+    """Async variant of `refund_credit`"""
+
+    if not reservation.reservation_id:
+        return
+
+    _, pending_key = get_counter_keys(
+        reservation.chat_id, reservation.user_id, reservation.day
+    )
+    try:
+        await ASYNC_REDIS_CLIENT.zrem(pending_key, reservation.reservation_id)
+    except redis.RedisError as e:
+        print(f"Couldn't refund credit: {type(e).__name__}: {e}")
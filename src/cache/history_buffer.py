@@ -0,0 +1,209 @@
+"""
+Ring buffer of the latest messages of each conversation, kept in redis
+"""
+
+# pylint:disable=wrong-import-position
+
+import os
+
+import orjson
+import redis
+from rich import print
+from wrapworks import cwdtoenv
+from dotenv import load_dotenv
+
+cwdtoenv()
+load_dotenv()
+
+from src.cache.core_redis_operations import REDIS_CLIENT, ASYNC_REDIS_CLIENT
+from src.postgres.select_functions import get_last_n_messages, async_get_last_n_messages
+from src.models.postgres_models import Message
+from src.models.gen_ai_models import LLMRoles
+from src.genai.token_estimator import estimate_tokens
+from src.cache.write_behind_buffer import (
+    get_pending_messages,
+    async_get_pending_messages,
+    merge_pending_messages,
+)
+
+HISTORY_DEPTH = int(os.getenv("HISTORY_DEPTH", "3"))
+# "chat" shares one history between everyone in a chat, "user" keeps one per user
+HISTORY_SCOPE = os.getenv("HISTORY_SCOPE", "chat")
+HISTORY_TTL = int(os.getenv("HISTORY_TTL", str(7 * 24 * 3600)))
+
+# Marks a buffer that was warmed from an empty history, so it isn't warmed again
+EMPTY_MARKER = "-"
+
+# KEYS: buffer
+# ARGV: ttl, depth, entries newest first followed by the empty marker
+# Fills the buffer unless it exists, so a warm can't overwrite messages appended since it read Postgres
+WARM_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('RPUSH', KEYS[1], unpack(ARGV, 3))
+redis.call('LTRIM', KEYS[1], 0, ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return 1
+"""
+
+_WARM = REDIS_CLIENT.register_script(WARM_SCRIPT)
+_ASYNC_WARM = ASYNC_REDIS_CLIENT.register_script(WARM_SCRIPT)
+
+
+def get_history_key(chat_id: int, user_id: int) -> str:
+    """Returns the redis key of a conversation's buffer for the configured scope"""
+
+    if HISTORY_SCOPE == "user":
+        return f"history:{chat_id}:{user_id}"
+    return f"history:{chat_id}"
+
+
+def _decode_entries(entries: list[str]) -> list[Message]:
+    messages = [
+        Message(**orjson.loads(x)) for x in entries[:HISTORY_DEPTH] if x != EMPTY_MARKER
+    ]
+    messages.reverse()
+    return messages
+
+
+def _encode_message(role: LLMRoles, text: str, token_count: int | None = None) -> str:
+    if token_count is None:
+        token_count = estimate_tokens(text)
+    return orjson.dumps(
+        {"role": role.value, "message": text, "token_count": token_count}
+    ).decode()
+
+
+def _warm_args(messages: list[Message]) -> list:
+    entries = [
+        _encode_message(LLMRoles(x.role), x.message, x.token_count)
+        for x in reversed(messages)
+    ]
+    return [HISTORY_TTL, HISTORY_DEPTH, *entries, EMPTY_MARKER]
+
+
+def get_history(chat_id: int, user_id: int) -> list[Message]:
+    """
+    ### Responsibility:
+        - Return the last `HISTORY_DEPTH` messages of a conversation, oldest first, for building the prompt.
+
+    ### Args:
+        - `chat_id`: int
+            The ID of the chat.
+        - `user_id`: int
+            The ID of the user, only used when `HISTORY_SCOPE` is "user".
+
+    ### Returns:
+        - `messages`: list[Message]
+            The messages with their role and text.
+
+    ### How does the function work:
+        - Reads the conversation's buffer with a single LRANGE.
+        - If the buffer doesn't exist (new conversation, expired or evicted), warms it from Postgres with `get_last_n_messages`.
+        - With write-behind on, adds the turns that are buffered but not flushed yet with `merge_pending_messages`.
+        - Stores the warmed messages only if the buffer is still absent, so messages appended by a concurrent exchange aren't overwritten.
+        - Reads from Postgres directly if redis is unreachable.
+    """
+
+    key = get_history_key(chat_id, user_id)
+    try:
+        if entries := REDIS_CLIENT.lrange(key, 0, HISTORY_DEPTH):
+            return _decode_entries(entries)
+    except redis.RedisError as e:
+        print(f"History buffer can't reach redis: {type(e).__name__}: {e}")
+        return get_last_n_messages(
+            chat_id, user_id, n=HISTORY_DEPTH, per_user=HISTORY_SCOPE == "user"
+        )
+
+    messages = merge_pending_messages(
+        get_last_n_messages(
+            chat_id, user_id, n=HISTORY_DEPTH, per_user=HISTORY_SCOPE == "user"
+        ),
+        get_pending_messages(chat_id),
+        user_id,
+        n=HISTORY_DEPTH,
+        per_user=HISTORY_SCOPE == "user",
+    )
+    try:
+        _WARM(keys=[key], args=_warm_args(messages))
+    except redis.RedisError:
+        pass
+    return messages
+
+
+def append_history(chat_id: int, user_id: int, messages: list[tuple[LLMRoles, str]]):
+    """
+    ### Responsibility:
+        - Add recorded messages to the conversation's buffer, keeping only the newest ones.
+
+    ### Args:
+        - `chat_id`: int
+            The ID of the chat.
+        - `user_id`: int
+            The ID of the user who started the exchange.
+        - `messages`: list[tuple[LLMRoles, str]]
+            The role and text of each message, oldest first.
+
+    ### Returns:
+        - None
+
+    ### How does the function work:
+        - Pushes with LPUSHX, so a buffer that isn't warm stays cold and is warmed from Postgres on the next read instead of holding a partial history.
+        - Trims the buffer to `HISTORY_DEPTH` entries (plus the empty marker) and refreshes its TTL, all in one round trip.
+    """
+
+    key = get_history_key(chat_id, user_id)
+    try:
+        with REDIS_CLIENT.pipeline(transaction=False) as pipe:
+            pipe.lpushx(key, *[_encode_message(role, text) for role, text in messages])
+            pipe.ltrim(key, 0, HISTORY_DEPTH)
+            pipe.expire(key, HISTORY_TTL)
+            pipe.execute()
+    except redis.RedisError as e:
+        print(f"Couldn't append to history buffer: {type(e).__name__}: {e}")
+
+
+async def async_get_history(chat_id: int, user_id: int) -> list[Message]:
+    """Async variant of `get_history`"""
+
+    key = get_history_key(chat_id, user_id)
+    try:
+        if entries := await ASYNC_REDIS_CLIENT.lrange(key, 0, HISTORY_DEPTH):
+            return _decode_entries(entries)
+    except redis.RedisError as e:
+        print(f"History buffer can't reach redis: {type(e).__name__}: {e}")
+        return await async_get_last_n_messages(
+            chat_id, user_id, n=HISTORY_DEPTH, per_user=HISTORY_SCOPE == "user"
+        )
+
+    messages = merge_pending_messages(
+        await async_get_last_n_messages(
+            chat_id, user_id, n=HISTORY_DEPTH, per_user=HISTORY_SCOPE == "user"
+        ),
+        await async_get_pending_messages(chat_id),
+        user_id,
+        n=HISTORY_DEPTH,
+        per_user=HISTORY_SCOPE == "user",
+    )
+    try:
+        await _ASYNC_WARM(keys=[key], args=_warm_args(messages))
+    except redis.RedisError:
+        pass
+    return messages
+
+
+async def async_append_history(
+    chat_id: int, user_id: int, messages: list[tuple[LLMRoles, str]]
+):
+    """Async variant of `append_history`"""
+
+    key = get_history_key(chat_id, user_id)
+    try:
+        async with ASYNC_REDIS_CLIENT.pipeline(transaction=False) as pipe:
+            pipe.lpushx(key, *[_encode_message(role, text) for role, text in messages])
+            pipe.ltrim(key, 0, HISTORY_DEPTH)
+            pipe.expire(key, HISTORY_TTL)
+            await pipe.execute()
+    except redis.RedisError as e:
+        print(f"Couldn't append to history buffer: {type(e).__name__}: {e}")
@@ -0,0 +1,253 @@
+"""
+Cache of LLM replies to questions that were already answered
+"""
+
+# pylint:disable=wrong-import-position
+
+import os
+import re
+import time
+import hashlib
+
+import orjson
+import redis
+from rich import print
+from wrapworks import cwdtoenv
+from dotenv import load_dotenv
+
+cwdtoenv()
+load_dotenv()
+
+from src.cache.core_redis_operations import REDIS_CLIENT, ASYNC_REDIS_CLIENT
+from src.models.gen_ai_models import AIResponse, LLMMessage
+
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() == "true"
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", str(24 * 3600)))
+# Least recently used entries beyond this are evicted
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "50000"))
+# How the conversation history affects caching:
+#   "include": the history is part of the key, so only identical conversations share a reply
+#   "empty": only questions asked without any history are cached
+#   "ignore": the history is left out, follow up questions may get a reply meant for another context
+RESPONSE_CACHE_HISTORY_POLICY = os.getenv("RESPONSE_CACHE_HISTORY_POLICY", "include")
+
+# Bump to drop every cached reply, e.g. after changing how replies are generated
+RESPONSE_CACHE_VERSION = 1
+
+INDEX_KEY = "response_cache:index"
+STATS_KEY = "response_cache:stats"
+# Stands for the asking user's handle in a cached reply
+HANDLE_PLACEHOLDER = "@{handle}"
+
+# KEYS: entry, index, stats
+# ARGV: now
+# Returns the entry and marks it as recently used, and counts the hit or miss
+LOOKUP_SCRIPT = """
+local value = redis.call('GET', KEYS[1])
+if value then
+    redis.call('ZADD', KEYS[2], 'XX', ARGV[1], KEYS[1])
+    redis.call('HINCRBY', KEYS[3], 'hits', 1)
+    return value
+end
+redis.call('HINCRBY', KEYS[3], 'misses', 1)
+return false
+"""
+
+# KEYS: entry, index, stats
+# ARGV: value, ttl, now, max entries
+STORE_SCRIPT = """
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+redis.call('ZADD', KEYS[2], ARGV[3], KEYS[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', tonumber(ARGV[3]) - tonumber(ARGV[2]))
+local extra = redis.call('ZCARD', KEYS[2]) - tonumber(ARGV[4])
+if extra > 0 then
+    local evicted = redis.call('ZPOPMIN', KEYS[2], extra)
+    for i = 1, #evicted, 2 do
+        redis.call('DEL', evicted[i])
+    end
+    redis.call('HINCRBY', KEYS[3], 'evictions', extra)
+end
+redis.call('HINCRBY', KEYS[3], 'stores', 1)
+"""
+
+_LOOKUP = REDIS_CLIENT.register_script(LOOKUP_SCRIPT)
+_STORE = REDIS_CLIENT.register_script(STORE_SCRIPT)
+_ASYNC_LOOKUP = ASYNC_REDIS_CLIENT.register_script(LOOKUP_SCRIPT)
+_ASYNC_STORE = ASYNC_REDIS_CLIENT.register_script(STORE_SCRIPT)
+
+
+def normalize_text(text: str) -> str:
+    """Lowercases and collapses whitespace and trailing punctuation"""
+
+    text = re.sub(r"\s+", " ", text.lower()).strip()
+    return text.rstrip(" ?!.؟")
+
+
+def get_response_cache_key(
+    model: str, system_prompt_template: str, history: list[LLMMessage], text: str
+) -> str | None:
+    """
+    ### Responsibility:
+        - Build the cache key of a question, so copies of a question that only differ in case, spacing or handles share it.
+
+    ### Args:
+        - `model`: str
+            The model that answers.
+        - `system_prompt_template`: str
+            The system prompt before the user's handle is filled in.
+        - `history`: list[LLMMessage]
+            The conversation history sent with the question, with handles removed.
+        - `text`: str
+            The user's message, with handles removed.
+
+    ### Returns:
+        - `key`: str | None
+            The redis key of the cached reply, or None if the cache is off or `RESPONSE_CACHE_HISTORY_POLICY` rules this question out.
+
+    ### How does the function work:
+        - Normalizes the text with `normalize_text`.
+        - Hashes the normalized text with the model, the prompt template, `RESPONSE_CACHE_VERSION` and, under the "include" policy, the normalized history.
+    """
+
+    if not RESPONSE_CACHE_ENABLED:
+        return None
+    if RESPONSE_CACHE_HISTORY_POLICY == "empty" and history:
+        return None
+
+    parts = [
+        RESPONSE_CACHE_VERSION,
+        model,
+        system_prompt_template,
+        normalize_text(text),
+    ]
+    if RESPONSE_CACHE_HISTORY_POLICY == "include":
+        parts.append([[x.role, normalize_text(x.content)] for x in history])
+
+    digest = hashlib.sha256(orjson.dumps(parts)).hexdigest()
+    return f"response_cache:{digest}"
+
+
+def _decode_entry(value: str, handle: str) -> AIResponse:
+    entry = orjson.loads(value)
+    return AIResponse.model_construct(
+        text=entry["text"].replace(HANDLE_PLACEHOLDER, f"@{handle}"),
+        input_tokens=0,
+        output_tokens=0,
+        cost=0,
+        cached=True,
+    )
+
+
+def _encode_entry(response: AIResponse, handle: str) -> str:
+    text = response.text.replace(f"@{handle}", HANDLE_PLACEHOLDER)
+    return orjson.dumps({"text": text}).decode()
+
+
+def get_cached_response(key: str | None, handle: str) -> AIResponse | None:
+    """
+    ### Responsibility:
+        - Return the cached reply of a question, addressed to the user asking it.
+
+    ### Args:
+        - `key`: str | None
+            The key from `get_response_cache_key`.
+        - `handle`: str
+            The asking user's handle, put back where the original reply tagged its user.
+
+    ### Returns:
+        - `response`: AIResponse | None
+            The reply with zero cost and tokens, so hits are recorded as free, or None on a miss.
+    """
+
+    if not key:
+        return None
+    try:
+        value = _LOOKUP(keys=[key, INDEX_KEY, STATS_KEY], args=[time.time()])
+    except redis.RedisError as e:
+        print(f"Response cache can't reach redis: {type(e).__name__}: {e}")
+        return None
+    return _decode_entry(value, handle) if value else None
+
+
+def store_cached_response(key: str | None, response: AIResponse, handle: str):
+    """
+    ### Responsibility:
+        - Cache a generated reply for the next user asking the same question.
+
+    ### Args:
+        - `key`: str | None
+            The key from `get_response_cache_key`.
+        - `response`: AIResponse
+            The generated reply.
+        - `handle`: str
+            The asking user's handle, replaced with `HANDLE_PLACEHOLDER`.
+
+    ### Returns:
+        - None
+
+    ### How does the function work:
+        - Stores the reply for `RESPONSE_CACHE_TTL` seconds and records it in a recency index.
+        - Evicts the least recently used replies beyond `RESPONSE_CACHE_MAX_ENTRIES`, in the same script.
+    """
+
+    if not key or not response.text:
+        return
+    try:
+        _STORE(
+            keys=[key, INDEX_KEY, STATS_KEY],
+            args=[
+                _encode_entry(response, handle),
+                RESPONSE_CACHE_TTL,
+                time.time(),
+                RESPONSE_CACHE_MAX_ENTRIES,
+            ],
+        )
+    except redis.RedisError as e:
+        print(f"Couldn't cache response: {type(e).__name__}: {e}")
+
+
+async def async_get_cached_response(key: str | None, handle: str) -> AIResponse | None:
+    """Async variant of `get_cached_response`"""
+
+    if not key:
+        return None
+    try:
+        value = await _ASYNC_LOOKUP(
+            keys=[key, INDEX_KEY, STATS_KEY], args=[time.time()]
+        )
+    except redis.RedisError as e:
+        print(f"Response cache can't reach redis: {type(e).__name__}: {e}")
+        return None
+    return _decode_entry(value, handle) if value else None
+
+
+async def async_store_cached_response(
+    key: str | None, response: AIResponse, handle: str
+):
+    """Async variant of `store_cached_response`"""
+
+    if not key or not response.text:
+        return
+    try:
+        await _ASYNC_STORE(
+            keys=[key, INDEX_KEY, STATS_KEY],
+            args=[
+                _encode_entry(response, handle),
+                RESPONSE_CACHE_TTL,
+                time.time(),
+                RESPONSE_CACHE_MAX_ENTRIES,
+            ],
+        )
+    except redis.RedisError as e:
+        print(f"Couldn't cache response: {type(e).__name__}: {e}")
+
+
+def get_response_cache_stats() -> dict:
+    """Returns the hits, misses, stores and evictions of every worker, and the hit rate"""
+
+    stats = {k: int(v) for k, v in REDIS_CLIENT.hgetall(STATS_KEY).items()}
+    lookups = stats.get("hits", 0) + stats.get("misses", 0)
+    return stats | {
+        "entries": REDIS_CLIENT.zcard(INDEX_KEY),
+        "hit_rate": stats.get("hits", 0) / lookups if lookups else 0,
+    }
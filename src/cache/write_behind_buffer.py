@@ -0,0 +1,258 @@
+"""
+Write-behind buffer of MESSAGES rows, held in a redis stream until `write_behind` copies them to Postgres
+"""
+
+# pylint:disable=wrong-import-position
+
+import os
+from datetime import datetime, timezone
+
+import orjson
+import redis
+from rich import print
+from wrapworks import cwdtoenv
+from dotenv import load_dotenv
+
+cwdtoenv()
+load_dotenv()
+
+from src.cache.core_redis_operations import REDIS_CLIENT, ASYNC_REDIS_CLIENT
+from src.models.postgres_models import Message
+from src.models.gen_ai_models import LLMRoles
+
+# When on, `insert_turn` buffers turns here instead of inserting them
+WRITE_BEHIND_ENABLED = os.getenv("WRITE_BEHIND_ENABLED", "false").lower() == "true"
+# Buffered rows of a chat stay readable this long even if no flusher is running
+WRITE_BEHIND_PENDING_TTL = int(os.getenv("WRITE_BEHIND_PENDING_TTL", "86400"))
+
+WRITE_BEHIND_STREAM = "write_behind:messages"
+# Turns Postgres refused, kept for inspection
+WRITE_BEHIND_DEAD_LETTER_STREAM = "write_behind:messages:dead"
+
+# Same order as the `COPY` in `write_behind`
+MESSAGE_FIELDS = [
+    "message_id",
+    "role",
+    "user_id",
+    "chat_id",
+    "message",
+    "cost",
+    "input_tokens",
+    "output_tokens",
+    "was_tagged",
+    "token_count",
+    "inserted_date",
+]
+
+# KEYS: stream, chat's pending rows
+# ARGV: turn, messages, pending ttl
+# Adds the turn to the stream and its messages to the chat's pending rows under the same ID
+BUFFER_TURN_SCRIPT = """
+local id = redis.call('XADD', KEYS[1], '*', 'turn', ARGV[1])
+redis.call('HSET', KEYS[2], id, ARGV[2])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+return id
+"""
+
+_BUFFER_TURN = REDIS_CLIENT.register_script(BUFFER_TURN_SCRIPT)
+_ASYNC_BUFFER_TURN = ASYNC_REDIS_CLIENT.register_script(BUFFER_TURN_SCRIPT)
+
+
+def get_pending_key(chat_id: int) -> str:
+    """Returns the key of the hash holding a chat's buffered rows, by stream entry ID"""
+
+    return f"write_behind:pending:{chat_id}"
+
+
+def _encode_turn(
+    user_rows: list[tuple], chat_row: tuple, message_rows: list[tuple]
+) -> tuple[list, bytes, bytes]:
+    now = datetime.now(timezone.utc).isoformat()
+    # Stamped now so credits and partitions use the time the message was recorded, not flushed
+    messages = [[*x, now] for x in message_rows]
+    encoded = orjson.dumps(messages)
+    turn = orjson.dumps({"users": user_rows, "chat": chat_row, "messages": messages})
+    return [WRITE_BEHIND_STREAM, get_pending_key(chat_row[0])], turn, encoded
+
+
+def buffer_turn_rows(
+    user_rows: list[tuple], chat_row: tuple, message_rows: list[tuple]
+) -> bool:
+    """
+    ### Responsibility:
+        - Hold a turn's rows in redis for `write_behind` to copy to Postgres in bulk.
+
+    ### Args:
+        - `user_rows`: list[tuple]
+            The user rows made by `build_turn_rows`.
+        - `chat_row`: tuple
+            The chat row.
+        - `message_rows`: list[tuple]
+            The message rows, stamped with the current time as `INSERTED_DATE`.
+
+    ### Returns:
+        - `buffered`: bool
+            False if redis couldn't be reached, in which case the caller inserts the rows itself.
+
+    ### How does the function work:
+        - Adds the turn to `WRITE_BEHIND_STREAM` and its messages to the chat's pending rows in one script, so a buffered row is always readable by `get_pending_messages` until it's flushed.
+        - The stream is the durable copy: rows survive a worker crash and are flushed once Postgres is reachable.
+    """
+
+    keys, turn, messages = _encode_turn(user_rows, chat_row, message_rows)
+    try:
+        _BUFFER_TURN(keys=keys, args=[turn, messages, WRITE_BEHIND_PENDING_TTL])
+        return True
+    except redis.RedisError as e:
+        print(f"Couldn't buffer turn: {type(e).__name__}: {e}")
+        return False
+
+
+def parse_entry_id(entry_id: str) -> tuple[int, int]:
+    """Returns the milliseconds and sequence number of a stream entry ID, which order entries"""
+
+    milliseconds, sequence = entry_id.split("-")
+    return int(milliseconds), int(sequence)
+
+
+def _decode_pending(values: list[tuple[str, str]]) -> list[Message]:
+    messages = []
+    for _, value in sorted(values, key=lambda x: parse_entry_id(x[0])):
+        for row in orjson.loads(value):
+            fields = dict(zip(MESSAGE_FIELDS, row))
+            fields["inserted_date"] = datetime.fromisoformat(fields["inserted_date"])
+            messages.append(Message(**fields))
+    return messages
+
+
+def get_pending_messages(chat_id: int) -> list[Message]:
+    """
+    ### Responsibility:
+        - Return a chat's messages that are buffered but not in Postgres yet, oldest first.
+
+    ### Args:
+        - `chat_id`: int
+            The ID of the chat.
+
+    ### Returns:
+        - `messages`: list[Message]
+            The buffered messages, without `pg_message_id`. Empty if write-behind is off or redis can't be reached.
+    """
+
+    if not WRITE_BEHIND_ENABLED:
+        return []
+    try:
+        values = REDIS_CLIENT.hgetall(get_pending_key(chat_id))
+    except redis.RedisError as e:
+        print(f"Couldn't read buffered messages: {type(e).__name__}: {e}")
+        return []
+    return _decode_pending(list(values.items()))
+
+
+def merge_pending_messages(
+    messages: list[Message],
+    pending: list[Message],
+    user_id: int,
+    n: int,
+    per_user: bool = False,
+) -> list[Message]:
+    """
+    ### Responsibility:
+        - Add a chat's buffered messages to the history read from Postgres, so a conversation sees its own unflushed turns.
+
+    ### Args:
+        - `messages`: list[Message]
+            The last `n` messages from `get_last_n_messages`, oldest first.
+        - `pending`: list[Message]
+            The chat's buffered messages from `get_pending_messages`.
+        - `user_id`: int
+            The ID of the user, only used when `per_user` is True.
+        - `n`: int
+            The number of messages to return.
+        - `per_user`: bool
+            Keep only the user's own messages and the bot's replies to them, like `get_last_n_messages`.
+
+    ### Returns:
+        - `messages`: list[Message]
+            The last `n` messages, oldest first.
+    """
+
+    if per_user:
+        # A turn's rows share the `inserted_date` it was buffered with
+        user_turns = {x.inserted_date for x in pending if x.user_id == user_id}
+        pending = [
+            x
+            for x in pending
+            if x.user_id == user_id
+            or (x.role == LLMRoles.AI.value and x.inserted_date in user_turns)
+        ]
+    if not pending:
+        return messages
+    return (messages + pending)[-n:]
+
+
+def count_pending_tagged_messages(
+    pending: list[Message], user_id: int, day_bounds: tuple[datetime, datetime]
+) -> int:
+    """Returns how many of a chat's buffered messages are tagged messages of the user on the usage day"""
+
+    start, end = day_bounds
+    return sum(
+        1
+        for x in pending
+        if x.user_id == user_id
+        and x.role == LLMRoles.USER.value
+        and x.was_tagged
+        and start <= x.inserted_date < end
+    )
+
+
+def remove_flushed_entries(entries: list[tuple[str, int]]):
+    """
+    ### Responsibility:
+        - Drop flushed turns from the stream and the chats' pending rows.
+
+    ### Args:
+        - `entries`: list[tuple[str, int]]
+            The stream entry ID and chat ID of each flushed turn.
+
+    ### Returns:
+        - None
+    """
+
+    if not entries:
+        return
+    with REDIS_CLIENT.pipeline(transaction=False) as pipe:
+        pipe.xdel(WRITE_BEHIND_STREAM, *[x[0] for x in entries])
+        for entry_id, chat_id in entries:
+            pipe.hdel(get_pending_key(chat_id), entry_id)
+        pipe.execute()
+
+
+async def async_buffer_turn_rows(
+    user_rows: list[tuple], chat_row: tuple, message_rows: list[tuple]
+) -> bool:
+    """Async variant of `buffer_turn_rows`"""
+
+    keys, turn, messages = _encode_turn(user_rows, chat_row, message_rows)
+    try:
+        await _ASYNC_BUFFER_TURN(
+            keys=keys, args=[turn, messages, WRITE_BEHIND_PENDING_TTL]
+        )
+        return True
+    except redis.RedisError as e:
+        print(f"Couldn't buffer turn: {type(e).__name__}: {e}")
+        return False
+
+
+async def async_get_pending_messages(chat_id: int) -> list[Message]:
+    """Async variant of `get_pending_messages`"""
+
+    if not WRITE_BEHIND_ENABLED:
+        return []
+    try:
+        values = await ASYNC_REDIS_CLIENT.hgetall(get_pending_key(chat_id))
+    except redis.RedisError as e:
+        print(f"Couldn't read buffered messages: {type(e).__name__}: {e}")
+        return []
+    return _decode_pending(list(values.items()))
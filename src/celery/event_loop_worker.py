@@ -0,0 +1,203 @@
+"""
+Event loop that keeps many updates in flight inside one worker process
+"""
+
+# pylint:disable=wrong-import-position
+
+import os
+import asyncio
+import threading
+from collections import Counter
+from concurrent.futures import Future
+
+from rich import print
+from wrapworks import cwdtoenv
+from dotenv import load_dotenv
+
+cwdtoenv()
+load_dotenv()
+
+from src.core.message_handler import async_entry_process_message
+from src.telegram.send_message import async_send_welcome_message
+from src.telegram.outbox import (
+    OUTBOX_ENABLED,
+    build_welcome_outbox_message,
+    async_enqueue_outbox_message,
+)
+from src.core.http_clients import close_async_http_clients
+from src.core.tracing import TraceContext, trace_segment
+from src.telegram.updates import parse_telegram_update
+from src.postgres.core_db_operations import (
+    open_async_postgres_pool,
+    close_async_postgres_pool,
+)
+from src.models.telegram_update_models import (
+    TelegramUpdatePing,
+    TelegramUpdateNewMember,
+)
+
+MAX_IN_FLIGHT = int(os.getenv("ASYNC_WORKER_MAX_IN_FLIGHT", "200"))
+
+
+async def async_handle_update(
+    update: dict | TelegramUpdatePing | TelegramUpdateNewMember,
+    earlier: list[TelegramUpdatePing] | None = None,
+):
+    """
+    ### Responsibility:
+        - Async counterpart of `worker_handle_update`: dispatch an update to the matching async handler.
+
+    ### Args:
+        - `update`: dict | TelegramUpdatePing | TelegramUpdateNewMember
+            A raw update, validated with `parse_telegram_update`, or an already parsed one.
+        - `earlier`: list[TelegramUpdatePing] | None
+            Messages coalesced into the same turn as `update`, see `async_entry_process_message`.
+
+    ### Returns:
+        - `result`: AIResponse or str
+            The result of `async_entry_process_message` or `async_send_welcome_message`.
+
+    ### Raises:
+        - `AttributeError`:
+            Raised if the provided update type is not recognized or supported.
+    """
+
+    update = parse_telegram_update(update)
+    if isinstance(update, TelegramUpdatePing):
+        return await async_entry_process_message(update, earlier)
+    if isinstance(update, TelegramUpdateNewMember):
+        if OUTBOX_ENABLED:
+            await async_enqueue_outbox_message(build_welcome_outbox_message(update))
+            return "Welcome message queued"
+        return await async_send_welcome_message(update)
+    raise AttributeError(f"Unknown update type: {type(update).__name__}: {update}")
+
+
+class EventLoopWorker:
+    """
+    Runs an asyncio event loop on a background thread of the current process.
+
+    Celery tasks hand updates over with `submit` and return straight away, so a
+    single worker process keeps up to `max_in_flight` updates waiting on
+    Postgres, OpenAI and Telegram at the same time. When all slots are taken,
+    `submit` blocks, which stops the worker from prefetching more work.
+
+    Updates of the same chat run one at a time, in the order they were
+    submitted, so a shard queue keeps its per chat ordering even though many
+    chats are processed concurrently.
+    """
+
+    def __init__(self, max_in_flight: int):
+        self.max_in_flight = max_in_flight
+        self.slots = threading.BoundedSemaphore(max_in_flight)
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.thread: threading.Thread | None = None
+        self.pid: int | None = None
+        self.lock = threading.Lock()
+        self.chat_locks: dict[int, asyncio.Lock] = {}
+        self.chat_waiters = Counter()
+
+    def start(self):
+        """Start the loop thread and open the async postgres pool on it"""
+
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+
+            self.slots = threading.BoundedSemaphore(self.max_in_flight)
+            self.chat_locks.clear()
+            self.chat_waiters.clear()
+            self.loop = asyncio.new_event_loop()
+            self.thread = threading.Thread(
+                target=self.loop.run_forever, name="event-loop-worker", daemon=True
+            )
+            self.thread.start()
+            asyncio.run_coroutine_threadsafe(
+                open_async_postgres_pool(), self.loop
+            ).result()
+            self.pid = os.getpid()
+            print(f"Event loop worker started with {self.max_in_flight} slots")
+
+    def submit(
+        self,
+        update: dict | TelegramUpdatePing | TelegramUpdateNewMember,
+        earlier: list[TelegramUpdatePing] | None = None,
+        trace_context: TraceContext | None = None,
+    ) -> Future:
+        """Schedule an update, and the messages coalesced with it, on the loop, waiting for a free slot first"""
+
+        if self.pid != os.getpid():
+            self.start()
+
+        self.slots.acquire()
+        future = asyncio.run_coroutine_threadsafe(
+            self._handle_in_chat_order(update, earlier, trace_context), self.loop
+        )
+        future.add_done_callback(self._on_done)
+        return future
+
+    async def _handle_in_chat_order(
+        self,
+        update: dict | TelegramUpdatePing | TelegramUpdateNewMember,
+        earlier: list[TelegramUpdatePing] | None = None,
+        trace_context: TraceContext | None = None,
+    ):
+        chat_id = parse_telegram_update(update).message.chat.id
+        # asyncio.Lock wakes waiters first in, first out, and coroutines start in submit order
+        lock = self.chat_locks.setdefault(chat_id, asyncio.Lock())
+        self.chat_waiters[chat_id] += 1
+        try:
+            # Every coroutine runs in its own context, so concurrent traces stay apart
+            with trace_segment(trace_context, "handle_update", "event_loop_worker"):
+                async with lock:
+                    return await async_handle_update(update, earlier)
+        finally:
+            self.chat_waiters[chat_id] -= 1
+            if not self.chat_waiters[chat_id]:
+                del self.chat_waiters[chat_id]
+                del self.chat_locks[chat_id]
+
+    def _on_done(self, future: Future):
+        self.slots.release()
+        if future.cancelled():
+            return
+        if exc := future.exception():
+            print(f"Event loop worker failed an update: {type(exc).__name__}: {exc}")
+
+    async def _drain(self):
+        current = asyncio.current_task()
+        pending = [x for x in asyncio.all_tasks() if x is not current]
+        await asyncio.gather(*pending, return_exceptions=True)
+        await close_async_http_clients()
+        await close_async_postgres_pool()
+
+    def stop(self, timeout: float = 60):
+        """Wait for in-flight updates, close the pool and clients and stop the loop thread"""
+
+        if self.pid != os.getpid():
+            return
+
+        asyncio.run_coroutine_threadsafe(self._drain(), self.loop).result(timeout)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout)
+        self.pid = None
+        print("Event loop worker stopped")
+
+
+EVENT_LOOP_WORKER = EventLoopWorker(MAX_IN_FLIGHT)
+
+
+def submit_update(
+    update: dict | TelegramUpdatePing | TelegramUpdateNewMember,
+    earlier: list[TelegramUpdatePing] | None = None,
+    trace_context: TraceContext | None = None,
+) -> Future:
+    """Hand an update, the messages coalesced with it and its trace to this process's `EVENT_LOOP_WORKER`"""
+
+    return EVENT_LOOP_WORKER.submit(update, earlier, trace_context)
+
+
+def stop_event_loop_worker():
+    """Drain and stop this process's `EVENT_LOOP_WORKER` if it was started"""
+
+    EVENT_LOOP_WORKER.stop()
@@ -7,19 +7,74 @@ Celery workers
 import os
 
 from celery import Celery
+from celery.signals import (
+    worker_init,
+    worker_process_init,
+    worker_process_shutdown,
+    worker_shutdown,
+    task_postrun,
+)
+from kombu.exceptions import ChannelError
 from wrapworks import cwdtoenv
 from dotenv import load_dotenv
 
 cwdtoenv()
 load_dotenv()
 
-from src.core.message_handler import entry_process_message
+from src.core.message_handler import entry_process_message, is_noreply_message
+from src.core.coalescer import (
+    COALESCE_ENABLED,
+    COALESCE_WINDOW,
+    COALESCE_MAX_MESSAGES,
+    buffer_update,
+    take_coalesced_updates,
+)
+from src.core.http_clients import close_http_clients
+from src.postgres.core_db_operations import open_postgres_pool, close_postgres_pool
+from src.celery.event_loop_worker import submit_update, stop_event_loop_worker
 from src.telegram.send_message import send_welcome_message
+from src.telegram.outbox import (
+    OUTBOX_ENABLED,
+    build_welcome_outbox_message,
+    enqueue_outbox_message,
+)
+from src.celery.payloads import SERIALIZER_NAME, encode_update, decode_update
+from src.celery.routing import (
+    SHARDED_QUEUES,
+    Lanes,
+    get_queue_name,
+    get_update_queue,
+    get_lane_queues,
+)
+from src.core.tracing import (
+    read_trace_context,
+    trace_segment,
+    get_trace_headers,
+    build_trace_headers,
+)
+from src.core.metrics import (
+    reset_multiprocess_dir,
+    start_worker_metrics_server,
+    mark_metrics_process_dead,
+    observe_postgres_pools,
+)
+from src.postgres.partition_manager import maintain_message_partitions
+from src.cache.activity_tracker import ACTIVITY_FLUSH_INTERVAL, flush_activity
 from src.models.telegram_update_models import (
     TelegramUpdatePing,
     TelegramUpdateNewMember,
 )
 
+# "sync" runs each update on a worker slot, "async" hands it to the event loop worker
+WORKER_MODE = os.getenv("WORKER_MODE", "sync")
+# Seconds between runs of the MESSAGES partition maintenance, scheduled by `celery beat`
+PARTITION_MAINTENANCE_INTERVAL = float(
+    os.getenv("PARTITION_MAINTENANCE_INTERVAL", "21600")
+)
+# A sharded deployment might not consume the default queue, so scheduled tasks go to the system lane
+SCHEDULED_TASK_OPTIONS = (
+    {"queue": get_queue_name(Lanes.SYSTEM, 0)} if SHARDED_QUEUES else {}
+)
 
 celery_master = Celery(
     broker=os.getenv("CELERY_BROKER"), backend=os.getenv("CELERY_BACKEND")
@@ -27,23 +82,83 @@ celery_master = Celery(
 celery_master.config_from_object(
     {
         "event_serializer": "json",
-        "task_serializer": "pickle",
-        "result_serializer": "pickle",
-        "accept_content": ["application/json", "application/x-python-serialize"],
+        "task_serializer": SERIALIZER_NAME,
+        "result_serializer": SERIALIZER_NAME,
+        # pickle is only accepted to drain tasks queued before the orjson payloads
+        "accept_content": [
+            "application/json",
+            "application/x-orjson",
+            "application/x-python-serialize",
+        ],
+        # Nothing reads the results, a task that needs one sets ignore_result=False
+        "task_ignore_result": True,
         "broker_connection_retry_on_startup": True,
+        "beat_schedule": {
+            "maintain_message_partitions": {
+                "task": "maintain_message_partitions",
+                "schedule": PARTITION_MAINTENANCE_INTERVAL,
+                "options": SCHEDULED_TASK_OPTIONS,
+            },
+            "flush_activity": {
+                "task": "flush_activity",
+                "schedule": ACTIVITY_FLUSH_INTERVAL,
+                "options": SCHEDULED_TASK_OPTIONS,
+            },
+        },
     }
 )
 
 
+@worker_init.connect
+def init_worker(**_):
+    """Serve the merged metrics of the worker's children from the parent process"""
+
+    reset_multiprocess_dir()
+    start_worker_metrics_server()
+
+
+@worker_process_init.connect
+def init_worker_process(**_):
+    """Open the postgres pool inside every forked worker child"""
+
+    open_postgres_pool()
+
+
+@worker_process_shutdown.connect
+def shutdown_worker_process(**_):
+    """Release the worker child's postgres and HTTP connections"""
+
+    stop_event_loop_worker()
+    close_http_clients()
+    close_postgres_pool()
+    mark_metrics_process_dead()
+
+
+@worker_shutdown.connect
+def shutdown_worker(**_):
+    """Drain the event loop worker when running without forked children (--pool=solo)"""
+
+    stop_event_loop_worker()
+
+
+@task_postrun.connect
+def observe_worker_pools(**_):
+    """Refresh the postgres pool gauges after every task, workers have no scrape of their own"""
+
+    observe_postgres_pools()
+
+
 @celery_master.task(bind=True, name="handle_update")
-def worker_handle_update(self, update: TelegramUpdatePing | TelegramUpdateNewMember):
+def worker_handle_update(
+    self, update: list | dict | TelegramUpdatePing | TelegramUpdateNewMember
+):
     """
     ### Responsibility:
         - Handle different types of Telegram updates and dispatch them to the appropriate handler functions.
 
     ### Args:
-        - `update`: TelegramUpdatePing | TelegramUpdateNewMember
-            An object representing either a message update or a new member update.
+        - `update`: list | dict | TelegramUpdatePing | TelegramUpdateNewMember
+            The payload made by `encode_update`, or a raw or parsed update from tasks queued before it.
 
     ### Returns:
         - `result`: AIResponse or str or None
@@ -56,16 +171,257 @@ def worker_handle_update(self, update: TelegramUpdatePing | TelegramUpdateNewMem
             Raised if the provided update type is not recognized or supported.
 
     ### How does the function work:
-        - Checks if the update is of type `TelegramUpdatePing`. If so, calls `entry_process_message` and returns the result.
-        - Checks if the update is of type `TelegramUpdateNewMember`. If so, calls `send_welcome_message` and returns the result.
+        - Decodes the payload into its model with `decode_update`.
+        - Checks if the update is of type `TelegramUpdatePing`. If so, calls `entry_process_message` and returns the result. With `COALESCE_ENABLED`, buffers it with `coalesce_update` instead.
+        - Checks if the update is of type `TelegramUpdateNewMember`. If so, calls `send_welcome_message`, or queues the welcome in the outbox when `OUTBOX_ENABLED` is set, and returns the result.
         - Raises an `AttributeError` if the update type is unrecognized.
+        - Records it all in the update's trace, continued from the task headers, see `src.core.tracing`.
+    """
+
+    with trace_segment(read_trace_context(self.request), "handle_update", "worker"):
+        update = decode_update(update)
+        if isinstance(update, TelegramUpdatePing):
+            if COALESCE_ENABLED and not is_noreply_message(update):
+                coalesce_update(update)
+                return "Update coalesced"
+            result = entry_process_message(update)
+            return result
+        if isinstance(update, TelegramUpdateNewMember):
+            if OUTBOX_ENABLED:
+                enqueue_outbox_message(build_welcome_outbox_message(update))
+                return "Welcome message queued"
+            result = send_welcome_message(update)
+            return result
+        else:
+            raise AttributeError(
+                f"Unknown update type: {type(update).__name__}: {update}"
+            )
+
+
+@celery_master.task(bind=True, name="handle_update_async")
+def worker_handle_update_async(
+    self, update: list | dict | TelegramUpdatePing | TelegramUpdateNewMember
+):
+    """
+    ### Responsibility:
+        - Hand a Telegram update to the process's event loop worker instead of processing it on this slot.
+
+    ### Args:
+        - `update`: list | dict | TelegramUpdatePing | TelegramUpdateNewMember
+            The payload made by `encode_update`, or a raw or parsed update from tasks queued before it.
+
+    ### Returns:
+        - `str`
+            Confirmation that the update was scheduled. The update's own result is logged by the event loop worker.
+
+    ### How does the function work:
+        - Calls `submit_update`, which blocks only while the event loop already has `ASYNC_WORKER_MAX_IN_FLIGHT` updates in flight.
+        - Returns as soon as the update is scheduled so the slot can take the next one.
+        - The task is acknowledged once the update is scheduled, so updates still in flight when the process dies are lost, not redelivered.
+        - Best run with `--pool=solo`, so one process and one event loop keep hundreds of updates in flight.
+        - Hands the update's trace over with it, the event loop records the handling.
+    """
+
+    context = read_trace_context(self.request)
+    update = decode_update(update)
+    if (
+        COALESCE_ENABLED
+        and isinstance(update, TelegramUpdatePing)
+        and not is_noreply_message(update)
+    ):
+        with trace_segment(context, "coalesce_update", "worker"):
+            coalesce_update(update)
+        return "Update coalesced"
+
+    submit_update(update, trace_context=context)
+    return "Update submitted to event loop"
+
+
+def coalesce_update(update: TelegramUpdatePing):
+    """
+    ### Responsibility:
+        - Hold a user's message so a burst of messages gets one reply.
+
+    ### Args:
+        - `update`: TelegramUpdatePing
+            The user's message.
+
+    ### Returns:
+        - None
+
+    ### How does the function work:
+        - Buffers the update with `buffer_update`.
+        - The first message of a burst schedules `worker_flush_coalesced` `COALESCE_WINDOW` seconds later, on the chat's queue. Reaching `COALESCE_MAX_MESSAGES` schedules it right away.
+        - The flush continues the trace of the message that scheduled it.
+    """
+
+    payload = encode_update(update)
+    chat_id, user_id = update.message.chat.id, update.message.from_.id
+    count = buffer_update(chat_id, user_id, payload)
+    if count not in {1, COALESCE_MAX_MESSAGES}:
+        return
+
+    queue = get_update_queue(payload)
+    worker_flush_coalesced.apply_async(
+        (chat_id, user_id, queue),
+        countdown=COALESCE_WINDOW if count == 1 else 0,
+        queue=queue,
+        headers=get_trace_headers(),
+    )
+
+
+@celery_master.task(bind=True, name="flush_coalesced")
+def worker_flush_coalesced(self, chat_id: int, user_id: int, queue: str | None = None):
+    """
+    ### Responsibility:
+        - Answer a user's burst of messages once it's over, as one turn.
+
+    ### Args:
+        - `chat_id`: int
+            The chat the messages were sent in.
+        - `user_id`: int
+            The user who sent them.
+        - `queue`: str | None
+            The chat's queue, where the task reschedules itself.
+
+    ### Returns:
+        - `result`: AIResponse or str or None
+            The result of processing the burst.
+
+    ### How does the function work:
+        - Takes the buffered messages with `take_coalesced_updates`. If the user is still typing, reschedules itself for when the burst ends.
+        - Processes the last message with the earlier ones as `earlier`: they're recorded, and the reply to the last one is generated with them in the history and charged one credit.
+        - In `async` mode, hands the turn to the event loop worker instead.
+    """
+
+    context = read_trace_context(self.request)
+    wait, payloads = take_coalesced_updates(chat_id, user_id)
+    if wait:
+        self.apply_async(
+            (chat_id, user_id, queue),
+            countdown=wait,
+            queue=queue,
+            headers=build_trace_headers(context),
+        )
+        return "Burst still going"
+    if not payloads:
+        return "Nothing to flush"
+
+    updates = [decode_update(x) for x in payloads]
+    if WORKER_MODE == "async":
+        submit_update(updates[-1], updates[:-1], context)
+        return "Coalesced updates submitted to event loop"
+    with trace_segment(context, "flush_coalesced", "worker"):
+        return entry_process_message(updates[-1], updates[:-1])
+
+
+@celery_master.task(bind=True, name="maintain_message_partitions")
+def worker_maintain_message_partitions(self):
+    """
+    ### Responsibility:
+        - Keep MESSAGES partitioned ahead of time and archive the months past retention.
+
+    ### Args:
+        - None
+
+    ### Returns:
+        - `str`
+            Confirmation that the maintenance ran.
+
+    ### How does the function work:
+        - Calls `maintain_message_partitions`, which creates `PARTITION_MONTHS_AHEAD` months of partitions and archives those older than `PARTITION_RETENTION_MONTHS`.
+        - Scheduled every `PARTITION_MAINTENANCE_INTERVAL` seconds by `celery beat`. Every step is idempotent, so an overlapping or repeated run is harmless.
+    """
+
+    maintain_message_partitions()
+    return "Partitions maintained"
+
+
+@celery_master.task(bind=True, name="flush_activity")
+def worker_flush_activity(self):
+    """
+    ### Responsibility:
+        - Write the last seen times of users and chats to Postgres.
+
+    ### Args:
+        - None
+
+    ### Returns:
+        - `str`
+            The number of users and chats flushed.
+
+    ### How does the function work:
+        - Calls `flush_activity`, scheduled every `ACTIVITY_FLUSH_INTERVAL` seconds by `celery beat`.
+    """
+
+    users, chats = flush_activity()
+    return f"Flushed activity of {users} users and {chats} chats"
+
+
+def get_queue_depths() -> dict[str, int]:
+    """
+    ### Responsibility:
+        - Count the tasks waiting in each update queue, to scale workers on.
+
+    ### Args:
+        - None
+
+    ### Returns:
+        - `depths`: dict[str, int]
+            Queue names mapped to their number of waiting tasks.
+
+    ### How does the function work:
+        - Reads every lane shard queue with `SHARDED_QUEUES`, otherwise the default queue.
+        - Declares each queue passively on one broker connection, which returns its message count without creating it. A queue that doesn't exist yet counts as empty.
     """
 
-    if isinstance(update, TelegramUpdatePing):
-        result = entry_process_message(update)
-        return result
-    if isinstance(update, TelegramUpdateNewMember):
-        result = send_welcome_message(update)
-        return result
+    if SHARDED_QUEUES:
+        queues = [x for lane in Lanes for x in get_lane_queues(lane)]
     else:
-        raise AttributeError(f"Unknown update type: {type(update).__name__}: {update}")
+        queues = [celery_master.conf.task_default_queue]
+
+    depths = {}
+    with celery_master.connection_for_read() as conn:
+        channel = conn.channel()
+        for queue in queues:
+            try:
+                depths[queue] = channel.queue_declare(queue, passive=True).message_count
+            except ChannelError:
+                # AMQP closes the channel on a missing queue
+                depths[queue] = 0
+                channel = conn.channel()
+        channel.close()
+    return depths
+
+
+def enqueue_update(
+    update: dict | TelegramUpdatePing | TelegramUpdateNewMember,
+    producer=None,
+    headers: dict | None = None,
+):
+    """
+    ### Responsibility:
+        - Queue an update on the task selected by `WORKER_MODE`.
+
+    ### Args:
+        - `update`: dict | TelegramUpdatePing | TelegramUpdateNewMember
+            The raw or parsed Telegram update, encoded with `encode_update`.
+        - `producer`: kombu.Producer | None
+            A producer to publish with, so a batch of updates shares one broker connection. Defaults to one from the app's pool.
+        - `headers`: dict | None
+            Extra task headers, such as the trace from `get_trace_headers`.
+
+    ### Returns:
+        - `AsyncResult`
+            The Celery result handle of the queued task.
+
+    ### How does the function work:
+        - Encodes the update with `encode_update` and picks its queue with `get_update_queue`, the chat's lane shard when `SHARDED_QUEUES` is on and Celery's default queue otherwise.
+    """
+
+    task = (
+        worker_handle_update_async if WORKER_MODE == "async" else worker_handle_update
+    )
+    payload = encode_update(update)
+    queue = get_update_queue(payload)
+    return task.apply_async((payload,), producer=producer, headers=headers, queue=queue)
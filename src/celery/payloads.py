@@ -0,0 +1,214 @@
+"""
+Compact, versioned wire format of the update tasks
+"""
+
+import orjson
+from pydantic import BaseModel
+from kombu.serialization import register
+
+from src.telegram.updates import UpdateKinds, get_update_kind, parse_telegram_update
+from src.models.telegram_update_models import (
+    TelegramUpdatePing,
+    TelegramUpdateNewMember,
+)
+
+SERIALIZER_NAME = "orjson"
+SERIALIZER_CONTENT_TYPE = "application/x-orjson"
+
+# Bump when the layout below changes, and keep decoding the previous version
+# until the queues are drained of it
+PAYLOAD_VERSION = 1
+
+# Version 1 layouts, positional to keep the payload small:
+#   ping:       [version, "p", update_id, message_id, date, text, chat, from]
+#   new member: [version, "n", update_id, date, chat, from, new_member]
+#   chat:       [id, type, title]
+#   from:       [id, is_bot, first_name, last_name, username]
+#   new_member: [id, is_bot, first_name, username, language_code]
+_KIND_CODES = {UpdateKinds.PING: "p", UpdateKinds.NEW_MEMBER: "n"}
+
+
+def _orjson_default(obj):
+    if isinstance(obj, BaseModel):
+        return obj.model_dump(mode="json")
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+def orjson_dumps(obj) -> bytes:
+    """Serializes task messages and results, dumping pydantic models to JSON types"""
+
+    return orjson.dumps(obj, default=_orjson_default)
+
+
+register(
+    SERIALIZER_NAME,
+    orjson_dumps,
+    orjson.loads,
+    content_type=SERIALIZER_CONTENT_TYPE,
+    content_encoding="binary",
+)
+
+
+def _to_raw(update: dict | TelegramUpdatePing | TelegramUpdateNewMember) -> dict:
+    if isinstance(update, dict):
+        return update
+    raw = update.model_dump(mode="json")
+    message = raw["message"]
+    message["from"] = message.pop("from_")
+    return raw
+
+
+def _slim_chat(chat: dict) -> list:
+    return [chat["id"], chat["type"], chat.get("title") or chat.get("username")]
+
+
+def _slim_user(user: dict) -> list:
+    return [
+        user["id"],
+        user.get("is_bot", False),
+        user.get("first_name"),
+        user.get("last_name"),
+        user.get("username"),
+    ]
+
+
+def encode_update(update: dict | TelegramUpdatePing | TelegramUpdateNewMember) -> list:
+    """
+    ### Responsibility:
+        - Reduce an update to the fields the workers use, in the current `PAYLOAD_VERSION` layout.
+
+    ### Args:
+        - `update`: dict | TelegramUpdatePing | TelegramUpdateNewMember
+            A raw update from the webhook, or a parsed one.
+
+    ### Returns:
+        - `payload`: list
+            The slim update, serialized with orjson by the task serializer.
+
+    ### Raises:
+        - `AttributeError`:
+            Raised if the update isn't a kind the bot handles.
+
+    ### How does the function work:
+        - Converts parsed models back to Telegram's field names so both inputs share one code path.
+        - Keeps only the fields of the models in `telegram_update_models`, dropping entities, photos, reply markup and the rest of Telegram's payload.
+    """
+
+    raw = _to_raw(update)
+    kind = get_update_kind(raw)
+    message = raw["message"]
+
+    if kind == UpdateKinds.PING:
+        return [
+            PAYLOAD_VERSION,
+            _KIND_CODES[kind],
+            raw.get("update_id"),
+            message["message_id"],
+            message["date"],
+            message["text"],
+            _slim_chat(message["chat"]),
+            _slim_user(message["from"]),
+        ]
+    if kind == UpdateKinds.NEW_MEMBER:
+        member = message["new_chat_member"]
+        return [
+            PAYLOAD_VERSION,
+            _KIND_CODES[kind],
+            raw.get("update_id"),
+            message["date"],
+            _slim_chat(message["chat"]),
+            _slim_user(message["from"]),
+            [
+                member["id"],
+                member.get("is_bot", False),
+                member.get("first_name"),
+                member.get("username"),
+                member.get("language_code"),
+            ],
+        ]
+    raise AttributeError(f"Unknown update type: {update}")
+
+
+def get_payload_kind(payload: list) -> UpdateKinds:
+    """Returns the kind of an update payload without decoding it"""
+
+    return {v: k for k, v in _KIND_CODES.items()}[payload[1]]
+
+
+def get_payload_chat(payload: list) -> tuple[int, str]:
+    """Returns the chat ID and chat type of an update payload without decoding it"""
+
+    chat = payload[6] if get_payload_kind(payload) == UpdateKinds.PING else payload[4]
+    return chat[0], chat[1]
+
+
+def _chat_from_slim(chat: list) -> dict:
+    return {"id": chat[0], "type": chat[1], "title": chat[2]}
+
+
+def _user_from_slim(user: list) -> dict:
+    return dict(zip(("id", "is_bot", "first_name", "last_name", "username"), user))
+
+
+def decode_update(
+    payload: list | dict | TelegramUpdatePing | TelegramUpdateNewMember,
+) -> TelegramUpdatePing | TelegramUpdateNewMember:
+    """
+    ### Responsibility:
+        - Turn a task payload back into the model its handler expects.
+
+    ### Args:
+        - `payload`: list | dict | TelegramUpdatePing | TelegramUpdateNewMember
+            A payload made by `encode_update`, or a raw or pickled update from tasks queued before the versioned format.
+
+    ### Returns:
+        - `update`: TelegramUpdatePing | TelegramUpdateNewMember
+            The validated update.
+
+    ### Raises:
+        - `ValueError`:
+            Raised if the payload version isn't supported.
+        - `AttributeError`:
+            Raised if the update isn't a kind the bot handles.
+    """
+
+    if not isinstance(payload, list):
+        return parse_telegram_update(payload)
+
+    version, kind = payload[0], payload[1]
+    if version != PAYLOAD_VERSION:
+        raise ValueError(f"Unsupported update payload version: {version}")
+
+    if kind == _KIND_CODES[UpdateKinds.PING]:
+        _, _, update_id, message_id, date, text, chat, user = payload
+        return TelegramUpdatePing.model_validate(
+            {
+                "update_id": update_id,
+                "message": {
+                    "message_id": message_id,
+                    "from": _user_from_slim(user),
+                    "chat": _chat_from_slim(chat),
+                    "date": date,
+                    "text": text,
+                },
+            }
+        )
+    if kind == _KIND_CODES[UpdateKinds.NEW_MEMBER]:
+        _, _, update_id, date, chat, user, member = payload
+        return TelegramUpdateNewMember.model_validate(
+            {
+                "update_id": update_id,
+                "message": {
+                    "new_chat_member": dict(
+                        zip(
+                            ("id", "is_bot", "first_name", "username", "language_code"),
+                            member,
+                        )
+                    ),
+                    "from": _user_from_slim(user),
+                    "chat": _chat_from_slim(chat),
+                    "date": date,
+                },
+            }
+        )
+    raise AttributeError(f"Unknown update payload kind: {kind}")
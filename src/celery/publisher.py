@@ -0,0 +1,120 @@
+"""
+Non blocking publisher that batches updates onto the broker
+"""
+
+# pylint:disable=wrong-import-position
+
+import os
+import asyncio
+import random
+
+from rich import print
+from wrapworks import cwdtoenv
+from dotenv import load_dotenv
+
+cwdtoenv()
+load_dotenv()
+
+from src.celery.main_queue import celery_master, enqueue_update
+from src.core.metrics import DROPPED_UPDATES
+
+PUBLISH_BATCH_SIZE = int(os.getenv("PUBLISH_BATCH_SIZE", "100"))
+# Updates waiting to be published. When full, the API asks Telegram to redeliver
+PUBLISH_QUEUE_SIZE = int(os.getenv("PUBLISH_QUEUE_SIZE", "10000"))
+# Telegram won't resend an update we answered, so a batch is retried before it's dropped
+PUBLISH_MAX_RETRIES = int(os.getenv("PUBLISH_MAX_RETRIES", "5"))
+PUBLISH_BACKOFF_BASE = float(os.getenv("PUBLISH_BACKOFF_BASE", "0.5"))
+PUBLISH_BACKOFF_CAP = float(os.getenv("PUBLISH_BACKOFF_CAP", "10"))
+
+
+class UpdatePublisher:
+    """
+    Moves broker publishing off the request path of the ingestion API.
+
+    `publish` only puts the update on an in-memory queue, so the endpoint can
+    answer Telegram straight away. A background task takes whatever is queued,
+    up to `batch_size` updates, and publishes the batch on a worker thread with
+    one producer, so a burst costs one broker connection checkout per batch
+    instead of one per update and never blocks the event loop.
+
+    A batch that fails to publish is retried with backoff before anything
+    else is taken from the queue, keeping the updates in order. Only the
+    updates still unpublished after `max_retries` are dropped, and counted.
+    """
+
+    def __init__(self, batch_size: int, max_queued: int, max_retries: int):
+        self.batch_size = batch_size
+        self.max_queued = max_queued
+        self.max_retries = max_retries
+        self.queue: asyncio.Queue | None = None
+        self.task: asyncio.Task | None = None
+
+    def start(self):
+        """Start the background publishing task on the running loop"""
+
+        if self.task and not self.task.done():
+            return
+        self.queue = asyncio.Queue(self.max_queued)
+        self.task = asyncio.create_task(self._run(), name="update-publisher")
+
+    def publish(self, update: dict, headers: dict | None = None) -> bool:
+        """Queue an update and its task headers for publishing, returns False if the queue is full"""
+
+        try:
+            self.queue.put_nowait((update, headers))
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    async def _run(self):
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            size = len(batch)
+            try:
+                await self._publish_with_retry(batch)
+            finally:
+                for _ in range(size):
+                    self.queue.task_done()
+
+    async def _publish_with_retry(self, batch: list[tuple[dict, dict | None]]):
+        for attempt in range(self.max_retries + 1):
+            try:
+                await asyncio.to_thread(self._publish_batch, batch)
+                return
+            except Exception as e:
+                print(
+                    f"Couldn't publish {len(batch)} updates, attempt {attempt + 1}: {type(e).__name__}: {e}"
+                )
+            if attempt < self.max_retries:
+                await asyncio.sleep(
+                    random.uniform(
+                        0, min(PUBLISH_BACKOFF_CAP, PUBLISH_BACKOFF_BASE * 2**attempt)
+                    )
+                )
+
+        print(f"Dropping {len(batch)} updates after {self.max_retries} retries")
+        DROPPED_UPDATES.inc(len(batch))
+
+    def _publish_batch(self, batch: list[tuple[dict, dict | None]]):
+        # Removes each update once published, so a retry doesn't publish it twice
+        with celery_master.producer_or_acquire() as producer:
+            while batch:
+                update, headers = batch[0]
+                enqueue_update(update, producer=producer, headers=headers)
+                batch.pop(0)
+
+    async def stop(self):
+        """Publish what's still queued and stop the background task"""
+
+        if not self.task:
+            return
+        await self.queue.join()
+        self.task.cancel()
+        self.task = None
+
+
+UPDATE_PUBLISHER = UpdatePublisher(
+    PUBLISH_BATCH_SIZE, PUBLISH_QUEUE_SIZE, PUBLISH_MAX_RETRIES
+)
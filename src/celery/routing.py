@@ -0,0 +1,93 @@
+"""
+Routing of update tasks onto chat sharded queues, one set of shards per priority lane
+"""
+
+import os
+import sys
+import zlib
+from enum import Enum
+
+from dotenv import load_dotenv
+
+from src.celery.payloads import get_payload_chat, get_payload_kind
+from src.telegram.updates import UpdateKinds
+
+load_dotenv()
+
+
+class Lanes(Enum):
+    PRIVATE = "private"
+    GROUP = "group"
+    # Welcome messages and other work that doesn't call the LLM
+    SYSTEM = "system"
+
+
+# When off, every update goes to Celery's default queue as before
+SHARDED_QUEUES = os.getenv("SHARDED_QUEUES", "false").lower() == "true"
+
+LANE_SHARDS = {
+    Lanes.PRIVATE: int(os.getenv("PRIVATE_QUEUE_SHARDS", "4")),
+    Lanes.GROUP: int(os.getenv("GROUP_QUEUE_SHARDS", "4")),
+    Lanes.SYSTEM: int(os.getenv("SYSTEM_QUEUE_SHARDS", "1")),
+}
+
+
+def get_queue_name(lane: Lanes, shard: int) -> str:
+    """Returns the name of a lane's shard queue"""
+
+    return f"updates.{lane.value}.{shard}"
+
+
+def get_payload_lane(payload: list) -> Lanes:
+    """Returns the lane of an update payload made by `encode_update`"""
+
+    if get_payload_kind(payload) != UpdateKinds.PING:
+        return Lanes.SYSTEM
+    _, chat_type = get_payload_chat(payload)
+    return Lanes.PRIVATE if chat_type == "private" else Lanes.GROUP
+
+
+def get_chat_shard(chat_id: int, shards: int) -> int:
+    """Returns the shard of a chat, stable across processes and restarts"""
+
+    # crc32 rather than hash(), which is salted per process
+    return zlib.crc32(str(chat_id).encode()) % shards
+
+
+def get_update_queue(payload: list) -> str | None:
+    """
+    ### Responsibility:
+        - Pick the queue of an update so all updates of a chat go through the same queue, in order.
+
+    ### Args:
+        - `payload`: list
+            The update payload made by `encode_update`.
+
+    ### Returns:
+        - `queue`: str | None
+            The shard queue of the update's lane and chat, or None to use the default queue when `SHARDED_QUEUES` is off.
+
+    ### How does the function work:
+        - Picks the lane from the update kind and chat type, so welcome messages, private chats and groups can be given their own workers.
+        - Hashes the chat ID onto one of the lane's `*_QUEUE_SHARDS` queues.
+        - Order within a chat holds as long as each shard queue is consumed by a single slot: one `--concurrency=1` worker in sync mode, or one event loop worker in async mode, which serializes each chat itself.
+    """
+
+    if not SHARDED_QUEUES:
+        return None
+
+    lane = get_payload_lane(payload)
+    chat_id, _ = get_payload_chat(payload)
+    return get_queue_name(lane, get_chat_shard(chat_id, LANE_SHARDS[lane]))
+
+
+def get_lane_queues(lane: Lanes) -> list[str]:
+    """Returns every shard queue of a lane"""
+
+    return [get_queue_name(lane, x) for x in range(LANE_SHARDS[lane])]
+
+
+if __name__ == "__main__":
+    # Prints the queues of the lanes given as arguments, for a worker's -Q option
+    lanes = [Lanes(x) for x in sys.argv[1:]] or list(Lanes)
+    print(",".join(x for lane in lanes for x in get_lane_queues(lane)))
@@ -0,0 +1,127 @@
+"""
+Debounce buffer that merges a burst of messages from one user into a single turn
+"""
+
+# pylint:disable=wrong-import-position
+
+import os
+import time
+
+import orjson
+from wrapworks import cwdtoenv
+from dotenv import load_dotenv
+
+cwdtoenv()
+load_dotenv()
+
+from src.cache.core_redis_operations import REDIS_CLIENT
+
+# When on, a user's messages are held for `COALESCE_WINDOW` seconds after the last one
+COALESCE_ENABLED = os.getenv("COALESCE_ENABLED", "false").lower() == "true"
+COALESCE_WINDOW = float(os.getenv("COALESCE_WINDOW", "2"))
+# A burst is answered after this long even if the user keeps typing
+COALESCE_MAX_WAIT = float(os.getenv("COALESCE_MAX_WAIT", "8"))
+COALESCE_MAX_MESSAGES = int(os.getenv("COALESCE_MAX_MESSAGES", "5"))
+
+# KEYS: updates, meta
+# ARGV: payload, now, ttl
+# Returns the number of buffered updates
+BUFFER_SCRIPT = """
+redis.call('RPUSH', KEYS[1], ARGV[1])
+redis.call('HSETNX', KEYS[2], 'first_at', ARGV[2])
+redis.call('HSET', KEYS[2], 'last_at', ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+return redis.call('LLEN', KEYS[1])
+"""
+
+# KEYS: updates, meta
+# ARGV: now, window, max wait, max messages
+# Returns {'wait', milliseconds} while the burst is still going, otherwise
+# {'take', payloads...} and empties the buffer. Empty if nothing is buffered
+TAKE_SCRIPT = """
+local count = redis.call('LLEN', KEYS[1])
+if count == 0 then
+    return {}
+end
+local now = tonumber(ARGV[1])
+local first_at = tonumber(redis.call('HGET', KEYS[2], 'first_at')) or now
+local last_at = tonumber(redis.call('HGET', KEYS[2], 'last_at')) or now
+if count < tonumber(ARGV[4]) then
+    local wait = math.min(last_at + tonumber(ARGV[2]), first_at + tonumber(ARGV[3])) - now
+    if wait > 0 then
+        return {'wait', tostring(math.ceil(wait * 1000))}
+    end
+end
+local payloads = redis.call('LRANGE', KEYS[1], 0, -1)
+redis.call('DEL', KEYS[1], KEYS[2])
+table.insert(payloads, 1, 'take')
+return payloads
+"""
+
+_BUFFER = REDIS_CLIENT.register_script(BUFFER_SCRIPT)
+_TAKE = REDIS_CLIENT.register_script(TAKE_SCRIPT)
+
+
+def get_coalesce_keys(chat_id: int, user_id: int) -> list[str]:
+    prefix = f"coalesce:{chat_id}:{user_id}"
+    return [f"{prefix}:updates", f"{prefix}:meta"]
+
+
+def buffer_update(chat_id: int, user_id: int, payload: list) -> int:
+    """
+    ### Responsibility:
+        - Hold a user's message until their burst of messages is over.
+
+    ### Args:
+        - `chat_id`: int
+            The chat the message was sent in.
+        - `user_id`: int
+            The user who sent it.
+        - `payload`: list
+            The update, encoded with `encode_update`.
+
+    ### Returns:
+        - `count`: int
+            The number of messages now buffered for the user. The caller schedules a flush when it's 1, and right away once it reaches `COALESCE_MAX_MESSAGES`.
+    """
+
+    return _BUFFER(
+        keys=get_coalesce_keys(chat_id, user_id),
+        args=[
+            orjson.dumps(payload),
+            time.time(),
+            int(COALESCE_MAX_WAIT + COALESCE_WINDOW) + 60,
+        ],
+    )
+
+
+def take_coalesced_updates(chat_id: int, user_id: int) -> tuple[float, list[list]]:
+    """
+    ### Responsibility:
+        - Take a user's buffered messages once their burst is over.
+
+    ### Args:
+        - `chat_id`: int
+            The chat the messages were sent in.
+        - `user_id`: int
+            The user who sent them.
+
+    ### Returns:
+        - `result`: tuple[float, list[list]]
+            The seconds to wait before trying again and no payloads while the burst goes on, otherwise 0 and the payloads in the order they arrived. Both are empty if another flush already took them.
+
+    ### How does the function work:
+        - The burst is over `COALESCE_WINDOW` seconds after the last message, `COALESCE_MAX_WAIT` seconds after the first, or at `COALESCE_MAX_MESSAGES` messages.
+        - Reads and deletes the buffer in one script, so concurrent flushes never answer a message twice.
+    """
+
+    result = _TAKE(
+        keys=get_coalesce_keys(chat_id, user_id),
+        args=[time.time(), COALESCE_WINDOW, COALESCE_MAX_WAIT, COALESCE_MAX_MESSAGES],
+    )
+    if not result:
+        return 0, []
+    if result[0] == "wait":
+        return int(result[1]) / 1000, []
+    return 0, [orjson.loads(x) for x in result[1:]]
@@ -0,0 +1,304 @@
+"""
+Long lived HTTP clients for the upstream APIs we call
+"""
+
+import os
+import random
+import time
+import asyncio
+import importlib.util
+from enum import Enum
+from typing import Callable
+
+import httpx
+from rich import print
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+class Upstreams(Enum):
+    OPENAI = "openai"
+    TELEGRAM = "telegram"
+
+
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "false").lower() == "true"
+if HTTP2_ENABLED and not importlib.util.find_spec("h2"):
+    print("HTTP2_ENABLED is set but the `h2` package isn't installed, using HTTP/1.1")
+    HTTP2_ENABLED = False
+
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "2"))
+HTTP_BACKOFF_BASE = float(os.getenv("HTTP_BACKOFF_BASE", "0.2"))
+HTTP_BACKOFF_CAP = float(os.getenv("HTTP_BACKOFF_CAP", "5"))
+
+UPSTREAM_SETTINGS = {
+    Upstreams.OPENAI: {
+        # Pointed at `benchmarks/fake_upstreams.py` for load tests
+        "base_url": os.getenv("OPENAI_BASE_URL", "https://api.openai.com"),
+        "timeout": httpx.Timeout(
+            float(os.getenv("OPENAI_HTTP_TIMEOUT", "120")),
+            connect=float(os.getenv("HTTP_CONNECT_TIMEOUT", "5")),
+        ),
+        "limits": httpx.Limits(
+            max_connections=int(os.getenv("OPENAI_HTTP_MAX_CONNECTIONS", "50")),
+            max_keepalive_connections=int(os.getenv("OPENAI_HTTP_MAX_KEEPALIVE", "20")),
+            keepalive_expiry=float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60")),
+        ),
+        # OpenAI doesn't process requests answered with these, so resending is safe
+        "retry_statuses": {429, 500, 502, 503, 504},
+    },
+    Upstreams.TELEGRAM: {
+        "base_url": os.getenv("TELEGRAM_BASE_URL", "https://api.telegram.org"),
+        "timeout": httpx.Timeout(
+            float(os.getenv("TELEGRAM_HTTP_TIMEOUT", "30")),
+            connect=float(os.getenv("HTTP_CONNECT_TIMEOUT", "5")),
+        ),
+        "limits": httpx.Limits(
+            max_connections=int(os.getenv("TELEGRAM_HTTP_MAX_CONNECTIONS", "50")),
+            max_keepalive_connections=int(
+                os.getenv("TELEGRAM_HTTP_MAX_KEEPALIVE", "20")
+            ),
+            keepalive_expiry=float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60")),
+        ),
+        # A resent sendMessage shows up twice in the chat, so only retry unsent requests
+        "retry_statuses": set(),
+    },
+}
+
+# Errors raised before the request reached the upstream, so retrying can't duplicate it
+RETRYABLE_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+_CLIENTS: dict[Upstreams, httpx.Client] = {}
+# Async clients are bound to the loop that created them
+_ASYNC_CLIENTS: dict[Upstreams, tuple] = {}
+_CLIENTS_PID = os.getpid()
+
+
+def _forget_clients():
+    """
+    ### Responsibility:
+        - Drop the clients inherited from a parent process after a fork.
+
+    ### How does the function work:
+        - Clears both registries without closing the clients, since closing would shut down sockets the parent is still using.
+        - Records the current pid so `get_http_client` can detect forks that bypass `os.register_at_fork`.
+    """
+
+    global _CLIENTS_PID
+
+    _CLIENTS.clear()
+    _ASYNC_CLIENTS.clear()
+    _CLIENTS_PID = os.getpid()
+
+
+os.register_at_fork(after_in_child=_forget_clients)
+
+
+def _client_kwargs(upstream: Upstreams) -> dict:
+    settings = UPSTREAM_SETTINGS[upstream]
+    return {
+        "base_url": settings["base_url"],
+        "timeout": settings["timeout"],
+        "limits": settings["limits"],
+        "http2": HTTP2_ENABLED,
+    }
+
+
+def get_http_client(upstream: Upstreams) -> httpx.Client:
+    """
+    ### Responsibility:
+        - Return the long lived, connection pooling client of an upstream for the current process.
+
+    ### Args:
+        - `upstream`: Upstreams
+            The API the client talks to.
+
+    ### Returns:
+        - `client`: httpx.Client
+            A client with the upstream's base url, timeouts and connection limits.
+
+    ### How does the function work:
+        - Drops inherited clients if the process was forked since they were created.
+        - Creates the client on first use and reuses it afterwards, so DNS, TCP and TLS setup happen once per connection instead of once per request.
+    """
+
+    if _CLIENTS_PID != os.getpid():
+        _forget_clients()
+
+    if upstream not in _CLIENTS:
+        _CLIENTS[upstream] = httpx.Client(**_client_kwargs(upstream))
+    return _CLIENTS[upstream]
+
+
+def get_async_http_client(upstream: Upstreams) -> httpx.AsyncClient:
+    """
+    ### Responsibility:
+        - Async counterpart of `get_http_client`, one client per upstream for the running event loop.
+
+    ### Args:
+        - `upstream`: Upstreams
+            The API the client talks to.
+
+    ### Returns:
+        - `client`: httpx.AsyncClient
+            A client bound to the running loop.
+    """
+
+    if _CLIENTS_PID != os.getpid():
+        _forget_clients()
+
+    loop = asyncio.get_running_loop()
+    cached = _ASYNC_CLIENTS.get(upstream)
+    if not cached or cached[0] is not loop:
+        cached = (loop, httpx.AsyncClient(**_client_kwargs(upstream)))
+        _ASYNC_CLIENTS[upstream] = cached
+    return cached[1]
+
+
+def get_backoff_delay(attempt: int, response: httpx.Response | None = None) -> float:
+    """
+    ### Responsibility:
+        - Compute how long to wait before the next attempt.
+
+    ### Args:
+        - `attempt`: int
+            The number of the attempt that just failed, starting at 0.
+        - `response`: httpx.Response | None
+            The failed response, if there was one.
+
+    ### Returns:
+        - `delay`: float
+            Seconds to sleep.
+
+    ### How does the function work:
+        - Honors a numeric `Retry-After` header if the upstream sent one.
+        - Otherwise uses full jitter exponential backoff capped at `HTTP_BACKOFF_CAP`, so retrying workers don't hit the upstream in lockstep.
+    """
+
+    if response is not None:
+        retry_after = response.headers.get("retry-after")
+        if retry_after and retry_after.replace(".", "", 1).isdigit():
+            return min(float(retry_after), HTTP_BACKOFF_CAP)
+
+    return random.uniform(0, min(HTTP_BACKOFF_CAP, HTTP_BACKOFF_BASE * 2**attempt))
+
+
+def request_with_retry(
+    upstream: Upstreams,
+    method: str,
+    url: str,
+    can_retry: Callable[[], bool] | None = None,
+    stream: bool = False,
+    **kwargs,
+) -> httpx.Response:
+    """
+    ### Responsibility:
+        - Send a request through the upstream's shared client, retrying failures that are safe to retry.
+
+    ### Args:
+        - `upstream`: Upstreams
+            The API to call.
+        - `method`: str
+            The HTTP method.
+        - `url`: str
+            The path, relative to the upstream's base url.
+        - `can_retry`: Callable[[], bool] | None
+            Asked before every retry, a retry budget can refuse it so the last response or error is returned straight away.
+        - `stream`: bool
+            Return as soon as the headers arrive, with the body left to read. The caller closes the response.
+        - `**kwargs`:
+            Passed on to `httpx.Client.build_request` (json, params, headers, timeout...).
+
+    ### Returns:
+        - `response`: httpx.Response
+            The last response received.
+
+    ### Raises:
+        - `httpx.TransportError`:
+            Raised if the last attempt failed without a response.
+
+    ### How does the function work:
+        - Retries up to `HTTP_MAX_RETRIES` times on errors raised before the request was sent, and on the upstream's `retry_statuses`.
+        - Sleeps with `get_backoff_delay` between attempts, closing a streamed response that's retried.
+    """
+
+    client = get_http_client(upstream)
+    retry_statuses = UPSTREAM_SETTINGS[upstream]["retry_statuses"]
+
+    for attempt in range(HTTP_MAX_RETRIES + 1):
+        is_last = attempt == HTTP_MAX_RETRIES
+        try:
+            response = client.send(
+                client.build_request(method, url, **kwargs), stream=stream
+            )
+        except RETRYABLE_ERRORS as e:
+            if is_last or (can_retry and not can_retry()):
+                raise
+            print(f"{upstream.value} request failed, retrying: {type(e).__name__}")
+            time.sleep(get_backoff_delay(attempt))
+            continue
+
+        if response.status_code not in retry_statuses or is_last:
+            return response
+        if can_retry and not can_retry():
+            return response
+        print(f"{upstream.value} returned {response.status_code}, retrying")
+        response.close()
+        time.sleep(get_backoff_delay(attempt, response))
+
+    return response
+
+
+async def async_request_with_retry(
+    upstream: Upstreams,
+    method: str,
+    url: str,
+    can_retry: Callable[[], bool] | None = None,
+    stream: bool = False,
+    **kwargs,
+) -> httpx.Response:
+    """Async variant of `request_with_retry` using `get_async_http_client`"""
+
+    client = get_async_http_client(upstream)
+    retry_statuses = UPSTREAM_SETTINGS[upstream]["retry_statuses"]
+
+    for attempt in range(HTTP_MAX_RETRIES + 1):
+        is_last = attempt == HTTP_MAX_RETRIES
+        try:
+            response = await client.send(
+                client.build_request(method, url, **kwargs), stream=stream
+            )
+        except RETRYABLE_ERRORS as e:
+            if is_last or (can_retry and not can_retry()):
+                raise
+            print(f"{upstream.value} request failed, retrying: {type(e).__name__}")
+            await asyncio.sleep(get_backoff_delay(attempt))
+            continue
+
+        if response.status_code not in retry_statuses or is_last:
+            return response
+        if can_retry and not can_retry():
+            return response
+        print(f"{upstream.value} returned {response.status_code}, retrying")
+        await response.aclose()
+        await asyncio.sleep(get_backoff_delay(attempt, response))
+
+    return response
+
+
+def close_http_clients():
+    """Close this process's sync clients"""
+
+    for client in _CLIENTS.values():
+        client.close()
+    _CLIENTS.clear()
+
+
+async def close_async_http_clients():
+    """Close this process's async clients that belong to the running loop"""
+
+    loop = asyncio.get_running_loop()
+    for upstream, (client_loop, client) in list(_ASYNC_CLIENTS.items()):
+        if client_loop is loop:
+            await client.aclose()
+            del _ASYNC_CLIENTS[upstream]
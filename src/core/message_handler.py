@@ -4,6 +4,8 @@ Main handler of messages
 
 # pylint:disable=wrong-import-position
 
+import os
+
 from fastapi import FastAPI
 import uvicorn
 from wrapworks import cwdtoenv
@@ -13,60 +15,184 @@ from rich import print
 cwdtoenv()
 load_dotenv()
 
-from src.genai.generate_message import entry_generate_response_from_user_message
-from src.telegram.send_message import send_message
-from src.postgres.insert_functions import insert_user, insert_chat, insert_message
-from src.postgres.select_functions import (
-    check_if_chat_is_authorized,
-    check_if_user_has_credits,
+from src.genai.generate_message import (
+    entry_generate_response_from_user_message,
+    async_entry_generate_response_from_user_message,
+    entry_stream_response_from_user_message,
+    async_entry_stream_response_from_user_message,
+)
+from src.telegram.send_message import (
+    send_message,
+    async_send_message,
+    StreamingReply,
+    AsyncStreamingReply,
+)
+from src.postgres.insert_functions import insert_turn, async_insert_turn
+from src.cache.chat_settings_cache import (
+    get_cached_chat_settings,
+    async_get_cached_chat_settings,
 )
+from src.telegram.outbox import (
+    OUTBOX_ENABLED,
+    build_reply_outbox_message,
+    enqueue_outbox_message,
+    async_enqueue_outbox_message,
+    acquire_send_token,
+    async_acquire_send_token,
+)
+from src.cache.history_buffer import append_history, async_append_history
+from src.cache.credit_counters import (
+    reserve_credit,
+    commit_credit,
+    refund_credit,
+    async_reserve_credit,
+    async_commit_credit,
+    async_refund_credit,
+)
+from src.core.metrics import Stages, Outcomes, time_stage, record_outcome
 
 from src.models.telegram_update_models import TelegramUpdatePing, ChatType
 from src.models.gen_ai_models import LLMRoles, AIResponse
 
+NOT_AUTHORIZED_TEXT = """دوست عزیز، برای استفاده از چت شخصی با ربات شما نیاز به پرداخت حق عضویت دارید. برای اطلاعات بیشتر به این آیدی پیام بدین
+@NaturalEnglish_Admin"""
 
-def record_message_in_db(
-    updates: TelegramUpdatePing,
-    role: LLMRoles = LLMRoles.USER,
-    cost=0,
-    input_tokens=0,
-    output_tokens=0,
-    was_tagged=False,
-):
+# Show replies while they're generated instead of after the whole completion
+STREAMING_ENABLED = os.getenv("STREAMING_ENABLED", "false").lower() == "true"
+
+
+def get_out_of_credits_text(update: TelegramUpdatePing) -> str:
+    """Returns the message that tells a user they've used all their credits"""
+
+    return f"⚠️ Sorry @{update.message.from_.username or update.message.from_.first_name}, you've used all your credits for today⏳ Please wait till tomorrow to try agian 🌞"
+
+
+def send_notice(update: TelegramUpdatePing, text: str):
+    """Replies with a fixed text, through the outbox when `OUTBOX_ENABLED` is set"""
+
+    if OUTBOX_ENABLED:
+        enqueue_outbox_message(build_reply_outbox_message(update, text))
+    else:
+        send_message(update, text)
+
+
+async def async_send_notice(update: TelegramUpdatePing, text: str):
+    """Async variant of `send_notice`"""
+
+    if OUTBOX_ENABLED:
+        await async_enqueue_outbox_message(build_reply_outbox_message(update, text))
+    else:
+        await async_send_message(update, text)
+
+
+def is_noreply_message(update: TelegramUpdatePing) -> bool:
+    """Checks if a group message asked the bot not to reply"""
+
+    return (
+        update.message.chat.type in {ChatType.SUPERGROUP, ChatType.GROUP}
+        and "#noreply" in update.message.text.lower()
+    )
+
+
+def record_message_in_db(updates: TelegramUpdatePing):
     """
     ### Responsibility:
-        - Record a message and its associated details into the database.
+        - Record a message that didn't get an AI reply into the database.
         - Insert user and chat information into the database if they do not already exist.
 
     ### Args:
         - `updates`: TelegramUpdatePing
             An object containing update information including user, chat, and message details.
-        - `role`: LLMRoles, optional
-            The role of the message sender, default is `LLMRoles.USER`.
-        - `cost`: int, optional
-            The cost associated with processing the message, default is 0.
-        - `input_tokens`: int, optional
-            The number of input tokens used, default is 0.
-        - `output_tokens`: int, optional
-            The number of output tokens generated, default is 0.
-        - `was_tagged`: bool, optional
-            Whether the message was tagged, default is False.
 
     ### Returns:
         - None
 
     ### How does the function work:
-        - Inserts user information into the database using `insert_user`.
-        - Inserts chat information into the database using `insert_chat`.
-        - Inserts the message and its associated details into the database using `insert_message`.
+        - Calls `insert_turn` without a reply, which writes the user, chat and message in one transaction.
+        - Adds the message to the conversation's history buffer with `append_history`.
+    """
+
+    insert_turn(updates.message)
+    append_history(
+        updates.message.chat.id,
+        updates.message.from_.id,
+        [(LLMRoles.USER, updates.message.text)],
+    )
+
+
+def record_turn_in_db(
+    update: TelegramUpdatePing, reply_data: TelegramUpdatePing, response: AIResponse
+):
+    """
+    ### Responsibility:
+        - Record a user's tagged message and the AI reply to it into the database as one exchange.
+
+    ### Args:
+        - `update`: TelegramUpdatePing
+            The update holding the user's message.
+        - `reply_data`: TelegramUpdatePing
+            The update Telegram returned for the bot's reply.
+        - `response`: AIResponse
+            The generated response, used for cost and token counts.
+
+    ### Returns:
+        - None
+
+    ### How does the function work:
+        - Calls `insert_turn` with both messages so users, chat, user message and reply are written in a single transaction.
+        - Stores cost and token counts on the user message and marks it as tagged so it counts against credits.
+        - Adds both messages to the conversation's history buffer with `append_history`.
     """
 
-    insert_user(updates.message.from_)
-    insert_chat(updates.message.chat)
-    insert_message(updates.message, role, cost, input_tokens, output_tokens, was_tagged)
+    insert_turn(
+        update.message,
+        reply_data.message,
+        cost=response.cost,
+        input_tokens=response.input_tokens,
+        output_tokens=response.output_tokens,
+        was_tagged=True,
+    )
+    append_history(
+        update.message.chat.id,
+        update.message.from_.id,
+        [(LLMRoles.USER, update.message.text), (LLMRoles.AI, reply_data.message.text)],
+    )
+
+
+async def async_record_message_in_db(updates: TelegramUpdatePing):
+    """Async variant of `record_message_in_db`"""
+
+    await async_insert_turn(updates.message)
+    await async_append_history(
+        updates.message.chat.id,
+        updates.message.from_.id,
+        [(LLMRoles.USER, updates.message.text)],
+    )
+
+
+async def async_record_turn_in_db(
+    update: TelegramUpdatePing, reply_data: TelegramUpdatePing, response: AIResponse
+):
+    """Async variant of `record_turn_in_db`"""
+
+    await async_insert_turn(
+        update.message,
+        reply_data.message,
+        cost=response.cost,
+        input_tokens=response.input_tokens,
+        output_tokens=response.output_tokens,
+        was_tagged=True,
+    )
+    await async_append_history(
+        update.message.chat.id,
+        update.message.from_.id,
+        [(LLMRoles.USER, update.message.text), (LLMRoles.AI, reply_data.message.text)],
+    )
 
 
-def entry_process_message(update: TelegramUpdatePing) -> AIResponse:
+def entry_process_message(
+    update: TelegramUpdatePing, earlier: list[TelegramUpdatePing] | None = None
+) -> AIResponse:
     """
     ### Responsibility:
         - Process a Telegram message update and generate a response if the chat and user are authorized and have credits.
@@ -75,6 +201,8 @@ def entry_process_message(update: TelegramUpdatePing) -> AIResponse:
     ### Args:
         - `update`: TelegramUpdatePing
             An object containing update information including chat, user, and message details.
+        - `earlier`: list[TelegramUpdatePing] | None
+            Messages the user sent just before `update` that were coalesced into this turn, see `coalescer`.
 
     ### Returns:
         - `response`: AIResponse or str
@@ -82,52 +210,151 @@ def entry_process_message(update: TelegramUpdatePing) -> AIResponse:
             Returns a string with a message indicating the result if the chat is not authorized, an ignore command is found, or the user doesn't have credits.
 
     ### How does the function work:
-        - Checks if the chat is authorized using `check_if_chat_is_authorized`. If not, sends an authorization message and records the message in the database.
+        - Records the `earlier` messages of a coalesced burst as plain messages first, so they are in `MESSAGES` and in the history the reply is generated from.
+        - Checks if the chat is authorized using the cached chat settings from `get_cached_chat_settings`. If not, sends an authorization message with `send_notice` and records the message in the database.
         - Checks if the chat type is a SUPERGROUP or GROUP and if the text contains the "#noreply" command. If found, records the message in the database and returns.
-        - Checks if the user has credits using `check_if_user_has_credits`. If not, sends a message indicating the usage limit and records the message in the database.
+        - Reserves one of the user's daily credits with `reserve_credit` against the cached daily allowance, once for the whole coalesced turn. If none is left, sends a message indicating the usage limit and records the message in the database.
         - Calls `entry_generate_response_from_user_message` to generate a response if all checks pass.
-        - Sends the generated response message.
-        - Records both the user's message and the generated response in the database with their associated details.
+        - With `STREAMING_ENABLED`, streams the response and shows it progressively with `StreamingReply` instead. With `OUTBOX_ENABLED` as well, the streamed sends and edits take tokens from the outbox's rate limits.
+        - With `OUTBOX_ENABLED`, queues the response in the outbox and returns as soon as it's queued. The outbox sender delivers it and records the exchange.
+        - Sends the generated response message, then commits the credit. If generating or sending fails, the credit is refunded.
+        - Records both the user's message and the generated response in the database in a single transaction.
+        - Times the authorization and credit checks and counts how the message ended, see `src.core.metrics`.
     """
-    
-    is_authorized = check_if_chat_is_authorized(update.message.chat.id)
-    if not is_authorized:
-        send_message(
-            update,
-            """دوست عزیز، برای استفاده از چت شخصی با ربات شما نیاز به پرداخت حق عضویت دارید. برای اطلاعات بیشتر به این آیدی پیام بدین
-@NaturalEnglish_Admin""",
-        )
+
+    for x in earlier or []:
+        record_message_in_db(x)
+
+    with time_stage(Stages.AUTH_CHECK):
+        settings = get_cached_chat_settings(update.message.chat.id)
+    if not settings.is_authorized:
+        send_notice(update, NOT_AUTHORIZED_TEXT)
         record_message_in_db(update)
+        record_outcome(Outcomes.UNAUTHORIZED)
         return "Chat Not Authorized"
 
-    if update.message.chat.type in {ChatType.SUPERGROUP, ChatType.GROUP}:
-        if "#noreply" in update.message.text.lower():
-            record_message_in_db(update)
-            return "Ignore message command found"
+    if is_noreply_message(update):
+        record_message_in_db(update)
+        record_outcome(Outcomes.NOREPLY)
+        return "Ignore message command found"
 
-    has_usage = check_if_user_has_credits(
-        update.message.chat.id, update.message.from_.id
-    )
-    if not has_usage:
-        send_message(
-            update,
-            f"⚠️ Sorry @{update.message.from_.username or update.message.from_.first_name}, you've used all your credits for today⏳ Please wait till tomorrow to try agian 🌞",
+    with time_stage(Stages.CREDIT_CHECK):
+        reservation = reserve_credit(
+            update.message.chat.id,
+            update.message.from_.id,
+            settings.allowed_usage_per_day,
         )
+    if not reservation:
+        send_notice(update, get_out_of_credits_text(update))
         record_message_in_db(update)
+        record_outcome(Outcomes.OUT_OF_CREDITS)
         return "User doesn't have credits"
 
-    response = entry_generate_response_from_user_message(update)
-    reply_data = send_message(update, response.text)
+    try:
+        if STREAMING_ENABLED:
+            reply = StreamingReply(
+                update, acquire_send_token if OUTBOX_ENABLED else None
+            )
+            response = entry_stream_response_from_user_message(update, reply.push)
+            reply_data = reply.finish(response.text)
+        elif OUTBOX_ENABLED:
+            response = entry_generate_response_from_user_message(update)
+            enqueue_outbox_message(
+                build_reply_outbox_message(update, response.text, response)
+            )
+            reply_data = None
+        else:
+            response = entry_generate_response_from_user_message(update)
+            reply_data = send_message(update, response.text)
+    except Exception:
+        refund_credit(reservation)
+        record_outcome(Outcomes.ERROR)
+        raise
+    commit_credit(reservation)
+    record_outcome(Outcomes.REPLIED)
 
-    record_message_in_db(
-        update,
-        cost=response.cost,
-        input_tokens=response.input_tokens,
-        output_tokens=response.output_tokens,
-        was_tagged=True,
-    )
-    record_message_in_db(
-        reply_data,
-        role=LLMRoles.AI,
-    )
+    # Outbox replies are recorded by the outbox sender once Telegram returns their ID
+    if reply_data:
+        record_turn_in_db(update, reply_data, response)
+    return response
+
+
+async def async_entry_process_message(
+    update: TelegramUpdatePing, earlier: list[TelegramUpdatePing] | None = None
+) -> AIResponse | str:
+    """
+    ### Responsibility:
+        - Async variant of `entry_process_message` for the event loop worker.
+        - Keep the same authorization, #noreply, credit, history and recording behaviour as the sync path.
+
+    ### Args:
+        - `update`: TelegramUpdatePing
+            An object containing update information including chat, user, and message details.
+        - `earlier`: list[TelegramUpdatePing] | None
+            Same as `entry_process_message`.
+
+    ### Returns:
+        - `response`: AIResponse or str
+            Same as `entry_process_message`.
+
+    ### How does the function work:
+        - Runs the same checks in the same order as `entry_process_message`, awaiting the async postgres, OpenAI and Telegram functions.
+        - Records the exchange with `async_record_turn_in_db`, which writes the same rows and history entries as the sync path.
+    """
+
+    for x in earlier or []:
+        await async_record_message_in_db(x)
+
+    with time_stage(Stages.AUTH_CHECK):
+        settings = await async_get_cached_chat_settings(update.message.chat.id)
+    if not settings.is_authorized:
+        await async_send_notice(update, NOT_AUTHORIZED_TEXT)
+        await async_record_message_in_db(update)
+        record_outcome(Outcomes.UNAUTHORIZED)
+        return "Chat Not Authorized"
+
+    if is_noreply_message(update):
+        await async_record_message_in_db(update)
+        record_outcome(Outcomes.NOREPLY)
+        return "Ignore message command found"
+
+    with time_stage(Stages.CREDIT_CHECK):
+        reservation = await async_reserve_credit(
+            update.message.chat.id,
+            update.message.from_.id,
+            settings.allowed_usage_per_day,
+        )
+    if not reservation:
+        await async_send_notice(update, get_out_of_credits_text(update))
+        await async_record_message_in_db(update)
+        record_outcome(Outcomes.OUT_OF_CREDITS)
+        return "User doesn't have credits"
+
+    try:
+        if STREAMING_ENABLED:
+            reply = AsyncStreamingReply(
+                update, async_acquire_send_token if OUTBOX_ENABLED else None
+            )
+            response = await async_entry_stream_response_from_user_message(
+                update, reply.push
+            )
+            reply_data = await reply.finish(response.text)
+        elif OUTBOX_ENABLED:
+            response = await async_entry_generate_response_from_user_message(update)
+            await async_enqueue_outbox_message(
+                build_reply_outbox_message(update, response.text, response)
+            )
+            reply_data = None
+        else:
+            response = await async_entry_generate_response_from_user_message(update)
+            reply_data = await async_send_message(update, response.text)
+    except Exception:
+        await async_refund_credit(reservation)
+        record_outcome(Outcomes.ERROR)
+        raise
+    await async_commit_credit(reservation)
+    record_outcome(Outcomes.REPLIED)
+
+    if reply_data:
+        await async_record_turn_in_db(update, reply_data, response)
     return response
@@ -0,0 +1,229 @@
+"""
+Prometheus metrics of the update pipeline, shared by the API and the workers
+"""
+
+# pylint:disable=wrong-import-position
+
+import os
+import time
+import shutil
+from enum import Enum
+from contextlib import contextmanager
+
+from rich import print
+from wrapworks import cwdtoenv
+from dotenv import load_dotenv
+
+cwdtoenv()
+# prometheus_client picks its storage from PROMETHEUS_MULTIPROC_DIR when imported
+load_dotenv()
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+    start_http_server,
+)
+
+from src.postgres.core_db_operations import POSTGRES_POOL, ASYNC_POSTGRES_POOL
+from src.core.tracing import span
+
+# Set to a directory to aggregate the metrics of forked processes (Celery prefork, uvicorn --workers)
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+# Port of the worker's scrape endpoint, the API serves /metrics itself. 0 turns it off
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", "0"))
+
+# Sub-second lookups up to minute long LLM calls
+STAGE_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    20,
+    40,
+    60,
+)
+
+
+class Stages(Enum):
+    AUTH_CHECK = "auth_check"
+    CREDIT_CHECK = "credit_check"
+    HISTORY_FETCH = "history_fetch"
+    LLM_CALL = "llm_call"
+    TELEGRAM_SEND = "telegram_send"
+    DB_RECORD = "db_record"
+
+
+class Outcomes(Enum):
+    UNAUTHORIZED = "unauthorized"
+    NOREPLY = "noreply"
+    OUT_OF_CREDITS = "out_of_credits"
+    REPLIED = "replied"
+    ERROR = "error"
+
+
+STAGE_LATENCY = Histogram(
+    "quicklingo_stage_duration_seconds",
+    "Time spent in each stage of handling an update",
+    ["stage"],
+    buckets=STAGE_BUCKETS,
+)
+UPDATE_OUTCOMES = Counter(
+    "quicklingo_update_outcomes",
+    "Messages handled, by how they ended",
+    ["outcome"],
+)
+LLM_TOKENS = Counter(
+    "quicklingo_llm_tokens",
+    "Tokens used by LLM calls",
+    ["model", "direction"],
+)
+LLM_COST = Counter(
+    "quicklingo_llm_cost_dollars",
+    "Cost of LLM calls in dollars",
+    ["model"],
+)
+TRUNCATED_REPLIES = Counter(
+    "quicklingo_truncated_replies",
+    "Replies cut off because they reached max_tokens",
+    ["model"],
+)
+DROPPED_UPDATES = Counter(
+    "quicklingo_dropped_updates",
+    "Updates the API accepted but couldn't publish on the broker",
+)
+# Only the API sets it, on every scrape
+QUEUE_DEPTH = Gauge(
+    "quicklingo_queue_depth",
+    "Tasks waiting in each broker queue",
+    ["queue"],
+    multiprocess_mode="livemostrecent",
+)
+DB_POOL_CONNECTIONS = Gauge(
+    "quicklingo_db_pool_connections",
+    "Postgres pool connections by state, summed over live processes",
+    ["pool", "state"],
+    multiprocess_mode="livesum",
+)
+
+
+@contextmanager
+def time_stage(stage: Stages):
+    """Observes the time spent in the block as `stage`, also when it raises, and records it as a span of the current trace"""
+
+    started = time.perf_counter()
+    try:
+        with span(stage.value):
+            yield
+    finally:
+        STAGE_LATENCY.labels(stage.value).observe(time.perf_counter() - started)
+
+
+def observe_stage(stage: Stages, seconds: float):
+    """Observes a duration measured by the caller as `stage`, for stages that interleave with others"""
+
+    STAGE_LATENCY.labels(stage.value).observe(seconds)
+
+
+def record_outcome(outcome: Outcomes):
+    UPDATE_OUTCOMES.labels(outcome.value).inc()
+
+
+def record_llm_usage(model: str, input_tokens: int, output_tokens: int, cost: float):
+    """Adds an LLM call's tokens and cost to the counters of the model that answered"""
+
+    LLM_TOKENS.labels(model, "input").inc(input_tokens or 0)
+    LLM_TOKENS.labels(model, "output").inc(output_tokens or 0)
+    LLM_COST.labels(model).inc(cost or 0)
+
+
+def record_truncated_reply(model: str, max_tokens: int):
+    """Counts a reply the model stopped at `max_tokens`, a sign the output floor is too low"""
+
+    print(f"{model} reply was cut off at {max_tokens} tokens")
+    TRUNCATED_REPLIES.labels(model).inc()
+
+
+def observe_postgres_pools():
+    """Sets the pool gauges from both postgres pools, a closed pool counts as empty"""
+
+    for pool in (POSTGRES_POOL, ASYNC_POSTGRES_POOL):
+        stats = {} if pool.closed else pool.get_stats()
+        size = stats.get("pool_size", 0)
+        available = stats.get("pool_available", 0)
+        DB_POOL_CONNECTIONS.labels(pool.name, "in_use").set(size - available)
+        DB_POOL_CONNECTIONS.labels(pool.name, "idle").set(available)
+        DB_POOL_CONNECTIONS.labels(pool.name, "waiting").set(
+            stats.get("requests_waiting", 0)
+        )
+
+
+def observe_queue_depths(depths: dict[str, int]):
+    for queue, depth in depths.items():
+        QUEUE_DEPTH.labels(queue).set(depth)
+
+
+def get_metrics_registry() -> CollectorRegistry:
+    """Returns the registry to expose: the merged files of all processes in multiprocess mode"""
+
+    if not PROMETHEUS_MULTIPROC_DIR:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def render_metrics() -> tuple[bytes, str]:
+    """Returns the metrics in the text exposition format, and its content type"""
+
+    return generate_latest(get_metrics_registry()), CONTENT_TYPE_LATEST
+
+
+def reset_multiprocess_dir():
+    """
+    ### Responsibility:
+        - Empty `PROMETHEUS_MULTIPROC_DIR` before the processes of a new run write to it.
+
+    ### Args:
+        - None
+
+    ### Returns:
+        - None
+
+    ### How does the function work:
+        - Removes the metric files left by an earlier run, which would otherwise be added to the new run's counters.
+        - Must run in the parent process before it forks, and each service (API, workers) needs its own directory.
+    """
+
+    if not PROMETHEUS_MULTIPROC_DIR:
+        return
+    shutil.rmtree(PROMETHEUS_MULTIPROC_DIR, ignore_errors=True)
+    os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+
+
+def mark_metrics_process_dead():
+    """Drops the live gauges of the exiting process, so they stop counting in sums"""
+
+    if PROMETHEUS_MULTIPROC_DIR:
+        multiprocess.mark_process_dead(os.getpid())
+
+
+def start_worker_metrics_server():
+    """Serves the merged metrics of the worker's processes on `WORKER_METRICS_PORT`"""
+
+    if not WORKER_METRICS_PORT:
+        return
+    start_http_server(WORKER_METRICS_PORT, registry=get_metrics_registry())
+    print(f"Worker metrics served on port {WORKER_METRICS_PORT}")
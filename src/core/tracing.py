@@ -0,0 +1,385 @@
+"""
+Per update traces, from the webhook through the broker to the reply
+"""
+
+# pylint:disable=wrong-import-position
+
+import os
+import time
+import zlib
+import queue
+import secrets
+import functools
+import threading
+import contextvars
+from abc import ABC, abstractmethod
+from inspect import iscoroutinefunction
+from contextlib import contextmanager
+
+import httpx
+import orjson
+from pydantic import BaseModel
+from rich import print
+from wrapworks import cwdtoenv
+from dotenv import load_dotenv
+
+cwdtoenv()
+load_dotenv()
+
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "false").lower() == "true"
+# Share of updates traced in full, picked from the update ID so every process agrees
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.01"))
+# Unsampled traces are still kept when they took this many seconds, queueing included, or failed
+TRACE_SLOW_THRESHOLD = float(os.getenv("TRACE_SLOW_THRESHOLD", "10"))
+# Spans kept per trace, so a runaway loop can't grow one without bound
+TRACE_MAX_SPANS = int(os.getenv("TRACE_MAX_SPANS", "200"))
+# "file", "fluentd" or "none"
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "file")
+TRACE_FILE_PATH = os.getenv("TRACE_FILE_PATH", "traces/traces.jsonl")
+# Fluentd's in_http input, the tag is appended as the path
+FLUENTD_URL = os.getenv("FLUENTD_URL", "http://localhost:9880")
+FLUENTD_TAG = os.getenv("FLUENTD_TAG", "quicklingo.trace")
+# Finished traces waiting to be exported, more are dropped rather than slowing updates down
+TRACE_EXPORT_QUEUE_SIZE = int(os.getenv("TRACE_EXPORT_QUEUE_SIZE", "10000"))
+
+# Celery task header that carries the trace to the worker
+TRACE_HEADER = "trace_context"
+
+
+class TraceContext(BaseModel):
+    """What a process needs to continue a trace started in another one"""
+
+    trace_id: str
+    update_id: int | None = None
+    parent_id: str | None = None
+    sampled: bool = False
+    # Unix time the update was handed to the broker, to measure queueing
+    published_at: float | None = None
+
+
+class Span(BaseModel):
+    name: str
+    span_id: str
+    parent_id: str | None = None
+    # Unix time, so spans of different processes line up
+    start: float
+    duration: float = 0
+    attributes: dict = {}
+    error: str | None = None
+
+
+class Trace:
+    """The spans one process records for an update, exported together when its root span ends"""
+
+    def __init__(self, context: TraceContext, service: str):
+        self.context = context
+        self.service = service
+        self.spans: list[Span] = []
+        self.dropped = 0
+        self.failed = False
+
+    def add(self, span: Span):
+        if len(self.spans) >= TRACE_MAX_SPANS:
+            self.dropped += 1
+            return
+        self.spans.append(span)
+
+    def should_keep(self) -> bool:
+        """Sampled up front, or kept after the fact because it failed or was slow"""
+
+        if self.context.sampled or self.failed:
+            return True
+        ends = [x.start + x.duration for x in self.spans]
+        starts = [x.start for x in self.spans]
+        if self.context.published_at:
+            starts.append(self.context.published_at)
+        return bool(ends) and max(ends) - min(starts) >= TRACE_SLOW_THRESHOLD
+
+    def to_record(self) -> dict:
+        return {
+            "trace_id": self.context.trace_id,
+            "update_id": self.context.update_id,
+            "service": self.service,
+            "pid": os.getpid(),
+            "sampled": self.context.sampled,
+            "dropped_spans": self.dropped,
+            "spans": [x.model_dump() for x in self.spans],
+        }
+
+
+_CURRENT_TRACE: contextvars.ContextVar[Trace | None] = contextvars.ContextVar(
+    "current_trace", default=None
+)
+_CURRENT_SPAN: contextvars.ContextVar[str | None] = contextvars.ContextVar(
+    "current_span", default=None
+)
+
+
+class TraceExporter(ABC):
+    """Sends finished traces somewhere. Subclass it and pass it to `set_trace_exporter` to plug in another backend"""
+
+    @abstractmethod
+    def export(self, records: list[dict]):
+        """Sends a batch of finished span records"""
+
+
+class FileTraceExporter(TraceExporter):
+    """Appends traces as JSON lines to a local file, for offline analysis"""
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    def export(self, records: list[dict]):
+        with open(self.path, "ab") as f:
+            f.write(b"".join(orjson.dumps(x) + b"\n" for x in records))
+
+
+class FluentdTraceExporter(TraceExporter):
+    """Posts traces to fluentd's in_http input, which can forward them anywhere or to a local file"""
+
+    def __init__(self, url: str, tag: str):
+        self.url = f"{url.rstrip('/')}/{tag}"
+        self.client = httpx.Client(timeout=5)
+
+    def export(self, records: list[dict]):
+        # A JSON array is taken as a batch of events
+        self.client.post(self.url, content=orjson.dumps(records)).raise_for_status()
+
+
+class _ExportQueue:
+    """
+    Exports finished traces on a background thread of the current process.
+
+    `put` never blocks the update that finished the trace: when the thread
+    falls behind and the queue is full, traces are dropped.
+    """
+
+    def __init__(self, max_queued: int):
+        self.max_queued = max_queued
+        self.exporter: TraceExporter | None = None
+        self.queue: queue.Queue | None = None
+        self.pid: int | None = None
+        self.lock = threading.Lock()
+
+    def _start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            # Started again after a fork, threads don't survive it
+            self.queue = queue.Queue(self.max_queued)
+            threading.Thread(
+                target=self._run, name="trace-exporter", daemon=True
+            ).start()
+            self.pid = os.getpid()
+
+    def put(self, record: dict):
+        if self.exporter is None:
+            return
+        if self.pid != os.getpid():
+            self._start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+    def _run(self):
+        while True:
+            records = [self.queue.get()]
+            while len(records) < 100 and not self.queue.empty():
+                records.append(self.queue.get_nowait())
+            try:
+                self.exporter.export(records)
+            except Exception as e:
+                print(f"Couldn't export {len(records)} traces: {type(e).__name__}: {e}")
+
+
+def build_exporter(name: str) -> TraceExporter | None:
+    if name == "file":
+        return FileTraceExporter(TRACE_FILE_PATH)
+    if name == "fluentd":
+        return FluentdTraceExporter(FLUENTD_URL, FLUENTD_TAG)
+    return None
+
+
+EXPORT_QUEUE = _ExportQueue(TRACE_EXPORT_QUEUE_SIZE)
+if TRACING_ENABLED:
+    EXPORT_QUEUE.exporter = build_exporter(TRACE_EXPORTER)
+
+
+def set_trace_exporter(exporter: TraceExporter | None):
+    """Replaces the exporter of this process, None drops finished traces"""
+
+    EXPORT_QUEUE.exporter = exporter
+
+
+def new_id() -> str:
+    return secrets.token_hex(8)
+
+
+def is_sampled(update_id: int | None) -> bool:
+    """Head sampling decision, the same for an update in every process"""
+
+    if update_id is None:
+        return False
+    # crc32 rather than hash(), which is salted per process
+    return zlib.crc32(str(update_id).encode()) % 10_000 < TRACE_SAMPLE_RATE * 10_000
+
+
+def new_trace_context(update_id: int | None) -> TraceContext | None:
+    """Returns the context of a new trace keyed on the update ID, or None when tracing is off"""
+
+    if not TRACING_ENABLED:
+        return None
+    trace_id = str(update_id) if update_id is not None else new_id()
+    return TraceContext(
+        trace_id=trace_id, update_id=update_id, sampled=is_sampled(update_id)
+    )
+
+
+@contextmanager
+def trace_segment(context: TraceContext | None, name: str, service: str):
+    """
+    ### Responsibility:
+        - Record the spans of this process for a trace, and export them when the block ends.
+
+    ### Args:
+        - `context`: TraceContext | None
+            The trace to record into, from `new_trace_context` or `read_trace_context`. Nothing is recorded when None.
+        - `name`: str
+            The name of the root span of this segment.
+        - `service`: str
+            The process kind, such as "api" or "worker".
+
+    ### Returns:
+        - `trace`: Trace | None
+            The trace being recorded.
+
+    ### How does the function work:
+        - Sets the trace as current, so `span` and `traced` functions called inside the block, also in awaited coroutines, add to it.
+        - When the context says when the update was published, adds a `queue_wait` span from then until now.
+        - Hands the segment to the export thread when the block ends, if it was sampled, failed or took at least `TRACE_SLOW_THRESHOLD` seconds since it was published. Other segments are thrown away, so unsampled updates only pay for recording.
+    """
+
+    if context is None:
+        yield None
+        return
+
+    trace = Trace(context, service)
+    if context.published_at:
+        trace.add(
+            Span(
+                name="queue_wait",
+                span_id=new_id(),
+                parent_id=context.parent_id,
+                start=context.published_at,
+                duration=max(0, time.time() - context.published_at),
+            )
+        )
+    trace_token = _CURRENT_TRACE.set(trace)
+    span_token = _CURRENT_SPAN.set(context.parent_id)
+    try:
+        with span(name, service=service):
+            yield trace
+    finally:
+        _CURRENT_SPAN.reset(span_token)
+        _CURRENT_TRACE.reset(trace_token)
+        if trace.should_keep():
+            EXPORT_QUEUE.put(trace.to_record())
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """Records the block as a span of the current trace, a no-op outside of one"""
+
+    trace = _CURRENT_TRACE.get()
+    if trace is None:
+        yield None
+        return
+
+    current = Span(
+        name=name,
+        span_id=new_id(),
+        parent_id=_CURRENT_SPAN.get(),
+        start=time.time(),
+        attributes=attributes,
+    )
+    started = time.perf_counter()
+    token = _CURRENT_SPAN.set(current.span_id)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = f"{type(e).__name__}: {e}"
+        trace.failed = True
+        raise
+    finally:
+        _CURRENT_SPAN.reset(token)
+        current.duration = time.perf_counter() - started
+        trace.add(current)
+
+
+def traced(name: str | None = None):
+    """Decorator that records every call of a function, sync or async, as a span named after it"""
+
+    def decorate(function):
+        span_name = name or function.__name__
+
+        if iscoroutinefunction(function):
+
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                if _CURRENT_TRACE.get() is None:
+                    return await function(*args, **kwargs)
+                with span(span_name):
+                    return await function(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _CURRENT_TRACE.get() is None:
+                return function(*args, **kwargs)
+            with span(span_name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+def get_trace_context() -> TraceContext | None:
+    """Returns the current trace with the current span as parent, to continue it elsewhere"""
+
+    trace = _CURRENT_TRACE.get()
+    if trace is None:
+        return None
+    return trace.context.model_copy(update={"parent_id": _CURRENT_SPAN.get()})
+
+
+def build_trace_headers(context: TraceContext | None) -> dict | None:
+    """Returns the Celery headers that carry a trace to a task, such as a task's own retry with its original publish time"""
+
+    if context is None:
+        return None
+    return {TRACE_HEADER: context.model_dump()}
+
+
+def get_trace_headers() -> dict | None:
+    """Returns the Celery headers that continue the current trace in the task, stamped with the time"""
+
+    context = get_trace_context()
+    if context is not None:
+        context.published_at = time.time()
+    return build_trace_headers(context)
+
+
+def read_trace_context(request) -> TraceContext | None:
+    """Reads the trace a Celery task continues from its request, None if it has none"""
+
+    if not TRACING_ENABLED:
+        return None
+    # Protocol 2 merges custom headers into the request, older ones keep them apart
+    raw = getattr(request, TRACE_HEADER, None) or (
+        getattr(request, "headers", None) or {}
+    ).get(TRACE_HEADER)
+    return TraceContext.model_validate(raw) if raw else None
@@ -2,9 +2,10 @@
 
 # pylint:disable=wrong-import-position
 
-from typing import Any
+from contextlib import asynccontextmanager
 
-from fastapi import FastAPI
+import orjson
+from fastapi import FastAPI, Request, Response
 import uvicorn
 from rich import print
 from wrapworks import cwdtoenv
@@ -13,16 +14,43 @@ from dotenv import load_dotenv
 cwdtoenv()
 load_dotenv()
 
-from src.genai.generate_message import entry_generate_response_from_user_message
-from src.telegram.send_message import send_message
-from src.celery.main_queue import worker_handle_update
-from src.models.telegram_update_models import (
-    TelegramUpdatePing,
-    TelegramUpdateNewMember,
+from src.celery.publisher import UPDATE_PUBLISHER
+from src.celery.main_queue import get_queue_depths
+from src.core.metrics import (
+    render_metrics,
+    observe_queue_depths,
+    observe_postgres_pools,
 )
+from src.telegram.updates import get_update_kind
+from src.core.tracing import new_trace_context, trace_segment, get_trace_headers
+from src.core.http_clients import close_http_clients
+from src.cache.chat_settings_cache import (
+    start_chat_settings_listener,
+    get_chat_settings_cache_stats,
+)
+from src.cache.response_cache import get_response_cache_stats
+from src.genai.resilience import get_resilience_stats
+from src.postgres.core_db_operations import (
+    open_postgres_pool,
+    close_postgres_pool,
+    get_postgres_pool_stats,
+)
+
 
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    """Open the postgres pool and update publisher once per API process and close them on shutdown"""
 
-app = FastAPI()
+    open_postgres_pool()
+    start_chat_settings_listener()
+    UPDATE_PUBLISHER.start()
+    yield
+    await UPDATE_PUBLISHER.stop()
+    close_http_clients()
+    close_postgres_pool()
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 @app.get("/")
@@ -30,30 +58,79 @@ def health_check():
     return "I'm running smoothly"
 
 
+@app.get("/stats/postgres")
+def postgres_pool_stats():
+    return get_postgres_pool_stats()
+
+
+@app.get("/stats/llm")
+def llm_stats():
+    return get_resilience_stats()
+
+
+@app.get("/stats/cache")
+def cache_stats():
+    return {
+        "chat_settings": get_chat_settings_cache_stats(),
+        "responses": get_response_cache_stats(),
+    }
+
+
+@app.get("/metrics")
+def metrics():
+    """
+    ### Description:
+    - Serves the Prometheus metrics of the API, and of its sibling processes when `PROMETHEUS_MULTIPROC_DIR` is set.
+    - Refreshes the broker queue depths and pool gauges first, so they're as of the scrape. Queue depth is what workers scale on.
+    """
+
+    depths = {
+        "api_publisher": UPDATE_PUBLISHER.queue.qsize() if UPDATE_PUBLISHER.queue else 0
+    }
+    try:
+        depths |= get_queue_depths()
+    except Exception as e:
+        print(f"Couldn't read queue depths: {type(e).__name__}: {e}")
+    observe_queue_depths(depths)
+    observe_postgres_pools()
+
+    body, content_type = render_metrics()
+    return Response(body, media_type=content_type)
+
+
 @app.post("/updates")
-def listen_for_updates(update: dict):
+async def listen_for_updates(request: Request):
     """
     ### Description:
     - Handles incoming updates from Telegram.
-    - Determines the type of update and processes it accordingly.
+    - Checks only the fields needed for routing and queues the raw update for the workers, which validate it.
+    - Acknowledges Telegram as soon as the update is queued, publishing to the broker happens in the background.
+    - Starts the update's trace, keyed on its `update_id`, and hands it to the worker in the task headers.
 
     ### Args:
-    - `update`: Dictionary containing the update payload from Telegram.
+    - `request`: The webhook request, whose body is the update payload from Telegram.
       - Keys may include "message", "text", "new_chat_member", etc.
     """
 
+    body = await request.body()
     try:
-        if "text" in update["message"]:
-            update: TelegramUpdatePing = TelegramUpdatePing(**update)
-        elif "new_chat_member" in update["message"]:
-            update: TelegramUpdateNewMember = TelegramUpdateNewMember(**update)
-    except Exception as e:
-        print(f"Couldn't parse what telegram sent:\n{update}")
+        update = orjson.loads(body)
+    except orjson.JSONDecodeError as e:
+        print(f"Couldn't parse what telegram sent:\n{body}")
         print(f"{type(e).__name__}: {e}")
-        return
-
-    _ = worker_handle_update.delay(update)
-    return
+        return Response()
+
+    if not get_update_kind(update):
+        return Response()
+
+    context = new_trace_context(update.get("update_id"))
+    with trace_segment(context, "webhook", "api"):
+        published = UPDATE_PUBLISHER.publish(update, get_trace_headers())
+    if not published:
+        # Telegram redelivers updates that weren't answered with a 2xx
+        print("Update publisher is full, asking telegram to retry")
+        return Response(status_code=503)
+    return Response()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,103 @@
+"""
+Fits the prompt of a reply into a token budget
+"""
+
+import os
+
+from pydantic import BaseModel
+from dotenv import load_dotenv
+
+from src.genai.token_estimator import (
+    MESSAGE_OVERHEAD_TOKENS,
+    REPLY_PRIMING_TOKENS,
+    estimate_message_tokens,
+    truncate_to_tokens,
+)
+from src.models.gen_ai_models import LLMMessage
+from src.models.postgres_models import Message
+
+load_dotenv()
+
+# Tokens the system prompt, history and user message may use together
+INPUT_TOKEN_BUDGET = int(os.getenv("INPUT_TOKEN_BUDGET", "1500"))
+# Longer messages are cut, so a pasted essay can't take the whole budget
+USER_MESSAGE_MAX_TOKENS = int(os.getenv("USER_MESSAGE_MAX_TOKENS", "600"))
+HISTORY_MESSAGE_MAX_TOKENS = int(os.getenv("HISTORY_MESSAGE_MAX_TOKENS", "250"))
+
+# The reply gets room in proportion to the question, between these bounds.
+# Even a short question needs room for an English answer and its Persian translation
+MIN_OUTPUT_TOKENS = int(os.getenv("MIN_OUTPUT_TOKENS", "1200"))
+MAX_OUTPUT_TOKENS = int(os.getenv("MAX_OUTPUT_TOKENS", "1500"))
+OUTPUT_TOKENS_PER_INPUT_TOKEN = float(os.getenv("OUTPUT_TOKENS_PER_INPUT_TOKEN", "4"))
+
+
+class PromptContext(BaseModel):
+    """The parts of a prompt that fit the budget, and the reply size to ask for"""
+
+    history: list[LLMMessage]
+    text: str
+    input_tokens: int
+    max_tokens: int
+    dropped_messages: int = 0
+
+
+def get_max_output_tokens(user_tokens: int) -> int:
+    """Returns the `max_tokens` of a reply to a message of `user_tokens` tokens"""
+
+    wanted = MIN_OUTPUT_TOKENS + OUTPUT_TOKENS_PER_INPUT_TOKEN * user_tokens
+    return int(min(MAX_OUTPUT_TOKENS, max(MIN_OUTPUT_TOKENS, wanted)))
+
+
+def fit_prompt(system_prompt: str, history: list[Message], text: str) -> PromptContext:
+    """
+    ### Responsibility:
+        - Choose what goes into the prompt so it stays within `INPUT_TOKEN_BUDGET`.
+        - Choose the reply's `max_tokens` instead of always asking for the maximum.
+
+    ### Args:
+        - `system_prompt`: str
+            The rendered system prompt, always sent in full.
+        - `history`: list[Message]
+            The conversation history, oldest first, with the `token_count` stored when each message was recorded.
+        - `text`: str
+            The user's message.
+
+    ### Returns:
+        - `context`: PromptContext
+            The history and text to send, their estimated input tokens and the `max_tokens` to request.
+
+    ### How does the function work:
+        - Cuts the user's message to `USER_MESSAGE_MAX_TOKENS` and every history message to `HISTORY_MESSAGE_MAX_TOKENS`.
+        - Adds history from the newest message back, and stops at the first message that doesn't fit the remaining budget, so the kept history is always the most recent stretch of the conversation.
+        - Uses the stored token counts, and only estimates the messages recorded before counts were stored or that had to be cut.
+        - Sets `max_tokens` with `get_max_output_tokens` from the size of the user's message.
+    """
+
+    text = truncate_to_tokens(text, USER_MESSAGE_MAX_TOKENS)
+    user_tokens = estimate_message_tokens(text)
+    used = estimate_message_tokens(system_prompt) + user_tokens + REPLY_PRIMING_TOKENS
+
+    kept: list[LLMMessage] = []
+    for message in reversed(history):
+        content = message.message or ""
+        tokens = (
+            message.token_count + MESSAGE_OVERHEAD_TOKENS
+            if message.token_count is not None
+            else estimate_message_tokens(content)
+        )
+        if tokens > HISTORY_MESSAGE_MAX_TOKENS:
+            content = truncate_to_tokens(content, HISTORY_MESSAGE_MAX_TOKENS)
+            tokens = estimate_message_tokens(content)
+        if used + tokens > INPUT_TOKEN_BUDGET:
+            break
+        kept.append(LLMMessage(role=message.role, content=content))
+        used += tokens
+    kept.reverse()
+
+    return PromptContext(
+        history=kept,
+        text=text,
+        input_tokens=used,
+        max_tokens=get_max_output_tokens(user_tokens),
+        dropped_messages=len(history) - len(kept),
+    )
@@ -9,17 +9,52 @@ import os
 from datetime import datetime
 import json
 import re
+import time
+from typing import Callable, Awaitable
 
 import httpx
 from wrapworks import cwdtoenv
 from dotenv import load_dotenv
 from rich import print
 
-
 cwdtoenv()
 load_dotenv()
 
-from src.postgres.select_functions import get_last_n_messages
+from src.core.http_clients import (
+    Upstreams,
+    request_with_retry,
+    async_request_with_retry,
+)
+from src.cache.history_buffer import get_history, async_get_history
+from src.genai.context_builder import MAX_OUTPUT_TOKENS, PromptContext, fit_prompt
+from src.genai.resilience import (
+    LLM_REQUEST_TIMEOUT,
+    RETRY_BUDGET,
+    resilient_request,
+    async_resilient_request,
+)
+from src.genai.model_router import (
+    route_model,
+    async_route_model,
+    DeliveryError,
+    track_model_call,
+    async_track_model_call,
+)
+from src.cache.response_cache import (
+    get_response_cache_key,
+    get_cached_response,
+    store_cached_response,
+    async_get_cached_response,
+    async_store_cached_response,
+)
+from src.core.metrics import (
+    Stages,
+    time_stage,
+    observe_stage,
+    record_llm_usage,
+    record_truncated_reply,
+)
+from src.core.tracing import traced, span
 from src.models.gen_ai_models import (
     ValidLLMModels,
     LLM_COST_PER_TOKEN,
@@ -30,56 +65,84 @@ from src.models.gen_ai_models import (
 )
 from src.models.telegram_update_models import TelegramUpdatePing
 
+OPENAI_CHAT_COMPLETIONS_PATH = "/v1/chat/completions"
+
+SYSTEM_PROMPT_TEMPLATE = """Your name is QuickLingoBot. You are a english langauge teacher and a helper for native persian speaker who wish to learn English. You'll be talking with them on a text chat. Focus on helping the user with thier questions. Help them in english and in persian. Be friendly, but assertive. You are an english teacher, so don't talk about anything that you wouldn't talk about in a casual classroom. In your response, make sure to include a persian translation of the english version as well. That way, users who don't english well can still learn something. Use telegram formatting as you'll be replying on telegram. Use emojis in your message
+                
+                You might be in a group chat. The user who sent the last message is @{handle}. Only tag this user if you want to tag them. """
 
-def invoke_openai(model: ValidLLMModels | str, messages: LLMMessageLog) -> AIResponse:
+
+def build_openai_request(
+    model: ValidLLMModels | str,
+    messages: LLMMessageLog,
+    max_tokens: int = MAX_OUTPUT_TOKENS,
+) -> tuple[str, dict, dict]:
     """
     ### Responsibility:
-        - Invoke the OpenAI API with a specific model and message log to get a response.
-        - Handle and raise any errors that occur during the API call or response parsing.
+        - Build the url, payload and headers for a chat completion request.
 
     ### Args:
         - `model`: ValidLLMModels | str
-            The language model to use for the API call. Could be an instance of `ValidLLMModels` or a string.
+            The language model to use for the API call.
         - `messages`: LLMMessageLog
-            A log of messages (as instances of `LLMMessage`) to send to the API.
+            A log of messages to send to the API.
+        - `max_tokens`: int
+            The most tokens the reply may use, see `get_max_output_tokens`.
 
     ### Returns:
-        - `response`: AIResponse
-            The response from the OpenAI API parsed into an `AIResponse` object.
-
-    ### Raises:
-        - `RuntimeError`:
-            Raised if the API response contains an error.
-        - `Exception`:
-            Raised if there is an error parsing the API response.
-
-    ### How does the function work:
-        - Converts `model` to its string representation if it is an instance of `ValidLLMModels`.
-        - Constructs the payload for the OpenAI API call with the specified model and messages.
-        - Sets the appropriate headers, including the API key from environment variables.
-        - Sends a POST request to the OpenAI API endpoint.
-        - Tries to parse the JSON response:
-            - If it contains an error, prints the payload and raises a `RuntimeError`.
-            - Returns an `AIResponse` object if parsing succeeds.
-            - Catches and prints exceptions that occur during response parsing and raises the exception.
+        - `request`: tuple[str, dict, dict]
+            The path on the OpenAI upstream, the JSON payload and the headers.
     """
 
     if not isinstance(model, str):
         model = model.value
 
-    url = "https://api.openai.com/v1/chat/completions"
-
     payload = {
         "model": model,
         "messages": [x.model_dump() for x in messages.messages],
-        "max_tokens": 1500,
+        "max_tokens": max_tokens,
     }
     headers = {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {os.getenv('AZ_OPENAI_API_KEY')}",
     }
 
-    response = httpx.post(url, json=payload, headers=headers, timeout=120)
+    return OPENAI_CHAT_COMPLETIONS_PATH, payload, headers
+
+
+def build_streaming_request(
+    model: ValidLLMModels | str,
+    messages: LLMMessageLog,
+    max_tokens: int = MAX_OUTPUT_TOKENS,
+) -> tuple[str, dict, dict]:
+    """Returns `build_openai_request` with streaming on, and token usage reported in the final chunk"""
+
+    url, payload, headers = build_openai_request(model, messages, max_tokens)
+    payload |= {"stream": True, "stream_options": {"include_usage": True}}
+    return url, payload, headers
+
+
+def parse_openai_response(response: httpx.Response, payload: dict) -> AIResponse:
+    """
+    ### Responsibility:
+        - Parse a chat completion response into an `AIResponse`.
+
+    ### Args:
+        - `response`: httpx.Response
+            The raw response from the OpenAI API.
+        - `payload`: dict
+            The payload that was sent, printed when the API returns an error.
+
+    ### Returns:
+        - `response`: AIResponse
+            The parsed response.
+
+    ### Raises:
+        - `RuntimeError`:
+            Raised if the API response contains an error.
+        - `Exception`:
+            Raised if there is an error parsing the API response.
+    """
 
     try:
         data = response.json()
@@ -94,8 +157,67 @@ def invoke_openai(model: ValidLLMModels | str, messages: LLMMessageLog) -> AIRes
         raise
 
 
+@traced()
+def invoke_openai(
+    model: ValidLLMModels | str,
+    messages: LLMMessageLog,
+    max_tokens: int = MAX_OUTPUT_TOKENS,
+) -> AIResponse:
+    """
+    ### Responsibility:
+        - Invoke the OpenAI API with a specific model and message log to get a response.
+        - Handle and raise any errors that occur during the API call or response parsing.
+
+    ### Args:
+        - `model`: ValidLLMModels | str
+            The language model to use for the API call. Could be an instance of `ValidLLMModels` or a string.
+        - `messages`: LLMMessageLog
+            A log of messages (as instances of `LLMMessage`) to send to the API.
+        - `max_tokens`: int
+            The most tokens the reply may use.
+
+    ### Returns:
+        - `response`: AIResponse
+            The response from the OpenAI API parsed into an `AIResponse` object.
+
+    ### Raises:
+        - `RuntimeError`:
+            Raised if the API response contains an error.
+        - `Exception`:
+            Raised if there is an error parsing the API response.
+
+    ### How does the function work:
+        - Builds the url, payload and headers with `build_openai_request`.
+        - Sends a POST request to the OpenAI API endpoint through the shared client with `request_with_retry`, which retries connection failures, 429s and 5xx responses with jittered backoff while the shared `RETRY_BUDGET` allows.
+        - Wraps the request in `resilient_request`, which hedges slow calls, skips models whose circuit is open and falls back to another model. The model that answered is set on `served_by`.
+        - Parses the JSON response with `parse_openai_response`:
+            - If it contains an error, prints the payload and raises a `RuntimeError`.
+            - Returns an `AIResponse` object if parsing succeeds.
+            - Catches and prints exceptions that occur during response parsing and raises the exception.
+    """
+
+    def send(candidate: ValidLLMModels) -> httpx.Response:
+        url, payload, headers = build_openai_request(candidate, messages, max_tokens)
+        return request_with_retry(
+            Upstreams.OPENAI,
+            "POST",
+            url,
+            can_retry=RETRY_BUDGET.try_withdraw,
+            json=payload,
+            headers=headers,
+            timeout=LLM_REQUEST_TIMEOUT,
+        )
+
+    response, served_by = resilient_request(ValidLLMModels(model), send)
+
+    _, payload, _ = build_openai_request(served_by, messages, max_tokens)
+    parsed = parse_openai_response(response, payload)
+    parsed.served_by = served_by.value
+    return parsed
+
+
 def handler_generate_response(
-    messages: LLMMessageLog, model: ValidLLMModels
+    messages: LLMMessageLog, model: ValidLLMModels, max_tokens: int = MAX_OUTPUT_TOKENS
 ) -> AIResponse:
     """
     ### Responsibility:
@@ -107,6 +229,8 @@ def handler_generate_response(
             A log of messages (as instances of `LLMMessage`) to send to the API.
         - `model`: ValidLLMModels
             The language model to use for generating the response.
+        - `max_tokens`: int
+            The most tokens the reply may use.
 
     ### Returns:
         - `response`: AIResponse
@@ -114,12 +238,352 @@ def handler_generate_response(
 
     ### How does the function work:
         - Calls the `invoke_openai` function to get a response from the API.
-        - Calculates the cost of the response using the model's value and a predefined token cost (`LLM_COST_PER_TOKEN`).
+        - Calculates the cost of the response using the model that answered and a predefined token cost (`LLM_COST_PER_TOKEN`).
         - Returns the `AIResponse` with the calculated cost.
+        - Times the call and adds its tokens and cost to the metrics of the model that answered.
+        - Counts the reply with `record_truncated_reply` if the model stopped at `max_tokens`.
     """
 
-    response = invoke_openai(model, messages)
-    response.calculate_cost(model.value, LLM_COST_PER_TOKEN)
+    with time_stage(Stages.LLM_CALL):
+        response = invoke_openai(model, messages, max_tokens)
+    response.calculate_cost(response.served_by, LLM_COST_PER_TOKEN)
+    record_llm_usage(
+        response.served_by, response.input_tokens, response.output_tokens, response.cost
+    )
+    if response.finish_reason == "length":
+        record_truncated_reply(response.served_by, max_tokens)
+
+    return response
+
+
+@traced()
+async def async_invoke_openai(
+    model: ValidLLMModels | str,
+    messages: LLMMessageLog,
+    max_tokens: int = MAX_OUTPUT_TOKENS,
+) -> AIResponse:
+    """Async variant of `invoke_openai` using the shared async OpenAI client, losing hedges are cancelled"""
+
+    async def send(candidate: ValidLLMModels) -> httpx.Response:
+        url, payload, headers = build_openai_request(candidate, messages, max_tokens)
+        return await async_request_with_retry(
+            Upstreams.OPENAI,
+            "POST",
+            url,
+            can_retry=RETRY_BUDGET.try_withdraw,
+            json=payload,
+            headers=headers,
+            timeout=LLM_REQUEST_TIMEOUT,
+        )
+
+    response, served_by = await async_resilient_request(ValidLLMModels(model), send)
+
+    _, payload, _ = build_openai_request(served_by, messages, max_tokens)
+    parsed = parse_openai_response(response, payload)
+    parsed.served_by = served_by.value
+    return parsed
+
+
+async def async_handler_generate_response(
+    messages: LLMMessageLog, model: ValidLLMModels, max_tokens: int = MAX_OUTPUT_TOKENS
+) -> AIResponse:
+    """Async variant of `handler_generate_response`"""
+
+    with time_stage(Stages.LLM_CALL):
+        response = await async_invoke_openai(model, messages, max_tokens)
+    response.calculate_cost(response.served_by, LLM_COST_PER_TOKEN)
+    record_llm_usage(
+        response.served_by, response.input_tokens, response.output_tokens, response.cost
+    )
+    if response.finish_reason == "length":
+        record_truncated_reply(response.served_by, max_tokens)
+
+    return response
+
+
+def build_streamed_response(
+    text: str, usage: dict | None, finish_reason: str | None = None
+) -> AIResponse:
+    """
+    ### Responsibility:
+        - Build an `AIResponse` from the text and usage collected from a streamed completion.
+
+    ### Args:
+        - `text`: str
+            The full generated text.
+        - `usage`: dict | None
+            The `usage` object of the final chunk, requested with `stream_options.include_usage`.
+        - `finish_reason`: str | None
+            The `finish_reason` of the chunk that ended the choice.
+
+    ### Returns:
+        - `response`: AIResponse
+            The same object a non streamed completion would have produced.
+    """
+
+    if not usage:
+        print("Streamed completion didn't report usage, recording 0 tokens")
+        usage = {"prompt_tokens": 0, "completion_tokens": 0}
+
+    return AIResponse(
+        choices=[{"message": {"content": text}, "finish_reason": finish_reason}],
+        usage=usage,
+    )
+
+
+def parse_stream_line(line: str) -> tuple[str, dict | None, str | None, bool]:
+    """
+    ### Responsibility:
+        - Parse one server sent event line of a streamed chat completion.
+
+    ### Args:
+        - `line`: str
+            A line of the response body.
+
+    ### Returns:
+        - `chunk`: tuple[str, dict | None, str | None, bool]
+            The text delta, the usage and the finish reason if the chunk carries them, and whether the stream is done.
+
+    ### Raises:
+        - `RuntimeError`:
+            Raised if the chunk carries an API error.
+    """
+
+    if not line.startswith("data:"):
+        return "", None, None, False
+    data = line[len("data:") :].strip()
+    if data == "[DONE]":
+        return "", None, None, True
+
+    chunk = json.loads(data)
+    if chunk.get("error"):
+        raise RuntimeError(chunk["error"]["message"])
+    choices = chunk.get("choices", [])
+    delta = "".join(x.get("delta", {}).get("content") or "" for x in choices)
+    finish_reason = next(
+        (x["finish_reason"] for x in choices if x.get("finish_reason")), None
+    )
+    return delta, chunk.get("usage"), finish_reason, False
+
+
+@traced()
+def stream_openai(
+    model: ValidLLMModels | str,
+    messages: LLMMessageLog,
+    on_text: Callable[[str], None],
+    max_tokens: int = MAX_OUTPUT_TOKENS,
+) -> AIResponse:
+    """
+    ### Responsibility:
+        - Invoke the OpenAI API in streaming mode and report the text as it's generated.
+
+    ### Args:
+        - `model`: ValidLLMModels | str
+            The language model to use for the API call.
+        - `messages`: LLMMessageLog
+            A log of messages to send to the API.
+        - `on_text`: Callable[[str], None]
+            Called with the full text generated so far every time a chunk arrives.
+        - `max_tokens`: int
+            The most tokens the reply may use.
+
+    ### Returns:
+        - `response`: AIResponse
+            The complete response with its token usage.
+
+    ### Raises:
+        - `RuntimeError`:
+            Raised if the API returns an error.
+
+    ### How does the function work:
+        - Builds the same request as `invoke_openai`, with `stream` and `stream_options.include_usage` set so the final chunk carries token usage.
+        - Opens the stream through `request_with_retry` and `resilient_request`, so it gets the same retries, circuit breakers and fallback models as `invoke_openai`, without hedging. Fallback only happens before the first chunk: once the headers of a good response arrived, the stream is read to the end.
+        - Reads the server sent events, accumulating the deltas and calling `on_text`.
+        - Builds the `AIResponse` with `build_streamed_response`, and sets the model that answered on `served_by`.
+    """
+
+    def send(candidate: ValidLLMModels) -> httpx.Response:
+        url, payload, headers = build_streaming_request(candidate, messages, max_tokens)
+        response = request_with_retry(
+            Upstreams.OPENAI,
+            "POST",
+            url,
+            can_retry=RETRY_BUDGET.try_withdraw,
+            stream=True,
+            json=payload,
+            headers=headers,
+            timeout=LLM_REQUEST_TIMEOUT,
+        )
+        if response.status_code != 200:
+            # Read and closed here, a failed response may be dropped for the next model
+            response.read()
+        return response
+
+    response, served_by = resilient_request(ValidLLMModels(model), send, hedge=False)
+
+    text, usage, finish_reason = "", None, None
+    try:
+        if response.status_code != 200:
+            _, payload, _ = build_streaming_request(served_by, messages, max_tokens)
+            return parse_openai_response(response, payload)
+        for line in response.iter_lines():
+            delta, chunk_usage, chunk_finish, done = parse_stream_line(line)
+            if done:
+                break
+            usage = chunk_usage or usage
+            finish_reason = chunk_finish or finish_reason
+            if delta:
+                text += delta
+                on_text(text)
+    finally:
+        response.close()
+
+    parsed = build_streamed_response(text, usage, finish_reason)
+    parsed.served_by = served_by.value
+    return parsed
+
+
+class DeliveryTimer:
+    """
+    Wraps the `on_text` callback of a streamed reply, adding up the time spent
+    showing the text so it can be left out of the model's latency. Errors raised
+    while showing it are re-raised as `DeliveryError`.
+    """
+
+    def __init__(self):
+        self.seconds = 0.0
+
+    def wrap(self, on_text: Callable[[str], None]) -> Callable[[str], None]:
+        def timed(text: str):
+            started = time.perf_counter()
+            try:
+                on_text(text)
+            except Exception as e:
+                raise DeliveryError(f"{type(e).__name__}: {e}") from e
+            finally:
+                self.seconds += time.perf_counter() - started
+
+        return timed
+
+    def async_wrap(
+        self, on_text: Callable[[str], Awaitable[None]]
+    ) -> Callable[[str], Awaitable[None]]:
+        async def timed(text: str):
+            started = time.perf_counter()
+            try:
+                await on_text(text)
+            except Exception as e:
+                raise DeliveryError(f"{type(e).__name__}: {e}") from e
+            finally:
+                self.seconds += time.perf_counter() - started
+
+        return timed
+
+
+def handler_stream_response(
+    messages: LLMMessageLog,
+    model: ValidLLMModels,
+    on_text: Callable[[str], None],
+    max_tokens: int = MAX_OUTPUT_TOKENS,
+) -> AIResponse:
+    """Streaming variant of `handler_generate_response`, sets `latency` to the time spent waiting on the model"""
+
+    timer = DeliveryTimer()
+    started = time.perf_counter()
+    try:
+        with span(Stages.LLM_CALL.value):
+            response = stream_openai(model, messages, timer.wrap(on_text), max_tokens)
+    finally:
+        # Showing the text is timed as TELEGRAM_SEND, so it's left out of LLM_CALL
+        latency = time.perf_counter() - started - timer.seconds
+        observe_stage(Stages.LLM_CALL, latency)
+    response.latency = latency
+    response.calculate_cost(response.served_by, LLM_COST_PER_TOKEN)
+    record_llm_usage(
+        response.served_by, response.input_tokens, response.output_tokens, response.cost
+    )
+    if response.finish_reason == "length":
+        record_truncated_reply(response.served_by, max_tokens)
+
+    return response
+
+
+@traced()
+async def async_stream_openai(
+    model: ValidLLMModels | str,
+    messages: LLMMessageLog,
+    on_text: Callable[[str], Awaitable[None]],
+    max_tokens: int = MAX_OUTPUT_TOKENS,
+) -> AIResponse:
+    """Async variant of `stream_openai`, awaiting `on_text` for every chunk"""
+
+    async def send(candidate: ValidLLMModels) -> httpx.Response:
+        url, payload, headers = build_streaming_request(candidate, messages, max_tokens)
+        response = await async_request_with_retry(
+            Upstreams.OPENAI,
+            "POST",
+            url,
+            can_retry=RETRY_BUDGET.try_withdraw,
+            stream=True,
+            json=payload,
+            headers=headers,
+            timeout=LLM_REQUEST_TIMEOUT,
+        )
+        if response.status_code != 200:
+            await response.aread()
+        return response
+
+    response, served_by = await async_resilient_request(
+        ValidLLMModels(model), send, hedge=False
+    )
+
+    text, usage, finish_reason = "", None, None
+    try:
+        if response.status_code != 200:
+            _, payload, _ = build_streaming_request(served_by, messages, max_tokens)
+            return parse_openai_response(response, payload)
+        async for line in response.aiter_lines():
+            delta, chunk_usage, chunk_finish, done = parse_stream_line(line)
+            if done:
+                break
+            usage = chunk_usage or usage
+            finish_reason = chunk_finish or finish_reason
+            if delta:
+                text += delta
+                await on_text(text)
+    finally:
+        await response.aclose()
+
+    parsed = build_streamed_response(text, usage, finish_reason)
+    parsed.served_by = served_by.value
+    return parsed
+
+
+async def async_handler_stream_response(
+    messages: LLMMessageLog,
+    model: ValidLLMModels,
+    on_text: Callable[[str], Awaitable[None]],
+    max_tokens: int = MAX_OUTPUT_TOKENS,
+) -> AIResponse:
+    """Async variant of `handler_stream_response`"""
+
+    timer = DeliveryTimer()
+    started = time.perf_counter()
+    try:
+        with span(Stages.LLM_CALL.value):
+            response = await async_stream_openai(
+                model, messages, timer.async_wrap(on_text), max_tokens
+            )
+    finally:
+        latency = time.perf_counter() - started - timer.seconds
+        observe_stage(Stages.LLM_CALL, latency)
+    response.latency = latency
+    response.calculate_cost(response.served_by, LLM_COST_PER_TOKEN)
+    record_llm_usage(
+        response.served_by, response.input_tokens, response.output_tokens, response.cost
+    )
+    if response.finish_reason == "length":
+        record_truncated_reply(response.served_by, max_tokens)
 
     return response
 
@@ -149,70 +613,244 @@ def remove_handles_from_message(message: str) -> str:
     return message
 
 
-def format_telegram_chat_history(update: TelegramUpdatePing) -> list[LLMMessage]:
+def format_telegram_chat_history(update: TelegramUpdatePing) -> PromptContext:
     """
     ### Responsibility:
-        - Format the last N messages from a Telegram chat history into a list of `LLMMessage` objects.
+        - Format the recent Telegram chat history and the user's message into the parts of the prompt that fit the token budget.
 
     ### Args:
         - `update`: TelegramUpdatePing
             An object containing update information including chat ID and user ID.
 
     ### Returns:
-        - `messages`: list[LLMMessage]
-            A list of formatted `LLMMessage` objects containing the role and content of the last N messages.
+        - `context`: PromptContext
+            The `LLMMessage` history and user text to send, their estimated input tokens and the `max_tokens` of the reply.
 
     ### How does the function work:
-        - Retrieves the last 5 messages from the chat using the `get_last_n_messages` function.
-        - Converts each retrieved message into an `LLMMessage` object by mapping the message role and content.
-        - Returns the list of `LLMMessage` objects.
+        - Retrieves the last `HISTORY_DEPTH` messages of the conversation from the redis ring buffer with `get_history`, which warms itself from Postgres when cold.
+        - Fits the rendered system prompt, the history and the user's text into `INPUT_TOKEN_BUDGET` with `fit_prompt`, which uses each message's stored token count.
+        - Returns the `PromptContext`.
     """
 
-    messages = get_last_n_messages(update.message.chat.id, update.message.from_.id, n=3)
+    with time_stage(Stages.HISTORY_FETCH):
+        messages = get_history(update.message.chat.id, update.message.from_.id)
 
-    return [LLMMessage(role=x.role, content=x.message) for x in messages]
+    return fit_prompt(get_system_prompt(update), messages, update.message.text)
 
 
-def entry_generate_response_from_user_message(update: TelegramUpdatePing) -> AIResponse:
+async def async_format_telegram_chat_history(
+    update: TelegramUpdatePing,
+) -> PromptContext:
+    """Async variant of `format_telegram_chat_history`"""
+
+    with time_stage(Stages.HISTORY_FETCH):
+        messages = await async_get_history(
+            update.message.chat.id, update.message.from_.id
+        )
+
+    return fit_prompt(get_system_prompt(update), messages, update.message.text)
+
+
+def get_prompt_handle(update: TelegramUpdatePing) -> str:
+    """Returns the name the prompt uses for the user who sent the message"""
+
+    return update.message.from_.username or update.message.from_.first_name or "friend"
+
+
+def get_system_prompt(update: TelegramUpdatePing) -> str:
+    """Returns the system prompt addressed to the user who sent the message"""
+
+    return SYSTEM_PROMPT_TEMPLATE.format(handle=get_prompt_handle(update))
+
+
+def get_cache_key(
+    update: TelegramUpdatePing, history: list[LLMMessage], model: ValidLLMModels
+) -> str | None:
     """
     ### Responsibility:
-        - Generate a response from the language model for a given user message received via a Telegram update.
-        - Include both English and Persian translations in the response to aid the user in language learning.
+        - Build the response cache key of a user's message, without anything specific to the user.
 
     ### Args:
         - `update`: TelegramUpdatePing
-            An object containing update information, including the chat and user details, as well as the user message text.
+            The update holding the user's message.
+        - `history`: list[LLMMessage]
+            The formatted chat history sent with the message.
+        - `model`: ValidLLMModels
+            The model that answers.
 
     ### Returns:
-        - `response`: AIResponse
-            The language model's response to the user's message, formatted as an `AIResponse` object.
+        - `key`: str | None
+            The key from `get_response_cache_key`, or None if the message can't be cached.
+    """
 
-    ### How does the function work:
-        - Initializes a `LLMMessageLog` with a system message containing instructions for the bot's behavior and user information.
-        - Extends the log with the last 5 messages from the chat history by calling `format_telegram_chat_history`.
-        - Appends the user's latest message to the log.
-        - Calls `handler_generate_response` with the message log and a specific language model (OpenAI GPT-3.5 Turbo) to generate a response.
-        - Returns the generated `AIResponse`.
+    return get_response_cache_key(
+        model.value,
+        SYSTEM_PROMPT_TEMPLATE,
+        [
+            LLMMessage(role=x.role, content=remove_handles_from_message(x.content))
+            for x in history
+        ],
+        remove_handles_from_message(update.message.text),
+    )
+
+
+def get_served_cache_key(
+    update: TelegramUpdatePing,
+    history: list[LLMMessage],
+    key: str | None,
+    response: AIResponse,
+) -> str | None:
+    """Returns the cache key of the model that answered, which differs from the routed one's after a fallback"""
+
+    if not key or not response.served_by:
+        return key
+    return get_cache_key(update, history, ValidLLMModels(response.served_by))
+
+
+def build_message_log(
+    update: TelegramUpdatePing, context: PromptContext
+) -> LLMMessageLog:
+    """
+    ### Responsibility:
+        - Assemble the prompt for a user message: system prompt, chat history and the user's text.
+
+    ### Args:
+        - `update`: TelegramUpdatePing
+            The update holding the user's message.
+        - `context`: PromptContext
+            The history and user text that fit the budget, from `format_telegram_chat_history`.
+
+    ### Returns:
+        - `messages`: LLMMessageLog
+            The message log to send to the language model.
     """
 
     messages = LLMMessageLog(
         messages=[
             LLMMessage(
                 role=LLMRoles.SYSTEM,
-                content=f"""Your name is QuickLingoBot. You are a english langauge teacher and a helper for native persian speaker who wish to learn English. You'll be talking with them on a text chat. Focus on helping the user with thier questions. Help them in english and in persian. Be friendly, but assertive. You are an english teacher, so don't talk about anything that you wouldn't talk about in a casual classroom. In your response, make sure to include a persian translation of the english version as well. That way, users who don't english well can still learn something. Use telegram formatting as you'll be replying on telegram. Use emojis in your message
-                
-                You might be in a group chat. The user who sent the last message is @{update.message.from_.username or update.message.from_.first_name or 'friend'}. Only tag this user if you want to tag them. """,
+                content=get_system_prompt(update),
             ),
         ]
     )
 
-    messages.messages.extend(format_telegram_chat_history(update))
-    messages.messages.append(
-        LLMMessage(role=LLMRoles.USER, content=update.message.text)
-    )
+    messages.messages.extend(context.history)
+    messages.messages.append(LLMMessage(role=LLMRoles.USER, content=context.text))
+    return messages
 
-    response = handler_generate_response(messages, ValidLLMModels.OPENAI_GPT4o_MINI)
-    return response
+
+def entry_generate_response_from_user_message(update: TelegramUpdatePing) -> AIResponse:
+    """
+    ### Responsibility:
+        - Generate a response from the language model for a given user message received via a Telegram update.
+        - Include both English and Persian translations in the response to aid the user in language learning.
+
+    ### Args:
+        - `update`: TelegramUpdatePing
+            An object containing update information, including the chat and user details, as well as the user message text.
+
+    ### Returns:
+        - `response`: AIResponse
+            The language model's response to the user's message, formatted as an `AIResponse` object.
+
+    ### How does the function work:
+        - Chooses the language model with `route_model`, from the message, the chat's override, model health and today's spend.
+        - Looks the question up in the response cache with `get_cached_response`, and returns a hit with zero cost and tokens.
+        - Otherwise builds the `LLMMessageLog` with `build_message_log`, using the budgeted history and text from `format_telegram_chat_history`.
+        - Calls `handler_generate_response` with the message log, the routed model and the `max_tokens` chosen for the message to generate a response.
+        - Records the call's latency and outcome for the router, and logs the decision, with `track_model_call`.
+        - Caches the generated `AIResponse` with `store_cached_response`, under the key of the model that answered, and returns it.
+    """
+
+    decision = route_model(update)
+    context = format_telegram_chat_history(update)
+    cache_key = get_cache_key(update, context.history, decision.model)
+    with track_model_call(decision) as call:
+        if cached := get_cached_response(cache_key, get_prompt_handle(update)):
+            call.response = cached
+            return cached
+
+        messages = build_message_log(update, context)
+
+        call.response = handler_generate_response(
+            messages, decision.model, context.max_tokens
+        )
+    cache_key = get_served_cache_key(update, context.history, cache_key, call.response)
+    store_cached_response(cache_key, call.response, get_prompt_handle(update))
+    return call.response
+
+
+async def async_entry_generate_response_from_user_message(
+    update: TelegramUpdatePing,
+) -> AIResponse:
+    """Async variant of `entry_generate_response_from_user_message`"""
+
+    decision = await async_route_model(update)
+    context = await async_format_telegram_chat_history(update)
+    cache_key = get_cache_key(update, context.history, decision.model)
+    async with async_track_model_call(decision) as call:
+        handle = get_prompt_handle(update)
+        if cached := await async_get_cached_response(cache_key, handle):
+            call.response = cached
+            return cached
+
+        messages = build_message_log(update, context)
+
+        call.response = await async_handler_generate_response(
+            messages, decision.model, context.max_tokens
+        )
+    cache_key = get_served_cache_key(update, context.history, cache_key, call.response)
+    await async_store_cached_response(cache_key, call.response, handle)
+    return call.response
+
+
+def entry_stream_response_from_user_message(
+    update: TelegramUpdatePing, on_text: Callable[[str], None]
+) -> AIResponse:
+    """Streaming variant of `entry_generate_response_from_user_message`, cache hits are shown at once"""
+
+    decision = route_model(update)
+    context = format_telegram_chat_history(update)
+    cache_key = get_cache_key(update, context.history, decision.model)
+    with track_model_call(decision) as call:
+        if cached := get_cached_response(cache_key, get_prompt_handle(update)):
+            call.response = cached
+            on_text(cached.text)
+            return cached
+
+        messages = build_message_log(update, context)
+
+        call.response = handler_stream_response(
+            messages, decision.model, on_text, context.max_tokens
+        )
+    cache_key = get_served_cache_key(update, context.history, cache_key, call.response)
+    store_cached_response(cache_key, call.response, get_prompt_handle(update))
+    return call.response
+
+
+async def async_entry_stream_response_from_user_message(
+    update: TelegramUpdatePing, on_text: Callable[[str], Awaitable[None]]
+) -> AIResponse:
+    """Async variant of `entry_stream_response_from_user_message`"""
+
+    decision = await async_route_model(update)
+    context = await async_format_telegram_chat_history(update)
+    cache_key = get_cache_key(update, context.history, decision.model)
+    async with async_track_model_call(decision) as call:
+        handle = get_prompt_handle(update)
+        if cached := await async_get_cached_response(cache_key, handle):
+            call.response = cached
+            await on_text(cached.text)
+            return cached
+
+        messages = build_message_log(update, context)
+
+        call.response = await async_handler_stream_response(
+            messages, decision.model, on_text, context.max_tokens
+        )
+    cache_key = get_served_cache_key(update, context.history, cache_key, call.response)
+    await async_store_cached_response(cache_key, call.response, handle)
+    return call.response
 
 
 if __name__ == "__main__":
@@ -0,0 +1,644 @@
+"""
+Chooses the model that answers each message, from the message, model health and spend
+"""
+
+# pylint:disable=wrong-import-position
+
+import os
+import re
+import time
+from contextlib import contextmanager, asynccontextmanager
+from datetime import datetime, timezone
+
+import orjson
+import redis
+from pydantic import BaseModel
+from rich import print
+from wrapworks import cwdtoenv
+from dotenv import load_dotenv
+
+cwdtoenv()
+load_dotenv()
+
+from src.cache.core_redis_operations import REDIS_CLIENT, ASYNC_REDIS_CLIENT
+from src.cache.chat_settings_cache import (
+    get_cached_chat_settings,
+    async_get_cached_chat_settings,
+)
+from src.genai.token_estimator import estimate_tokens
+from src.postgres.select_functions import (
+    get_usage_day,
+    get_spend_on_day,
+    async_get_spend_on_day,
+)
+from src.models.gen_ai_models import ValidLLMModels, LLM_COST_PER_TOKEN, AIResponse
+from src.models.telegram_update_models import TelegramUpdatePing
+
+# When off, every message is answered by `ROUTER_DEFAULT_MODEL`
+MODEL_ROUTER_ENABLED = os.getenv("MODEL_ROUTER_ENABLED", "false").lower() == "true"
+
+ROUTER_CHEAP_MODEL = ValidLLMModels(os.getenv("ROUTER_CHEAP_MODEL", "gpt-4o-mini"))
+ROUTER_DEFAULT_MODEL = ValidLLMModels(os.getenv("ROUTER_DEFAULT_MODEL", "gpt-4o-mini"))
+ROUTER_STRONG_MODEL = ValidLLMModels(os.getenv("ROUTER_STRONG_MODEL", "gpt-4o"))
+
+# Messages at least this long go to the strong model
+LONG_MESSAGE_TOKENS = int(os.getenv("ROUTER_LONG_MESSAGE_TOKENS", "120"))
+# Translation requests up to this long go to the cheap model
+SHORT_MESSAGE_TOKENS = int(os.getenv("ROUTER_SHORT_MESSAGE_TOKENS", "30"))
+
+# Dollars per UTC day. Past a ceiling every message goes to the cheapest model, 0 turns it off
+DAILY_SPEND_CEILING = float(os.getenv("ROUTER_DAILY_SPEND_CEILING", "0"))
+CHAT_DAILY_SPEND_CEILING = float(os.getenv("ROUTER_CHAT_DAILY_SPEND_CEILING", "0"))
+SPEND_CACHE_TTL = float(os.getenv("ROUTER_SPEND_CACHE_TTL", "60"))
+
+# A model is skipped while its calls of the last window are failing or slow
+STATS_WINDOW = int(os.getenv("ROUTER_STATS_WINDOW", "300"))
+STATS_CACHE_TTL = float(os.getenv("ROUTER_STATS_CACHE_TTL", "5"))
+MIN_CALLS_FOR_HEALTH = int(os.getenv("ROUTER_MIN_CALLS_FOR_HEALTH", "20"))
+MAX_ERROR_RATE = float(os.getenv("ROUTER_MAX_ERROR_RATE", "0.2"))
+MAX_AVG_LATENCY = float(os.getenv("ROUTER_MAX_AVG_LATENCY", "20"))
+
+# Capped stream of decisions and their outcome, export it with `python -m src.genai.model_router`
+DECISIONS_STREAM = "model_router:decisions"
+DECISIONS_MAX_ENTRIES = int(os.getenv("ROUTER_DECISIONS_MAX_ENTRIES", "200000"))
+
+STATS_BUCKET_SECONDS = 60
+
+TRANSLATION_PATTERN = re.compile(
+    r"\b(translate|translation|meaning of|what does .+ mean|how do you say)\b"
+    r"|ترجمه|معنی|معنای|یعنی چی|به انگلیسی|به فارسی",
+    re.IGNORECASE,
+)
+PERSIAN_LETTER_PATTERN = re.compile(r"[؀-ۿ]")
+LATIN_LETTER_PATTERN = re.compile(r"[A-Za-z]")
+
+_SPEND_CACHE: dict[int, tuple[float, tuple[float, float]]] = {}
+_STATS_CACHE: dict[str, tuple[float, "ModelStats"]] = {}
+
+
+class MessageFeatures(BaseModel):
+    """What the router looks at in a message"""
+
+    tokens: int
+    persian_ratio: float
+    is_translation: bool
+
+    @property
+    def is_mixed_language(self) -> bool:
+        return 0.2 <= self.persian_ratio <= 0.8
+
+
+class ModelStats(BaseModel):
+    """Calls, errors and latency of a model over the last `STATS_WINDOW` seconds, across workers"""
+
+    calls: int = 0
+    errors: int = 0
+    latency: float = 0
+
+    @property
+    def error_rate(self) -> float:
+        return self.errors / self.calls if self.calls else 0
+
+    @property
+    def avg_latency(self) -> float:
+        successes = self.calls - self.errors
+        return self.latency / successes if successes else 0
+
+    @property
+    def is_healthy(self) -> bool:
+        if self.calls < MIN_CALLS_FOR_HEALTH:
+            return True
+        return self.error_rate <= MAX_ERROR_RATE and self.avg_latency <= MAX_AVG_LATENCY
+
+
+class RoutingDecision(BaseModel):
+    """The model chosen for a message and why, logged with the outcome of the call"""
+
+    model: ValidLLMModels
+    reason: str
+    wanted: ValidLLMModels
+    features: MessageFeatures | None = None
+    day_spend: float = 0
+    chat_spend: float = 0
+    chat_id: int
+    user_id: int
+    message_id: int
+    decided_at: float
+
+
+def get_message_features(text: str) -> MessageFeatures:
+    """
+    ### Responsibility:
+        - Extract the features the router decides on from a user's message.
+
+    ### Args:
+        - `text`: str
+            The user's message.
+
+    ### Returns:
+        - `features`: MessageFeatures
+            The estimated tokens, the share of Persian letters and whether the message asks for a translation.
+    """
+
+    persian = len(PERSIAN_LETTER_PATTERN.findall(text))
+    latin = len(LATIN_LETTER_PATTERN.findall(text))
+
+    return MessageFeatures(
+        tokens=estimate_tokens(text),
+        persian_ratio=persian / (persian + latin) if persian + latin else 0,
+        is_translation=bool(TRANSLATION_PATTERN.search(text)),
+    )
+
+
+def get_cheapest_model() -> ValidLLMModels:
+    """Returns the model with the lowest output price in `LLM_COST_PER_TOKEN`"""
+
+    return min(ValidLLMModels, key=lambda x: LLM_COST_PER_TOKEN[x.value]["output"])
+
+
+def choose_model_for_features(features: MessageFeatures) -> tuple[ValidLLMModels, str]:
+    """
+    ### Responsibility:
+        - Pick the model a message needs, before health and spend are considered.
+
+    ### Args:
+        - `features`: MessageFeatures
+            The features from `get_message_features`.
+
+    ### Returns:
+        - `choice`: tuple[ValidLLMModels, str]
+            The model and the reason it was picked.
+
+    ### How does the function work:
+        - Short translation requests go to `ROUTER_CHEAP_MODEL`.
+        - Long messages, and questions mixing Persian and English that aren't translations, go to `ROUTER_STRONG_MODEL`.
+        - Everything else goes to `ROUTER_DEFAULT_MODEL`.
+    """
+
+    if features.is_translation and features.tokens <= SHORT_MESSAGE_TOKENS:
+        return ROUTER_CHEAP_MODEL, "short_translation"
+    if features.tokens >= LONG_MESSAGE_TOKENS:
+        return ROUTER_STRONG_MODEL, "long_message"
+    if features.is_mixed_language and not features.is_translation:
+        return ROUTER_STRONG_MODEL, "mixed_language"
+    return ROUTER_DEFAULT_MODEL, "default"
+
+
+def get_stats_key(model: ValidLLMModels, bucket: int) -> str:
+    return f"model_stats:{model.value}:{bucket}"
+
+
+def _get_stats_keys(model: ValidLLMModels) -> list[str]:
+    current = int(time.time()) // STATS_BUCKET_SECONDS
+    buckets = STATS_WINDOW // STATS_BUCKET_SECONDS
+    return [get_stats_key(model, current - i) for i in range(buckets)]
+
+
+def _sum_stats(buckets: list[dict]) -> ModelStats:
+    stats = ModelStats()
+    for bucket in buckets:
+        stats.calls += int(bucket.get("calls", 0))
+        stats.errors += int(bucket.get("errors", 0))
+        stats.latency += float(bucket.get("latency", 0))
+    return stats
+
+
+def _get_local(cache: dict, key):
+    cached = cache.get(key)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    return None
+
+
+def get_model_stats() -> dict[str, ModelStats]:
+    """
+    ### Responsibility:
+        - Return the rolling call statistics of every model.
+
+    ### Returns:
+        - `stats`: dict[str, ModelStats]
+            The statistics of each model in `ValidLLMModels`, by model name.
+
+    ### How does the function work:
+        - Sums the per minute buckets of the last `STATS_WINDOW` seconds that `record_model_call` writes in redis, in one pipeline.
+        - Keeps the result in process for `ROUTER_STATS_CACHE_TTL` seconds, so routing doesn't cost a redis round trip per message.
+        - Treats every model as healthy if redis is unreachable.
+    """
+
+    if cached := _get_local(_STATS_CACHE, "all"):
+        return cached
+
+    try:
+        with REDIS_CLIENT.pipeline(transaction=False) as pipe:
+            for model in ValidLLMModels:
+                for key in _get_stats_keys(model):
+                    pipe.hgetall(key)
+            buckets = pipe.execute()
+    except redis.RedisError as e:
+        print(f"Model router can't read stats: {type(e).__name__}: {e}")
+        return {x.value: ModelStats() for x in ValidLLMModels}
+
+    size = STATS_WINDOW // STATS_BUCKET_SECONDS
+    stats = {
+        model.value: _sum_stats(buckets[i * size : (i + 1) * size])
+        for i, model in enumerate(ValidLLMModels)
+    }
+    _STATS_CACHE["all"] = (time.monotonic() + STATS_CACHE_TTL, stats)
+    return stats
+
+
+async def async_get_model_stats() -> dict[str, ModelStats]:
+    """Async variant of `get_model_stats`"""
+
+    if cached := _get_local(_STATS_CACHE, "all"):
+        return cached
+
+    try:
+        async with ASYNC_REDIS_CLIENT.pipeline(transaction=False) as pipe:
+            for model in ValidLLMModels:
+                for key in _get_stats_keys(model):
+                    pipe.hgetall(key)
+            buckets = await pipe.execute()
+    except redis.RedisError as e:
+        print(f"Model router can't read stats: {type(e).__name__}: {e}")
+        return {x.value: ModelStats() for x in ValidLLMModels}
+
+    size = STATS_WINDOW // STATS_BUCKET_SECONDS
+    stats = {
+        model.value: _sum_stats(buckets[i * size : (i + 1) * size])
+        for i, model in enumerate(ValidLLMModels)
+    }
+    _STATS_CACHE["all"] = (time.monotonic() + STATS_CACHE_TTL, stats)
+    return stats
+
+
+def get_spend(chat_id: int) -> tuple[float, float]:
+    """Returns today's total and chat spend, cached in process for `ROUTER_SPEND_CACHE_TTL` seconds"""
+
+    if not DAILY_SPEND_CEILING and not CHAT_DAILY_SPEND_CEILING:
+        return 0, 0
+    if cached := _get_local(_SPEND_CACHE, chat_id):
+        return cached
+
+    spend = get_spend_on_day(chat_id, get_usage_day())
+    _SPEND_CACHE[chat_id] = (time.monotonic() + SPEND_CACHE_TTL, spend)
+    return spend
+
+
+async def async_get_spend(chat_id: int) -> tuple[float, float]:
+    """Async variant of `get_spend`"""
+
+    if not DAILY_SPEND_CEILING and not CHAT_DAILY_SPEND_CEILING:
+        return 0, 0
+    if cached := _get_local(_SPEND_CACHE, chat_id):
+        return cached
+
+    spend = await async_get_spend_on_day(chat_id, get_usage_day())
+    _SPEND_CACHE[chat_id] = (time.monotonic() + SPEND_CACHE_TTL, spend)
+    return spend
+
+
+def is_over_spend_ceiling(day_spend: float, chat_spend: float) -> bool:
+    """Checks if today's spend reached the global or the chat's ceiling"""
+
+    if DAILY_SPEND_CEILING and day_spend >= DAILY_SPEND_CEILING:
+        return True
+    return bool(CHAT_DAILY_SPEND_CEILING and chat_spend >= CHAT_DAILY_SPEND_CEILING)
+
+
+def get_healthy_model(
+    model: ValidLLMModels, stats: dict[str, ModelStats]
+) -> ValidLLMModels | None:
+    """
+    ### Responsibility:
+        - Replace a model that is failing or slow with the closest healthy one.
+
+    ### Args:
+        - `model`: ValidLLMModels
+            The model the router wants.
+        - `stats`: dict[str, ModelStats]
+            The rolling statistics from `get_model_stats`.
+
+    ### Returns:
+        - `model`: ValidLLMModels | None
+            The healthy model closest in price, or None if the model is healthy or no model is.
+    """
+
+    if stats[model.value].is_healthy:
+        return None
+
+    price = LLM_COST_PER_TOKEN[model.value]["output"]
+    healthy = [x for x in ValidLLMModels if stats[x.value].is_healthy]
+    if not healthy:
+        return None
+    return min(
+        healthy, key=lambda x: abs(LLM_COST_PER_TOKEN[x.value]["output"] - price)
+    )
+
+
+def decide_model(
+    update: TelegramUpdatePing,
+    override: str | None,
+    stats: dict[str, ModelStats],
+    spend: tuple[float, float],
+) -> RoutingDecision:
+    """
+    ### Responsibility:
+        - Choose the model for a message from the inputs `route_model` gathered.
+
+    ### Args:
+        - `update`: TelegramUpdatePing
+            The update holding the user's message.
+        - `override`: str | None
+            The chat's `MODEL_OVERRIDE`.
+        - `stats`: dict[str, ModelStats]
+            The rolling statistics from `get_model_stats`.
+        - `spend`: tuple[float, float]
+            Today's total and chat spend from `get_spend`.
+
+    ### Returns:
+        - `decision`: RoutingDecision
+            The chosen model, the model that was wanted and the reason for the difference.
+
+    ### How does the function work:
+        - Uses the chat's override if it has a valid one, otherwise `choose_model_for_features`.
+        - Downgrades to the cheapest model once a spend ceiling is reached, overrides included.
+        - Otherwise swaps an unhealthy model for a healthy one with `get_healthy_model`.
+    """
+
+    message = update.message
+    features = get_message_features(message.text)
+    if override in {x.value for x in ValidLLMModels}:
+        wanted, reason = ValidLLMModels(override), "chat_override"
+    else:
+        wanted, reason = choose_model_for_features(features)
+
+    model = wanted
+    if is_over_spend_ceiling(*spend):
+        model, reason = get_cheapest_model(), "spend_ceiling"
+    elif replacement := get_healthy_model(wanted, stats):
+        model, reason = replacement, f"{reason}:unhealthy"
+
+    return RoutingDecision(
+        model=model,
+        reason=reason,
+        wanted=wanted,
+        features=features,
+        day_spend=spend[0],
+        chat_spend=spend[1],
+        chat_id=message.chat.id,
+        user_id=message.from_.id,
+        message_id=message.message_id,
+        decided_at=time.time(),
+    )
+
+
+def get_default_decision(update: TelegramUpdatePing) -> RoutingDecision:
+    """Returns the decision used while `MODEL_ROUTER_ENABLED` is off"""
+
+    return RoutingDecision(
+        model=ROUTER_DEFAULT_MODEL,
+        reason="router_disabled",
+        wanted=ROUTER_DEFAULT_MODEL,
+        chat_id=update.message.chat.id,
+        user_id=update.message.from_.id,
+        message_id=update.message.message_id,
+        decided_at=time.time(),
+    )
+
+
+def route_model(update: TelegramUpdatePing) -> RoutingDecision:
+    """
+    ### Responsibility:
+        - Choose the model that answers a user's message.
+
+    ### Args:
+        - `update`: TelegramUpdatePing
+            The update holding the user's message.
+
+    ### Returns:
+        - `decision`: RoutingDecision
+            The decision, to pass to `track_model_call` around the LLM call.
+
+    ### How does the function work:
+        - Returns `ROUTER_DEFAULT_MODEL` while `MODEL_ROUTER_ENABLED` is off.
+        - Reads the chat's override from the cached chat settings, the rolling model statistics and today's spend, all cached in process.
+        - Decides with `decide_model`.
+    """
+
+    if not MODEL_ROUTER_ENABLED:
+        return get_default_decision(update)
+
+    settings = get_cached_chat_settings(update.message.chat.id)
+    return decide_model(
+        update,
+        settings.model_override,
+        get_model_stats(),
+        get_spend(update.message.chat.id),
+    )
+
+
+async def async_route_model(update: TelegramUpdatePing) -> RoutingDecision:
+    """Async variant of `route_model`"""
+
+    if not MODEL_ROUTER_ENABLED:
+        return get_default_decision(update)
+
+    settings = await async_get_cached_chat_settings(update.message.chat.id)
+    return decide_model(
+        update,
+        settings.model_override,
+        await async_get_model_stats(),
+        await async_get_spend(update.message.chat.id),
+    )
+
+
+class DeliveryError(Exception):
+    """Raised when showing a streamed reply fails during a model call, which the model isn't to blame for"""
+
+
+class ModelCall(BaseModel):
+    """Outcome of the LLM call of a decision, set inside `track_model_call`"""
+
+    response: AIResponse | None = None
+    started_at: float = 0
+    # The model answered, but the reply couldn't be delivered
+    delivery_failed: bool = False
+
+    def get_latency(self) -> float:
+        """Returns the latency the response measured, or the time since the call started"""
+
+        if self.response and self.response.latency is not None:
+            return self.response.latency
+        return time.perf_counter() - self.started_at
+
+    def get_model(self, decision: RoutingDecision) -> ValidLLMModels:
+        """Returns the model that answered, the routed one if there's no response"""
+
+        if self.response and self.response.served_by:
+            return ValidLLMModels(self.response.served_by)
+        return decision.model
+
+
+def build_decision_entry(
+    decision: RoutingDecision, call: ModelCall, latency: float, error: str | None
+) -> dict:
+    """Returns the stream entry of a decision and the outcome of its call"""
+
+    response = call.response
+    entry = decision.model_dump(mode="json") | {
+        "latency": round(latency, 3),
+        "error": error,
+        "cached": bool(response and response.cached),
+        "input_tokens": response.input_tokens if response else 0,
+        "output_tokens": response.output_tokens if response else 0,
+        "cost": (response.cost or 0) if response else 0,
+        "served_by": response.served_by if response else None,
+        "day": datetime.fromtimestamp(decision.decided_at, timezone.utc).date(),
+    }
+    return {"d": orjson.dumps(entry)}
+
+
+def _stats_updates(model: ValidLLMModels, latency: float, error: str | None):
+    key = get_stats_key(model, int(time.time()) // STATS_BUCKET_SECONDS)
+    fields = {"calls": 1, "errors": 1 if error else 0}
+    return key, fields, 0 if error else latency
+
+
+def record_model_call(
+    decision: RoutingDecision, call: ModelCall, latency: float, error: str | None
+):
+    """
+    ### Responsibility:
+        - Feed the outcome of a routed call back into the model statistics and the decision log.
+
+    ### Args:
+        - `decision`: RoutingDecision
+            The decision the call was made with.
+        - `call`: ModelCall
+            The call, with its response if it succeeded.
+        - `latency`: float
+            Seconds the call took.
+        - `error`: str | None
+            The error the call failed with.
+
+    ### Returns:
+        - None
+
+    ### How does the function work:
+        - Cache hits don't reach a model and failed deliveries aren't the model's fault, so they are only logged.
+        - Otherwise counts the call, its error and latency in the current minute bucket of the model that answered, which differs from the routed one after a fallback.
+        - Appends the decision with its latency, tokens and cost to `DECISIONS_STREAM`, capped near `ROUTER_DECISIONS_MAX_ENTRIES` entries.
+        - Logging never fails the reply, redis errors are printed.
+    """
+
+    try:
+        with REDIS_CLIENT.pipeline(transaction=False) as pipe:
+            if (
+                not (call.response and call.response.cached)
+                and not call.delivery_failed
+            ):
+                key, fields, spent = _stats_updates(
+                    call.get_model(decision), latency, error
+                )
+                for field, amount in fields.items():
+                    pipe.hincrby(key, field, amount)
+                pipe.hincrbyfloat(key, "latency", spent)
+                pipe.expire(key, STATS_WINDOW + STATS_BUCKET_SECONDS)
+            pipe.xadd(
+                DECISIONS_STREAM,
+                build_decision_entry(decision, call, latency, error),
+                maxlen=DECISIONS_MAX_ENTRIES,
+                approximate=True,
+            )
+            pipe.execute()
+    except redis.RedisError as e:
+        print(f"Couldn't record routing decision: {type(e).__name__}: {e}")
+
+
+async def async_record_model_call(
+    decision: RoutingDecision, call: ModelCall, latency: float, error: str | None
+):
+    """Async variant of `record_model_call`"""
+
+    try:
+        async with ASYNC_REDIS_CLIENT.pipeline(transaction=False) as pipe:
+            if (
+                not (call.response and call.response.cached)
+                and not call.delivery_failed
+            ):
+                key, fields, spent = _stats_updates(
+                    call.get_model(decision), latency, error
+                )
+                for field, amount in fields.items():
+                    pipe.hincrby(key, field, amount)
+                pipe.hincrbyfloat(key, "latency", spent)
+                pipe.expire(key, STATS_WINDOW + STATS_BUCKET_SECONDS)
+            pipe.xadd(
+                DECISIONS_STREAM,
+                build_decision_entry(decision, call, latency, error),
+                maxlen=DECISIONS_MAX_ENTRIES,
+                approximate=True,
+            )
+            await pipe.execute()
+    except redis.RedisError as e:
+        print(f"Couldn't record routing decision: {type(e).__name__}: {e}")
+
+
+@contextmanager
+def track_model_call(decision: RoutingDecision):
+    """
+    ### Responsibility:
+        - Time the LLM call made for a decision and record its outcome with `record_model_call`.
+
+    ### Args:
+        - `decision`: RoutingDecision
+            The decision from `route_model`.
+
+    ### Returns:
+        - `call`: ModelCall
+            Set `call.response` to the response inside the block.
+
+    ### How does the function work:
+        - Uses the latency set on the response if there is one, streamed replies set it to leave out the time spent showing the text.
+        - A `DeliveryError` is logged with the decision but not counted against the model.
+    """
+
+    call = ModelCall(started_at=time.perf_counter())
+    try:
+        yield call
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        call.delivery_failed = isinstance(e, DeliveryError)
+        record_model_call(decision, call, call.get_latency(), error)
+        raise
+    record_model_call(decision, call, call.get_latency(), None)
+
+
+@asynccontextmanager
+async def async_track_model_call(decision: RoutingDecision):
+    """Async variant of `track_model_call`"""
+
+    call = ModelCall(started_at=time.perf_counter())
+    try:
+        yield call
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        call.delivery_failed = isinstance(e, DeliveryError)
+        await async_record_model_call(decision, call, call.get_latency(), error)
+        raise
+    await async_record_model_call(decision, call, call.get_latency(), None)
+
+
+def export_decisions():
+    """Print every logged decision as JSON lines, oldest first, for offline analysis"""
+
+    start = "-"
+    while entries := REDIS_CLIENT.xrange(DECISIONS_STREAM, min=start, count=1000):
+        for _, fields in entries:
+            os.write(1, fields["d"].encode() + b"\n")
+        start = f"({entries[-1][0]}"
+
+
+if __name__ == "__main__":
+    export_decisions()
@@ -0,0 +1,536 @@
+"""
+Hedging, circuit breaking and fallback around the LLM calls
+"""
+
+# pylint:disable=wrong-import-position
+
+import os
+import time
+import asyncio
+import threading
+from functools import partial
+from enum import Enum
+from collections import deque
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ThreadPoolExecutor,
+    TimeoutError as FutureTimeoutError,
+    wait,
+)
+from typing import Awaitable, Callable
+
+import httpx
+import redis
+from rich import print
+from wrapworks import cwdtoenv
+from dotenv import load_dotenv
+
+cwdtoenv()
+load_dotenv()
+
+from src.cache.core_redis_operations import REDIS_CLIENT, ASYNC_REDIS_CLIENT
+from src.models.gen_ai_models import ValidLLMModels
+
+# Bounds a single attempt, hedging and fallback handle the slow ones
+LLM_REQUEST_TIMEOUT = float(os.getenv("LLM_REQUEST_TIMEOUT", "60"))
+
+# A second request is sent once the first takes longer than this percentile of recent calls.
+# Off by default: both requests are billed, and the sync workers can't cancel the losing one
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "false").lower() == "true"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "0.95"))
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "2"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+LATENCY_WINDOW = int(os.getenv("HEDGE_LATENCY_WINDOW", "200"))
+HEDGE_THREADS = int(os.getenv("HEDGE_THREADS", "8"))
+
+# Consecutive failures that open an endpoint's circuit, and how long it stays open
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_OPEN_SECONDS = float(os.getenv("CIRCUIT_OPEN_SECONDS", "30"))
+
+# Hedges and retries may add this share of extra requests, plus a small floor
+RETRY_BUDGET_RATIO = float(os.getenv("RETRY_BUDGET_RATIO", "0.1"))
+RETRY_BUDGET_MIN_PER_SECOND = float(os.getenv("RETRY_BUDGET_MIN_PER_SECOND", "0.5"))
+RETRY_BUDGET_MAX_TOKENS = float(os.getenv("RETRY_BUDGET_MAX_TOKENS", "10"))
+
+# Tried in order when a model's circuit is open or its call failed, as model:fallback,...
+LLM_FALLBACK_MODELS = os.getenv(
+    "LLM_FALLBACK_MODELS",
+    "gpt-4o:gpt-4o-mini,gpt-4o-mini:gpt-3.5-turbo,gpt-3.5-turbo:gpt-4o-mini",
+)
+
+STATS_KEY = "llm_resilience:stats"
+
+# Statuses that mean the endpoint is unhealthy, anything else is the request's fault
+FAILURE_STATUSES = {429, 500, 502, 503, 504}
+
+
+class CircuitStates(Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised when every model that could answer has an open circuit"""
+
+
+class CircuitBreaker:
+    """
+    Stops calling an endpoint after `failure_threshold` consecutive failures.
+
+    The circuit stays open for `open_seconds`, then lets a single trial call
+    through. The trial closes the circuit if it succeeds and opens it again if
+    it fails. State is per process, each worker finds out on its own.
+    """
+
+    def __init__(self, name: str, failure_threshold: int, open_seconds: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.state = CircuitStates.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """Checks if a call may go through, moving an open circuit to half open once it cooled down"""
+
+        with self.lock:
+            if self.state == CircuitStates.CLOSED:
+                return True
+            if self.state == CircuitStates.OPEN:
+                if time.monotonic() - self.opened_at < self.open_seconds:
+                    return False
+                self.state = CircuitStates.HALF_OPEN
+                return True
+            # Half open: the trial call is in flight
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.state = CircuitStates.CLOSED
+            self.failures = 0
+
+    def record_failure(self) -> bool:
+        """Counts a failure, returns True if it opened the circuit"""
+
+        with self.lock:
+            self.failures += 1
+            if self.state == CircuitStates.HALF_OPEN or (
+                self.state == CircuitStates.CLOSED
+                and self.failures >= self.failure_threshold
+            ):
+                self.state = CircuitStates.OPEN
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+
+class RetryBudget:
+    """
+    Token bucket that bounds the extra requests sent on top of first attempts.
+
+    Every first attempt deposits `ratio` tokens and the bucket refills by
+    `min_per_second`, so while the upstream struggles the extra load stays
+    around `ratio` of the normal load instead of multiplying it.
+    """
+
+    def __init__(self, ratio: float, min_per_second: float, max_tokens: float):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, amount: float):
+        now = time.monotonic()
+        amount += (now - self.updated_at) * self.min_per_second
+        self.tokens = min(self.max_tokens, self.tokens + amount)
+        self.updated_at = now
+
+    def deposit(self):
+        """Record a first attempt"""
+
+        with self.lock:
+            self._refill(self.ratio)
+
+    def try_withdraw(self) -> bool:
+        """Take a token for an extra request, returns False if the budget is spent"""
+
+        with self.lock:
+            self._refill(0)
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class LatencyTracker:
+    """Latencies of a model's recent successful calls, to decide when to hedge"""
+
+    def __init__(self, size: int):
+        self.latencies: deque[float] = deque(maxlen=size)
+
+    def record(self, latency: float):
+        self.latencies.append(latency)
+
+    def get_hedge_delay(self) -> float | None:
+        """Returns the `HEDGE_PERCENTILE` latency, or None while there are too few samples"""
+
+        if len(self.latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * HEDGE_PERCENTILE))
+        return max(HEDGE_MIN_DELAY, ordered[index])
+
+
+BREAKERS = {
+    x: CircuitBreaker(x.value, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_OPEN_SECONDS)
+    for x in ValidLLMModels
+}
+LATENCIES = {x: LatencyTracker(LATENCY_WINDOW) for x in ValidLLMModels}
+RETRY_BUDGET = RetryBudget(
+    RETRY_BUDGET_RATIO, RETRY_BUDGET_MIN_PER_SECOND, RETRY_BUDGET_MAX_TOKENS
+)
+
+_EXECUTOR: ThreadPoolExecutor | None = None
+_EXECUTOR_PID: int | None = None
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _EXECUTOR, _EXECUTOR_PID
+
+    # Threads don't survive a fork, so each worker process needs its own pool
+    if _EXECUTOR_PID != os.getpid():
+        _EXECUTOR = ThreadPoolExecutor(HEDGE_THREADS, thread_name_prefix="llm-hedge")
+        _EXECUTOR_PID = os.getpid()
+    return _EXECUTOR
+
+
+def get_fallback_chain(model: ValidLLMModels) -> list[ValidLLMModels]:
+    """
+    ### Responsibility:
+        - List the models to try for a call, in order.
+
+    ### Args:
+        - `model`: ValidLLMModels
+            The model the call was made for.
+
+    ### Returns:
+        - `models`: list[ValidLLMModels]
+            The model followed by its fallbacks from `LLM_FALLBACK_MODELS`, without repeats.
+    """
+
+    fallbacks = dict(x.split(":") for x in LLM_FALLBACK_MODELS.split(",") if x)
+    chain = [model]
+    while (name := fallbacks.get(chain[-1].value)) and ValidLLMModels(
+        name
+    ) not in chain:
+        chain.append(ValidLLMModels(name))
+    return chain
+
+
+def is_failure(response: httpx.Response) -> bool:
+    """Checks if a response means the endpoint is unhealthy"""
+
+    return response.status_code in FAILURE_STATUSES
+
+
+def get_response_tokens(response: httpx.Response) -> int:
+    """Returns the tokens a completion was billed for, 0 when it has no usage"""
+
+    try:
+        return int(response.json().get("usage", {}).get("total_tokens") or 0)
+    except Exception:
+        return 0
+
+
+def count_event(event: str, amount: int = 1):
+    """Counts a hedge, trip or fallback across every worker, never failing the call"""
+
+    try:
+        REDIS_CLIENT.hincrby(STATS_KEY, event, amount)
+    except redis.RedisError as e:
+        print(f"Couldn't count {event}: {type(e).__name__}: {e}")
+
+
+async def async_count_event(event: str, amount: int = 1):
+    """Async variant of `count_event`"""
+
+    try:
+        await ASYNC_REDIS_CLIENT.hincrby(STATS_KEY, event, amount)
+    except redis.RedisError as e:
+        print(f"Couldn't count {event}: {type(e).__name__}: {e}")
+
+
+def _timed(send: Callable[[], httpx.Response]) -> tuple[httpx.Response, float]:
+    started = time.perf_counter()
+    response = send()
+    return response, time.perf_counter() - started
+
+
+def _count_duplicate_tokens(future: Future):
+    """Counts the tokens of a losing hedge once it finishes, it was billed all the same"""
+
+    if future.exception() is None and not is_failure(future.result()[0]):
+        count_event("hedge_duplicate_tokens", get_response_tokens(future.result()[0]))
+
+
+def _first_success(futures: list[Future]) -> Future:
+    pending = set(futures)
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None and not is_failure(future.result()[0]):
+                return future
+    # Every request failed, report the first one
+    return futures[0]
+
+
+def hedged_request(
+    model: ValidLLMModels, send: Callable[[], httpx.Response]
+) -> httpx.Response:
+    """
+    ### Responsibility:
+        - Send a request, and a copy of it if the first is slower than usual, and return the first good answer.
+
+    ### Args:
+        - `model`: ValidLLMModels
+            The model the request is for, whose recent latencies decide when to hedge.
+        - `send`: Callable[[], httpx.Response]
+            Sends the request once.
+
+    ### Returns:
+        - `response`: httpx.Response
+            The first successful response, or the first request's response if both failed.
+
+    ### Raises:
+        - `httpx.TransportError`:
+            Raised if the first request failed without a response and the hedge didn't succeed.
+
+    ### How does the function work:
+        - Without enough latency samples, or with `HEDGE_ENABLED` off, sends the request once.
+        - Otherwise sends it on the hedge thread pool and waits up to the model's `HEDGE_PERCENTILE` latency.
+        - If it's still running and `RETRY_BUDGET` allows, sends a second copy and takes whichever succeeds first.
+        - A blocking request can't be cancelled, so the losing request finishes on its thread and is discarded. It's still a completion OpenAI bills for: every hedge that fires costs a second call, and its tokens are counted as `hedge_duplicate_tokens`.
+    """
+
+    delay = LATENCIES[model].get_hedge_delay() if HEDGE_ENABLED else None
+    if delay is None:
+        response, latency = _timed(send)
+    else:
+        executor = _get_executor()
+        first = executor.submit(_timed, send)
+        try:
+            response, latency = first.result(timeout=delay)
+        except FutureTimeoutError:
+            if not RETRY_BUDGET.try_withdraw():
+                count_event("hedges_over_budget")
+                response, latency = first.result()
+            else:
+                count_event("hedges")
+                second = executor.submit(_timed, send)
+                winner = _first_success([first, second])
+                if winner is second:
+                    count_event("hedge_wins")
+                (first if winner is second else second).add_done_callback(
+                    _count_duplicate_tokens
+                )
+                response, latency = winner.result()
+
+    if not is_failure(response):
+        LATENCIES[model].record(latency)
+    return response
+
+
+async def _async_timed(
+    send: Callable[[], Awaitable[httpx.Response]],
+) -> tuple[httpx.Response, float]:
+    started = time.perf_counter()
+    response = await send()
+    return response, time.perf_counter() - started
+
+
+async def async_hedged_request(
+    model: ValidLLMModels, send: Callable[[], Awaitable[httpx.Response]]
+) -> httpx.Response:
+    """Async variant of `hedged_request`, the losing request is cancelled and only counted when it had already finished"""
+
+    delay = LATENCIES[model].get_hedge_delay() if HEDGE_ENABLED else None
+    first = asyncio.create_task(_async_timed(send))
+    tasks = [first]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done and RETRY_BUDGET.try_withdraw():
+            await async_count_event("hedges")
+            tasks.append(asyncio.create_task(_async_timed(send)))
+        elif not done:
+            await async_count_event("hedges_over_budget")
+
+        pending = set(tasks)
+        winner = first
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            good = [
+                x
+                for x in done
+                if x.exception() is None and not is_failure(x.result()[0])
+            ]
+            if good:
+                winner = good[0]
+                break
+        if winner is not first:
+            await async_count_event("hedge_wins")
+        for task in tasks:
+            if task is not winner and task.done() and not task.cancelled():
+                if task.exception() is None and not is_failure(task.result()[0]):
+                    await async_count_event(
+                        "hedge_duplicate_tokens", get_response_tokens(task.result()[0])
+                    )
+        # Every request failed: raises or returns the first one's failure
+        response, latency = await winner
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    if not is_failure(response):
+        LATENCIES[model].record(latency)
+    return response
+
+
+def resilient_request(
+    model: ValidLLMModels,
+    send: Callable[[ValidLLMModels], httpx.Response],
+    hedge: bool = True,
+) -> tuple[httpx.Response, ValidLLMModels]:
+    """
+    ### Responsibility:
+        - Get an answer for a model's request even when its endpoint is slow or failing.
+
+    ### Args:
+        - `model`: ValidLLMModels
+            The model the request is for.
+        - `send`: Callable[[ValidLLMModels], httpx.Response]
+            Sends the request for a given model once.
+        - `hedge`: bool
+            Whether slow calls may be hedged. Streamed requests turn it off, a losing stream would be left open.
+
+    ### Returns:
+        - `result`: tuple[httpx.Response, ValidLLMModels]
+            The response, and the model that produced it.
+
+    ### Raises:
+        - `CircuitOpenError`:
+            Raised if no model in the chain could be called.
+        - `httpx.TransportError`:
+            Raised if the last model tried failed without a response.
+
+    ### How does the function work:
+        - Walks the chain from `get_fallback_chain`, skipping models whose circuit is open.
+        - Calls each model with `hedged_request`. A failure status or transport error counts against the model's circuit and moves on to the next model.
+        - Any other exception, a cancellation included, also counts against the circuit before it's raised, so a half open circuit never waits on a trial that won't report back.
+        - Fallbacks go to other endpoints and are bounded by the chain, so they don't draw from `RETRY_BUDGET`. Retries and hedges do.
+        - Returns the last failed response if the chain runs out after a call, so the caller reports the upstream's error.
+        - Counts trips, short circuits and fallbacks with `count_event`.
+    """
+
+    RETRY_BUDGET.deposit()
+    response, answered_by, error = None, None, None
+
+    for i, candidate in enumerate(get_fallback_chain(model)):
+        breaker = BREAKERS[candidate]
+        if not breaker.allow():
+            count_event("short_circuits")
+            continue
+        if i > 0:
+            count_event("fallbacks")
+            print(f"Falling back from {model.value} to {candidate.value}")
+
+        try:
+            if hedge:
+                response = hedged_request(candidate, partial(send, candidate))
+            else:
+                response = send(candidate)
+            answered_by, error = candidate, None
+        except httpx.TransportError as e:
+            response, error = None, e
+        except BaseException:
+            breaker.record_failure()
+            raise
+        if response is not None and not is_failure(response):
+            breaker.record_success()
+            return response, candidate
+
+        if breaker.record_failure():
+            count_event("trips")
+            print(f"Circuit of {candidate.value} opened")
+
+    if error:
+        raise error
+    if response is None:
+        raise CircuitOpenError(f"No model could answer for {model.value}")
+    return response, answered_by
+
+
+async def async_resilient_request(
+    model: ValidLLMModels,
+    send: Callable[[ValidLLMModels], Awaitable[httpx.Response]],
+    hedge: bool = True,
+) -> tuple[httpx.Response, ValidLLMModels]:
+    """Async variant of `resilient_request`"""
+
+    RETRY_BUDGET.deposit()
+    response, answered_by, error = None, None, None
+
+    for i, candidate in enumerate(get_fallback_chain(model)):
+        breaker = BREAKERS[candidate]
+        if not breaker.allow():
+            await async_count_event("short_circuits")
+            continue
+        if i > 0:
+            await async_count_event("fallbacks")
+            print(f"Falling back from {model.value} to {candidate.value}")
+
+        try:
+            if hedge:
+                response = await async_hedged_request(
+                    candidate, partial(send, candidate)
+                )
+            else:
+                response = await send(candidate)
+            answered_by, error = candidate, None
+        except httpx.TransportError as e:
+            response, error = None, e
+        except BaseException:
+            breaker.record_failure()
+            raise
+        if response is not None and not is_failure(response):
+            breaker.record_success()
+            return response, candidate
+
+        if breaker.record_failure():
+            await async_count_event("trips")
+            print(f"Circuit of {candidate.value} opened")
+
+    if error:
+        raise error
+    if response is None:
+        raise CircuitOpenError(f"No model could answer for {model.value}")
+    return response, answered_by
+
+
+def get_resilience_stats() -> dict:
+    """Returns the hedge, trip and fallback counters of every worker, and this process's circuits"""
+
+    return {
+        "events": {k: int(v) for k, v in REDIS_CLIENT.hgetall(STATS_KEY).items()},
+        "circuits": {x.value: BREAKERS[x].state.value for x in ValidLLMModels},
+        "hedge_delays": {
+            x.value: LATENCIES[x].get_hedge_delay() for x in ValidLLMModels
+        },
+        "retry_budget": round(RETRY_BUDGET.tokens, 2),
+    }
@@ -0,0 +1,81 @@
+"""
+Offline estimate of how many tokens a text costs
+"""
+
+import re
+import math
+
+# Runs of ASCII letters, digits, other letters (Persian...), newlines, or any other character
+_PIECES = re.compile(r"[A-Za-z]+|\d+|[^\W\d_]+|\n+|\S")
+
+# Tokens the chat format adds around every message, and to prime the reply
+MESSAGE_OVERHEAD_TOKENS = 4
+REPLY_PRIMING_TOKENS = 3
+
+
+def _estimate_piece(piece: str) -> int:
+    if piece.isascii() and piece.isalpha():
+        return math.ceil(len(piece) / 5)
+    if piece.isdigit():
+        return math.ceil(len(piece) / 3)
+    if piece.isalpha():
+        # Persian and other non latin scripts split into shorter tokens
+        return math.ceil(len(piece) / 3)
+    return 1
+
+
+def estimate_tokens(text: str | None) -> int:
+    """
+    ### Responsibility:
+        - Estimate the number of tokens of a text without a tokenizer or network access.
+
+    ### Args:
+        - `text`: str | None
+            The text to measure.
+
+    ### Returns:
+        - `tokens`: int
+            The estimated token count, erring on the high side.
+
+    ### How does the function work:
+        - Splits the text into words, numbers, newlines and single symbols.
+        - Counts about 5 characters per token for English words, 3 per token for numbers and other scripts such as Persian, and one token per symbol or emoji.
+        - Tends to overestimate compared to the OpenAI tokenizers, which is the safe side for budgeting.
+    """
+
+    if not text:
+        return 0
+    return sum(_estimate_piece(x) for x in _PIECES.findall(text))
+
+
+def estimate_message_tokens(text: str | None) -> int:
+    """Returns the estimated tokens of a chat message, including the chat format overhead"""
+
+    return estimate_tokens(text) + MESSAGE_OVERHEAD_TOKENS
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """
+    ### Responsibility:
+        - Cut a text down to roughly `max_tokens` tokens, keeping its beginning.
+
+    ### Args:
+        - `text`: str
+            The text to cut.
+        - `max_tokens`: int
+            The number of tokens to keep.
+
+    ### Returns:
+        - `text`: str
+            The text unchanged if it fits, otherwise its beginning followed by an ellipsis.
+    """
+
+    if estimate_tokens(text) <= max_tokens:
+        return text
+
+    tokens = 0
+    for match in _PIECES.finditer(text):
+        tokens += _estimate_piece(match.group())
+        if tokens > max_tokens:
+            return text[: match.start()].rstrip() + " …"
+    return text
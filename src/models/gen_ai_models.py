@@ -69,7 +69,20 @@ class AIResponse(BaseModel):
             AliasPath("usage", "completion_tokens"),
         )
     )
+    # "length" when the reply was cut at `max_tokens`
+    finish_reason: str | None = Field(
+        default=None,
+        validation_alias=AliasChoices(
+            AliasPath("choices", 0, "finish_reason"),
+        ),
+    )
     cost: float | None = None
+    # Served from the response cache instead of the model
+    cached: bool = False
+    # The model that answered, differs from the requested one after a fallback
+    served_by: str | None = None
+    # Seconds the model took, without the time spent delivering a streamed reply
+    latency: float | None = None
 
     def calculate_cost(self, model: str, cpt_table: dict):
         """Calculates the usage cost"""
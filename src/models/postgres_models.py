@@ -1,4 +1,4 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 from datetime import datetime
 
 
@@ -29,4 +29,16 @@ class Message(BaseModel):
     cost: float | None = None
     input_tokens: int | None = None
     output_tokens: int | None = None
+    token_count: int | None = None
+    was_tagged: bool | None = None
     inserted_date: datetime | None = None
+
+
+class ChatSettings(BaseModel):
+    model_config = ConfigDict(protected_namespaces=())
+
+    chat_id: int
+    is_authorized: bool = False
+    allowed_usage_per_day: int = 0
+    # Model that answers every message of the chat, see `model_router`
+    model_override: str | None = None
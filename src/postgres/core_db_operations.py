@@ -4,14 +4,144 @@ Contain all core db operations
 
 import os
 
-from psycopg_pool import ConnectionPool, NullConnectionPool
+from psycopg_pool import ConnectionPool, AsyncConnectionPool
 from dotenv import load_dotenv
+from rich import print
 
 load_dotenv()
 
-POSTGRES_POOL = NullConnectionPool(os.getenv("AZ_POSTGRES_URL"), open=True, min_size=0)
+POOL_SETTINGS = {
+    "min_size": int(os.getenv("POSTGRES_POOL_MIN_SIZE", "1")),
+    "max_size": int(os.getenv("POSTGRES_POOL_MAX_SIZE", "4")),
+    "max_idle": float(os.getenv("POSTGRES_POOL_MAX_IDLE", "300")),
+    "max_lifetime": float(os.getenv("POSTGRES_POOL_MAX_LIFETIME", "1800")),
+    "timeout": float(os.getenv("POSTGRES_POOL_TIMEOUT", "10")),
+}
+
+POSTGRES_POOL = ConnectionPool(
+    os.getenv("AZ_POSTGRES_URL"),
+    open=False,
+    check=ConnectionPool.check_connection,
+    name="quicklingo",
+    **POOL_SETTINGS,
+)
+
+# Used by the event loop worker, where one process keeps many updates in flight
+ASYNC_POSTGRES_POOL = AsyncConnectionPool(
+    os.getenv("AZ_POSTGRES_URL"),
+    open=False,
+    check=AsyncConnectionPool.check_connection,
+    name="quicklingo-async",
+    **(
+        POOL_SETTINGS
+        | {
+            "min_size": int(os.getenv("ASYNC_POSTGRES_POOL_MIN_SIZE", "2")),
+            "max_size": int(os.getenv("ASYNC_POSTGRES_POOL_MAX_SIZE", "20")),
+        }
+    ),
+)
+
+
+def open_postgres_pool():
+    """
+    ### Responsibility:
+        - Open the process wide `POSTGRES_POOL` so connections are kept alive between calls.
+        - Be safe to call more than once from the same process.
+
+    ### Returns:
+        - None
+
+    ### How does the function work:
+        - Returns early if the pool is already open.
+        - Opens the pool and waits until `min_size` connections are ready, so the first message doesn't pay the connection cost.
+        - Must be called after forking (Celery `worker_process_init`, FastAPI lifespan), never in a parent process that will fork.
+    """
+
+    if not POSTGRES_POOL.closed:
+        return
+
+    POSTGRES_POOL.open(wait=True)
+    print(f"Postgres pool opened: {get_postgres_pool_stats()}")
+
+
+def close_postgres_pool():
+    """
+    ### Responsibility:
+        - Close the process wide `POSTGRES_POOL` and release all its connections.
+
+    ### Returns:
+        - None
+
+    ### How does the function work:
+        - Returns early if the pool is already closed.
+        - Prints the final pool statistics and closes the pool.
+    """
+
+    if POSTGRES_POOL.closed:
+        return
+
+    print(f"Closing postgres pool: {get_postgres_pool_stats()}")
+    POSTGRES_POOL.close()
+
+
+def get_postgres_pool_stats() -> dict:
+    """
+    ### Responsibility:
+        - Read the current statistics of `POSTGRES_POOL`.
+
+    ### Returns:
+        - `stats`: dict
+            Pool counters such as `pool_size`, `pool_available`, `requests_waiting` and `connections_num`, plus a `closed` flag.
+
+    ### How does the function work:
+        - Calls `get_stats` on the pool, which doesn't reset the counters.
+        - Adds whether the pool is currently closed.
+    """
+
+    stats = POSTGRES_POOL.get_stats()
+    stats["closed"] = POSTGRES_POOL.closed
+    return stats
+
+
+async def open_async_postgres_pool():
+    """
+    ### Responsibility:
+        - Open the process wide `ASYNC_POSTGRES_POOL` on the running event loop.
+
+    ### Returns:
+        - None
+
+    ### How does the function work:
+        - Returns early if the pool is already open.
+        - Opens the pool and waits until `min_size` connections are ready.
+        - Must be awaited on the loop that will use the pool.
+    """
+
+    if not ASYNC_POSTGRES_POOL.closed:
+        return
+
+    await ASYNC_POSTGRES_POOL.open(wait=True)
+    print(f"Async postgres pool opened: {ASYNC_POSTGRES_POOL.get_stats()}")
+
+
+async def close_async_postgres_pool():
+    """
+    ### Responsibility:
+        - Close the process wide `ASYNC_POSTGRES_POOL` and release all its connections.
+
+    ### Returns:
+        - None
+    """
+
+    if ASYNC_POSTGRES_POOL.closed:
+        return
+
+    print(f"Closing async postgres pool: {ASYNC_POSTGRES_POOL.get_stats()}")
+    await ASYNC_POSTGRES_POOL.close()
 
 
 if __name__ == "__main__":
+    open_postgres_pool()
     with POSTGRES_POOL.connection() as conn:
         print("We're connected")
+    close_postgres_pool()
@@ -2,165 +2,193 @@
 Functions to insert into postgres
 """
 
-from psycopg.errors import UniqueViolation
-
-from src.models.telegram_update_models import TelegramUser, TelegramChat, Message
-from src.postgres.core_db_operations import POSTGRES_POOL
+from src.models.telegram_update_models import Message
+from src.postgres.core_db_operations import POSTGRES_POOL, ASYNC_POSTGRES_POOL
 from src.models.gen_ai_models import LLMRoles
+from src.genai.token_estimator import estimate_tokens
+from src.cache.activity_tracker import record_activity, async_record_activity
+from src.cache.write_behind_buffer import (
+    WRITE_BEHIND_ENABLED,
+    buffer_turn_rows,
+    async_buffer_turn_rows,
+)
+from src.core.metrics import Stages, time_stage
+from src.core.tracing import traced
+
+TURN_USER_STATEMENT = """
+INSERT INTO USERS (USER_ID,FIRST_NAME,LAST_NAME,USERNAME,IS_BOT)
+VALUES (%s,%s,%s,%s,%s)
+ON CONFLICT (USER_ID) DO NOTHING;
+"""
 
+TURN_CHAT_STATEMENT = """
+INSERT INTO CHATS (CHAT_ID,TITLE,TYPE)
+VALUES (%s,%s,%s)
+ON CONFLICT (CHAT_ID) DO NOTHING;
+"""
 
-def insert_user(user: TelegramUser):
-    """
-    ### Responsibility:
-        - Insert a new Telegram user into the database.
-        - Handle any uniqueness conflict by ignoring duplicate entries.
-
-    ### Args:
-        - `user`: TelegramUser
-            An object containing user details such as ID, first name, last name, username, and bot status.
-
-    ### Returns:
-        - None
-
-    ### How does the function work:
-        - Defines a SQL query that:
-            - Inserts the user's ID, first name, last name, username, and bot status into the `USERS` table.
-            - Ignores the insertion if a user with the same ID already exists (ON CONFLICT DO NOTHING).
-        - Executes the SQL query using a connection from the `POSTGRES_POOL`.
-        - Catches any `UniqueViolation` exceptions to handle conflicts.
-        - Returns None if an exception occurs.
-    """
+TURN_MESSAGE_STATEMENT = """
+INSERT INTO MESSAGES (
+    MESSAGE_ID,
+    ROLE,
+    USER_ID,
+    CHAT_ID,
+    MESSAGE,
+    COST,
+    INPUT_TOKENS,
+    OUTPUT_TOKENS,
+    WAS_TAGGED,
+    TOKEN_COUNT)
+VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
+"""
 
-    statement = """
-    INSERT INTO USERS (USER_ID,FIRST_NAME,LAST_NAME,USERNAME,IS_BOT)
-    VALUES (%s,%s,%s,%s,%s)
-    ON CONFLICT (USER_ID) DO NOTHING;
-    """
 
-    with POSTGRES_POOL.connection() as conn:
-        with conn.cursor() as cur:
-            try:
-                cur.execute(
-                    statement,
-                    (
-                        user.id,
-                        user.first_name,
-                        user.last_name,
-                        user.username,
-                        user.is_bot,
-                    ),
-                )
-            except UniqueViolation:
-                return
-
-
-def insert_chat(chat: TelegramChat):
+def build_turn_rows(
+    user_message: Message,
+    reply_message: Message | None = None,
+    cost=0,
+    input_tokens=0,
+    output_tokens=0,
+    was_tagged: bool = False,
+) -> tuple[list[tuple], tuple, list[tuple]]:
     """
     ### Responsibility:
-        - Insert a new Telegram chat into the database.
-        - Handle any uniqueness conflict by ignoring duplicate entries.
+        - Build the parameter rows needed to record a user/bot exchange.
 
     ### Args:
-        - `chat`: TelegramChat
-            An object containing chat details such as ID, title, and type.
+        - Same as `insert_turn`.
 
     ### Returns:
-        - None
+        - `rows`: tuple[list[tuple], tuple, list[tuple]]
+            The distinct user rows, the chat row and the message rows, in insertion order.
 
     ### How does the function work:
-        - Defines a SQL query that:
-            - Inserts the chat's ID, title, and type into the `CHATS` table.
-            - Ignores the insertion if a chat with the same ID already exists (ON CONFLICT DO NOTHING).
-        - Executes the SQL query using a connection from the `POSTGRES_POOL`.
-        - Catches any `UniqueViolation` exceptions to handle conflicts.
-        - Returns None if an exception occurs.
+        - Collects the sender and, if present, the bot as distinct users.
+        - Puts cost, token counts and the tagged flag on the user message; the reply is recorded with the AI role and zero cost.
+        - Stores the estimated token count of each message's text, so prompts can be budgeted without measuring the history again.
     """
 
-    statement = """
-    INSERT INTO CHATS (CHAT_ID,TITLE,TYPE)
-    VALUES (%s,%s,%s)
-    ON CONFLICT (CHAT_ID) DO NOTHING;
-    """
-
-    with POSTGRES_POOL.connection() as conn:
-        with conn.cursor() as cur:
-            try:
-                cur.execute(
-                    statement,
-                    (chat.id, chat.title, chat.type),
-                )
-            except UniqueViolation:
-                return
-
-
-def insert_message(
-    message: Message,
-    role: LLMRoles,
+    users = {user_message.from_.id: user_message.from_}
+    message_rows = [
+        (
+            user_message.message_id,
+            LLMRoles.USER.value,
+            user_message.from_.id,
+            user_message.chat.id,
+            user_message.text,
+            cost,
+            input_tokens,
+            output_tokens,
+            was_tagged,
+            estimate_tokens(user_message.text),
+        )
+    ]
+    if reply_message:
+        users.setdefault(reply_message.from_.id, reply_message.from_)
+        message_rows.append(
+            (
+                reply_message.message_id,
+                LLMRoles.AI.value,
+                reply_message.from_.id,
+                reply_message.chat.id,
+                reply_message.text,
+                0,
+                0,
+                0,
+                False,
+                estimate_tokens(reply_message.text),
+            )
+        )
+
+    user_rows = [
+        (x.id, x.first_name, x.last_name, x.username, x.is_bot) for x in users.values()
+    ]
+    chat = user_message.chat
+    chat_row = (chat.id, chat.title, chat.type)
+
+    return user_rows, chat_row, message_rows
+
+
+@traced()
+def insert_turn(
+    user_message: Message,
+    reply_message: Message | None = None,
     cost=0,
-    input_token=0,
+    input_tokens=0,
     output_tokens=0,
     was_tagged: bool = False,
 ):
     """
     ### Responsibility:
-        - Insert a new message into the database with associated metadata such as role, cost, and token counts.
-        - Handle any uniqueness conflict by ignoring duplicate entries.
+        - Record a full user/bot exchange (users, chat, user message and optional AI reply) in a single transaction.
 
     ### Args:
-        - `message`: Message
-            An object containing message details such as ID, text, sender, and chat.
-        - `role`: LLMRoles
-            The role associated with the message (e.g., user, assistant).
+        - `user_message`: Message
+            The message sent by the user.
+        - `reply_message`: Message | None, optional (default is None)
+            The message the bot replied with. When None, only the user message is recorded (unauthorized, #noreply and out-of-credits branches).
         - `cost`: float, optional (default is 0)
-            The cost associated with the message.
-        - `input_token`: int, optional (default is 0)
-            The number of input tokens for the message.
+            The cost of generating the reply, stored on the user message.
+        - `input_tokens`: int, optional (default is 0)
+            The number of input tokens used for the reply, stored on the user message.
         - `output_tokens`: int, optional (default is 0)
-            The number of output tokens for the message.
+            The number of output tokens generated for the reply, stored on the user message.
         - `was_tagged`: bool, optional (default is False)
-            Indicates whether the message was tagged.
+            Whether the user message counts against the user's daily credits.
 
     ### Returns:
         - None
 
     ### How does the function work:
-        - Defines a SQL query that:
-            - Inserts message details including the message ID, role, user ID, chat ID, message content, cost, input tokens, output tokens, and tagged status into the `MESSAGES` table.
-        - Executes the SQL query using a connection from the `POSTGRES_POOL`.
-        - Catches any `UniqueViolation` exceptions to handle conflicts.
-        - Returns None if an exception occurs.
-    """
-
-    statement = """
-    INSERT INTO MESSAGES (
-        MESSAGE_ID,
-        ROLE,
-        USER_ID,
-        CHAT_ID,
-        MESSAGE,
-        COST,
-        INPUT_TOKENS,
-        OUTPUT_TOKENS,
-        WAS_TAGGED)
-    VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s)
+        - Builds the user, chat and message rows with `build_turn_rows`.
+        - Notes the senders and the chat as active with `record_activity`, flushed to their LAST_ACTIVE columns by `flush_activity`.
+        - With `WRITE_BEHIND_ENABLED`, hands the rows to `buffer_turn_rows` and returns; `write_behind` copies them to Postgres in bulk. Inserts them directly if redis can't be reached.
+        - Checks out a single connection from the `POSTGRES_POOL` and enters psycopg pipeline mode, so all statements are sent without waiting on each other.
+        - Inserts users and chat with ON CONFLICT DO NOTHING, then the message rows, in that order to satisfy the foreign keys.
+        - Commits once when the connection is returned to the pool.
+        - Times the write, buffered or direct, as the `DB_RECORD` stage.
     """
 
-    with POSTGRES_POOL.connection() as conn:
-        with conn.cursor() as cur:
-            try:
-                cur.execute(
-                    statement,
-                    (
-                        message.message_id,
-                        role.value,
-                        message.from_.id,
-                        message.chat.id,
-                        message.text,
-                        cost,
-                        input_token,
-                        output_tokens,
-                        was_tagged,
-                    ),
-                )
-            except UniqueViolation:
-                return
+    user_rows, chat_row, message_rows = build_turn_rows(
+        user_message, reply_message, cost, input_tokens, output_tokens, was_tagged
+    )
+    record_activity([x[2] for x in message_rows], chat_row[0])
+    with time_stage(Stages.DB_RECORD):
+        if WRITE_BEHIND_ENABLED and buffer_turn_rows(user_rows, chat_row, message_rows):
+            return
+
+        with POSTGRES_POOL.connection() as conn:
+            with conn.pipeline():
+                with conn.cursor() as cur:
+                    cur.executemany(TURN_USER_STATEMENT, user_rows)
+                    cur.execute(TURN_CHAT_STATEMENT, chat_row)
+                    cur.executemany(TURN_MESSAGE_STATEMENT, message_rows)
+
+
+@traced()
+async def async_insert_turn(
+    user_message: Message,
+    reply_message: Message | None = None,
+    cost=0,
+    input_tokens=0,
+    output_tokens=0,
+    was_tagged: bool = False,
+):
+    """Async variant of `insert_turn` using the `ASYNC_POSTGRES_POOL`"""
+
+    user_rows, chat_row, message_rows = build_turn_rows(
+        user_message, reply_message, cost, input_tokens, output_tokens, was_tagged
+    )
+    await async_record_activity([x[2] for x in message_rows], chat_row[0])
+    with time_stage(Stages.DB_RECORD):
+        if WRITE_BEHIND_ENABLED and await async_buffer_turn_rows(
+            user_rows, chat_row, message_rows
+        ):
+            return
+
+        async with ASYNC_POSTGRES_POOL.connection() as conn:
+            async with conn.pipeline():
+                async with conn.cursor() as cur:
+                    await cur.executemany(TURN_USER_STATEMENT, user_rows)
+                    await cur.execute(TURN_CHAT_STATEMENT, chat_row)
+                    await cur.executemany(TURN_MESSAGE_STATEMENT, message_rows)
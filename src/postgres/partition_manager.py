@@ -0,0 +1,394 @@
+"""
+Create, archive and restore the monthly partitions of MESSAGES
+"""
+
+# pylint:disable=wrong-import-position
+
+import os
+import re
+import gzip
+import argparse
+from pathlib import Path
+from datetime import datetime, timezone
+
+import psycopg
+from psycopg import sql
+from pydantic import BaseModel
+from rich import print
+from wrapworks import cwdtoenv
+from dotenv import load_dotenv
+
+cwdtoenv()
+load_dotenv()
+
+# Partitions created ahead of the current month
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", "3"))
+# Months of messages kept in Postgres, older partitions are archived. 0 keeps everything
+PARTITION_RETENTION_MONTHS = int(os.getenv("PARTITION_RETENTION_MONTHS", "0"))
+PARTITION_ARCHIVE_DIR = os.getenv("PARTITION_ARCHIVE_DIR", "archive/messages")
+
+LIST_PARTITIONS_STATEMENT = """
+SELECT
+    CHILD.RELNAME,
+    PG_GET_EXPR(CHILD.RELPARTBOUND, CHILD.OID),
+    PG_INHERITS.INHDETACHPENDING
+FROM
+    PG_INHERITS
+    JOIN PG_CLASS CHILD ON CHILD.OID = PG_INHERITS.INHRELID
+WHERE
+    PG_INHERITS.INHPARENT = 'public.messages'::REGCLASS
+"""
+
+_BOUND_PATTERN = re.compile(r"FROM \((.+?)\) TO \((.+?)\)")
+
+
+class MessagesPartition(BaseModel):
+    """A partition of MESSAGES and the range of INSERTED_DATE it holds"""
+
+    name: str
+    # None for the legacy partition, which starts at MINVALUE
+    start: datetime | None
+    end: datetime
+    rows: int | None = None
+    # Left by an interrupted DETACH ... CONCURRENTLY, only FINALIZE can complete it
+    detach_pending: bool = False
+
+
+def get_maintenance_connection() -> psycopg.Connection:
+    """Opens an autocommit connection, DETACH ... CONCURRENTLY can't run in a transaction"""
+
+    return psycopg.connect(os.getenv("AZ_POSTGRES_URL"), autocommit=True)
+
+
+def get_partition_name(start: datetime) -> str:
+    return f"messages_{start:%Y_%m}"
+
+
+def add_months(day: datetime, months: int) -> datetime:
+    """Returns the first instant of the month `months` after `day`'s month, in UTC"""
+
+    index = day.year * 12 + day.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def _parse_bound(value: str) -> datetime | None:
+    if value == "MINVALUE":
+        return None
+    return datetime.fromisoformat(value.strip("'")).astimezone(timezone.utc)
+
+
+def list_message_partitions(conn: psycopg.Connection) -> list[MessagesPartition]:
+    """
+    ### Responsibility:
+        - List the partitions attached to MESSAGES, oldest first.
+
+    ### Args:
+        - `conn`: psycopg.Connection
+            The connection to read the catalog with.
+
+    ### Returns:
+        - `partitions`: list[MessagesPartition]
+            Each partition with the bounds parsed from its `FOR VALUES FROM (...) TO (...)` expression, and whether a detach of it is pending.
+    """
+
+    partitions = []
+    for name, bound, detach_pending in conn.execute(
+        LIST_PARTITIONS_STATEMENT
+    ).fetchall():
+        match = _BOUND_PATTERN.search(bound)
+        if not match:
+            print(f"Skipping partition {name} with bound {bound}")
+            continue
+        partitions.append(
+            MessagesPartition(
+                name=name,
+                start=_parse_bound(match.group(1)),
+                end=_parse_bound(match.group(2)),
+                detach_pending=detach_pending,
+            )
+        )
+
+    partitions.sort(key=lambda x: x.end)
+    return partitions
+
+
+def create_message_partitions(months_ahead: int = PARTITION_MONTHS_AHEAD) -> list[str]:
+    """
+    ### Responsibility:
+        - Make sure MESSAGES has a partition for every month from now to `months_ahead` months ahead.
+
+    ### Args:
+        - `months_ahead`: int
+            How many months after the current one need a partition.
+
+    ### Returns:
+        - `created`: list[str]
+            The names of the partitions created.
+
+    ### How does the function work:
+        - Starts after the newest existing partition, so it never overlaps the legacy partition or a restored one.
+        - Creates one partition per month. Creating an empty partition only takes a brief lock on MESSAGES.
+        - Safe to run as often as needed, it does nothing when partitions already reach far enough.
+    """
+
+    created = []
+    target = add_months(datetime.now(timezone.utc), months_ahead + 1)
+    with get_maintenance_connection() as conn:
+        partitions = list_message_partitions(conn)
+        start = (
+            partitions[-1].end
+            if partitions
+            else add_months(datetime.now(timezone.utc), 0)
+        )
+        while start < target:
+            end = add_months(start, 1)
+            name = get_partition_name(start)
+            conn.execute(
+                sql.SQL(
+                    "CREATE TABLE IF NOT EXISTS {} PARTITION OF MESSAGES FOR VALUES FROM ({}) TO ({})"
+                ).format(sql.Identifier(name), start, end)
+            )
+            created.append(name)
+            start = end
+
+    if created:
+        print(f"Created MESSAGES partitions: {', '.join(created)}")
+    return created
+
+
+def export_partition(
+    conn: psycopg.Connection, partition: MessagesPartition, directory: Path
+) -> Path:
+    """
+    ### Responsibility:
+        - Write a detached partition's rows to a gzipped JSON lines file and a manifest.
+
+    ### Args:
+        - `conn`: psycopg.Connection
+            The maintenance connection.
+        - `partition`: MessagesPartition
+            The detached partition.
+        - `directory`: Path
+            Where the files go.
+
+    ### Returns:
+        - `manifest`: Path
+            The manifest, holding the bounds and row count `restore_message_partition` needs.
+
+    ### How does the function work:
+        - Streams the rows out of Postgres with `COPY ... TO STDOUT`, one JSON object per line, so memory use doesn't depend on the partition's size.
+        - Writes to a temporary file and renames it once complete.
+    """
+
+    directory.mkdir(parents=True, exist_ok=True)
+    data_path = directory / f"{partition.name}.jsonl.gz"
+    temp_path = data_path.with_suffix(".tmp")
+
+    rows = 0
+    query = sql.SQL(
+        "COPY (SELECT ROW_TO_JSON(T) FROM {} T ORDER BY PG_MESSAGE_ID) TO STDOUT"
+    ).format(sql.Identifier(partition.name))
+    with gzip.open(temp_path, "wb") as file:
+        with conn.cursor().copy(query) as copy:
+            for row in copy.rows():
+                file.write(row[0].encode() + b"\n")
+                rows += 1
+    temp_path.rename(data_path)
+
+    manifest_path = directory / f"{partition.name}.json"
+    manifest = partition.model_copy(update={"rows": rows})
+    manifest_path.write_text(
+        manifest.model_dump_json(indent=2, exclude={"detach_pending"})
+    )
+    return manifest_path
+
+
+def archive_message_partitions(
+    retention_months: int = PARTITION_RETENTION_MONTHS,
+    directory: str = PARTITION_ARCHIVE_DIR,
+) -> list[str]:
+    """
+    ### Responsibility:
+        - Move the partitions older than `retention_months` months out of Postgres into compressed files.
+
+    ### Args:
+        - `retention_months`: int
+            Months of messages to keep. 0 archives nothing.
+        - `directory`: str
+            Where the archive files go.
+
+    ### Returns:
+        - `archived`: list[str]
+            The names of the partitions archived and dropped.
+
+    ### How does the function work:
+        - Picks the partitions whose range ends before the first day of the month `retention_months` months ago.
+        - Detaches each with `DETACH PARTITION ... CONCURRENTLY`, which doesn't block inserts or reads of MESSAGES. A partition an interrupted detach left pending is completed with `DETACH PARTITION ... FINALIZE` instead.
+        - Exports it with `export_partition` and checks the row count of the file against the table before dropping the table.
+        - Leaves a `.pending.json` manifest until the table is dropped, so a partition detached by a failed run is exported again on the next one, once.
+        - `USAGE_DAILY` keeps the credits and cost of archived days.
+    """
+
+    if retention_months <= 0:
+        return []
+
+    cutoff = add_months(datetime.now(timezone.utc), -retention_months)
+    root = Path(directory)
+    root.mkdir(parents=True, exist_ok=True)
+    archived = []
+    with get_maintenance_connection() as conn:
+        # By name, a partition can have a pending manifest and still be attached
+        detached = {x.name: x for x in _find_detached_partitions(conn, root)}
+        for partition in list_message_partitions(conn):
+            if partition.end > cutoff:
+                continue
+            pending = root / f"{partition.name}.pending.json"
+            pending.write_text(partition.model_dump_json(exclude={"detach_pending"}))
+            mode = "FINALIZE" if partition.detach_pending else "CONCURRENTLY"
+            conn.execute(
+                sql.SQL("ALTER TABLE MESSAGES DETACH PARTITION {} {}").format(
+                    sql.Identifier(partition.name), sql.SQL(mode)
+                )
+            )
+            detached[partition.name] = partition
+
+        for partition in detached.values():
+            manifest = MessagesPartition.model_validate_json(
+                export_partition(conn, partition, root).read_text()
+            )
+            count = conn.execute(
+                sql.SQL("SELECT COUNT(1) FROM {}").format(
+                    sql.Identifier(partition.name)
+                )
+            ).fetchone()[0]
+            if count != manifest.rows:
+                print(f"{partition.name} has {count} rows, exported {manifest.rows}")
+                continue
+
+            conn.execute(
+                sql.SQL("DROP TABLE {}").format(sql.Identifier(partition.name))
+            )
+            (root / f"{partition.name}.pending.json").unlink(missing_ok=True)
+            archived.append(partition.name)
+            print(f"Archived {partition.name}: {count} rows")
+
+    return archived
+
+
+def _find_detached_partitions(
+    conn: psycopg.Connection, directory: Path
+) -> list[MessagesPartition]:
+    """Returns the partitions an earlier run detached but didn't drop, from their pending manifests"""
+
+    partitions = []
+    for path in directory.glob("*.pending.json"):
+        partition = MessagesPartition.model_validate_json(path.read_text())
+        exists = conn.execute(
+            "SELECT TO_REGCLASS(%s) IS NOT NULL", (f"public.{partition.name}",)
+        ).fetchone()[0]
+        if exists:
+            partitions.append(partition)
+        else:
+            path.unlink()
+    return partitions
+
+
+def restore_message_partition(manifest_path: str) -> int:
+    """
+    ### Responsibility:
+        - Put an archived partition back into MESSAGES.
+
+    ### Args:
+        - `manifest_path`: str
+            The manifest written by `export_partition`, next to its `.jsonl.gz` file.
+
+    ### Returns:
+        - `rows`: int
+            The number of rows restored.
+
+    ### Raises:
+        - `ValueError`:
+            Raised if the file doesn't hold the number of rows the manifest says.
+
+    ### How does the function work:
+        - Creates a standalone table shaped like MESSAGES and fills it from the JSON lines, so the parent's triggers don't count the restored usage again.
+        - Loads the lines as JSONB with `COPY ... FROM STDIN` and expands them with `JSONB_POPULATE_RECORD`, which keeps NUMERIC costs exact.
+        - Attaches it for the partition's original range. Restoring a range that overlaps an existing partition fails and leaves MESSAGES unchanged.
+    """
+
+    path = Path(manifest_path)
+    partition = MessagesPartition.model_validate_json(path.read_text())
+    data_path = path.with_name(f"{partition.name}.jsonl.gz")
+    table = sql.Identifier(partition.name)
+
+    with get_maintenance_connection() as conn:
+        with conn.transaction():
+            conn.execute(
+                sql.SQL("CREATE TABLE {} (LIKE MESSAGES INCLUDING DEFAULTS)").format(
+                    table
+                )
+            )
+            conn.execute("CREATE TEMP TABLE RESTORE_ROWS (RECORD JSONB) ON COMMIT DROP")
+            rows = 0
+            with gzip.open(data_path, "rb") as file:
+                with conn.cursor().copy("COPY RESTORE_ROWS FROM STDIN") as copy:
+                    for line in file:
+                        copy.write_row([line.rstrip(b"\n").decode()])
+                        rows += 1
+            if rows != partition.rows:
+                raise ValueError(
+                    f"{data_path} holds {rows} rows, the manifest says {partition.rows}"
+                )
+            conn.execute(
+                sql.SQL(
+                    "INSERT INTO {} SELECT (JSONB_POPULATE_RECORD(NULL::MESSAGES, RECORD)).* FROM RESTORE_ROWS"
+                ).format(table)
+            )
+
+            bound = (
+                sql.SQL("MINVALUE")
+                if partition.start is None
+                else sql.Literal(partition.start)
+            )
+            conn.execute(
+                sql.SQL(
+                    "ALTER TABLE MESSAGES ATTACH PARTITION {} FOR VALUES FROM ({}) TO ({})"
+                ).format(table, bound, sql.Literal(partition.end))
+            )
+
+    print(f"Restored {partition.name}: {rows} rows")
+    return rows
+
+
+def maintain_message_partitions():
+    """Create the partitions ahead and archive the expired ones, run on a schedule"""
+
+    create_message_partitions()
+    archive_message_partitions()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the partitions of MESSAGES")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("list")
+    create = commands.add_parser("create")
+    create.add_argument("--months-ahead", type=int, default=PARTITION_MONTHS_AHEAD)
+    archive = commands.add_parser("archive")
+    archive.add_argument(
+        "--retention-months", type=int, default=PARTITION_RETENTION_MONTHS
+    )
+    archive.add_argument("--directory", default=PARTITION_ARCHIVE_DIR)
+    restore = commands.add_parser("restore")
+    restore.add_argument("manifest")
+    args = parser.parse_args()
+
+    if args.command == "list":
+        with get_maintenance_connection() as conn:
+            for partition in list_message_partitions(conn):
+                print(partition)
+    elif args.command == "create":
+        create_message_partitions(args.months_ahead)
+    elif args.command == "archive":
+        archive_message_partitions(args.retention_months, args.directory)
+    elif args.command == "restore":
+        restore_message_partition(args.manifest)
@@ -1,5 +1,8 @@
 """Functions that select from postgres"""
 
+import os
+from datetime import date, datetime, time, timedelta, timezone
+
 from wrapworks import cwdtoenv
 from dotenv import load_dotenv
 from rich import print
@@ -7,10 +10,154 @@ from rich import print
 cwdtoenv()
 load_dotenv()
 
-from src.postgres.core_db_operations import POSTGRES_POOL
-from src.models.postgres_models import Message
+from src.postgres.core_db_operations import (
+    POSTGRES_POOL,
+    ASYNC_POSTGRES_POOL,
+    open_postgres_pool,
+)
+from src.models.postgres_models import Message, ChatSettings
+from src.models.gen_ai_models import LLMRoles
+from src.core.tracing import traced
+
+# History older than this isn't read, so MESSAGES lookups only touch recent partitions
+HISTORY_LOOKBACK_DAYS = int(os.getenv("HISTORY_LOOKBACK_DAYS", "90"))
+
+CHECK_CHAT_AUTHORIZED_STATEMENT = """
+SELECT 
+    IS_AUTHORIZED 
+FROM 
+    PUBLIC.CHATS
+WHERE 
+    chat_id = %s
+"""
+
+CHAT_SETTINGS_STATEMENT = """
+SELECT
+    IS_AUTHORIZED,
+    ALLOWED_USAGE_PER_DAY,
+    MODEL_OVERRIDE
+FROM
+    PUBLIC.CHATS
+WHERE
+    CHAT_ID = %s
+"""
+
+# A primary key lookup on the rollup, no matter how large MESSAGES grows
+COUNT_TAGGED_ON_DAY_STATEMENT = """
+SELECT
+    COALESCE(SUM(TAGGED_MESSAGES), 0)
+FROM
+    PUBLIC.USAGE_DAILY
+WHERE
+    DAY = %s
+    AND CHAT_ID = %s
+    AND USER_ID = %s
+"""
+
+CHECK_USER_CREDITS_STATEMENT = """
+WITH
+    USAGE AS (
+        SELECT
+            COALESCE(SUM(TAGGED_MESSAGES), 0) AS COUNT
+        FROM
+            PUBLIC.USAGE_DAILY
+        WHERE
+            DAY = %s
+            AND CHAT_ID = %s
+            AND USER_ID = %s
+    ),
+    ALLOWED AS (
+        SELECT
+            ALLOWED_USAGE_PER_DAY
+        FROM
+            PUBLIC.CHATS
+        WHERE
+            CHAT_ID = %s
+    )
+SELECT
+    ALLOWED.ALLOWED_USAGE_PER_DAY - USAGE.COUNT
+FROM
+    USAGE,
+    ALLOWED;
+"""
+
+# Both sums come from the DAY prefix of the rollup's primary key
+SPEND_ON_DAY_STATEMENT = """
+SELECT
+    COALESCE(SUM(COST), 0),
+    COALESCE(SUM(COST) FILTER (WHERE CHAT_ID = %s), 0)
+FROM
+    PUBLIC.USAGE_DAILY
+WHERE
+    DAY = %s
+"""
+
+LAST_N_MESSAGES_STATEMENT = """
+SELECT PG_MESSAGE_ID,MESSAGE,ROLE,TOKEN_COUNT
+FROM messages
+WHERE chat_id = %s
+AND INSERTED_DATE >= NOW() - %s * INTERVAL '1 day'
+ORDER BY PG_MESSAGE_ID DESC
+LIMIT %s;
+"""
+
+# The user's last messages and the bot's replies to them. Ordered by INSERTED_DATE so the
+# (CHAT_ID, USER_ID, INSERTED_DATE) index serves it. A reply is recorded in the same
+# transaction or write-behind entry as the message it answers, so it has the same
+# INSERTED_DATE and the next PG_MESSAGE_ID of the chat with that date
+LAST_N_USER_MESSAGES_STATEMENT = """
+WITH USER_MESSAGES AS (
+    SELECT PG_MESSAGE_ID,MESSAGE,ROLE,TOKEN_COUNT,INSERTED_DATE
+    FROM messages
+    WHERE chat_id = %(chat_id)s
+    AND user_id = %(user_id)s
+    AND INSERTED_DATE >= NOW() - %(days)s * INTERVAL '1 day'
+    ORDER BY INSERTED_DATE DESC
+    LIMIT %(n)s
+)
+SELECT PG_MESSAGE_ID,MESSAGE,ROLE,TOKEN_COUNT
+FROM USER_MESSAGES
+UNION ALL
+SELECT REPLY.PG_MESSAGE_ID,REPLY.MESSAGE,REPLY.ROLE,REPLY.TOKEN_COUNT
+FROM USER_MESSAGES
+JOIN LATERAL (
+    SELECT PG_MESSAGE_ID,MESSAGE,ROLE,TOKEN_COUNT
+    FROM messages
+    WHERE chat_id = %(chat_id)s
+    AND INSERTED_DATE = USER_MESSAGES.INSERTED_DATE
+    AND PG_MESSAGE_ID > USER_MESSAGES.PG_MESSAGE_ID
+    ORDER BY PG_MESSAGE_ID
+    LIMIT 1
+) REPLY ON REPLY.ROLE = %(reply_role)s;
+"""
+
+
+def get_user_messages_params(chat_id: int, user_id: int, n: int) -> dict:
+    """Returns the parameters of `LAST_N_USER_MESSAGES_STATEMENT`"""
 
+    return {
+        "chat_id": chat_id,
+        "user_id": user_id,
+        "days": HISTORY_LOOKBACK_DAYS,
+        "n": n,
+        "reply_role": LLMRoles.AI.value,
+    }
 
+
+def get_usage_day() -> date:
+    """Returns the current usage day. Daily credits roll over at midnight UTC."""
+
+    return datetime.now(timezone.utc).date()
+
+
+def get_usage_day_bounds(day: date) -> tuple[datetime, datetime]:
+    """Returns the UTC start and end timestamps of a usage day"""
+
+    start = datetime.combine(day, time.min, tzinfo=timezone.utc)
+    return start, start + timedelta(days=1)
+
+
+@traced()
 def check_if_chat_is_authorized(chat_id: int) -> bool:
     """
     ### Responsibility:
@@ -26,30 +173,110 @@ def check_if_chat_is_authorized(chat_id: int) -> bool:
             True if the chat is authorized, False otherwise.
 
     ### How does the function work:
-        - Defines an SQL query to select the authorization status from the `CHATS` table using the given `chat_id`.
+        - Uses `CHECK_CHAT_AUTHORIZED_STATEMENT` to select the authorization status from the `CHATS` table using the given `chat_id`.
         - Executes the SQL query using a connection from the `POSTGRES_POOL`.
         - Fetches the first result and prints the retrieved data.
         - Returns True if the chat is authorized; otherwise, returns False.
     """
 
-    statement = """
-    SELECT 
-        IS_AUTHORIZED 
-    FROM 
-        PUBLIC.CHATS
-    WHERE 
-        chat_id = %s
-    """
-
     with POSTGRES_POOL.connection() as conn:
         with conn.cursor() as cur:
-            cur.execute(statement, (chat_id,))
+            cur.execute(CHECK_CHAT_AUTHORIZED_STATEMENT, (chat_id,))
             data = cur.fetchone()
             print(f"check_if_chat_is_authorized: {data}")
             return bool(data[0] if data else 0)
 
 
-def check_if_user_has_credits(chat_id: int, user_id: int) -> bool:
+@traced()
+def get_chat_settings(chat_id: int) -> ChatSettings:
+    """
+    ### Responsibility:
+        - Read the settings of a chat that decide whether and how much the bot answers there.
+
+    ### Args:
+        - `chat_id`: int
+            The ID of the chat.
+
+    ### Returns:
+        - `settings`: ChatSettings
+            The authorization flag, daily allowance and model override of the chat. Unknown chats are unauthorized with no allowance.
+
+    ### How does the function work:
+        - Executes `CHAT_SETTINGS_STATEMENT` using a connection from the `POSTGRES_POOL`.
+        - Returns default settings if the chat doesn't exist yet.
+    """
+
+    with POSTGRES_POOL.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(CHAT_SETTINGS_STATEMENT, (chat_id,))
+            data = cur.fetchone()
+
+    if not data:
+        return ChatSettings(chat_id=chat_id)
+    return ChatSettings(
+        chat_id=chat_id,
+        is_authorized=bool(data[0]),
+        allowed_usage_per_day=data[1] or 0,
+        model_override=data[2],
+    )
+
+
+@traced()
+def count_tagged_messages_on_day(chat_id: int, user_id: int, day: date) -> int:
+    """
+    ### Responsibility:
+        - Count how many tagged messages a user sent in a chat on a usage day.
+
+    ### Args:
+        - `chat_id`: int
+            The ID of the chat.
+        - `user_id`: int
+            The ID of the user.
+        - `day`: date
+            The usage day, see `get_usage_day`.
+
+    ### Returns:
+        - `count`: int
+            The number of tagged messages, which is the number of credits used.
+
+    ### How does the function work:
+        - Executes `COUNT_TAGGED_ON_DAY_STATEMENT`, a primary key lookup on the `USAGE_DAILY` rollup that the `MESSAGES_ROLLUP_USAGE_DAILY` trigger keeps up to date.
+    """
+
+    with POSTGRES_POOL.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(COUNT_TAGGED_ON_DAY_STATEMENT, (day, chat_id, user_id))
+            return cur.fetchone()[0]
+
+
+@traced()
+def get_spend_on_day(chat_id: int, day: date) -> tuple[float, float]:
+    """
+    ### Responsibility:
+        - Read how much the bot spent on LLM calls on a usage day, overall and in one chat.
+
+    ### Args:
+        - `chat_id`: int
+            The ID of the chat.
+        - `day`: date
+            The usage day, see `get_usage_day`.
+
+    ### Returns:
+        - `spend`: tuple[float, float]
+            The total cost of the day across all chats, and in the given chat.
+    """
+
+    with POSTGRES_POOL.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(SPEND_ON_DAY_STATEMENT, (chat_id, day))
+            data = cur.fetchone()
+    return float(data[0]), float(data[1])
+
+
+@traced()
+def check_if_user_has_credits(
+    chat_id: int, user_id: int, allowed_usage_per_day: int | None = None
+) -> bool:
     """
     ### Responsibility:
         - Check if a user in a given chat has available message credits for the current day.
@@ -60,14 +287,17 @@ def check_if_user_has_credits(chat_id: int, user_id: int) -> bool:
             The ID of the chat where the user belongs.
         - `user_id`: int
             The ID of the user whose credits are being checked.
+        - `allowed_usage_per_day`: int | None, optional (default is None)
+            The chat's daily allowance if the caller already knows it, e.g. from the chat settings cache. When None, it is read from `CHATS`.
 
     ### Returns:
         - `has_credits`: bool
             True if the user has remaining credits for the day; otherwise, False.
 
     ### How does the function work:
-        - Defines a SQL query that:
-            - Computes the number of messages the user has tagged today in the chat (`USAGE`).
+        - If `allowed_usage_per_day` is given, only counts today's tagged messages with `count_tagged_messages_on_day` and compares against it.
+        - Otherwise uses `CHECK_USER_CREDITS_STATEMENT`, which:
+            - Reads the number of messages the user has tagged today in the chat from `USAGE_DAILY` (`USAGE`).
             - Retrieves the allowed usage per day for the chat from the `CHATS` table (`ALLOWED`).
             - Calculates the remaining credits by subtracting the usage count from the allowed usage.
         - Executes the SQL query using a connection from the `POSTGRES_POOL`.
@@ -76,89 +306,186 @@ def check_if_user_has_credits(chat_id: int, user_id: int) -> bool:
         - Returns True if the user has more than 0 remaining credits; otherwise, returns False.
     """
 
-    statement = """
-    WITH
-        USAGE AS (
-            SELECT
-                COUNT(1)
-            FROM
-                PUBLIC.MESSAGES
-            WHERE
-                CHAT_ID = %s
-                AND USER_ID = %s
-                AND DATE (INSERTED_DATE) = CURRENT_DATE
-                AND WAS_TAGGED = TRUE
-        ),
-        ALLOWED AS (
-            SELECT
-                ALLOWED_USAGE_PER_DAY
-            FROM
-                PUBLIC.CHATS
-            WHERE
-                CHAT_ID = %s
-        )
-    SELECT
-        ALLOWED.ALLOWED_USAGE_PER_DAY - USAGE.COUNT
-    FROM
-        USAGE,
-        ALLOWED;
-    """
+    if allowed_usage_per_day is not None:
+        used = count_tagged_messages_on_day(chat_id, user_id, get_usage_day())
+        data = (allowed_usage_per_day - used,)
+        print(f"check_if_user_has_credits: {data}")
+        return bool(data[0] > 0)
 
     with POSTGRES_POOL.connection() as conn:
         with conn.cursor() as cur:
-            cur.execute(statement, (chat_id, user_id, chat_id))
+            cur.execute(
+                CHECK_USER_CREDITS_STATEMENT,
+                (get_usage_day(), chat_id, user_id, chat_id),
+            )
             data = cur.fetchone()
             print(f"check_if_user_has_credits: {data}")
             return bool(data[0] > 0)
 
 
-def get_last_n_messages(chat_id: int, user_id: str, n=5) -> list[Message]:
+@traced()
+def get_last_n_messages(
+    chat_id: int, user_id: str, n=5, per_user: bool = False
+) -> list[Message]:
     """
     ### Responsibility:
-        - Retrieve the last `n` messages for a specified user in a given chat.
+        - Retrieve the last `n` messages of a chat, or of a specified user in a given chat.
         - Return the messages as a list of `Message` objects.
 
     ### Args:
         - `chat_id`: int
             The ID of the chat to retrieve messages from.
         - `user_id`: str
-            The ID of the user whose messages are being retrieved.
+            The ID of the user whose messages are being retrieved when `per_user` is True.
         - `n`: int, optional (default is 5)
             The number of most recent messages to retrieve.
+        - `per_user`: bool, optional (default is False)
+            Only return messages sent by `user_id`. Otherwise every message of the chat is considered.
 
     ### Returns:
         - `messages`: list[Message]
             A list of `Message` objects containing the last `n` messages sorted by message ID in ascending order.
 
     ### How does the function work:
-        - Defines a SQL query that:
-            - Selects the message ID, message content, and role from the `messages` table for the given `chat_id` and `user_id`.
-            - Orders the results by message ID in descending order and limits the number of results to `n`.
+        - Uses `LAST_N_USER_MESSAGES_STATEMENT` if `per_user` is True, otherwise `LAST_N_MESSAGES_STATEMENT`, which:
+            - Selects the message ID, message content, role and token count from the `messages` table for the given `chat_id` (and `user_id`, with the bot's replies to those messages).
+            - Skips messages older than `HISTORY_LOOKBACK_DAYS`, so only the recent partitions of `messages` are scanned.
+            - Orders the results from newest to oldest and limits the number of results to `n`.
         - Executes the SQL query using a connection from the `POSTGRES_POOL`.
         - Fetches all resulting rows.
         - Creates `Message` objects for each row and stores them in a list.
         - Sorts the messages list by message ID in ascending order.
-        - Returns the sorted list of `Message` objects.
-    """
-
-    statement = """
-    SELECT PG_MESSAGE_ID,MESSAGE,ROLE
-    FROM messages
-    WHERE chat_id = %s
-    ORDER BY PG_MESSAGE_ID DESC
-    LIMIT %s;
+        - Returns the last `n` of the sorted `Message` objects.
     """
 
     with POSTGRES_POOL.connection() as conn:
         with conn.cursor() as cur:
-            cur.execute(statement, (chat_id, n))
+            if per_user:
+                cur.execute(
+                    LAST_N_USER_MESSAGES_STATEMENT,
+                    get_user_messages_params(chat_id, user_id, n),
+                )
+            else:
+                cur.execute(
+                    LAST_N_MESSAGES_STATEMENT, (chat_id, HISTORY_LOOKBACK_DAYS, n)
+                )
             data = cur.fetchall()
 
-    messages = [Message(pg_message_id=x[0], message=x[1], role=x[2]) for x in data]
+    messages = [
+        Message(pg_message_id=x[0], message=x[1], role=x[2], token_count=x[3])
+        for x in data
+    ]
+    messages.sort(key=lambda x: x.pg_message_id)
+    return messages[-n:]
+
+
+@traced()
+async def async_check_if_chat_is_authorized(chat_id: int) -> bool:
+    """Async variant of `check_if_chat_is_authorized` using the `ASYNC_POSTGRES_POOL`"""
+
+    async with ASYNC_POSTGRES_POOL.connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(CHECK_CHAT_AUTHORIZED_STATEMENT, (chat_id,))
+            data = await cur.fetchone()
+            print(f"check_if_chat_is_authorized: {data}")
+            return bool(data[0] if data else 0)
+
+
+@traced()
+async def async_get_chat_settings(chat_id: int) -> ChatSettings:
+    """Async variant of `get_chat_settings` using the `ASYNC_POSTGRES_POOL`"""
+
+    async with ASYNC_POSTGRES_POOL.connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(CHAT_SETTINGS_STATEMENT, (chat_id,))
+            data = await cur.fetchone()
+
+    if not data:
+        return ChatSettings(chat_id=chat_id)
+    return ChatSettings(
+        chat_id=chat_id,
+        is_authorized=bool(data[0]),
+        allowed_usage_per_day=data[1] or 0,
+        model_override=data[2],
+    )
+
+
+@traced()
+async def async_count_tagged_messages_on_day(
+    chat_id: int, user_id: int, day: date
+) -> int:
+    """Async variant of `count_tagged_messages_on_day` using the `ASYNC_POSTGRES_POOL`"""
+
+    async with ASYNC_POSTGRES_POOL.connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(COUNT_TAGGED_ON_DAY_STATEMENT, (day, chat_id, user_id))
+            return (await cur.fetchone())[0]
+
+
+@traced()
+async def async_get_spend_on_day(chat_id: int, day: date) -> tuple[float, float]:
+    """Async variant of `get_spend_on_day` using the `ASYNC_POSTGRES_POOL`"""
+
+    async with ASYNC_POSTGRES_POOL.connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(SPEND_ON_DAY_STATEMENT, (chat_id, day))
+            data = await cur.fetchone()
+    return float(data[0]), float(data[1])
+
+
+@traced()
+async def async_check_if_user_has_credits(
+    chat_id: int, user_id: int, allowed_usage_per_day: int | None = None
+) -> bool:
+    """Async variant of `check_if_user_has_credits` using the `ASYNC_POSTGRES_POOL`"""
+
+    if allowed_usage_per_day is not None:
+        used = await async_count_tagged_messages_on_day(
+            chat_id, user_id, get_usage_day()
+        )
+        data = (allowed_usage_per_day - used,)
+        print(f"check_if_user_has_credits: {data}")
+        return bool(data[0] > 0)
+
+    async with ASYNC_POSTGRES_POOL.connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                CHECK_USER_CREDITS_STATEMENT,
+                (get_usage_day(), chat_id, user_id, chat_id),
+            )
+            data = await cur.fetchone()
+            print(f"check_if_user_has_credits: {data}")
+            return bool(data[0] > 0)
+
+
+@traced()
+async def async_get_last_n_messages(
+    chat_id: int, user_id: str, n=5, per_user: bool = False
+) -> list[Message]:
+    """Async variant of `get_last_n_messages` using the `ASYNC_POSTGRES_POOL`"""
+
+    async with ASYNC_POSTGRES_POOL.connection() as conn:
+        async with conn.cursor() as cur:
+            if per_user:
+                await cur.execute(
+                    LAST_N_USER_MESSAGES_STATEMENT,
+                    get_user_messages_params(chat_id, user_id, n),
+                )
+            else:
+                await cur.execute(
+                    LAST_N_MESSAGES_STATEMENT, (chat_id, HISTORY_LOOKBACK_DAYS, n)
+                )
+            data = await cur.fetchall()
+
+    messages = [
+        Message(pg_message_id=x[0], message=x[1], role=x[2], token_count=x[3])
+        for x in data
+    ]
     messages.sort(key=lambda x: x.pg_message_id)
-    return messages
+    return messages[-n:]
 
 
 if __name__ == "__main__":
+    open_postgres_pool()
     messages = get_last_n_messages(-1002248772367, 5159937523)
     print(messages)
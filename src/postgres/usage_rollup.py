@@ -0,0 +1,79 @@
+"""
+Maintain the USAGE_DAILY rollup
+"""
+
+# pylint:disable=wrong-import-position
+
+import argparse
+from datetime import date
+
+from rich import print
+from wrapworks import cwdtoenv
+from dotenv import load_dotenv
+
+cwdtoenv()
+load_dotenv()
+
+from src.postgres.core_db_operations import (
+    POSTGRES_POOL,
+    open_postgres_pool,
+    close_postgres_pool,
+)
+from src.postgres.select_functions import get_usage_day
+
+FIRST_MESSAGE_DAY_STATEMENT = """
+SELECT (MIN(INSERTED_DATE) AT TIME ZONE 'UTC')::DATE FROM MESSAGES;
+"""
+
+REBUILD_USAGE_DAILY_STATEMENT = """
+SELECT REBUILD_USAGE_DAILY(%s, %s);
+"""
+
+
+def rebuild_usage_daily(
+    from_day: date | None = None, to_day: date | None = None
+) -> int:
+    """
+    ### Responsibility:
+        - Backfill or repair the `USAGE_DAILY` rollup from the raw `MESSAGES` rows.
+
+    ### Args:
+        - `from_day`: date | None, optional (default is None)
+            The first UTC day to rebuild. Defaults to the day of the oldest message.
+        - `to_day`: date | None, optional (default is None)
+            The last UTC day to rebuild, inclusive. Defaults to today.
+
+    ### Returns:
+        - `rows`: int
+            The number of rollup rows written.
+
+    ### How does the function work:
+        - Finds the oldest message day if `from_day` isn't given.
+        - Calls the `REBUILD_USAGE_DAILY` SQL function, which replaces the rollup rows of the range in one transaction while holding off concurrent rollup updates.
+    """
+
+    with POSTGRES_POOL.connection() as conn:
+        with conn.cursor() as cur:
+            if from_day is None:
+                cur.execute(FIRST_MESSAGE_DAY_STATEMENT)
+                from_day = cur.fetchone()[0]
+                if from_day is None:
+                    return 0
+            cur.execute(
+                REBUILD_USAGE_DAILY_STATEMENT, (from_day, to_day or get_usage_day())
+            )
+            rows = cur.fetchone()[0]
+
+    print(f"Rebuilt USAGE_DAILY from {from_day} to {to_day or 'today'}: {rows} rows")
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild the USAGE_DAILY rollup")
+    parser.add_argument("--from-day", type=date.fromisoformat, default=None)
+    parser.add_argument("--to-day", type=date.fromisoformat, default=None)
+    args = parser.parse_args()
+
+    open_postgres_pool()
+    rebuild_usage_daily(args.from_day, args.to_day)
+    close_postgres_pool()
@@ -0,0 +1,254 @@
+"""
+Flusher that copies the write-behind buffer into MESSAGES in bulk
+
+Run with `python -m src.postgres.write_behind`
+"""
+
+# pylint:disable=wrong-import-position
+
+import os
+import time
+import argparse
+
+import orjson
+import psycopg
+import redis
+from rich import print
+from wrapworks import cwdtoenv
+from dotenv import load_dotenv
+
+cwdtoenv()
+load_dotenv()
+
+from src.cache.core_redis_operations import REDIS_CLIENT
+from src.cache.write_behind_buffer import (
+    WRITE_BEHIND_STREAM,
+    WRITE_BEHIND_DEAD_LETTER_STREAM,
+    parse_entry_id,
+    remove_flushed_entries,
+)
+from src.postgres.core_db_operations import (
+    POSTGRES_POOL,
+    open_postgres_pool,
+    close_postgres_pool,
+)
+from src.postgres.insert_functions import TURN_USER_STATEMENT, TURN_CHAT_STATEMENT
+
+# A batch is flushed once it has this many turns, or once its oldest turn waited the interval
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv("WRITE_BEHIND_BATCH_SIZE", "500"))
+WRITE_BEHIND_FLUSH_INTERVAL_MS = int(os.getenv("WRITE_BEHIND_FLUSH_INTERVAL_MS", "200"))
+
+ENSURE_OFFSET_STATEMENT = """
+INSERT INTO WRITE_BEHIND_OFFSETS (STREAM)
+VALUES (%s)
+ON CONFLICT (STREAM) DO NOTHING;
+"""
+
+# Held until the COPY commits, so concurrent flushers never copy an entry twice
+LOCK_OFFSET_STATEMENT = """
+SELECT LAST_ENTRY_MS, LAST_ENTRY_SEQ
+FROM WRITE_BEHIND_OFFSETS
+WHERE STREAM = %s
+FOR UPDATE;
+"""
+
+UPDATE_OFFSET_STATEMENT = """
+UPDATE WRITE_BEHIND_OFFSETS
+SET LAST_ENTRY_MS = %s, LAST_ENTRY_SEQ = %s, UPDATED_DATE = CURRENT_TIMESTAMP
+WHERE STREAM = %s;
+"""
+
+COPY_MESSAGES_STATEMENT = """
+COPY MESSAGES (
+    MESSAGE_ID,
+    ROLE,
+    USER_ID,
+    CHAT_ID,
+    MESSAGE,
+    COST,
+    INPUT_TOKENS,
+    OUTPUT_TOKENS,
+    WAS_TAGGED,
+    TOKEN_COUNT,
+    INSERTED_DATE)
+FROM STDIN
+"""
+
+
+def read_batch() -> list[tuple[str, dict]]:
+    """Returns the oldest `WRITE_BEHIND_BATCH_SIZE` buffered turns with their stream entry IDs"""
+
+    entries = REDIS_CLIENT.xrange(WRITE_BEHIND_STREAM, count=WRITE_BEHIND_BATCH_SIZE)
+    return [(entry_id, orjson.loads(fields["turn"])) for entry_id, fields in entries]
+
+
+def get_batch_wait(entries: list[tuple[str, dict]]) -> float:
+    """Returns the seconds until a batch is due: full, or its oldest turn waited `WRITE_BEHIND_FLUSH_INTERVAL_MS`"""
+
+    if len(entries) >= WRITE_BEHIND_BATCH_SIZE:
+        return 0
+    if not entries:
+        return WRITE_BEHIND_FLUSH_INTERVAL_MS / 1000
+    age = time.time() * 1000 - parse_entry_id(entries[0][0])[0]
+    return max(0, WRITE_BEHIND_FLUSH_INTERVAL_MS - age) / 1000
+
+
+def copy_turns(conn: psycopg.Connection, turns: list[dict]) -> int:
+    """
+    ### Responsibility:
+        - Write a batch of buffered turns with one round of statements, inside the caller's transaction.
+
+    ### Args:
+        - `conn`: psycopg.Connection
+            The connection whose transaction the rows are written in.
+        - `turns`: list[dict]
+            The turns made by `buffer_turn_rows`.
+
+    ### Returns:
+        - `rows`: int
+            The number of message rows copied.
+
+    ### How does the function work:
+        - Inserts the batch's distinct users and chats with ON CONFLICT DO NOTHING, sorted so concurrent flushers lock them in the same order.
+        - Streams every message row into MESSAGES with a single `COPY`, keeping the `INSERTED_DATE` stamped when the turn was buffered. The statement level `MESSAGES_ROLLUP_USAGE_DAILY` trigger runs once for the whole batch.
+    """
+
+    users = {x[0]: x for turn in turns for x in turn["users"]}
+    chats = {turn["chat"][0]: turn["chat"] for turn in turns}
+
+    rows = 0
+    with conn.cursor() as cur:
+        cur.executemany(TURN_USER_STATEMENT, [users[x] for x in sorted(users)])
+        cur.executemany(TURN_CHAT_STATEMENT, [chats[x] for x in sorted(chats)])
+        with cur.copy(COPY_MESSAGES_STATEMENT) as copy:
+            for turn in turns:
+                for row in turn["messages"]:
+                    copy.write_row(row)
+                    rows += 1
+    return rows
+
+
+def flush_entries(entries: list[tuple[str, dict]]) -> int:
+    """
+    ### Responsibility:
+        - Copy buffered turns into Postgres exactly once, then drop them from redis.
+
+    ### Args:
+        - `entries`: list[tuple[str, dict]]
+            Turns from `read_batch`, oldest first.
+
+    ### Returns:
+        - `rows`: int
+            The number of message rows copied.
+
+    ### How does the function work:
+        - Locks the stream's row in `WRITE_BEHIND_OFFSETS` and skips entries at or before its last copied entry. Those were copied by a flusher that stopped before trimming the stream.
+        - Copies the rest with `copy_turns` and moves the offset forward in the same transaction.
+        - Removes all the entries from the stream and the chats' pending rows once the transaction commits. If that fails, the next flush skips them by their offset.
+    """
+
+    rows = 0
+    with POSTGRES_POOL.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(ENSURE_OFFSET_STATEMENT, (WRITE_BEHIND_STREAM,))
+            cur.execute(LOCK_OFFSET_STATEMENT, (WRITE_BEHIND_STREAM,))
+            last = tuple(cur.fetchone())
+            fresh = [x for x in entries if parse_entry_id(x[0]) > last]
+            if fresh:
+                rows = copy_turns(conn, [x[1] for x in fresh])
+                cur.execute(
+                    UPDATE_OFFSET_STATEMENT,
+                    (*parse_entry_id(fresh[-1][0]), WRITE_BEHIND_STREAM),
+                )
+
+    remove_flushed_entries([(x[0], x[1]["chat"][0]) for x in entries])
+    return rows
+
+
+def flush_batch(entries: list[tuple[str, dict]]) -> int:
+    """
+    ### Responsibility:
+        - Flush a batch, setting aside the turns Postgres refuses so they don't block the rest.
+
+    ### Args:
+        - `entries`: list[tuple[str, dict]]
+            Turns from `read_batch`, oldest first.
+
+    ### Returns:
+        - `rows`: int
+            The number of message rows copied.
+
+    ### How does the function work:
+        - Flushes the whole batch with `flush_entries`.
+        - If Postgres rejects the data (`DataError`, `IntegrityError`), flushes the turns one by one and moves the rejected ones to `WRITE_BEHIND_DEAD_LETTER_STREAM`.
+        - Connection errors propagate, so the batch stays buffered and is retried.
+    """
+
+    try:
+        return flush_entries(entries)
+    except (psycopg.DataError, psycopg.IntegrityError) as e:
+        print(f"Batch rejected, flushing turns one by one: {type(e).__name__}: {e}")
+
+    rows = 0
+    for entry in entries:
+        try:
+            rows += flush_entries([entry])
+        except (psycopg.DataError, psycopg.IntegrityError) as e:
+            REDIS_CLIENT.xadd(
+                WRITE_BEHIND_DEAD_LETTER_STREAM,
+                {"turn": orjson.dumps(entry[1]), "error": f"{type(e).__name__}: {e}"},
+            )
+            remove_flushed_entries([(entry[0], entry[1]["chat"][0])])
+    return rows
+
+
+def run_flusher(once: bool = False):
+    """
+    ### Responsibility:
+        - Copy the write-behind buffer into Postgres until stopped.
+
+    ### Args:
+        - `once`: bool
+            Flush everything that's buffered and return, to drain the buffer before turning write-behind off.
+
+    ### Returns:
+        - None
+
+    ### How does the function work:
+        - Reads the oldest buffered turns and waits until the batch is due, see `get_batch_wait`.
+        - Flushes it with `flush_batch`. Redis or Postgres being unreachable is logged and retried after a second.
+        - Running more than one flusher is safe, they take turns on the offset lock.
+    """
+
+    open_postgres_pool()
+    print("Write-behind flusher started")
+    try:
+        while True:
+            try:
+                entries = read_batch()
+                if once and not entries:
+                    return
+                wait = get_batch_wait(entries)
+                if wait and not once:
+                    time.sleep(wait)
+                    continue
+                started = time.perf_counter()
+                rows = flush_batch(entries)
+                print(
+                    f"Flushed {len(entries)} turns, {rows} rows in {time.perf_counter() - started:.3f}s"
+                )
+            except (redis.RedisError, psycopg.OperationalError) as e:
+                print(f"Write-behind flush failed: {type(e).__name__}: {e}")
+                time.sleep(1)
+    finally:
+        close_postgres_pool()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Flush the write-behind buffer")
+    parser.add_argument(
+        "--once", action="store_true", help="Flush what's buffered and exit"
+    )
+    args = parser.parse_args()
+
+    run_flusher(args.once)
@@ -0,0 +1,213 @@
+"""
+Durable outbox of messages waiting to be sent to Telegram
+"""
+
+# pylint:disable=wrong-import-position
+
+import os
+import time
+
+from pydantic import BaseModel
+from wrapworks import cwdtoenv
+from dotenv import load_dotenv
+
+cwdtoenv()
+load_dotenv()
+
+from src.cache.core_redis_operations import REDIS_CLIENT, ASYNC_REDIS_CLIENT
+from src.celery.payloads import encode_update
+from src.telegram.send_message import build_reply_params, build_welcome_params
+from src.models.gen_ai_models import AIResponse
+from src.models.telegram_update_models import (
+    TelegramUpdatePing,
+    TelegramUpdateNewMember,
+)
+
+# When on, workers queue their replies here and `outbox_sender` delivers them
+OUTBOX_ENABLED = os.getenv("OUTBOX_ENABLED", "false").lower() == "true"
+
+OUTBOX_STREAM = "telegram:outbox"
+OUTBOX_GROUP = "senders"
+# Messages Telegram refused for good, kept for inspection
+DEAD_LETTER_STREAM = "telegram:outbox:dead"
+
+# Telegram allows about 30 messages per second overall, one per second in a
+# private chat and 20 per minute in a group
+GLOBAL_RATE_PER_SECOND = float(os.getenv("OUTBOX_GLOBAL_RATE_PER_SECOND", "30"))
+GLOBAL_BURST = int(os.getenv("OUTBOX_GLOBAL_BURST", "30"))
+PRIVATE_RATE_PER_SECOND = float(os.getenv("OUTBOX_PRIVATE_RATE_PER_SECOND", "1"))
+GROUP_RATE_PER_MINUTE = float(os.getenv("OUTBOX_GROUP_RATE_PER_MINUTE", "20"))
+CHAT_BURST = int(os.getenv("OUTBOX_CHAT_BURST", "1"))
+
+# KEYS: global bucket, chat bucket
+# ARGV: now, global rate, global burst, chat rate, chat burst
+# Takes a token from both buckets, or none. Returns 0 when taken, otherwise the
+# milliseconds until both buckets have a token
+TOKEN_BUCKET_SCRIPT = """
+local now = tonumber(ARGV[1])
+local function refill(key, rate, burst)
+    local bucket = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(bucket[1]) or burst
+    local ts = tonumber(bucket[2]) or now
+    return math.min(burst, tokens + math.max(0, now - ts) * rate)
+end
+local function take(key, tokens, rate, burst)
+    redis.call('HSET', key, 'tokens', tostring(tokens - 1), 'ts', tostring(now))
+    redis.call('PEXPIRE', key, math.ceil(burst / rate * 1000) + 1000)
+end
+
+local global_rate, global_burst = tonumber(ARGV[2]), tonumber(ARGV[3])
+local chat_rate, chat_burst = tonumber(ARGV[4]), tonumber(ARGV[5])
+local global_tokens = refill(KEYS[1], global_rate, global_burst)
+local chat_tokens = refill(KEYS[2], chat_rate, chat_burst)
+
+if global_tokens >= 1 and chat_tokens >= 1 then
+    take(KEYS[1], global_tokens, global_rate, global_burst)
+    take(KEYS[2], chat_tokens, chat_rate, chat_burst)
+    return 0
+end
+local wait = 0
+if global_tokens < 1 then
+    wait = (1 - global_tokens) / global_rate
+end
+if chat_tokens < 1 then
+    wait = math.max(wait, (1 - chat_tokens) / chat_rate)
+end
+return math.ceil(wait * 1000)
+"""
+
+_TOKEN_BUCKET = REDIS_CLIENT.register_script(TOKEN_BUCKET_SCRIPT)
+_ASYNC_TOKEN_BUCKET = ASYNC_REDIS_CLIENT.register_script(TOKEN_BUCKET_SCRIPT)
+
+
+class OutboxMessage(BaseModel):
+    """A sendMessage call waiting in the outbox, with what's needed to record it once sent"""
+
+    params: dict
+    # `encode_update` payload of the update a reply answers, None for messages that aren't recorded
+    update: list | None = None
+    cost: float = 0
+    input_tokens: int = 0
+    output_tokens: int = 0
+
+
+def build_reply_outbox_message(
+    update: TelegramUpdatePing, text: str, response: AIResponse | None = None
+) -> OutboxMessage:
+    """
+    ### Responsibility:
+        - Build the outbox entry of a reply to a user's message.
+
+    ### Args:
+        - `update`: TelegramUpdatePing
+            The update being answered.
+        - `text`: str
+            The text of the reply.
+        - `response`: AIResponse | None
+            The generated response. When given, the sender records the exchange with its cost and tokens once Telegram returns the reply's message ID.
+
+    ### Returns:
+        - `message`: OutboxMessage
+            The entry to pass to `enqueue_outbox_message`.
+    """
+
+    if not response:
+        return OutboxMessage(params=build_reply_params(update, text))
+
+    return OutboxMessage(
+        params=build_reply_params(update, text),
+        update=encode_update(update),
+        cost=response.cost or 0,
+        input_tokens=response.input_tokens,
+        output_tokens=response.output_tokens,
+    )
+
+
+def build_welcome_outbox_message(update: TelegramUpdateNewMember) -> OutboxMessage:
+    """Build the outbox entry that welcomes a new member"""
+
+    return OutboxMessage(params=build_welcome_params(update))
+
+
+def enqueue_outbox_message(message: OutboxMessage) -> str:
+    """
+    ### Responsibility:
+        - Hand a message over to the outbox sender and return straight away.
+
+    ### Args:
+        - `message`: OutboxMessage
+            The message to send.
+
+    ### Returns:
+        - `entry_id`: str
+            The ID of the entry in `OUTBOX_STREAM`.
+
+    ### How does the function work:
+        - Appends the message to a redis stream, where it stays until a sender acknowledges it. Enable AOF persistence on redis for the outbox to survive a redis restart.
+    """
+
+    return REDIS_CLIENT.xadd(OUTBOX_STREAM, {"m": message.model_dump_json()})
+
+
+async def async_enqueue_outbox_message(message: OutboxMessage) -> str:
+    """Async variant of `enqueue_outbox_message`"""
+
+    return await ASYNC_REDIS_CLIENT.xadd(
+        OUTBOX_STREAM, {"m": message.model_dump_json()}
+    )
+
+
+def get_chat_rate(chat_id: int) -> float:
+    """Returns the messages per second Telegram allows in a chat"""
+
+    # Group and channel IDs are negative, private chat IDs are the user's ID
+    if chat_id < 0:
+        return GROUP_RATE_PER_MINUTE / 60
+    return PRIVATE_RATE_PER_SECOND
+
+
+def get_bucket_keys(chat_id: int) -> list[str]:
+    return ["telegram:bucket:global", f"telegram:bucket:chat:{chat_id}"]
+
+
+def acquire_send_token(chat_id: int) -> float:
+    """
+    ### Responsibility:
+        - Take a send token from the global and the chat's bucket, shared by every sender and by the workers streaming replies.
+
+    ### Args:
+        - `chat_id`: int
+            The chat the message goes to.
+
+    ### Returns:
+        - `wait`: float
+            0 if the message can be sent now, otherwise the seconds to wait before trying again.
+    """
+
+    wait_ms = _TOKEN_BUCKET(
+        keys=get_bucket_keys(chat_id),
+        args=[
+            time.time(),
+            GLOBAL_RATE_PER_SECOND,
+            GLOBAL_BURST,
+            get_chat_rate(chat_id),
+            CHAT_BURST,
+        ],
+    )
+    return wait_ms / 1000
+
+
+async def async_acquire_send_token(chat_id: int) -> float:
+    """Async variant of `acquire_send_token`"""
+
+    wait_ms = await _ASYNC_TOKEN_BUCKET(
+        keys=get_bucket_keys(chat_id),
+        args=[
+            time.time(),
+            GLOBAL_RATE_PER_SECOND,
+            GLOBAL_BURST,
+            get_chat_rate(chat_id),
+            CHAT_BURST,
+        ],
+    )
+    return wait_ms / 1000
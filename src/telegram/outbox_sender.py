@@ -0,0 +1,303 @@
+"""
+Sender that drains the Telegram outbox within Telegram's rate limits
+
+Run with `python -m src.telegram.outbox_sender`, as many instances as needed
+"""
+
+# pylint:disable=wrong-import-position
+
+import os
+import time
+import socket
+import asyncio
+from collections import deque
+
+import httpx
+import redis
+from rich import print
+from wrapworks import cwdtoenv
+from dotenv import load_dotenv
+
+cwdtoenv()
+load_dotenv()
+
+from src.cache.core_redis_operations import ASYNC_REDIS_CLIENT
+from src.cache.history_buffer import async_append_history
+from src.celery.payloads import decode_update
+from src.core.message_handler import async_record_turn_in_db
+from src.core.http_clients import (
+    Upstreams,
+    async_request_with_retry,
+    get_backoff_delay,
+    close_async_http_clients,
+)
+from src.postgres.core_db_operations import (
+    open_async_postgres_pool,
+    close_async_postgres_pool,
+)
+from src.postgres.insert_functions import async_insert_turn
+from src.core.metrics import Stages, time_stage
+from src.telegram.send_message import get_bot_method_path, parse_reply
+from src.telegram.outbox import (
+    OUTBOX_STREAM,
+    OUTBOX_GROUP,
+    DEAD_LETTER_STREAM,
+    OutboxMessage,
+    async_acquire_send_token,
+)
+from src.models.gen_ai_models import AIResponse, LLMRoles
+from src.models.telegram_update_models import TelegramUpdatePing
+
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "100"))
+OUTBOX_MAX_IN_FLIGHT = int(os.getenv("OUTBOX_MAX_IN_FLIGHT", "1000"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+# Entries another sender read but didn't acknowledge for this long are taken over
+OUTBOX_CLAIM_IDLE = int(os.getenv("OUTBOX_CLAIM_IDLE", "300"))
+# Queued entries are reclaimed this often so they never look abandoned while a chat waits on its rate limit
+OUTBOX_REFRESH_INTERVAL = OUTBOX_CLAIM_IDLE / 3
+
+
+class OutboxSender:
+    """
+    Reads the outbox stream as one consumer of `OUTBOX_GROUP` and sends its messages.
+
+    Each chat gets its own queue and drain task, so a chat that is rate limited
+    or told to back off by Telegram waits on its own while the others keep
+    going, and messages of a chat are sent in the order they were queued. All
+    sends go through the shared keep-alive Telegram client concurrently.
+    """
+
+    def __init__(self, batch_size: int, max_in_flight: int, max_attempts: int):
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+        self.max_attempts = max_attempts
+        self.consumer = f"{socket.gethostname()}-{os.getpid()}"
+        self.chat_queues: dict[int, deque[tuple[str, OutboxMessage]]] = {}
+        self.chat_tasks: set[asyncio.Task] = set()
+        self.in_flight: set[str] = set()
+        self.refreshed_at = time.monotonic()
+
+    async def ensure_group(self):
+        """Create the stream and its consumer group if they don't exist"""
+
+        try:
+            await ASYNC_REDIS_CLIENT.xgroup_create(
+                OUTBOX_STREAM, OUTBOX_GROUP, id="0", mkstream=True
+            )
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    async def run(self):
+        """
+        ### Responsibility:
+            - Deliver outbox messages until cancelled.
+
+        ### How does the function work:
+            - Takes over entries other senders left unacknowledged for `OUTBOX_CLAIM_IDLE` seconds, then reads new entries in batches of `OUTBOX_BATCH_SIZE`.
+            - Reclaims its own queued entries every `OUTBOX_REFRESH_INTERVAL` seconds, so a long rate limited backlog isn't taken over and sent twice by another sender.
+            - Stops reading while `OUTBOX_MAX_IN_FLIGHT` messages are waiting to be sent.
+            - Hands each entry to its chat's queue, see `_drain_chat`.
+        """
+
+        await open_async_postgres_pool()
+        await self.ensure_group()
+        print(f"Outbox sender {self.consumer} started")
+
+        try:
+            while True:
+                await self._refresh_claims()
+                await self._claim_abandoned()
+                free = self.max_in_flight - len(self.in_flight)
+                if free <= 0:
+                    await asyncio.sleep(0.05)
+                    continue
+
+                response = await ASYNC_REDIS_CLIENT.xreadgroup(
+                    OUTBOX_GROUP,
+                    self.consumer,
+                    {OUTBOX_STREAM: ">"},
+                    count=min(free, self.batch_size),
+                    block=1000,
+                )
+                for _, entries in response:
+                    for entry_id, fields in entries:
+                        self._dispatch(entry_id, fields)
+        finally:
+            await asyncio.gather(*self.chat_tasks, return_exceptions=True)
+            await close_async_http_clients()
+            await close_async_postgres_pool()
+
+    async def _refresh_claims(self):
+        if time.monotonic() - self.refreshed_at < OUTBOX_REFRESH_INTERVAL:
+            return
+        self.refreshed_at = time.monotonic()
+
+        # Resets the idle time of the entries without reading them again
+        entry_ids = list(self.in_flight)
+        for i in range(0, len(entry_ids), self.batch_size):
+            await ASYNC_REDIS_CLIENT.xclaim(
+                OUTBOX_STREAM,
+                OUTBOX_GROUP,
+                self.consumer,
+                min_idle_time=0,
+                message_ids=entry_ids[i : i + self.batch_size],
+                justid=True,
+            )
+
+    async def _claim_abandoned(self):
+        _, entries, _ = await ASYNC_REDIS_CLIENT.xautoclaim(
+            OUTBOX_STREAM,
+            OUTBOX_GROUP,
+            self.consumer,
+            min_idle_time=OUTBOX_CLAIM_IDLE * 1000,
+            count=self.batch_size,
+        )
+        for entry_id, fields in entries:
+            if fields:
+                self._dispatch(entry_id, fields)
+
+    def _dispatch(self, entry_id: str, fields: dict):
+        if entry_id in self.in_flight:
+            return
+        self.in_flight.add(entry_id)
+
+        message = OutboxMessage.model_validate_json(fields["m"])
+        chat_id = message.params["chat_id"]
+        if chat_id in self.chat_queues:
+            self.chat_queues[chat_id].append((entry_id, message))
+            return
+
+        self.chat_queues[chat_id] = deque([(entry_id, message)])
+        task = asyncio.create_task(self._drain_chat(chat_id))
+        self.chat_tasks.add(task)
+        task.add_done_callback(self.chat_tasks.discard)
+
+    async def _drain_chat(self, chat_id: int):
+        queue = self.chat_queues[chat_id]
+        try:
+            while queue:
+                entry_id, message = queue.popleft()
+                try:
+                    await self._send(entry_id, message)
+                except Exception as e:
+                    # Left pending, another sender takes it over after OUTBOX_CLAIM_IDLE
+                    print(f"Outbox entry {entry_id} failed: {type(e).__name__}: {e}")
+                finally:
+                    self.in_flight.discard(entry_id)
+        finally:
+            del self.chat_queues[chat_id]
+
+    async def _send(self, entry_id: str, message: OutboxMessage):
+        """
+        ### Responsibility:
+            - Send one outbox message, retrying until Telegram accepts or refuses it for good.
+
+        ### Args:
+            - `entry_id`: str
+                The ID of the stream entry.
+            - `message`: OutboxMessage
+                The message to send.
+
+        ### How does the function work:
+            - Waits for a token from the global and chat buckets with `async_acquire_send_token`.
+            - On a 429, sleeps for Telegram's `retry_after` and tries again without counting an attempt.
+            - Retries transport errors and 5xx responses up to `OUTBOX_MAX_ATTEMPTS` times with backoff.
+            - Records the exchange once the reply is sent, or moves the message to `DEAD_LETTER_STREAM` if Telegram refused it, then acknowledges the entry.
+        """
+
+        chat_id = message.params["chat_id"]
+        attempts = 0
+        while True:
+            while wait := await async_acquire_send_token(chat_id):
+                await asyncio.sleep(wait)
+
+            try:
+                with time_stage(Stages.TELEGRAM_SEND):
+                    res = await async_request_with_retry(
+                        Upstreams.TELEGRAM,
+                        "POST",
+                        get_bot_method_path("sendMessage"),
+                        params=message.params,
+                    )
+            except httpx.TransportError as e:
+                error = f"{type(e).__name__}: {e}"
+                res = None
+
+            if res is not None and res.status_code == 200:
+                await self._record_sent(message, parse_reply(res))
+                await self._ack(entry_id)
+                return
+
+            if res is not None and res.status_code == 429:
+                retry_after = res.json().get("parameters", {}).get("retry_after", 1)
+                print(f"Telegram asked to retry chat {chat_id} after {retry_after}s")
+                await asyncio.sleep(retry_after)
+                continue
+
+            if res is not None:
+                error = f"{res.status_code} - {res.text}"
+                if res.status_code < 500:
+                    break
+
+            attempts += 1
+            if attempts >= self.max_attempts:
+                break
+            await asyncio.sleep(get_backoff_delay(attempts, res))
+
+        print(f"Outbox message to chat {chat_id} failed for good: {error}")
+        await ASYNC_REDIS_CLIENT.xadd(
+            DEAD_LETTER_STREAM, {"m": message.model_dump_json(), "error": error}
+        )
+        await self._record_undelivered(message)
+        await self._ack(entry_id)
+
+    async def _record_sent(
+        self, message: OutboxMessage, reply_data: TelegramUpdatePing
+    ):
+        if not message.update:
+            return
+
+        response = AIResponse.model_construct(
+            text=reply_data.message.text,
+            input_tokens=message.input_tokens,
+            output_tokens=message.output_tokens,
+            cost=message.cost,
+        )
+        try:
+            await async_record_turn_in_db(
+                decode_update(message.update), reply_data, response
+            )
+        except Exception as e:
+            # The reply is out, so don't send it again because recording failed
+            print(f"Couldn't record sent reply: {type(e).__name__}: {e}")
+
+    async def _record_undelivered(self, message: OutboxMessage):
+        if not message.update:
+            return
+
+        # The reply was paid for, so keep its cost on the user's message
+        update = decode_update(message.update)
+        await async_insert_turn(
+            update.message,
+            cost=message.cost,
+            input_tokens=message.input_tokens,
+            output_tokens=message.output_tokens,
+            was_tagged=True,
+        )
+        await async_append_history(
+            update.message.chat.id,
+            update.message.from_.id,
+            [(LLMRoles.USER, update.message.text)],
+        )
+
+    async def _ack(self, entry_id: str):
+        async with ASYNC_REDIS_CLIENT.pipeline(transaction=False) as pipe:
+            pipe.xack(OUTBOX_STREAM, OUTBOX_GROUP, entry_id)
+            pipe.xdel(OUTBOX_STREAM, entry_id)
+            await pipe.execute()
+
+
+if __name__ == "__main__":
+    sender = OutboxSender(OUTBOX_BATCH_SIZE, OUTBOX_MAX_IN_FLIGHT, OUTBOX_MAX_ATTEMPTS)
+    asyncio.run(sender.run())
@@ -1,6 +1,9 @@
 """Module to get updates from telegram"""
 
 import os
+import time
+import asyncio
+from typing import Awaitable, Callable
 
 import httpx
 from rich import print
@@ -11,11 +14,91 @@ load_dotenv()
 cwdtoenv()
 
 
+from src.core.http_clients import (
+    Upstreams,
+    request_with_retry,
+    async_request_with_retry,
+)
+from src.core.metrics import Stages, time_stage
+from src.core.tracing import traced
 from src.models.telegram_update_models import (
     TelegramUpdatePing,
     TelegramUpdateNewMember,
+    ChatType,
 )
 
+# Seconds between two edits of a streamed reply. Telegram allows about one
+# message per second in a private chat and 20 per minute in a group
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+STREAM_GROUP_EDIT_INTERVAL = float(os.getenv("STREAM_GROUP_EDIT_INTERVAL", "3.0"))
+# Characters to collect before the first message, so it doesn't start with a lone word
+STREAM_FIRST_CHUNK_CHARS = int(os.getenv("STREAM_FIRST_CHUNK_CHARS", "20"))
+# Attempts at the final edit of a streamed reply, which holds the text the user paid for
+STREAM_FINISH_ATTEMPTS = int(os.getenv("STREAM_FINISH_ATTEMPTS", "4"))
+# Longest wait between them, a longer retry_after gives up
+STREAM_FINISH_MAX_WAIT = float(os.getenv("STREAM_FINISH_MAX_WAIT", "30"))
+
+
+def get_bot_method_path(method: str) -> str:
+    """Returns the path of a bot API method on the Telegram upstream"""
+
+    return f"/bot{os.getenv('TELBOTKEY')}/{method}"
+
+
+def build_welcome_params(update: TelegramUpdateNewMember) -> dict:
+    """Builds the sendMessage parameters that welcome a new member"""
+
+    return {
+        "chat_id": update.message.chat.id,
+        "text": f"👋 سلام @{update.message.new_chat_member.username or update.message.new_chat_member.first_name}, خوش آمدید!! 🎉 من QuickLingoBot هستم🤖 و اینجا هستم که بهت کمک کنم انگلیسی یاد بگیری📚. من رو @QuickLingoBot تو پیامت تگ کن و هر سوالی داری ازم بپرس💬",
+    }
+
+
+def build_reply_params(update: TelegramUpdatePing, response: str) -> dict:
+    """Builds the sendMessage parameters that reply to the user's message"""
+
+    return {
+        "chat_id": update.message.chat.id,
+        "text": response,
+        "reply_to_message_id": update.message.message_id,
+    }
+
+
+def check_welcome_reply(res: httpx.Response):
+    """Logs the Telegram response of a welcome message if it can't be parsed"""
+
+    try:
+        _ = TelegramUpdatePing(**res.json())
+    except Exception as e:
+        print(
+            f"Error in parsing my reply: {type(e)}: {e}\n{res.status_code} - {res.text}"
+        )
+
+
+def parse_reply(res: httpx.Response) -> TelegramUpdatePing:
+    """
+    ### Responsibility:
+        - Parse the Telegram response of a sent message into a `TelegramUpdatePing`.
+
+    ### Args:
+        - `res`: httpx.Response
+            The response of the sendMessage call.
+
+    ### Returns:
+        - `formatted_response`: TelegramUpdatePing
+            The message that was sent, as Telegram returned it.
+
+    ### Raises:
+        - `AttributeError`:
+            If there is an error parsing the API response.
+    """
+
+    try:
+        return TelegramUpdatePing(**res.json())
+    except Exception as e:
+        print(f"Error in parsing my reply: {type(e)}: {e}")
+        raise AttributeError(res.json()) from e
+
 
 def get_updates():
     """
@@ -27,15 +110,18 @@ def get_updates():
         - `httpx.HTTPStatusError`: If the request to the Telegram API fails.
 
     ### How does the function work:
-        - Makes an HTTP GET request to the Telegram bot API.
+        - Makes an HTTP GET request to the Telegram bot API through the shared client.
         - Uses an environment variable for the bot token.
         - Prints the response text from the API call.
     """
 
-    res = httpx.get(f"https://api.telegram.org/bot{os.getenv('TELBOTKEY')}/getUpdates")
+    res = request_with_retry(
+        Upstreams.TELEGRAM, "GET", get_bot_method_path("getUpdates")
+    )
     print(res.text)
 
 
+@traced()
 def send_welcome_message(update: TelegramUpdateNewMember) -> str:
     """
     ### Responsibility:
@@ -52,30 +138,26 @@ def send_welcome_message(update: TelegramUpdateNewMember) -> str:
             Confirmation string indicating that the welcome message has been sent.
 
     ### How does the function work:
-        - Constructs the base URL for the Telegram bot API and message parameters.
-        - Sends an HTTP POST request with the welcome message and chat ID to the Telegram bot API.
-        - Prints a confirmation message once the message is sent.
-        - Attempts to parse the API response into a `TelegramUpdatePing` object.
-        - Logs any parsing errors and prints detailed error information.
+        - Builds the message parameters with `build_welcome_params`.
+        - Sends an HTTP POST request with the welcome message and chat ID to the Telegram bot API through the shared client.
+        - Times the request as the `TELEGRAM_SEND` stage and prints a confirmation message once the message is sent.
+        - Checks the API response with `check_welcome_reply`, which logs any parsing errors.
     """
 
-    base_url = f"https://api.telegram.org/bot{os.getenv('TELBOTKEY')}/sendMessage"
-    params = {
-        "chat_id": update.message.chat.id,
-        "text": f"👋 سلام @{update.message.new_chat_member.username or update.message.new_chat_member.first_name}, خوش آمدید!! 🎉 من QuickLingoBot هستم🤖 و اینجا هستم که بهت کمک کنم انگلیسی یاد بگیری📚. من رو @QuickLingoBot تو پیامت تگ کن و هر سوالی داری ازم بپرس💬",
-    }
-    res = httpx.post(base_url, params=params)
-    print("Message sent")
-    try:
-        _ = TelegramUpdatePing(**res.json())
-    except Exception as e:
-        print(
-            f"Error in parsing my reply: {type(e)}: {e}\n{res.status_code} - {res.text}"
+    with time_stage(Stages.TELEGRAM_SEND):
+        res = request_with_retry(
+            Upstreams.TELEGRAM,
+            "POST",
+            get_bot_method_path("sendMessage"),
+            params=build_welcome_params(update),
         )
+    print("Message sent")
+    check_welcome_reply(res)
 
     return "Welcome message sent"
 
 
+@traced()
 def send_message(
     update: TelegramUpdatePing, response: str
 ) -> TelegramUpdatePing | None:
@@ -99,15 +181,12 @@ def send_message(
             If there is an error parsing the API response.
 
     ### How does the function work:
-        - Constructs the base URL for the Telegram bot API and message parameters.
-        - Sends an HTTP POST request with the response message, chat ID, and reply-to message ID to the Telegram bot API.
-        - Prints a confirmation message once the message is sent.
-        - Attempts to parse the API response into a `TelegramUpdatePing` object.
-        - Logs any parsing errors and raises an `AttributeError` if parsing fails.
+        - Builds the message parameters with `build_reply_params`.
+        - Sends an HTTP POST request with the response message, chat ID, and reply-to message ID to the Telegram bot API through the shared client.
+        - Times the request as the `TELEGRAM_SEND` stage and prints a confirmation message once the message is sent.
+        - Parses the API response with `parse_reply`, which raises an `AttributeError` if parsing fails.
     """
 
-    base_url = f"https://api.telegram.org/bot{os.getenv('TELBOTKEY')}/sendMessage"
-
     # # TESTING
     # chat_id = -865047911
     # message = "Hello @KnotAsaniczka"
@@ -115,21 +194,311 @@ def send_message(
     #     "chat_id": chat_id,
     #     "text": message,
     # }
-    params = {
+    with time_stage(Stages.TELEGRAM_SEND):
+        res = request_with_retry(
+            Upstreams.TELEGRAM,
+            "POST",
+            get_bot_method_path("sendMessage"),
+            params=build_reply_params(update, response),
+        )
+    print("Message sent")
+    return parse_reply(res)
+
+
+@traced()
+async def async_send_welcome_message(update: TelegramUpdateNewMember) -> str:
+    """Async variant of `send_welcome_message` using the shared async Telegram client"""
+
+    with time_stage(Stages.TELEGRAM_SEND):
+        res = await async_request_with_retry(
+            Upstreams.TELEGRAM,
+            "POST",
+            get_bot_method_path("sendMessage"),
+            params=build_welcome_params(update),
+        )
+    print("Message sent")
+    check_welcome_reply(res)
+
+    return "Welcome message sent"
+
+
+@traced()
+async def async_send_message(
+    update: TelegramUpdatePing, response: str
+) -> TelegramUpdatePing | None:
+    """Async variant of `send_message` using the shared async Telegram client"""
+
+    with time_stage(Stages.TELEGRAM_SEND):
+        res = await async_request_with_retry(
+            Upstreams.TELEGRAM,
+            "POST",
+            get_bot_method_path("sendMessage"),
+            params=build_reply_params(update, response),
+        )
+    print("Message sent")
+    return parse_reply(res)
+
+
+def build_edit_params(update: TelegramUpdatePing, message_id: int, text: str) -> dict:
+    """Builds the editMessageText parameters that replace the text of a sent reply"""
+
+    return {
         "chat_id": update.message.chat.id,
-        "text": response,
-        "reply_to_message_id": update.message.message_id,
+        "message_id": message_id,
+        "text": text,
     }
-    res = httpx.post(base_url, params=params)
-    print("Message sent")
-    formatted_response = None
-    try:
-        formatted_response = TelegramUpdatePing(**res.json())
-    except Exception as e:
-        print(f"Error in parsing my reply: {type(e)}: {e}")
-        raise AttributeError(res.json()) from e
 
-    return formatted_response
+
+@traced()
+def edit_message_text(
+    update: TelegramUpdatePing, message_id: int, text: str
+) -> httpx.Response:
+    """
+    ### Responsibility:
+        - Replace the text of a message the bot already sent.
+
+    ### Args:
+        - `update`: TelegramUpdatePing
+            The update the message replies to, used for the chat ID.
+        - `message_id`: int
+            The ID of the bot's message.
+        - `text`: str
+            The new text.
+
+    ### Returns:
+        - `res`: httpx.Response
+            The raw Telegram response, parse it with `parse_reply`.
+    """
+
+    return request_with_retry(
+        Upstreams.TELEGRAM,
+        "POST",
+        get_bot_method_path("editMessageText"),
+        params=build_edit_params(update, message_id, text),
+    )
+
+
+@traced()
+async def async_edit_message_text(
+    update: TelegramUpdatePing, message_id: int, text: str
+) -> httpx.Response:
+    """Async variant of `edit_message_text`"""
+
+    return await async_request_with_retry(
+        Upstreams.TELEGRAM,
+        "POST",
+        get_bot_method_path("editMessageText"),
+        params=build_edit_params(update, message_id, text),
+    )
+
+
+class _StreamingReplyState:
+    """Throttling state shared by the sync and async streaming replies"""
+
+    def __init__(self, update: TelegramUpdatePing, acquire_token=None):
+        self.update = update
+        # Takes a send token from the outbox's rate limits, see `acquire_send_token`
+        self.acquire_token = acquire_token
+        self.reply: TelegramUpdatePing | None = None
+        self.sent_text = ""
+        self.next_edit_at = 0.0
+        self.interval = (
+            STREAM_GROUP_EDIT_INTERVAL
+            if update.message.chat.type in {ChatType.SUPERGROUP, ChatType.GROUP}
+            else STREAM_EDIT_INTERVAL
+        )
+
+    def _should_send_first(self, text: str) -> bool:
+        return self.reply is None and len(text.strip()) >= STREAM_FIRST_CHUNK_CHARS
+
+    def _should_edit(self, text: str) -> bool:
+        return (
+            self.reply is not None
+            and text != self.sent_text
+            and time.monotonic() >= self.next_edit_at
+        )
+
+    def _on_token_wait(self, wait: float) -> bool:
+        """Checks if an edit may go out after asking for a token, pushing the next edit back otherwise"""
+
+        if wait <= 0:
+            return True
+        self.next_edit_at = time.monotonic() + wait
+        return False
+
+    def _on_sent(self, reply: TelegramUpdatePing, text: str):
+        self.reply = reply
+        self.sent_text = text
+        self.next_edit_at = time.monotonic() + self.interval
+
+    @staticmethod
+    def _get_retry_after(res: httpx.Response) -> float:
+        """Returns the wait Telegram asked for, 0 when the body isn't Telegram's JSON, such as a proxy's 502 page"""
+
+        try:
+            return float(res.json().get("parameters", {}).get("retry_after", 0))
+        except Exception:
+            return 0
+
+    def _on_edit(self, res: httpx.Response, text: str):
+        if res.status_code == 200:
+            self._on_sent(parse_reply(res), text)
+            return
+
+        # A failed intermediate edit only delays the next one, the final edit sets the full text
+        retry_after = self._get_retry_after(res)
+        self.next_edit_at = time.monotonic() + max(self.interval, retry_after)
+        print(f"Couldn't edit streamed reply: {res.status_code} - {res.text}")
+
+    def _get_finish_delay(self, res: httpx.Response, attempt: int) -> float | None:
+        """
+        ### Responsibility:
+            - Decide if the final edit of a streamed reply is tried again, and when.
+
+        ### Args:
+            - `res`: httpx.Response
+                The response of the final edit.
+            - `attempt`: int
+                The number of the attempt that just failed, starting at 0.
+
+        ### Returns:
+            - `delay`: float | None
+                Seconds to wait before the next attempt, or None to give up.
+
+        ### How does the function work:
+            - Retries rate limits and server errors, up to `STREAM_FINISH_ATTEMPTS` attempts. An edit sets the text rather than adding a message, so resending it is safe.
+            - Waits the `parameters.retry_after` Telegram sent with a 429, or the edit interval, and gives up when that's over `STREAM_FINISH_MAX_WAIT`.
+        """
+
+        if res.status_code != 429 and res.status_code < 500:
+            return None
+        if attempt + 1 >= STREAM_FINISH_ATTEMPTS:
+            return None
+        delay = self._get_retry_after(res) or self.interval
+        if delay > STREAM_FINISH_MAX_WAIT:
+            return None
+        print(
+            f"Final edit of streamed reply got {res.status_code}, retrying in {delay}s"
+        )
+        return delay
+
+
+class StreamingReply(_StreamingReplyState):
+    """
+    Delivers a reply to Telegram while it's being generated.
+
+    Pass `push` as the `on_text` callback of a streaming completion: the first
+    `STREAM_FIRST_CHUNK_CHARS` characters are sent as a reply straight away, and
+    the message is then edited with the text generated so far at most once per
+    edit interval. `finish` writes the complete text, waiting out rate limits,
+    and returns the sent message, like `send_message` does.
+
+    With `acquire_token`, every send and edit also takes a token from the
+    outbox's global and per chat buckets: intermediate edits are skipped while
+    the buckets are empty, the first message and the final edit wait for one.
+    """
+
+    def __init__(
+        self,
+        update: TelegramUpdatePing,
+        acquire_token: Callable[[int], float] | None = None,
+    ):
+        super().__init__(update, acquire_token)
+
+    def _wait_for_token(self):
+        while self.acquire_token and (
+            wait := self.acquire_token(self.update.message.chat.id)
+        ):
+            time.sleep(wait)
+
+    def _take_edit_token(self) -> bool:
+        if not self.acquire_token:
+            return True
+        return self._on_token_wait(self.acquire_token(self.update.message.chat.id))
+
+    def push(self, text: str):
+        """Show the text generated so far if the throttle allows it"""
+
+        if self._should_send_first(text):
+            self._wait_for_token()
+            self._on_sent(send_message(self.update, text), text)
+        elif self._should_edit(text) and self._take_edit_token():
+            res = edit_message_text(self.update, self.reply.message.message_id, text)
+            self._on_edit(res, text)
+
+    def finish(self, text: str) -> TelegramUpdatePing:
+        """Show the complete text and return the message as Telegram stored it"""
+
+        if self.reply is None:
+            self._wait_for_token()
+            return send_message(self.update, text)
+        if text == self.sent_text:
+            return self.reply
+
+        for attempt in range(STREAM_FINISH_ATTEMPTS):
+            self._wait_for_token()
+            res = edit_message_text(self.update, self.reply.message.message_id, text)
+            delay = self._get_finish_delay(res, attempt)
+            if delay is None:
+                break
+            time.sleep(delay)
+        return parse_reply(res)
+
+
+class AsyncStreamingReply(_StreamingReplyState):
+    """Async variant of `StreamingReply`, `acquire_token` is awaited"""
+
+    def __init__(
+        self,
+        update: TelegramUpdatePing,
+        acquire_token: Callable[[int], Awaitable[float]] | None = None,
+    ):
+        super().__init__(update, acquire_token)
+
+    async def _wait_for_token(self):
+        while self.acquire_token and (
+            wait := await self.acquire_token(self.update.message.chat.id)
+        ):
+            await asyncio.sleep(wait)
+
+    async def _take_edit_token(self) -> bool:
+        if not self.acquire_token:
+            return True
+        return self._on_token_wait(
+            await self.acquire_token(self.update.message.chat.id)
+        )
+
+    async def push(self, text: str):
+        """Show the text generated so far if the throttle allows it"""
+
+        if self._should_send_first(text):
+            await self._wait_for_token()
+            self._on_sent(await async_send_message(self.update, text), text)
+        elif self._should_edit(text) and await self._take_edit_token():
+            res = await async_edit_message_text(
+                self.update, self.reply.message.message_id, text
+            )
+            self._on_edit(res, text)
+
+    async def finish(self, text: str) -> TelegramUpdatePing:
+        """Show the complete text and return the message as Telegram stored it"""
+
+        if self.reply is None:
+            await self._wait_for_token()
+            return await async_send_message(self.update, text)
+        if text == self.sent_text:
+            return self.reply
+
+        for attempt in range(STREAM_FINISH_ATTEMPTS):
+            await self._wait_for_token()
+            res = await async_edit_message_text(
+                self.update, self.reply.message.message_id, text
+            )
+            delay = self._get_finish_delay(res, attempt)
+            if delay is None:
+                break
+            await asyncio.sleep(delay)
+        return parse_reply(res)
 
 
 if __name__ == "__main__":
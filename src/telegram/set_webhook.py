@@ -1,9 +1,13 @@
 import os
 
-import httpx
 from dotenv import load_dotenv
+from wrapworks import cwdtoenv
 
 load_dotenv()
+cwdtoenv()
+
+from src.core.http_clients import Upstreams, request_with_retry
+from src.telegram.send_message import get_bot_method_path
 
 
 def set_webhook():
@@ -19,12 +23,11 @@ def set_webhook():
     """
 
     url = os.getenv("WEBHOOK_DOMAIN") + "/updates"
-    
+
     print(url)
     params = {"url": url}
-    res = httpx.get(
-        f"https://api.telegram.org/bot{os.getenv('TELBOTKEY')}/setWebhook",
-        params=params,
+    res = request_with_retry(
+        Upstreams.TELEGRAM, "GET", get_bot_method_path("setWebhook"), params=params
     )
     print(res.text)
 
@@ -41,8 +44,8 @@ def delete_webhook():
     """
 
     print(os.getenv("TELBOTKEY"))
-    res = httpx.get(
-        f"https://api.telegram.org/bot{os.getenv('TELBOTKEY')}/deleteWebhook"
+    res = request_with_retry(
+        Upstreams.TELEGRAM, "GET", get_bot_method_path("deleteWebhook")
     )
     print(res.text)
 
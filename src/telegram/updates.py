@@ -0,0 +1,81 @@
+"""
+Routing and parsing of raw Telegram updates
+"""
+
+from enum import Enum
+
+from src.models.telegram_update_models import (
+    TelegramUpdatePing,
+    TelegramUpdateNewMember,
+)
+
+
+class UpdateKinds(Enum):
+    PING = "ping"
+    NEW_MEMBER = "new_member"
+
+
+def get_update_kind(raw: dict) -> UpdateKinds | None:
+    """
+    ### Responsibility:
+        - Check the few fields needed to route an update, without validating the whole payload.
+
+    ### Args:
+        - `raw`: dict
+            The update as decoded from Telegram's JSON body.
+
+    ### Returns:
+        - `kind`: UpdateKinds | None
+            The kind of update, or None if the bot doesn't handle it.
+
+    ### How does the function work:
+        - Requires a `message` object with an integer `chat.id`.
+        - A message with `text` is a ping, one with `new_chat_member` is a new member. Everything else (edits, photos, channel posts...) is ignored.
+        - The complete validation happens in the worker with `parse_telegram_update`.
+    """
+
+    message = raw.get("message") if isinstance(raw, dict) else None
+    if not isinstance(message, dict):
+        return None
+    chat = message.get("chat")
+    if not isinstance(chat, dict) or not isinstance(chat.get("id"), int):
+        return None
+
+    if isinstance(message.get("text"), str):
+        return UpdateKinds.PING
+    if isinstance(message.get("new_chat_member"), dict):
+        return UpdateKinds.NEW_MEMBER
+    return None
+
+
+def parse_telegram_update(
+    update: dict | TelegramUpdatePing | TelegramUpdateNewMember,
+) -> TelegramUpdatePing | TelegramUpdateNewMember:
+    """
+    ### Responsibility:
+        - Turn a raw update into the model its handler expects.
+
+    ### Args:
+        - `update`: dict | TelegramUpdatePing | TelegramUpdateNewMember
+            A raw update from the ingestion API, or an already parsed one from tasks queued before the API published raw updates.
+
+    ### Returns:
+        - `update`: TelegramUpdatePing | TelegramUpdateNewMember
+            The validated update.
+
+    ### Raises:
+        - `AttributeError`:
+            Raised if the update isn't a kind the bot handles.
+        - `pydantic.ValidationError`:
+            Raised if the update doesn't match its model.
+    """
+
+    if isinstance(update, (TelegramUpdatePing, TelegramUpdateNewMember)):
+        return update
+
+    kind = get_update_kind(update)
+    if kind == UpdateKinds.PING:
+        return TelegramUpdatePing.model_validate(update)
+    if kind == UpdateKinds.NEW_MEMBER:
+        return TelegramUpdateNewMember.model_validate(update)
+    raise AttributeError(f"Unknown update type: {update}")
@@ -0,0 +1,40 @@
+"""
+Shared fixtures: an in-memory redis and a clock the tests move by hand
+"""
+
+import fakeredis
+import pytest
+
+from src.cache.core_redis_operations import REDIS_CLIENT, ASYNC_REDIS_CLIENT
+
+
+class FakeClock:
+    """Stands in for the `time` module of the code under test, only `time()` is used"""
+
+    def __init__(self, now: float):
+        self.now = now
+
+    def time(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+
+@pytest.fixture
+def fake_redis(monkeypatch) -> fakeredis.FakeRedis:
+    """Points the shared redis clients, and the Lua scripts registered on them, at one empty fake server"""
+
+    server = fakeredis.FakeServer()
+    fake = fakeredis.FakeRedis(server=server, decode_responses=True)
+    async_fake = fakeredis.FakeAsyncRedis(server=server, decode_responses=True)
+    monkeypatch.setattr(REDIS_CLIENT, "connection_pool", fake.connection_pool)
+    monkeypatch.setattr(
+        ASYNC_REDIS_CLIENT, "connection_pool", async_fake.connection_pool
+    )
+    return fake
+
+
+@pytest.fixture
+def clock() -> FakeClock:
+    return FakeClock(1_719_400_000.0)
@@ -0,0 +1,69 @@
+"""
+Checks when a burst of buffered messages is released, against a fake redis
+"""
+
+import pytest
+
+from src.core import coalescer
+from src.core.coalescer import buffer_update, take_coalesced_updates
+
+CHAT_ID = -1001234567890
+USER_ID = 91234567
+
+
+@pytest.fixture
+def burst(fake_redis, clock, monkeypatch):
+    """A 2 second window, 8 second max wait and 3 message cutoff, on `clock`"""
+
+    monkeypatch.setattr(coalescer, "time", clock)
+    monkeypatch.setattr(coalescer, "COALESCE_WINDOW", 2)
+    monkeypatch.setattr(coalescer, "COALESCE_MAX_WAIT", 8)
+    monkeypatch.setattr(coalescer, "COALESCE_MAX_MESSAGES", 3)
+
+
+def test_nothing_buffered(burst):
+    assert take_coalesced_updates(CHAT_ID, USER_ID) == (0, [])
+
+
+def test_waits_for_the_window_after_the_last_message(burst, clock):
+    assert buffer_update(CHAT_ID, USER_ID, ["first"]) == 1
+    clock.advance(1.5)
+    assert buffer_update(CHAT_ID, USER_ID, ["second"]) == 2
+
+    clock.advance(0.5)
+    assert take_coalesced_updates(CHAT_ID, USER_ID) == (1.5, [])
+
+    clock.advance(1.5)
+    assert take_coalesced_updates(CHAT_ID, USER_ID) == (0, [["first"], ["second"]])
+    # Taken once, a concurrent flush finds nothing
+    assert take_coalesced_updates(CHAT_ID, USER_ID) == (0, [])
+
+
+def test_max_wait_ends_a_burst_that_keeps_going(burst, clock, monkeypatch):
+    monkeypatch.setattr(coalescer, "COALESCE_MAX_MESSAGES", 100)
+    for i in range(5):
+        buffer_update(CHAT_ID, USER_ID, [i])
+        clock.advance(1.9)
+
+    # 9.5 seconds after the first message, within the window of the last one
+    wait, payloads = take_coalesced_updates(CHAT_ID, USER_ID)
+    assert (wait, payloads) == (0, [[0], [1], [2], [3], [4]])
+
+
+def test_max_messages_ends_the_burst_at_once(burst, clock):
+    for i in range(2):
+        buffer_update(CHAT_ID, USER_ID, [i])
+    assert take_coalesced_updates(CHAT_ID, USER_ID)[1] == []
+
+    assert buffer_update(CHAT_ID, USER_ID, [2]) == 3
+    assert take_coalesced_updates(CHAT_ID, USER_ID) == (0, [[0], [1], [2]])
+
+
+def test_users_are_buffered_apart(burst, clock):
+    buffer_update(CHAT_ID, USER_ID, ["mine"])
+    clock.advance(1)
+    buffer_update(CHAT_ID, USER_ID + 1, ["theirs"])
+    clock.advance(1)
+
+    assert take_coalesced_updates(CHAT_ID, USER_ID) == (0, [["mine"]])
+    assert take_coalesced_updates(CHAT_ID, USER_ID + 1) == (1, [])
@@ -0,0 +1,106 @@
+"""
+Checks the credit reservation scripts against a fake redis, including expired reservations and counters
+"""
+
+import pytest
+
+from src.cache import credit_counters
+from src.cache.credit_counters import (
+    RESERVATION_TTL,
+    reserve_credit,
+    commit_credit,
+    refund_credit,
+    get_counter_keys,
+)
+
+CHAT_ID = -1001234567890
+USER_ID = 91234567
+
+
+@pytest.fixture
+def postgres_usage(fake_redis, clock, monkeypatch) -> dict:
+    """Serves the user's tagged messages in Postgres from the returned dict, and runs the scripts on `clock`"""
+
+    usage = {"used": 0}
+    monkeypatch.setattr(credit_counters, "time", clock)
+    monkeypatch.setattr(
+        credit_counters,
+        "count_tagged_messages_on_day",
+        lambda chat_id, user_id, day: usage["used"],
+    )
+    monkeypatch.setattr(credit_counters, "get_pending_messages", lambda chat_id: [])
+    return usage
+
+
+def get_used(fake_redis, reservation) -> str | None:
+    used_key, _ = get_counter_keys(CHAT_ID, USER_ID, reservation.day)
+    return fake_redis.get(used_key)
+
+
+def test_reserve_stops_at_allowance(postgres_usage):
+    postgres_usage["used"] = 1
+
+    assert reserve_credit(CHAT_ID, USER_ID, 3)
+    assert reserve_credit(CHAT_ID, USER_ID, 3)
+    # 1 used and 2 pending
+    assert reserve_credit(CHAT_ID, USER_ID, 3) is None
+
+
+def test_commit_and_refund(postgres_usage, fake_redis):
+    first = reserve_credit(CHAT_ID, USER_ID, 2)
+    second = reserve_credit(CHAT_ID, USER_ID, 2)
+
+    commit_credit(first)
+    refund_credit(second)
+
+    assert get_used(fake_redis, first) == "1"
+    assert reserve_credit(CHAT_ID, USER_ID, 2)
+    assert reserve_credit(CHAT_ID, USER_ID, 2) is None
+
+
+def test_expired_reservation_frees_the_credit(postgres_usage, clock):
+    assert reserve_credit(CHAT_ID, USER_ID, 1)
+    assert reserve_credit(CHAT_ID, USER_ID, 1) is None
+
+    clock.advance(RESERVATION_TTL + 1)
+
+    assert reserve_credit(CHAT_ID, USER_ID, 1)
+
+
+def test_commit_after_reservation_expired_still_charges(
+    postgres_usage, fake_redis, clock
+):
+    slow = reserve_credit(CHAT_ID, USER_ID, 2)
+    clock.advance(RESERVATION_TTL + 1)
+
+    assert reserve_credit(CHAT_ID, USER_ID, 2)
+    commit_credit(slow)
+
+    assert get_used(fake_redis, slow) == "1"
+    # 1 used and 1 pending
+    assert reserve_credit(CHAT_ID, USER_ID, 2) is None
+
+
+def test_commit_after_counter_expired_reloads_from_postgres(postgres_usage, fake_redis):
+    reservation = reserve_credit(CHAT_ID, USER_ID, 2)
+    fake_redis.delete(get_counter_keys(CHAT_ID, USER_ID, reservation.day)[0])
+
+    commit_credit(reservation)
+    assert get_used(fake_redis, reservation) is None
+
+    # The reply was recorded in Postgres, which the reload counts
+    postgres_usage["used"] = 1
+    assert reserve_credit(CHAT_ID, USER_ID, 2)
+    assert get_used(fake_redis, reservation) == "1"
+    assert reserve_credit(CHAT_ID, USER_ID, 2) is None
+
+
+def test_reservation_without_id_is_ignored(postgres_usage, fake_redis):
+    reservation = credit_counters.CreditReservation(
+        chat_id=CHAT_ID, user_id=USER_ID, day=credit_counters.get_usage_day()
+    )
+
+    commit_credit(reservation)
+    refund_credit(reservation)
+
+    assert not fake_redis.keys()
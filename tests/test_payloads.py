@@ -0,0 +1,78 @@
+"""
+Checks that update payloads survive the wire format, including tasks queued before it
+"""
+
+import copy
+
+import orjson
+import pytest
+
+from benchmarks.task_payloads import RAW_PING, RAW_NEW_MEMBER
+from src.celery.payloads import (
+    PAYLOAD_VERSION,
+    encode_update,
+    decode_update,
+    orjson_dumps,
+    get_payload_chat,
+)
+from src.telegram.updates import parse_telegram_update
+
+
+def round_trip(update) -> object:
+    """Encodes an update the way the task serializer does and decodes it back"""
+
+    return decode_update(orjson.loads(orjson_dumps(encode_update(update))))
+
+
+@pytest.mark.parametrize("raw", [RAW_PING, RAW_NEW_MEMBER], ids=["ping", "new member"])
+def test_raw_update_round_trip(raw):
+    assert round_trip(raw) == parse_telegram_update(raw)
+
+
+@pytest.mark.parametrize("raw", [RAW_PING, RAW_NEW_MEMBER], ids=["ping", "new member"])
+def test_parsed_update_encodes_like_raw(raw):
+    assert encode_update(parse_telegram_update(raw)) == encode_update(raw)
+
+
+def test_private_chat_keeps_username_as_title():
+    raw = copy.deepcopy(RAW_PING)
+    raw["message"]["chat"] = {"id": 91234567, "type": "private", "username": "sara"}
+
+    update = round_trip(raw)
+
+    assert update.message.chat.title == "sara"
+    assert get_payload_chat(encode_update(raw)) == (91234567, "private")
+
+
+def test_payload_drops_unused_fields():
+    payload = encode_update(RAW_PING)
+
+    assert payload[:2] == [PAYLOAD_VERSION, "p"]
+    assert "entities" not in orjson_dumps(payload).decode()
+
+
+@pytest.mark.parametrize("raw", [RAW_PING, RAW_NEW_MEMBER], ids=["ping", "new member"])
+def test_legacy_dict_payload_is_decoded(raw):
+    assert decode_update(orjson.loads(orjson.dumps(raw))) == parse_telegram_update(raw)
+
+
+def test_legacy_parsed_payload_is_decoded():
+    update = parse_telegram_update(RAW_PING)
+
+    assert decode_update(update) == update
+
+
+def test_unsupported_version_is_refused():
+    payload = encode_update(RAW_PING)
+    payload[0] = PAYLOAD_VERSION + 1
+
+    with pytest.raises(ValueError):
+        decode_update(payload)
+
+
+def test_unknown_kind_is_refused():
+    payload = encode_update(RAW_PING)
+    payload[1] = "x"
+
+    with pytest.raises(AttributeError):
+        decode_update(payload)
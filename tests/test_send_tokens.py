@@ -0,0 +1,77 @@
+"""
+Checks the global and per chat token buckets of the outbox, against a fake redis
+"""
+
+import asyncio
+
+import pytest
+
+from src.telegram import outbox
+from src.telegram.outbox import acquire_send_token, async_acquire_send_token
+
+PRIVATE_CHAT_ID = 91234567
+GROUP_CHAT_ID = -1001234567890
+
+
+@pytest.fixture
+def buckets(fake_redis, clock, monkeypatch):
+    """A global bucket of 3 tokens refilled at 3 per second, 1 per second in private chats and 20 per minute in groups"""
+
+    monkeypatch.setattr(outbox, "time", clock)
+    monkeypatch.setattr(outbox, "GLOBAL_RATE_PER_SECOND", 3)
+    monkeypatch.setattr(outbox, "GLOBAL_BURST", 3)
+    monkeypatch.setattr(outbox, "PRIVATE_RATE_PER_SECOND", 1)
+    monkeypatch.setattr(outbox, "GROUP_RATE_PER_MINUTE", 20)
+    monkeypatch.setattr(outbox, "CHAT_BURST", 1)
+
+
+def test_private_chat_refills_every_second(buckets, clock):
+    assert acquire_send_token(PRIVATE_CHAT_ID) == 0
+    assert acquire_send_token(PRIVATE_CHAT_ID) == 1
+
+    clock.advance(0.25)
+    assert acquire_send_token(PRIVATE_CHAT_ID) == 0.75
+
+    clock.advance(0.75)
+    assert acquire_send_token(PRIVATE_CHAT_ID) == 0
+
+
+def test_group_chat_refills_every_three_seconds(buckets, clock):
+    assert acquire_send_token(GROUP_CHAT_ID) == 0
+    assert acquire_send_token(GROUP_CHAT_ID) == 3
+
+    clock.advance(3)
+    assert acquire_send_token(GROUP_CHAT_ID) == 0
+
+
+def test_global_bucket_is_shared_by_all_chats(buckets, clock):
+    for chat_id in range(1, 4):
+        assert acquire_send_token(chat_id) == 0
+    # The fourth chat still has its token, the global bucket is empty
+    assert acquire_send_token(4) == 0.334
+
+    clock.advance(0.334)
+    assert acquire_send_token(4) == 0
+
+
+def test_global_burst_caps_the_refill(buckets, clock):
+    clock.advance(60)
+    for chat_id in range(1, 4):
+        assert acquire_send_token(chat_id) == 0
+    assert acquire_send_token(4) > 0
+
+
+def test_refused_chat_keeps_the_global_token(buckets, clock):
+    assert acquire_send_token(PRIVATE_CHAT_ID) == 0
+    for _ in range(5):
+        assert acquire_send_token(PRIVATE_CHAT_ID) > 0
+
+    # Refusals took nothing from the global bucket, 2 tokens are left
+    assert acquire_send_token(1) == 0
+    assert acquire_send_token(2) == 0
+    assert acquire_send_token(3) > 0
+
+
+def test_async_shares_the_buckets(buckets):
+    assert acquire_send_token(PRIVATE_CHAT_ID) == 0
+    assert asyncio.run(async_acquire_send_token(PRIVATE_CHAT_ID)) == 1
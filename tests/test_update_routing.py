@@ -0,0 +1,50 @@
+"""
+Checks that webhook updates are published on their chat's lane shard queue
+"""
+
+import copy
+
+import pytest
+
+from benchmarks.task_payloads import RAW_PING
+from src.celery import main_queue, routing
+from src.celery.routing import Lanes
+
+
+@pytest.fixture
+def published(monkeypatch) -> list[dict]:
+    """Shards every lane in 4 and records the options of each published task"""
+
+    calls = []
+    monkeypatch.setattr(routing, "SHARDED_QUEUES", True)
+    monkeypatch.setattr(routing, "LANE_SHARDS", {x: 4 for x in Lanes})
+    monkeypatch.setattr(main_queue, "WORKER_MODE", "sync")
+    monkeypatch.setattr(
+        main_queue.worker_handle_update,
+        "apply_async",
+        lambda args, **options: calls.append(options),
+    )
+    return calls
+
+
+def test_group_update_goes_to_group_shard(published):
+    main_queue.enqueue_update(RAW_PING)
+
+    # crc32("-1001234567890") % 4
+    assert published[0]["queue"] == "updates.group.1"
+
+
+def test_private_update_goes_to_private_shard(published):
+    update = copy.deepcopy(RAW_PING)
+    update["message"]["chat"] = {"id": 91234567, "type": "private"}
+    main_queue.enqueue_update(update)
+
+    # crc32("91234567") % 4
+    assert published[0]["queue"] == "updates.private.2"
+
+
+def test_unsharded_update_goes_to_default_queue(published, monkeypatch):
+    monkeypatch.setattr(routing, "SHARDED_QUEUES", False)
+    main_queue.enqueue_update(RAW_PING)
+
+    assert published[0]["queue"] is None